@@ -5,11 +5,18 @@ import click
 import os
 
 from bin import helper_functions
+from bin import asv_registry
+from bin import dada2_optimizer
 from bin import qiime2_pipeline
+from bin import quality_profiler
+from bin import rarefaction
+from bin import scratch_space
+from bin import taxonomy_cache
 
 # TODO: Move over to pathlib
 # TODO: Use f-strings (from __future__)
-# NOTE: Must set environment variable $TMPDIR to an existing folder with sufficient free space or you'll get an OSError
+# NOTE: Temporary files are written to a scratch folder inside $TMPDIR (or --scratch_dir) that is checked for sufficient
+# free space before the run starts, see bin/scratch_space.py
 
 
 @click.command()
@@ -21,7 +28,7 @@ from bin import qiime2_pipeline
               type=click.Path(exists=False),
               required=True,
               help='Base directory for all output from AmpliconPipeline. '
-                   'Note that this directory must NOT already exist.')
+                   'Note that this directory must NOT already exist unless --resume is set.')
 @click.option('-m', '--metadata',
               type=click.Path(exists=True),
               required=True,
@@ -40,9 +47,21 @@ from bin import qiime2_pipeline
 @click.option('-eq', '--evaluate_quality',
               is_flag=True,
               default=False,
-              help='Setting this flag will only run the pipeline up until generating the demux_summary.qzv file. '
-                   'This is important to do before running the pipeline to establish acceptable trimming/truncation '
-                   'parameters to pass to dada2.')
+              help='Setting this flag will only profile the read quality of the run, writing per-position quality '
+                   'quantiles and read length histograms to quality_profile.json/.png in --outdir. No QIIME 2 '
+                   'artifacts are created. This is important to do before running the pipeline to establish '
+                   'acceptable trimming/truncation parameters to pass to dada2.')
+@click.option('-op', '--optimize_parameters',
+              is_flag=True,
+              default=False,
+              help='Setting this flag will only propose trimming/truncation parameters for dada2 based on the read '
+                   'quality profile and --amplicon_length, writing them to dada2_parameters.json in --outdir. '
+                   'Run "python -m bin.dada2_optimizer --sweep" to also test candidates on subsampled reads.')
+@click.option('-al', '--amplicon_length',
+              default=dada2_optimizer.DEFAULT_AMPLICON_LENGTH,
+              help='Expected amplicon length including primers, used by --optimize_parameters to keep enough overlap '
+                   'between truncated read pairs. Defaults to {} (V3-V4).'.format(
+                  dada2_optimizer.DEFAULT_AMPLICON_LENGTH))
 @click.option('-tf', '--trim_left_f',
               default=0,
               help='Trim n bases from the 5\' end of the forward reads. Defaults to 0.')
@@ -55,13 +74,117 @@ from bin import qiime2_pipeline
 @click.option('-trr', '--trunc_len_r',
               default=300,
               help='Truncate the reverse reads to n bases. Defaults to 300.')
+@click.option('-r', '--resume',
+              is_flag=True,
+              default=False,
+              help='Resume a previous run in --outdir. Every stage whose inputs and parameters match a cached result '
+                   'is restored from the stage cache instead of being recomputed.')
+@click.option('--cache_dir',
+              type=click.Path(exists=False),
+              default=None,
+              required=False,
+              help='Directory to store cached stage results in. Defaults to a "stage_cache" folder inside --outdir. '
+                   'Point several runs at the same folder to share results between them.')
+@click.option('--fastq_pattern',
+              default=helper_functions.DEFAULT_FASTQ_PATTERN,
+              required=False,
+              help='Regular expression used to pair *.fastq.gz files. Must define the named groups "sample_id" and '
+                   '"read" (R1/R2) and may define "lane"; samples spread over several lanes are merged. '
+                   'Defaults to Illumina naming, e.g. SAMPLEID_S1_L001_R1_001.fastq.gz')
+@click.option('--taxonomy_cache', 'taxonomy_cache_path',
+              type=click.Path(exists=False),
+              default=taxonomy_cache.DEFAULT_CACHE_PATH,
+              required=False,
+              help='Path to the persistent per-ASV taxonomy cache shared between runs. Only ASVs that have not been '
+                   'classified with the same classifier before are sent to the classifier. '
+                   'Defaults to {}'.format(taxonomy_cache.DEFAULT_CACHE_PATH))
+@click.option('--taxonomy_cache_size',
+              default=taxonomy_cache.DEFAULT_MAX_ENTRIES,
+              required=False,
+              help='Maximum number of ASV assignments kept in the taxonomy cache. The least recently used are evicted '
+                   'first. Defaults to {}.'.format(taxonomy_cache.DEFAULT_MAX_ENTRIES))
+@click.option('--no_taxonomy_cache',
+              is_flag=True,
+              default=False,
+              help='Set this flag to classify every ASV from scratch without using the taxonomy cache.')
+@click.option('--asv_registry', 'asv_registry_path',
+              type=click.Path(exists=False),
+              default=asv_registry.DEFAULT_REGISTRY_PATH,
+              required=False,
+              help='Path to the ASV registry shared between runs. The per-sample counts and taxonomy of every ASV in '
+                   'this run are added to it, registered under --run_id. '
+                   'Defaults to {}'.format(asv_registry.DEFAULT_REGISTRY_PATH))
+@click.option('--no_asv_registry',
+              is_flag=True,
+              default=False,
+              help='Set this flag to skip adding this run to the ASV registry.')
+@click.option('--run_id',
+              default=None,
+              required=False,
+              help='ID the run is registered under in the ASV registry. Defaults to the absolute path of --outdir.')
+@click.option('--overwrite_run_id',
+              is_flag=True,
+              default=False,
+              help='Set this flag to replace a run registered under the same --run_id from another output folder. '
+                   'Without it the run is not registered and the pipeline stops.')
+@click.option('--dada2_shard_size',
+              type=click.INT,
+              default=None,
+              required=False,
+              help='Run DADA2 in shards of this many samples processed in parallel, learning the error models once '
+                   'and merging the shards afterwards. Failed shards are retried on --resume. Defaults to a single '
+                   'DADA2 process for the whole run.')
+@click.option('--dada2_shard_dir',
+              type=click.Path(exists=False),
+              default=None,
+              required=False,
+              help='Work folder for --dada2_shard_size on storage shared with other hosts, which can then help with '
+                   'the run with "python -m bin.dada2_sharding -w DADA2_SHARD_DIR". Defaults to a temporary folder '
+                   'inside --outdir.')
+@click.option('--rarefaction_steps',
+              type=click.INT,
+              default=rarefaction.DEFAULT_STEPS,
+              required=False,
+              help='Number of depths between 1 and 80% of the deepest sample at which alpha rarefaction curves are '
+                   'computed. Defaults to {}.'.format(rarefaction.DEFAULT_STEPS))
+@click.option('--rarefaction_iterations',
+              type=click.INT,
+              default=rarefaction.DEFAULT_ITERATIONS,
+              required=False,
+              help='Number of random subsamples drawn at every depth of the alpha rarefaction curves. Defaults to '
+                   '{}.'.format(rarefaction.DEFAULT_ITERATIONS))
+@click.option('--scratch_dir',
+              type=click.Path(exists=False),
+              default=None,
+              required=False,
+              help='Folder for the temporary files of the run, e.g. a fast local disk. A scratch folder is created in '
+                   'it and removed once the run is done. Defaults to the first of $TMPDIR, the system temporary '
+                   'folder and --outdir with enough free space for the run.')
+@click.option('--no_space_check',
+              is_flag=True,
+              default=False,
+              help='Set this flag to skip checking that there is enough free space for the run before it starts.')
+@click.option('--out_of_core',
+              is_flag=True,
+              default=False,
+              help='Set this flag to keep the Bray-Curtis and Jaccard distance matrices on disk and read them a block '
+                   'at a time, for studies with too many samples for in-memory matrices. UniFrac is skipped.')
+@click.option('-n', '--cpus',
+              type=click.INT,
+              default=None,
+              required=False,
+              help='Total number of CPUs shared by pipeline stages running concurrently. Defaults to all CPUs.')
 @click.option('-v', '--verbose',
               is_flag=True,
               default=False,
               help='Set this flag to enable more verbose output.')
 @click.pass_context
-def cli(ctx, inputdir, outdir, metadata, classifier, evaluate_quality, filtering_flag,
-        trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, verbose):
+def cli(ctx, inputdir, outdir, metadata, classifier, evaluate_quality, optimize_parameters, amplicon_length,
+        filtering_flag, trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, resume, cache_dir, fastq_pattern,
+        taxonomy_cache_path, taxonomy_cache_size, no_taxonomy_cache, asv_registry_path, no_asv_registry,
+        run_id, overwrite_run_id,
+        dada2_shard_size, dada2_shard_dir, rarefaction_steps, rarefaction_iterations, scratch_dir, no_space_check,
+        out_of_core, cpus, verbose):
     # Logging setup
     if verbose:
         logging.basicConfig(
@@ -75,44 +198,81 @@ def cli(ctx, inputdir, outdir, metadata, classifier, evaluate_quality, filtering
             datefmt='%Y-%m-%d %H:%M:%S')
 
     if evaluate_quality:
-        logging.info('Starting QIIME2-QC Pipeline with output routing to {}'.format(outdir))
-        data_artifact_path = helper_functions.project_setup(outdir=outdir, inputdir=inputdir)
-        qiime2_pipeline.run_qc_pipeline(base_dir=os.path.join(outdir, 'qiime2'),
-                                        data_artifact_path=data_artifact_path,
-                                        sample_metadata_path=metadata)
-        logging.info('QIIME2-QC Pipeline Completed')
+        logging.info('Starting quality profiling with output routing to {}'.format(outdir))
+        quality_profiler.evaluate_quality(inputdir=inputdir, outdir=outdir, cpu_count=cpus,
+                                          fastq_pattern=fastq_pattern)
+        logging.info('Quality profiling Completed')
+        ctx.exit()
+
+    if optimize_parameters:
+        logging.info('Starting DADA2 parameter optimization with output routing to {}'.format(outdir))
+        dada2_optimizer.optimize_parameters(inputdir=inputdir, outdir=outdir, amplicon_length=amplicon_length,
+                                            cpu_count=cpus, fastq_pattern=fastq_pattern)
+        logging.info('DADA2 parameter optimization Completed')
         ctx.exit()
 
     # Input validation
-    if os.path.isdir(outdir):
+    if os.path.isdir(outdir) and not resume:
         click.echo(ctx.get_help(), err=True)
         click.echo('\nERROR: Specified output directory already exists. '
                    'Please provide a new path that does not already exist.', err=True)
-        ctx.exit()
+        ctx.exit(1)
 
     # Classifier check
     if not os.path.isfile(classifier):
         click.echo(ctx.get_help(), err=True)
         click.echo('\nERROR: Classifier path is not valid. Please point to an existing classifier .qza file.', err=True)
-        ctx.exit()
+        ctx.exit(1)
     else:
         logging.debug('Classifier path found at {}'.format(os.path.abspath(classifier)))
 
-    # Project setup + get path to data artifact
-    data_artifact_path = helper_functions.project_setup(outdir=outdir, inputdir=inputdir)
-
-    # Filtering flag
-    if filtering_flag:
-        logging.info('FILTERING_FLAG SET. Pipeline will only proceed to DADA2 filtering step.')
-
-    # Run the full pipeline
-    qiime2_pipeline.run_pipeline(base_dir=os.path.join(outdir, 'qiime2'),
-                                 data_artifact_path=data_artifact_path,
-                                 sample_metadata_path=metadata,
-                                 classifier_artifact_path=classifier,
-                                 filtering_flag=filtering_flag,
-                                 trim_left_f=trim_left_f, trim_left_r=trim_left_r,
-                                 trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r)
+    # Fail now rather than hours into the run if there isn't enough room for it
+    if not no_space_check:
+        fastq_paths = [os.path.join(inputdir, filename)
+                       for filename in helper_functions.scan_fastq_directory(inputdir)]
+        try:
+            scratch_dir = scratch_space.preflight(fastq_paths, outdir=outdir, scratch_dir=scratch_dir,
+                                                  trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r)
+        except OSError as e:
+            click.echo('\nERROR: {}'.format(e.strerror or e), err=True)
+            ctx.exit(1)
+
+    # Temporary files of QIIME 2, DADA2 and MAFFT go to a scratch folder that is removed at the end of the run
+    with scratch_space.scratch_space(outdir, scratch_dir=scratch_dir):
+        # Project setup + get path to data artifact. Resource usage of every step is collected in profile_records.
+        profile_records = []
+        data_artifact_path = helper_functions.project_setup(outdir=outdir, inputdir=inputdir, resume=resume,
+                                                            profile_records=profile_records,
+                                                            fastq_pattern=fastq_pattern)
+
+        # Stage cache setup
+        if cache_dir is None:
+            cache_dir = os.path.join(outdir, 'stage_cache')
+        if resume:
+            logging.info('RESUME SET. Stages with a cached result in {} will be skipped.'.format(cache_dir))
+
+        # Filtering flag
+        if filtering_flag:
+            logging.info('FILTERING_FLAG SET. Pipeline will only proceed to DADA2 filtering step.')
+
+        # Run the full pipeline
+        qiime2_pipeline.run_pipeline(base_dir=os.path.join(outdir, 'qiime2'),
+                                     data_artifact_path=data_artifact_path,
+                                     sample_metadata_path=metadata,
+                                     classifier_artifact_path=classifier,
+                                     filtering_flag=filtering_flag,
+                                     trim_left_f=trim_left_f, trim_left_r=trim_left_r,
+                                     trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r,
+                                     cache_dir=cache_dir, resume=resume, cpu_count=cpus,
+                                     profile_records=profile_records,
+                                     taxonomy_cache_path=None if no_taxonomy_cache else taxonomy_cache_path,
+                                     taxonomy_cache_size=taxonomy_cache_size,
+                                     registry_path=None if no_asv_registry else asv_registry_path,
+                                     run_id=run_id, overwrite_run_id=overwrite_run_id,
+                                     dada2_shard_size=dada2_shard_size, dada2_shard_dir=dada2_shard_dir,
+                                     rarefaction_steps=rarefaction_steps,
+                                     rarefaction_iterations=rarefaction_iterations,
+                                     out_of_core=out_of_core)
     logging.info('QIIME2 Pipeline Completed')
     ctx.exit()
 
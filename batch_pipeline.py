@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import click
+import logging
+import multiprocessing
+
+from bin import batch_queue
+
+"""
+Runs ampliconpipeline.py over many MiSeq runs listed in a manifest, a few runs at a time. Progress is kept in a state
+file next to the manifest, so re-running the same command after an interruption skips completed runs and resumes the
+ones that were in progress.
+
+Example manifest (tab-separated, optional columns may be left empty or omitted):
+run_id  inputdir              outdir               metadata                 cpus  memory_gb  trunc_len_f
+RUN_1   /mnt/nas/MiSeq/RUN_1  /mnt/analysis/RUN_1  /mnt/metadata/RUN_1.tsv  8     32                 280
+RUN_2   /mnt/nas/MiSeq/RUN_2  /mnt/analysis/RUN_2  /mnt/metadata/RUN_2.tsv
+"""
+
+logging.basicConfig(
+    format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+
+def format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp else '-'
+
+
+def format_duration(run):
+    if not run['started']:
+        return '-'
+    seconds = int((run['finished'] or time.time()) - run['started'])
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def status_report(state_path):
+    """
+    :param state_path: Path to the state file of a batch
+    :return: Summary of the batch with a line per run
+    """
+    state = batch_queue.load_state(state_path)
+    counts = batch_queue.summarize(state)
+    lines = ['{} runs: {}'.format(sum(counts.values()),
+                                  ', '.join('{} {}'.format(count, status) for status, count in counts.items())),
+             '',
+             '{:<24}{:<11}{:<10}{:<21}{:<10}{}'.format('run_id', 'status', 'attempts', 'started', 'elapsed',
+                                                        'log')]
+    for run_id, run in state['runs'].items():
+        run_log_path = batch_queue.log_path(state_path, run_id)
+        lines.append('{:<24}{:<11}{:<10}{:<21}{:<10}{}'.format(run_id, run['status'], run['attempts'],
+                                                               format_time(run['started']), format_duration(run),
+                                                               run_log_path if os.path.isfile(run_log_path) else '-'))
+    return '\n'.join(lines)
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('-m', '--manifest',
+              type=click.Path(exists=True),
+              required=True,
+              help='Tab-separated file with a row per run and the columns inputdir, outdir and metadata. Optional '
+                   'columns: run_id (defaults to the name of outdir), cpus, memory_gb, and the '
+                   'ampliconpipeline.py options classifier, trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, '
+                   'cache_dir, fastq_pattern, taxonomy_cache, taxonomy_cache_size, asv_registry, dada2_shard_size, '
+                   'dada2_shard_dir, rarefaction_steps, rarefaction_iterations and scratch_dir, and the flags '
+                   'filtering_flag, no_taxonomy_cache, no_asv_registry, no_space_check and verbose (true/false).')
+@click.option('-s', '--state',
+              type=click.Path(),
+              default=None,
+              help='State file tracking the progress of the batch. Defaults to MANIFEST.state.json next to the '
+                   'manifest.')
+@click.option('-j', '--concurrency',
+              type=click.INT,
+              default=1,
+              help='Maximum number of runs processed at the same time.')
+@click.option('-n', '--cpus_per_run',
+              type=click.INT,
+              default=None,
+              help='CPUs given to each run that does not set its own in the manifest. Defaults to all CPUs divided '
+                   'by --concurrency.')
+@click.option('--memory_per_run',
+              type=click.FLOAT,
+              default=None,
+              help='Memory budget in GB for each run that does not set its own in the manifest. A run is stopped and '
+                   'marked failed once the pipeline and the processes it starts (DADA2\'s R session, MAFFT, ...) '
+                   'together use more resident memory than this. No limit by default.')
+@click.option('--retry_failed',
+              is_flag=True,
+              default=False,
+              help='Also retry runs that failed in a previous invocation. They are resumed with --resume.')
+def run(manifest, state, concurrency, cpus_per_run, memory_per_run, retry_failed):
+    """
+    Process every run in the manifest that hasn't completed yet
+    """
+    state_path = state or batch_queue.default_state_path(manifest)
+    try:
+        runs = batch_queue.read_manifest(manifest)
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--manifest')
+
+    if cpus_per_run is None:
+        cpus_per_run = max(1, multiprocessing.cpu_count() // concurrency)
+    if cpus_per_run * concurrency > multiprocessing.cpu_count():
+        logging.warning('{} concurrent runs with {} CPUs each oversubscribe the {} CPUs of this host'.format(
+            concurrency, cpus_per_run, multiprocessing.cpu_count()))
+
+    batch_queue.add_runs(state_path, runs)
+    if retry_failed:
+        batch_queue.recover_interrupted(state_path, retry_failed=True)
+    logging.info('Processing batch {} with up to {} concurrent runs'.format(state_path, concurrency))
+    batch_queue.run_queue(state_path, concurrency=concurrency, default_cpus=cpus_per_run,
+                          default_memory_gb=memory_per_run)
+
+    click.echo(status_report(state_path))
+    counts = batch_queue.summarize(batch_queue.load_state(state_path))
+    if counts['failed']:
+        raise click.ClickException('{} run(s) failed. Fix the cause and re-run with --retry_failed to resume '
+                                   'them.'.format(counts['failed']))
+
+
+@cli.command()
+@click.option('-m', '--manifest',
+              type=click.Path(),
+              default=None,
+              help='Manifest of the batch. Its state file is read from MANIFEST.state.json.')
+@click.option('-s', '--state',
+              type=click.Path(),
+              default=None,
+              help='State file of the batch.')
+def status(manifest, state):
+    """
+    Summarize the progress of a batch
+    """
+    if state is None:
+        if manifest is None:
+            raise click.UsageError('Provide either --manifest or --state')
+        state = batch_queue.default_state_path(manifest)
+    if not os.path.isfile(state):
+        raise click.BadParameter('No batch state found at {}'.format(state))
+    click.echo(status_report(state))
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,232 @@
+"""
+Persistent registry of every ASV seen across runs.
+
+ASVs are keyed by the MD5 of their sequence (bin.run_merger.sequence_digest), so the same ASV has the same ID in every
+run. The registry stores each ASV's sequence and latest taxonomy assignment along with its count in every sample of
+every registered run, with indexes for lookups by sequence, taxon, run and sample. Cross-run questions such as
+"which runs contained this Listeria ASV?" become index lookups rather than loading and merging artifacts.
+"""
+
+import os
+import sys
+import time
+import click
+import sqlite3
+import logging
+
+from scipy import sparse
+from collections import OrderedDict
+
+from bin.run_merger import sequence_digest
+
+DEFAULT_REGISTRY_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'AmpliconPipeline', 'asv_registry.sqlite')
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS asvs ('
+    'sequence_hash TEXT PRIMARY KEY, '
+    'sequence TEXT NOT NULL, '
+    'length INTEGER NOT NULL, '
+    'taxon TEXT, '
+    'confidence TEXT)',
+    'CREATE TABLE IF NOT EXISTS runs ('
+    'run_id TEXT PRIMARY KEY, '
+    'run_path TEXT, '
+    'registered REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS counts ('
+    'sequence_hash TEXT NOT NULL REFERENCES asvs (sequence_hash), '
+    'run_id TEXT NOT NULL REFERENCES runs (run_id), '
+    'sample_id TEXT NOT NULL, '
+    'count INTEGER NOT NULL, '
+    'PRIMARY KEY (sequence_hash, run_id, sample_id))',
+    'CREATE INDEX IF NOT EXISTS counts_run_sample ON counts (run_id, sample_id)',
+    'CREATE INDEX IF NOT EXISTS counts_sample ON counts (sample_id)',
+    'CREATE INDEX IF NOT EXISTS asvs_taxon ON asvs (taxon)',
+]
+
+
+def open_registry(registry_path: str = DEFAULT_REGISTRY_PATH) -> sqlite3.Connection:
+    """
+    :param registry_path: Path to the SQLite database. Created if it doesn't exist.
+    :return: Open connection to the registry
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(registry_path)), exist_ok=True)
+    # Several pipelines may register runs at once, so wait on their writes rather than failing immediately
+    connection = sqlite3.connect(registry_path, timeout=60)
+    for statement in SCHEMA:
+        connection.execute(statement)
+    connection.commit()
+    return connection
+
+
+def register_run(connection: sqlite3.Connection, run_id: str, sequences: dict, counts, run_path: str = None,
+                 overwrite: bool = False) -> int:
+    """
+    Adds a run to the registry, replacing any counts previously registered under the same run ID by the same output
+    folder (e.g. when a run is resumed)
+
+    :param connection: Connection returned by open_registry()
+    :param run_id: Unique name of the run
+    :param sequences: Dictionary of {sequence hash: sequence} for every ASV in the run
+    :param counts: Iterable of (sequence hash, sample ID, count) tuples
+    :param run_path: Output folder of the run
+    :param overwrite: Replace a run registered under the same run ID from a different output folder. Without it, a
+    ValueError is raised rather than deleting the other run's counts.
+    :return: Number of (ASV, sample) counts registered
+    """
+    with connection:
+        # The insert takes the write lock before the registered run is read, so no other pipeline can register the
+        # same run ID in between
+        connection.execute('INSERT OR IGNORE INTO runs VALUES (?, ?, ?)', (run_id, run_path, time.time()))
+        existing = connection.execute('SELECT run_path FROM runs WHERE run_id = ?', (run_id,)).fetchone()
+        if existing[0] != run_path and not overwrite:
+            raise ValueError('Run {} is already registered from {}, not {}. Register this run under another run ID, '
+                             'or overwrite the registered run explicitly.'.format(run_id, existing[0], run_path))
+        connection.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?)', (run_id, run_path, time.time()))
+        connection.executemany('INSERT OR IGNORE INTO asvs (sequence_hash, sequence, length) VALUES (?, ?, ?)',
+                               [(sequence_hash, sequence, len(sequence))
+                                for sequence_hash, sequence in sequences.items()])
+        connection.execute('DELETE FROM counts WHERE run_id = ?', (run_id,))
+        cursor = connection.executemany('INSERT INTO counts VALUES (?, ?, ?, ?)',
+                                        ((sequence_hash, run_id, sample_id, int(count))
+                                         for sequence_hash, sample_id, count in counts if count))
+    logging.info('Registered {} ASV counts for run {}'.format(cursor.rowcount, run_id))
+    return cursor.rowcount
+
+
+def update_taxonomy(connection: sqlite3.Connection, assignments: dict):
+    """
+    :param connection: Connection returned by open_registry()
+    :param assignments: Dictionary of {sequence hash: (taxon, confidence)}
+    """
+    with connection:
+        connection.executemany('UPDATE asvs SET taxon = ?, confidence = ? WHERE sequence_hash = ?',
+                               [(str(taxon), str(confidence), sequence_hash)
+                                for sequence_hash, (taxon, confidence) in assignments.items()])
+
+
+def find_by_sequence(connection: sqlite3.Connection, sequence: str) -> list:
+    """
+    :param connection: Connection returned by open_registry()
+    :param sequence: Exact ASV sequence
+    :return: List of (sequence hash, taxon, run ID, sample ID, count) tuples for every sample containing the ASV
+    """
+    return connection.execute('SELECT asvs.sequence_hash, taxon, run_id, sample_id, count '
+                              'FROM asvs JOIN counts ON asvs.sequence_hash = counts.sequence_hash '
+                              'WHERE asvs.sequence_hash = ? ORDER BY run_id, sample_id',
+                              (sequence_digest(sequence),)).fetchall()
+
+
+def find_by_taxon(connection: sqlite3.Connection, taxon: str) -> list:
+    """
+    :param connection: Connection returned by open_registry()
+    :param taxon: Taxonomy string prefix, e.g. 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli'. Lineages are stored from
+    the domain down, so a prefix match selects a clade.
+    :return: List of (sequence hash, taxon, run ID, sample ID, count) tuples for every sample containing a matching ASV
+    """
+    # A range query on the prefix (rather than LIKE) is answered from the taxon index
+    return connection.execute('SELECT asvs.sequence_hash, taxon, run_id, sample_id, count '
+                              'FROM asvs JOIN counts ON asvs.sequence_hash = counts.sequence_hash '
+                              'WHERE taxon >= ? AND taxon < ? ORDER BY run_id, sample_id, count DESC',
+                              (taxon, taxon + '\U0010ffff')).fetchall()
+
+
+def find_by_sample(connection: sqlite3.Connection, sample_id: str, run_id: str = None) -> list:
+    """
+    :param connection: Connection returned by open_registry()
+    :param sample_id: Sample ID as it appears in the run's feature table
+    :param run_id: Restrict the lookup to one run. Defaults to every run containing the sample.
+    :return: List of (sequence hash, taxon, run ID, sample ID, count) tuples for every ASV in the sample
+    """
+    query = ('SELECT asvs.sequence_hash, taxon, run_id, sample_id, count '
+             'FROM counts JOIN asvs ON asvs.sequence_hash = counts.sequence_hash WHERE sample_id = ?')
+    params = [sample_id]
+    if run_id is not None:
+        query += ' AND run_id = ?'
+        params.append(run_id)
+    return connection.execute(query + ' ORDER BY run_id, count DESC', params).fetchall()
+
+
+def run_tables(connection: sqlite3.Connection, run_ids: list):
+    """
+    :param connection: Connection returned by open_registry()
+    :param run_ids: Runs to retrieve
+    :return: Generator of (matrix, feature_ids, sample_ids) tuples, one per run, in the format consumed by
+    bin.run_merger.merge_sparse_tables(). Feature IDs are sequence hashes.
+    """
+    for run_id in run_ids:
+        if connection.execute('SELECT 1 FROM runs WHERE run_id = ?', (run_id,)).fetchone() is None:
+            raise ValueError('Run {} is not in the ASV registry'.format(run_id))
+        feature_index = OrderedDict()
+        sample_index = OrderedDict()
+        rows, cols, values = [], [], []
+        for sequence_hash, sample_id, count in connection.execute(
+                'SELECT sequence_hash, sample_id, count FROM counts WHERE run_id = ?', (run_id,)):
+            rows.append(feature_index.setdefault(sequence_hash, len(feature_index)))
+            cols.append(sample_index.setdefault(sample_id, len(sample_index)))
+            values.append(count)
+        matrix = sparse.coo_matrix((values, (rows, cols)), shape=(len(feature_index), len(sample_index)))
+        yield matrix, list(feature_index), list(sample_index)
+
+
+def sequences_for_hashes(connection: sqlite3.Connection, sequence_hashes) -> dict:
+    """
+    :param connection: Connection returned by open_registry()
+    :param sequence_hashes: Iterable of sequence hashes
+    :return: Dictionary of {sequence hash: sequence}
+    """
+    sequences = {}
+    for sequence_hash in sequence_hashes:
+        row = connection.execute('SELECT sequence FROM asvs WHERE sequence_hash = ?', (sequence_hash,)).fetchone()
+        sequences[sequence_hash] = row[0]
+    return sequences
+
+
+def write_rows(rows: list):
+    """
+    :param rows: Rows returned by one of the find_by_* functions, written to stdout as tab-separated values
+    """
+    click.echo('\t'.join(['sequence_hash', 'taxon', 'run_id', 'sample_id', 'count']))
+    for row in rows:
+        click.echo('\t'.join('' if value is None else str(value) for value in row))
+
+
+@click.command()
+@click.option('-r', '--registry',
+              type=click.Path(exists=True),
+              default=DEFAULT_REGISTRY_PATH,
+              help='Path to the ASV registry. Defaults to {}'.format(DEFAULT_REGISTRY_PATH))
+@click.option('-s', '--sequence',
+              default=None,
+              help='Report every run and sample containing this exact ASV sequence')
+@click.option('-t', '--taxon',
+              default=None,
+              help='Report every run and sample containing an ASV whose taxonomy starts with this lineage, '
+                   'e.g. "D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae"')
+@click.option('-i', '--sample_id',
+              default=None,
+              help='Report every ASV in this sample')
+@click.option('--run_id',
+              default=None,
+              help='Restrict a --sample_id query to a single run')
+def cli(registry, sequence, taxon, sample_id, run_id):
+    """
+    Queries the ASV registry and writes the matching counts to stdout as tab-separated values
+    """
+    if sum(query is not None for query in [sequence, taxon, sample_id]) != 1:
+        raise click.UsageError('Provide exactly one of --sequence, --taxon or --sample_id')
+
+    connection = open_registry(registry)
+    if sequence is not None:
+        rows = find_by_sequence(connection, sequence)
+    elif taxon is not None:
+        rows = find_by_taxon(connection, taxon)
+    else:
+        rows = find_by_sample(connection, sample_id, run_id=run_id)
+    write_rows(rows)
+    connection.close()
+    if not rows:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
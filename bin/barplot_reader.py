@@ -0,0 +1,71 @@
+"""
+Reads the level-N.csv tables of a taxonomy barplot visualization (.qzv) straight out of its zip archive.
+
+A .qzv is a zip holding <uuid>/data/ with one level-N.csv per taxonomic level alongside the HTML and JavaScript of the
+visualization itself. Loading it through qiime2 and exporting it unpacks every file into a temporary folder; here only
+the requested members are opened and streamed to pandas (or to disk), without a temporary folder or importing qiime2.
+"""
+
+import io
+import re
+import shutil
+import zipfile
+
+from contextlib import contextmanager
+
+import pandas as pd
+
+LEVEL_MEMBER_PATTERN = re.compile(r'^[^/]+/data/(level-\d+)\.csv$')
+
+
+def level_members(qzv_path: str) -> dict:
+    """
+    :param qzv_path: Path to a taxonomy barplot .qzv file
+    :return: Dictionary of {level name: archive member}, e.g. {'level-5': '<uuid>/data/level-5.csv'}
+    """
+    with zipfile.ZipFile(qzv_path) as archive:
+        members = {}
+        for name in archive.namelist():
+            match = LEVEL_MEMBER_PATTERN.match(name)
+            if match:
+                members[match.group(1)] = name
+    if not members:
+        raise ValueError('{} does not contain any level-N.csv files. Is it a taxonomy barplot?'.format(qzv_path))
+    return members
+
+
+@contextmanager
+def open_level_csv(qzv_path: str, level_name: str):
+    """
+    :param qzv_path: Path to a taxonomy barplot .qzv file
+    :param level_name: Level file to open without its extension, e.g. 'level-5'
+    :return: Context manager yielding an open text handle streaming the level file from the archive
+    """
+    members = level_members(qzv_path)
+    if level_name not in members:
+        raise ValueError('{} does not contain {}.csv'.format(qzv_path, level_name))
+    with zipfile.ZipFile(qzv_path) as archive, archive.open(members[level_name]) as f:
+        yield io.TextIOWrapper(f, encoding='utf-8')
+
+
+def read_level_csv(qzv_path: str, level_name: str, **kwargs) -> pd.DataFrame:
+    """
+    :param qzv_path: Path to a taxonomy barplot .qzv file
+    :param level_name: Level file to read without its extension, e.g. 'level-5'
+    :param kwargs: Passed on to pandas.read_csv()
+    :return: DataFrame of the level file
+    """
+    with open_level_csv(qzv_path, level_name) as f:
+        return pd.read_csv(f, **kwargs)
+
+
+def extract_level_csv(qzv_path: str, level_name: str, out_path: str) -> str:
+    """
+    :param qzv_path: Path to a taxonomy barplot .qzv file
+    :param level_name: Level file to extract without its extension, e.g. 'level-5'
+    :param out_path: Path to write the level file to
+    :return: out_path
+    """
+    with open_level_csv(qzv_path, level_name) as f, open(out_path, 'w') as out:
+        shutil.copyfileobj(f, out)
+    return out_path
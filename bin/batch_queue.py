@@ -0,0 +1,408 @@
+"""
+Local work queue for running ampliconpipeline.py over many MiSeq runs, used by batch_pipeline.py.
+
+The queue lives in a JSON state file holding every run (its input folder, output folder, metadata, pipeline
+parameters, CPU and memory budget) along with its status: pending, running, completed or failed.
+Every change is made under an exclusive lock and written atomically, so the state always reflects what has been done
+and several processes (e.g. batch_pipeline.py and watch_runs.py) can add to and work through the same queue. A run
+that was running when its batch was interrupted goes back to pending and is resumed with --resume on the next
+invocation.
+
+A run's memory budget covers the pipeline and every process it starts (DADA2's R session, MAFFT, ...): the queue polls
+the summed resident memory of the run's process tree with psutil and stops the run once it goes over.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import fcntl
+import socket
+import logging
+import threading
+import subprocess
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+PIPELINE_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ampliconpipeline.py')
+
+# Seconds between checks of a run's memory use, and to wait for a run over budget to exit before killing it
+MEMORY_POLL_INTERVAL = 2
+TERMINATE_TIMEOUT = 30
+
+# ampliconpipeline.py options that can be set per run in a manifest, and those that are on/off flags
+PIPELINE_OPTIONS = ['classifier', 'trim_left_f', 'trim_left_r', 'trunc_len_f', 'trunc_len_r', 'cache_dir',
+                    'fastq_pattern', 'taxonomy_cache', 'taxonomy_cache_size', 'asv_registry', 'dada2_shard_size',
+                    'dada2_shard_dir', 'rarefaction_steps', 'rarefaction_iterations', 'scratch_dir']
+PIPELINE_FLAGS = ['filtering_flag', 'no_taxonomy_cache', 'no_asv_registry', 'overwrite_run_id', 'no_space_check',
+                  'out_of_core', 'verbose']
+REQUIRED_COLUMNS = ['inputdir', 'outdir', 'metadata']
+TRUE_VALUES = ['true', 'yes', 'y', '1']
+
+STATUSES = ['pending', 'running', 'completed', 'failed']
+
+
+def read_manifest(manifest_path: str) -> list:
+    """
+    :param manifest_path: Tab-separated file with a row per run and the columns inputdir, outdir and metadata.
+    Optional columns: run_id (defaults to the name of outdir), cpus, memory_gb, and any of PIPELINE_OPTIONS
+    and PIPELINE_FLAGS. Empty cells fall back to the defaults. Relative paths are resolved against the folder
+    containing the manifest, and lines starting with # are ignored.
+    :return: List of run dictionaries in manifest order
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    with open(manifest_path) as f:
+        rows = list(csv.DictReader((line for line in f if line.strip() and not line.startswith('#')),
+                                   delimiter='\t'))
+
+    runs = []
+    for row in rows:
+        row = OrderedDict((key.strip(), value.strip()) for key, value in row.items() if value and value.strip())
+        missing = [column for column in REQUIRED_COLUMNS if column not in row]
+        if missing:
+            raise ValueError('Manifest row {} is missing {}'.format(dict(row), ', '.join(missing)))
+        unknown = [column for column in row
+                   if column not in REQUIRED_COLUMNS + ['run_id', 'cpus', 'memory_gb'] +
+                   PIPELINE_OPTIONS + PIPELINE_FLAGS]
+        if unknown:
+            raise ValueError('Unknown manifest columns: {}'.format(', '.join(unknown)))
+
+        for column in ['inputdir', 'outdir', 'metadata']:
+            row[column] = os.path.join(manifest_dir, os.path.expanduser(row[column]))
+        run = OrderedDict([
+            ('run_id', row.get('run_id', os.path.basename(os.path.normpath(row['outdir'])))),
+            ('inputdir', row['inputdir']),
+            ('outdir', row['outdir']),
+            ('metadata', row['metadata']),
+            ('cpus', int(row['cpus']) if 'cpus' in row else None),
+            ('memory_gb', float(row['memory_gb']) if 'memory_gb' in row else None),
+            ('options', OrderedDict((option, row[option]) for option in PIPELINE_OPTIONS if option in row)),
+            ('flags', [flag for flag in PIPELINE_FLAGS if row.get(flag, '').lower() in TRUE_VALUES]),
+        ])
+        runs.append(run)
+
+    run_ids = [run['run_id'] for run in runs]
+    duplicates = sorted(set(run_id for run_id in run_ids if run_ids.count(run_id) > 1))
+    if duplicates:
+        raise ValueError('Duplicate run IDs in manifest: {}'.format(', '.join(duplicates)))
+    return runs
+
+
+def default_state_path(manifest_path: str) -> str:
+    """
+    :param manifest_path: Path to a batch manifest
+    :return: Path to its state file, e.g. backlog.tsv -> backlog.state.json
+    """
+    return os.path.splitext(os.path.abspath(manifest_path))[0] + '.state.json'
+
+
+def log_path(state_path: str, run_id: str) -> str:
+    """
+    :return: Path to the log file capturing the pipeline output of a run
+    """
+    return os.path.join(os.path.dirname(os.path.abspath(state_path)), 'batch_logs', '{}.log'.format(run_id))
+
+
+def load_state(state_path: str) -> OrderedDict:
+    """
+    :param state_path: Path to the state file
+    :return: State dictionary with a 'runs' OrderedDict of {run ID: run}. Empty if the file doesn't exist yet.
+    """
+    if not os.path.isfile(state_path):
+        return OrderedDict([('runs', OrderedDict())])
+    with open(state_path) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+@contextmanager
+def locked_state(state_path: str):
+    """
+    Context manager yielding the state for modification. The state file is locked for the duration and the changes
+    are written back atomically on exit.
+
+    :param state_path: Path to the state file
+    """
+    state_path = os.path.abspath(state_path)
+    os.makedirs(os.path.dirname(state_path), exist_ok=True)
+    with open(state_path + '.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            state = load_state(state_path)
+            yield state
+            tmp_path = '{}.{}.tmp'.format(state_path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.rename(tmp_path, state_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def queue_runs(state: dict, runs: list) -> list:
+    """
+    Adds runs to a state loaded with locked_state(). Runs already in the queue keep their status.
+
+    :param state: State dictionary
+    :param runs: Run dictionaries, e.g. from read_manifest()
+    :return: Run IDs that were added
+    """
+    added = []
+    for run in runs:
+        if run['run_id'] in state['runs']:
+            continue
+        entry = OrderedDict(run)
+        entry.update([('status', 'pending'), ('attempts', 0), ('returncode', None), ('host', None), ('pid', None),
+                      ('started', None), ('finished', None)])
+        state['runs'][run['run_id']] = entry
+        added.append(run['run_id'])
+    if added:
+        logging.info('Queued {} run(s): {}'.format(len(added), ', '.join(added)))
+    return added
+
+
+def add_runs(state_path: str, runs: list) -> list:
+    """
+    Adds runs to the queue. Runs already in the queue keep their status, so a manifest can be re-submitted safely.
+
+    :param state_path: Path to the state file
+    :param runs: Run dictionaries, e.g. from read_manifest()
+    :return: Run IDs that were added
+    """
+    with locked_state(state_path) as state:
+        return queue_runs(state, runs)
+
+
+def process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def recover_interrupted(state_path: str, retry_failed: bool = False) -> list:
+    """
+    Puts runs whose batch process on this host is gone (e.g. it was killed) back into the queue
+
+    :param state_path: Path to the state file
+    :param retry_failed: Also put failed runs back into the queue
+    :return: Run IDs put back into the queue
+    """
+    recovered = []
+    with locked_state(state_path) as state:
+        for run_id, run in state['runs'].items():
+            interrupted = (run['status'] == 'running' and run['host'] == socket.gethostname() and
+                           not process_alive(run['pid']))
+            if interrupted or (retry_failed and run['status'] == 'failed'):
+                run['status'] = 'pending'
+                recovered.append(run_id)
+    if recovered:
+        logging.info('Re-queued {} interrupted or failed run(s): {}'.format(len(recovered), ', '.join(recovered)))
+    return recovered
+
+
+def claim_next_run(state_path: str):
+    """
+    :param state_path: Path to the state file
+    :return: The next pending run, now marked as running by this process, or None if there are no pending runs
+    """
+    with locked_state(state_path) as state:
+        for run in state['runs'].values():
+            if run['status'] == 'pending':
+                run['status'] = 'running'
+                run['attempts'] += 1
+                run['host'] = socket.gethostname()
+                run['pid'] = os.getpid()
+                run['started'] = time.time()
+                run['finished'] = None
+                run['returncode'] = None
+                return OrderedDict(run)
+    return None
+
+
+def update_run(state_path: str, run_id: str, **fields):
+    with locked_state(state_path) as state:
+        state['runs'][run_id].update(fields)
+
+
+def pipeline_command(run: dict, pipeline_script: str = PIPELINE_SCRIPT, default_cpus: int = None) -> list:
+    """
+    :param run: Run dictionary
+    :param pipeline_script: Path to ampliconpipeline.py
+    :param default_cpus: CPUs for runs that don't set their own. All CPUs when None.
+    :return: Command line running the pipeline on the run. Runs attempted before are resumed.
+    """
+    command = [sys.executable, pipeline_script, '--inputdir', run['inputdir'], '--outdir', run['outdir'],
+               '--metadata', run['metadata']]
+    for option, value in run['options'].items():
+        command += ['--' + option, str(value)]
+    command += ['--' + flag for flag in run['flags']]
+    cpus = run['cpus'] or default_cpus
+    if cpus:
+        command += ['--cpus', str(cpus)]
+    if run['attempts'] > 1:
+        command.append('--resume')
+    return command
+
+
+def process_tree_rss(process) -> int:
+    """
+    :param process: psutil.Process
+    :return: Summed resident memory in bytes of process and all of its descendants
+    """
+    rss = 0
+    for member in [process] + process.children(recursive=True):
+        try:
+            rss += member.memory_info().rss
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            pass
+    return rss
+
+
+def stop_process_tree(process):
+    """
+    Terminates process and all of its descendants, killing those still running after TERMINATE_TIMEOUT seconds
+
+    :param process: psutil.Process
+    """
+    try:
+        members = process.children(recursive=True) + [process]
+    except psutil.NoSuchProcess:
+        return
+    for member in members:
+        try:
+            member.terminate()
+        except psutil.NoSuchProcess:
+            pass
+    _, alive = psutil.wait_procs(members, timeout=TERMINATE_TIMEOUT)
+    for member in alive:
+        try:
+            member.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def wait_within_budget(process: subprocess.Popen, memory_gb: float, poll_interval: float = MEMORY_POLL_INTERVAL):
+    """
+    Waits for process to exit, stopping it and its descendants if their summed resident memory exceeds memory_gb
+
+    :param process: Running pipeline
+    :param memory_gb: Memory budget in GB for the whole process tree
+    :param poll_interval: Seconds between memory checks
+    :return: Tuple of (exit code, peak resident memory in bytes, whether the run was stopped for exceeding its budget)
+    """
+    budget = memory_gb * 1024 ** 3
+    tree = psutil.Process(process.pid)
+    peak = 0
+    while True:
+        try:
+            return process.wait(timeout=poll_interval), peak, False
+        except subprocess.TimeoutExpired:
+            pass
+        try:
+            peak = max(peak, process_tree_rss(tree))
+        except psutil.NoSuchProcess:
+            continue
+        if peak > budget:
+            stop_process_tree(tree)
+            # psutil may already have reaped the pipeline, in which case Popen.wait() reports 0
+            return process.wait() or -1, peak, True
+
+
+def execute_run(state_path: str, run: dict, pipeline_script: str = PIPELINE_SCRIPT, default_cpus: int = None,
+                default_memory_gb: float = None) -> int:
+    """
+    Runs the pipeline on a run claimed with claim_next_run() and records the outcome in the state file
+
+    :return: Exit code of the pipeline
+    """
+    run_log_path = log_path(state_path, run['run_id'])
+    os.makedirs(os.path.dirname(run_log_path), exist_ok=True)
+    command = pipeline_command(run, pipeline_script=pipeline_script, default_cpus=default_cpus)
+    memory_gb = run.get('memory_gb') or default_memory_gb
+    logging.info('Starting run {} (attempt {})'.format(run['run_id'], run['attempts']))
+
+    with open(run_log_path, 'a') as log:
+        log.write('$ {}\n'.format(' '.join(command)))
+        log.flush()
+        try:
+            if memory_gb and psutil is None:
+                raise OSError('psutil is required to enforce the memory budget of {} GB'.format(memory_gb))
+            process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            log.write('{}\n'.format(e))
+            returncode = -1
+        else:
+            if memory_gb:
+                returncode, peak, over_budget = wait_within_budget(process, memory_gb)
+                if over_budget:
+                    message = 'Run {} stopped after using {:.1f} GB, over its memory budget of {} GB'.format(
+                        run['run_id'], peak / 1024 ** 3, memory_gb)
+                    log.write('{}\n'.format(message))
+                    logging.warning(message)
+            else:
+                returncode = process.wait()
+
+    status = 'completed' if returncode == 0 else 'failed'
+    update_run(state_path, run['run_id'], status=status, returncode=returncode, pid=None, finished=time.time())
+    if status == 'completed':
+        logging.info('Run {} completed'.format(run['run_id']))
+    else:
+        logging.warning('Run {} failed with exit code {}. See {}'.format(run['run_id'], returncode, run_log_path))
+    return returncode
+
+
+def run_queue(state_path: str, concurrency: int = 1, pipeline_script: str = PIPELINE_SCRIPT, default_cpus: int = None,
+              default_memory_gb: float = None, poll_interval: float = None,
+              stop_event: threading.Event = None):
+    """
+    Works through the pending runs with up to concurrency runs at a time
+
+    :param state_path: Path to the state file
+    :param concurrency: Maximum number of runs processed at once
+    :param pipeline_script: Path to ampliconpipeline.py
+    :param default_cpus: CPUs for runs that don't set their own
+    :param default_memory_gb: Memory budget in GB for runs that don't set their own. Unlimited when None.
+    :param poll_interval: Keep checking for newly queued runs every poll_interval seconds until stop_event is set.
+    Returns once the queue is empty when None.
+    :param stop_event: Event that stops the workers from starting new runs
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    recover_interrupted(state_path)
+
+    def worker():
+        while not stop_event.is_set():
+            run = claim_next_run(state_path)
+            if run is None:
+                if poll_interval is None:
+                    return
+                stop_event.wait(poll_interval)
+                continue
+            execute_run(state_path, run, pipeline_script=pipeline_script, default_cpus=default_cpus,
+                        default_memory_gb=default_memory_gb)
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+
+def summarize(state: dict) -> OrderedDict:
+    """
+    :param state: State dictionary from load_state()
+    :return: OrderedDict of {status: number of runs}
+    """
+    counts = OrderedDict((status, 0) for status in STATUSES)
+    for run in state['runs'].values():
+        counts[run['status']] += 1
+    return counts
@@ -0,0 +1,168 @@
+"""
+Memory-mapped copies of QIIME 2 feature classifiers.
+
+A TaxonomicClassifier .qza stores its scikit-learn pipeline as a pickle inside a tar inside a zip, so every load
+decompresses and unpickles the entire pipeline into private memory. convert_classifier() unpacks the pipeline once
+into a store folder next to the artifact (e.g. classifier.qza -> classifier.mmap/), re-dumped with joblib without
+compression. load_mmap_classifier() then opens it with mmap_mode='r': the large arrays are mapped read-only
+straight from disk, load in seconds and share one copy in the page cache between every process and concurrent run
+on the host. Within a process the loaded pipeline is kept and reused.
+"""
+
+import os
+import json
+import click
+import shutil
+import tarfile
+import logging
+import zipfile
+import tempfile
+import threading
+
+try:
+    from sklearn.externals import joblib
+except ImportError:
+    import joblib
+
+from bin import stage_cache
+
+PIPELINE_FILENAME = 'sklearn_pipeline.pkl'
+MANIFEST_FILENAME = 'store.json'
+
+_loaded_pipelines = {}
+_loaded_pipelines_lock = threading.Lock()
+
+
+def default_store_path(classifier_artifact_path: str) -> str:
+    """
+    :param classifier_artifact_path: Path to a TaxonomicClassifier .qza file
+    :return: Path to the store folder for the classifier, e.g. classifier.qza -> classifier.mmap
+    """
+    return os.path.splitext(os.path.abspath(classifier_artifact_path))[0] + '.mmap'
+
+
+def archive_fingerprint(classifier_artifact_path: str) -> dict:
+    """
+    Cheap identity of a classifier artifact: the UUID QIIME 2 names the archive's root folder after, read from the zip
+    directory without decompressing anything, with the size and modification time of the file
+
+    :param classifier_artifact_path: Path to a TaxonomicClassifier .qza file
+    :return: Dictionary with the uuid, size and mtime of the artifact
+    """
+    with zipfile.ZipFile(classifier_artifact_path) as archive:
+        names = archive.namelist()
+    stat = os.stat(classifier_artifact_path)
+    return {
+        'uuid': names[0].split('/')[0] if names else None,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+    }
+
+
+def extract_pipeline(classifier_artifact_path: str, out_dir: str) -> str:
+    """
+    :param classifier_artifact_path: Path to a TaxonomicClassifier .qza file
+    :param out_dir: Folder to extract the pipeline pickle into
+    :return: Path to the extracted pickle
+    """
+    with zipfile.ZipFile(classifier_artifact_path) as archive:
+        members = [name for name in archive.namelist() if name.endswith('/data/sklearn_pipeline.tar')]
+        if not members:
+            raise ValueError('{} does not contain a scikit-learn pipeline'.format(classifier_artifact_path))
+        with archive.open(members[0]) as f, tarfile.open(fileobj=f, mode='r|') as tar:
+            for member in tar:
+                if os.path.basename(member.name) == PIPELINE_FILENAME and member.isfile():
+                    pickle_path = os.path.join(out_dir, PIPELINE_FILENAME)
+                    with open(pickle_path, 'wb') as out:
+                        shutil.copyfileobj(tar.extractfile(member), out)
+                    return pickle_path
+    raise ValueError('{} does not contain {}'.format(classifier_artifact_path, PIPELINE_FILENAME))
+
+
+def convert_classifier(classifier_artifact_path: str, store_path: str = None) -> str:
+    """
+    Converts a classifier artifact into a memory-mappable store. The store is built in a temporary folder and moved
+    into place once complete, so a half-written store is never picked up.
+
+    :param classifier_artifact_path: Path to a TaxonomicClassifier .qza file
+    :param store_path: Folder to write the store to. Defaults to default_store_path().
+    :return: Path to the store folder
+    """
+    if store_path is None:
+        store_path = default_store_path(classifier_artifact_path)
+    logging.info('Converting {} into a memory-mapped classifier at {}...'.format(classifier_artifact_path,
+                                                                                store_path))
+
+    tmp_path = tempfile.mkdtemp(prefix='.tmp-', dir=os.path.dirname(os.path.abspath(store_path)))
+    try:
+        with tempfile.TemporaryDirectory() as extract_dir:
+            pipeline = joblib.load(extract_pipeline(classifier_artifact_path, extract_dir))
+        joblib.dump(pipeline, os.path.join(tmp_path, PIPELINE_FILENAME), compress=0)
+        del pipeline
+
+        manifest = {
+            'classifier_artifact_path': os.path.abspath(classifier_artifact_path),
+            'classifier_digest': stage_cache.file_digest(classifier_artifact_path),
+            'classifier_fingerprint': archive_fingerprint(classifier_artifact_path),
+        }
+        with open(os.path.join(tmp_path, MANIFEST_FILENAME), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+        if os.path.isdir(store_path):
+            shutil.rmtree(store_path)
+        os.rename(tmp_path, store_path)
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    logging.info('Saved {}'.format(store_path))
+    return store_path
+
+
+def load_mmap_classifier(classifier_artifact_path: str, store_path: str = None):
+    """
+    :param classifier_artifact_path: Path to a TaxonomicClassifier .qza file
+    :param store_path: Folder the store was written to. Defaults to default_store_path().
+    :return: The scikit-learn pipeline with its arrays memory-mapped, or None if there is no store for the classifier
+    or the store was built from a different version of it. The store is matched to the artifact with
+    archive_fingerprint() rather than a digest of its content, which would take about as long as loading it.
+    """
+    if store_path is None:
+        store_path = default_store_path(classifier_artifact_path)
+    manifest_path = os.path.join(store_path, MANIFEST_FILENAME)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('classifier_fingerprint') != archive_fingerprint(classifier_artifact_path):
+        logging.warning('Ignoring {} as it was built from a different version of {}. Re-run the conversion to '
+                        'use it.'.format(store_path, classifier_artifact_path))
+        return None
+
+    with _loaded_pipelines_lock:
+        if store_path not in _loaded_pipelines:
+            logging.info('Loading memory-mapped classifier from {}'.format(store_path))
+            _loaded_pipelines[store_path] = joblib.load(os.path.join(store_path, PIPELINE_FILENAME), mmap_mode='r')
+        return _loaded_pipelines[store_path]
+
+
+@click.command()
+@click.option('-c', '--classifier',
+              type=click.Path(exists=True),
+              required=True,
+              help='Path to a QIIME2 Classifier Artifact to convert')
+@click.option('-o', '--store_path',
+              type=click.Path(exists=False),
+              default=None,
+              help='Folder to write the memory-mapped classifier to. Defaults to the classifier path with a .mmap '
+                   'extension instead of .qza, where ampliconpipeline.py and merge_runs.py pick it up automatically.')
+def cli(classifier, store_path):
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    convert_classifier(classifier, store_path=store_path)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,351 @@
+"""
+Proposes DADA2 trimming/truncation parameters for a run instead of guessing them by hand.
+
+1. Proposal: per-position quality profiles from bin.quality_profiler are used to find where the quality of the
+   forward and reverse reads drops off. Truncation lengths are then adjusted so the truncated reads still overlap by
+   at least min_overlap bases across the expected amplicon, which DADA2 needs to merge the pairs.
+2. Sweep (optional): a grid of candidates around the proposal is evaluated by denoising a small random subsample of
+   read pairs from every sample, in parallel, and reporting the fraction of reads retained after chimera removal.
+"""
+
+import os
+import gzip
+import json
+import click
+import shutil
+import logging
+import tempfile
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from bin import helper_functions
+from bin import quality_profiler
+
+# V3-V4 (S-D-Bact-0341-b-S-17 / S-D-Bact-0785-a-A-21) amplicon length including primers
+DEFAULT_AMPLICON_LENGTH = 464
+DEFAULT_MIN_OVERLAP = 20
+DEFAULT_MIN_QUALITY = 25
+DEFAULT_QUALITY_QUANTILE = 0.25
+DEFAULT_SUBSAMPLE_READS = 2000
+SMOOTHING_WINDOW = 5
+
+
+def quality_cutoff(position_histogram: np.ndarray, min_quality: int = DEFAULT_MIN_QUALITY,
+                   quantile: float = DEFAULT_QUALITY_QUANTILE) -> int:
+    """
+    Finds the last position before the given quality quantile (smoothed over a few bases so a single poor cycle
+    doesn't cut the read short) falls below min_quality
+
+    :param position_histogram: Histogram of scores per position from bin.quality_profiler
+    :param min_quality: Minimum acceptable quality score
+    :param quantile: Quality quantile that must stay above min_quality, e.g. 0.25 for the lower quartile
+    :return: Proposed truncation length. 0 if the reads are poor from the first base.
+    """
+    scores = quality_profiler.histogram_quantiles(position_histogram, quantiles=(quantile,))[quantile]
+    padded = np.pad(scores.astype(float), SMOOTHING_WINDOW // 2, mode='edge')
+    smoothed = np.convolve(padded, np.ones(SMOOTHING_WINDOW) / SMOOTHING_WINDOW, mode='valid')
+    passing = smoothed >= min_quality
+    if passing.all():
+        return len(scores)
+    return int(np.argmin(passing))
+
+
+def apply_overlap_constraint(trunc_len_f: int, trunc_len_r: int, max_len_f: int, max_len_r: int,
+                             amplicon_length: int = DEFAULT_AMPLICON_LENGTH,
+                             min_overlap: int = DEFAULT_MIN_OVERLAP) -> tuple:
+    """
+    Extends the truncation lengths until the reads overlap by min_overlap bases across the amplicon. The shortfall
+    is split evenly, with anything one read can't absorb (because it's already at full length) going to the other.
+
+    :return: Tuple of (trunc_len_f, trunc_len_r, satisfied) where satisfied is False if even full length reads
+    cannot reach the requested overlap
+    """
+    shortfall = amplicon_length + min_overlap - (trunc_len_f + trunc_len_r)
+    if shortfall > 0:
+        extend_f = min(max_len_f - trunc_len_f, (shortfall + 1) // 2)
+        extend_r = min(max_len_r - trunc_len_r, shortfall - extend_f)
+        extend_f = min(max_len_f - trunc_len_f, shortfall - extend_r)
+        trunc_len_f += extend_f
+        trunc_len_r += extend_r
+    satisfied = trunc_len_f + trunc_len_r >= amplicon_length + min_overlap
+    return trunc_len_f, trunc_len_r, satisfied
+
+
+def propose_parameters(profile: dict, amplicon_length: int = DEFAULT_AMPLICON_LENGTH,
+                       min_overlap: int = DEFAULT_MIN_OVERLAP, min_quality: int = DEFAULT_MIN_QUALITY,
+                       quantile: float = DEFAULT_QUALITY_QUANTILE, forward_primer: str = None,
+                       reverse_primer: str = None) -> OrderedDict:
+    """
+    :param profile: Profile generated by quality_profiler.profile_run()
+    :param amplicon_length: Expected length of the sequenced amplicon, including primers if they are in the reads
+    :param min_overlap: Minimum number of overlapping bases required to merge read pairs
+    :param min_quality: Minimum acceptable quality score, see quality_cutoff()
+    :param quantile: Quality quantile that must stay above min_quality, see quality_cutoff()
+    :param forward_primer: Forward primer sequence. If provided, it is trimmed from the 5' end of the forward reads.
+    :param reverse_primer: Reverse primer sequence. If provided, it is trimmed from the 5' end of the reverse reads.
+    :return: OrderedDict of trim_left_f, trim_left_r, trunc_len_f, trunc_len_r and diagnostic values
+    """
+    forward_histogram = quality_profiler.combine_samples(profile['R1'])
+    reverse_histogram = quality_profiler.combine_samples(profile['R2'])
+    quality_len_f = quality_cutoff(forward_histogram, min_quality=min_quality, quantile=quantile)
+    quality_len_r = quality_cutoff(reverse_histogram, min_quality=min_quality, quantile=quantile)
+
+    trunc_len_f, trunc_len_r, satisfied = apply_overlap_constraint(
+        quality_len_f, quality_len_r, max_len_f=forward_histogram.shape[0], max_len_r=reverse_histogram.shape[0],
+        amplicon_length=amplicon_length, min_overlap=min_overlap)
+    if not satisfied:
+        logging.warning('Reads are too short to overlap by {} bases across a {} bp amplicon; DADA2 will not be able '
+                        'to merge most pairs'.format(min_overlap, amplicon_length))
+
+    proposal = OrderedDict()
+    proposal['trim_left_f'] = len(forward_primer) if forward_primer else 0
+    proposal['trim_left_r'] = len(reverse_primer) if reverse_primer else 0
+    proposal['trunc_len_f'] = trunc_len_f
+    proposal['trunc_len_r'] = trunc_len_r
+    proposal['quality_cutoff_f'] = quality_len_f
+    proposal['quality_cutoff_r'] = quality_len_r
+    proposal['expected_overlap'] = trunc_len_f + trunc_len_r - amplicon_length
+    proposal['overlap_satisfied'] = satisfied
+    return proposal
+
+
+def candidate_grid(proposal: dict, max_len_f: int, max_len_r: int, step: int = 10,
+                   amplicon_length: int = DEFAULT_AMPLICON_LENGTH, min_overlap: int = DEFAULT_MIN_OVERLAP) -> list:
+    """
+    :return: List of candidate parameter dictionaries within one step of the proposal that still satisfy the
+    overlap constraint. The proposal itself is always first.
+    """
+    candidates = [OrderedDict((key, proposal[key])
+                              for key in ['trim_left_f', 'trim_left_r', 'trunc_len_f', 'trunc_len_r'])]
+    for delta_f, delta_r in itertools.product((-step, 0, step), repeat=2):
+        if delta_f == 0 and delta_r == 0:
+            continue
+        trunc_len_f = proposal['trunc_len_f'] + delta_f
+        trunc_len_r = proposal['trunc_len_r'] + delta_r
+        if not (0 < trunc_len_f <= max_len_f and 0 < trunc_len_r <= max_len_r):
+            continue
+        if trunc_len_f + trunc_len_r < amplicon_length + min_overlap:
+            continue
+        candidate = OrderedDict(candidates[0])
+        candidate['trunc_len_f'] = trunc_len_f
+        candidate['trunc_len_r'] = trunc_len_r
+        candidates.append(candidate)
+    return candidates
+
+
+def _read_fastq_records(handle):
+    """
+    :param handle: Open binary handle to a FASTQ file
+    :return: Generator of 4-line FASTQ records as bytes
+    """
+    while True:
+        record = b''.join(itertools.islice(handle, 4))
+        if not record:
+            return
+        yield record
+
+
+def _read_pair_chunks(read_pairs: list):
+    """
+    :param read_pairs: List of (R1 path, R2 path) tuples, e.g. one per lane
+    :return: Generator of lists of up to quality_profiler.CHUNK_SIZE (R1 record, R2 record) tuples, over every pair of
+    files in turn
+    """
+    for r1_path, r2_path in read_pairs:
+        with gzip.open(r1_path, 'rb') as r1, gzip.open(r2_path, 'rb') as r2:
+            pairs = zip(_read_fastq_records(r1), _read_fastq_records(r2))
+            while True:
+                chunk = list(itertools.islice(pairs, quality_profiler.CHUNK_SIZE))
+                if not chunk:
+                    break
+                yield chunk
+
+
+def subsample_read_pairs(read_pairs: list, out_dir: str, n_reads: int = DEFAULT_SUBSAMPLE_READS,
+                         seed: int = 0) -> tuple:
+    """
+    Draws a uniform random subsample of read pairs from across every file of a sample (reservoir sampling, see
+    quality_profiler.reservoir_sample()) and writes it to out_dir with the filenames of the first pair. The first
+    tiles of a MiSeq run have lower quality than the rest, and every lane is sampled in proportion to its reads.
+
+    :param read_pairs: List of (R1 path, R2 path) tuples of the sample, e.g. one per lane
+    :param out_dir: Folder to write the subsample into
+    :param n_reads: Number of read pairs to keep
+    :param seed: Seed of the subsample
+    :return: Tuple of paths to the subsampled R1 and R2 files
+    """
+    reservoir, _ = quality_profiler.reservoir_sample(_read_pair_chunks(read_pairs), n_reads, seed=seed)
+
+    out_paths = []
+    for read_index, filepath in enumerate(read_pairs[0]):
+        out_path = os.path.join(out_dir, os.path.basename(filepath))
+        with gzip.open(out_path, 'wb', compresslevel=1) as f:
+            for pair in reservoir:
+                f.write(pair[read_index])
+        out_paths.append(out_path)
+    return tuple(out_paths)
+
+
+def create_subsample_artifact(index: dict, work_dir: str, n_reads: int = DEFAULT_SUBSAMPLE_READS) -> str:
+    """
+    Subsamples every sample across all of its lanes and imports the result as a paired-end QIIME 2 artifact
+
+    :param index: Index generated by helper_functions.index_fastq_files()
+    :param work_dir: Scratch folder for the subsampled reads and artifact
+    :param n_reads: Number of read pairs per sample
+    :return: Path to the subsampled paired-sample-data.qza
+    """
+    data_dir = os.path.join(work_dir, 'data')
+    os.makedirs(data_dir, exist_ok=True)
+    for seed, (sample_id, lanes) in enumerate(index.items()):
+        subsample_read_pairs([(reads['R1'], reads['R2']) for reads in lanes.values()], data_dir, n_reads=n_reads,
+                             seed=seed)
+    helper_functions.append_dummy_barcodes(data_dir)
+    return helper_functions.create_sampledata_artifact(datadir=data_dir, qiimedir=work_dir)
+
+
+def evaluate_candidate(task: tuple) -> OrderedDict:
+    """
+    Process pool entry point. Denoises the subsample artifact with one candidate parameter set.
+
+    :param task: Tuple of (path to subsample artifact, candidate parameters, n_threads)
+    :return: Candidate parameters with the read counts and retained fraction added
+    """
+    # Imported here so that proposals can be made without loading the QIIME 2 framework
+    import qiime2
+    import pandas as pd
+    from qiime2.plugins import dada2
+
+    artifact_path, candidate, n_threads = task
+    demultiplexed_seqs = qiime2.Artifact.load(artifact_path)
+    table, rep_seqs, denoising_stats = dada2.methods.denoise_paired(demultiplexed_seqs=demultiplexed_seqs,
+                                                                    n_threads=n_threads, **candidate)
+    stats = denoising_stats.view(qiime2.Metadata).to_dataframe().apply(pd.to_numeric)
+
+    result = OrderedDict(candidate)
+    result['input'] = int(stats['input'].sum())
+    for column in ['filtered', 'denoised', 'merged', 'non-chimeric']:
+        result[column] = int(stats[column].sum())
+    result['retained_fraction'] = round(result['non-chimeric'] / max(result['input'], 1), 4)
+    return result
+
+
+def sweep_candidates(artifact_path: str, candidates: list, cpu_count: int = None) -> list:
+    """
+    Evaluates candidates in parallel, splitting cpu_count CPUs between the concurrent DADA2 runs
+
+    :return: List of evaluate_candidate() results sorted by retained fraction, best first
+    """
+    cpu_count = cpu_count or multiprocessing.cpu_count()
+    n_workers = max(1, min(len(candidates), cpu_count))
+    n_threads = max(1, cpu_count // n_workers)
+    logging.info('Evaluating {} candidate parameter sets on subsampled reads...'.format(len(candidates)))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        results = list(executor.map(evaluate_candidate,
+                                    [(artifact_path, candidate, n_threads) for candidate in candidates]))
+    return sorted(results, key=lambda result: result['retained_fraction'], reverse=True)
+
+
+def optimize_parameters(inputdir: str, outdir: str, amplicon_length: int = DEFAULT_AMPLICON_LENGTH,
+                        min_overlap: int = DEFAULT_MIN_OVERLAP, forward_primer: str = None,
+                        reverse_primer: str = None, sweep: bool = False,
+                        subsample_reads: int = DEFAULT_SUBSAMPLE_READS, cpu_count: int = None,
+                        fastq_pattern: str = helper_functions.DEFAULT_FASTQ_PATTERN) -> OrderedDict:
+    """
+    Proposes DADA2 parameters for a run and optionally sweeps candidates around the proposal. The report is written
+    to outdir/dada2_parameters.json.
+
+    :return: Report dictionary with the 'proposal', the 'recommended' parameters and any 'sweep' results
+    """
+    os.makedirs(outdir, exist_ok=True)
+    index, orphans = helper_functions.index_fastq_directory(inputdir, pattern=fastq_pattern)
+    profile = quality_profiler.profile_run(index, cpu_count=cpu_count)
+    quality_profiler.write_quality_report(profile, outdir)
+
+    proposal = propose_parameters(profile, amplicon_length=amplicon_length, min_overlap=min_overlap,
+                                  forward_primer=forward_primer, reverse_primer=reverse_primer)
+    report = OrderedDict([('proposal', proposal)])
+    report['recommended'] = OrderedDict((key, proposal[key])
+                                        for key in ['trim_left_f', 'trim_left_r', 'trunc_len_f', 'trunc_len_r'])
+
+    if sweep:
+        candidates = candidate_grid(proposal,
+                                    max_len_f=quality_profiler.combine_samples(profile['R1']).shape[0],
+                                    max_len_r=quality_profiler.combine_samples(profile['R2']).shape[0],
+                                    amplicon_length=amplicon_length, min_overlap=min_overlap)
+        work_dir = tempfile.mkdtemp(prefix='dada2_sweep_', dir=outdir)
+        try:
+            artifact_path = create_subsample_artifact(index, work_dir, n_reads=subsample_reads)
+            results = sweep_candidates(artifact_path, candidates, cpu_count=cpu_count)
+        finally:
+            shutil.rmtree(work_dir)
+        report['sweep'] = results
+        report['recommended'] = OrderedDict((key, results[0][key]) for key in report['recommended'])
+
+        logging.info('{:>12} {:>12} {:>12} {:>12} {:>10}'.format('trim_left_f', 'trim_left_r', 'trunc_len_f',
+                                                                 'trunc_len_r', 'retained'))
+        for result in results:
+            logging.info('{trim_left_f:>12} {trim_left_r:>12} {trunc_len_f:>12} {trunc_len_r:>12} '
+                         '{retained_fraction:>10.2%}'.format(**result))
+
+    report_path = os.path.join(outdir, 'dada2_parameters.json')
+    with open(report_path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logging.info('Saved {}'.format(report_path))
+    logging.info('Recommended DADA2 parameters: {}'.format(
+        ' '.join('--{} {}'.format(key, value) for key, value in report['recommended'].items())))
+    return report
+
+
+@click.command()
+@click.option('-i', '--inputdir',
+              type=click.Path(exists=True),
+              required=True,
+              help='Directory containing your raw MiSeq output (files must be *.fastq.gz)')
+@click.option('-o', '--outdir',
+              type=click.Path(),
+              required=True,
+              help='Folder to write dada2_parameters.json and the quality profile into')
+@click.option('-a', '--amplicon_length',
+              default=DEFAULT_AMPLICON_LENGTH,
+              help='Expected amplicon length including primers. Defaults to {} (V3-V4).'.format(
+                  DEFAULT_AMPLICON_LENGTH))
+@click.option('--min_overlap',
+              default=DEFAULT_MIN_OVERLAP,
+              help='Minimum overlap between truncated read pairs. Defaults to {}.'.format(DEFAULT_MIN_OVERLAP))
+@click.option('-f', '--forward_primer',
+              default=None,
+              help='Forward primer sequence, if present in the reads. Its length is used for trim_left_f.')
+@click.option('-r', '--reverse_primer',
+              default=None,
+              help='Reverse primer sequence, if present in the reads. Its length is used for trim_left_r.')
+@click.option('-s', '--sweep',
+              is_flag=True,
+              default=False,
+              help='Evaluate candidates around the proposal by denoising a random subsample of reads per sample.')
+@click.option('--subsample_reads',
+              default=DEFAULT_SUBSAMPLE_READS,
+              help='Number of read pairs per sample to denoise for each candidate. Defaults to {}.'.format(
+                  DEFAULT_SUBSAMPLE_READS))
+@click.option('-n', '--cpus',
+              type=click.INT,
+              default=None,
+              help='Number of CPUs to use. Defaults to all CPUs.')
+def cli(inputdir, outdir, amplicon_length, min_overlap, forward_primer, reverse_primer, sweep, subsample_reads,
+        cpus):
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    optimize_parameters(inputdir=inputdir, outdir=outdir, amplicon_length=amplicon_length, min_overlap=min_overlap,
+                        forward_primer=forward_primer, reverse_primer=reverse_primer, sweep=sweep,
+                        subsample_reads=subsample_reads, cpu_count=cpus)
+
+
+if __name__ == '__main__':
+    cli()
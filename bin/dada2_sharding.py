@@ -0,0 +1,556 @@
+"""
+Sample-sharded DADA2 for runs that are too large or too slow for a single denoise_paired call.
+
+denoise_paired runs filtering, error learning, denoising, read merging and chimera removal for the whole run in one R
+process, so the run is bounded by one node's memory and a failure anywhere loses everything. Here the same steps are
+run by bin/dada2_shard.R as separate tasks in a work folder:
+
+1. filter-NNN: quality filter and trim the samples of shard NNN
+2. learn: learn the forward and reverse error models once, from the filtered reads of every sample
+3. denoise-NNN: denoise and merge the read pairs of shard NNN with the shared error models
+4. merge: combine the per-shard sequence tables and remove chimeras over the combined table
+
+Filtering, denoising and read merging are independent for each sample, while error learning and chimera removal see
+every sample, so the result matches a single denoise_paired run. Tasks are claimed by creating a folder under claims/
+(os.mkdir is atomic), so workers on other hosts can join a run in a shared work folder with
+python -m bin.dada2_sharding -w <work folder>. A claim records the host and PID of its owner, which touches it every
+HEARTBEAT_INTERVAL seconds while the task runs. A claim whose owner is gone (a dead PID on this host, or no heartbeat
+for CLAIM_TIMEOUT seconds from another host) is taken over, so a crashed worker never leaves a task waiting forever.
+Every completed task leaves a marker under done/; re-running the same command retries only the tasks that failed.
+"""
+
+import os
+import csv
+import json
+import time
+import click
+import shutil
+import socket
+import logging
+import zipfile
+import subprocess
+import multiprocessing
+
+import pandas as pd
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from bin import run_merger, stage_cache
+
+SHARD_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dada2_shard.R')
+PLAN_FILENAME = 'plan.json'
+DEFAULT_SHARD_SIZE = 8
+DEFAULT_MAX_ATTEMPTS = 2
+POLL_INTERVAL = 10
+HEARTBEAT_INTERVAL = 30
+CLAIM_TIMEOUT = 300
+
+# Defaults of q2-dada2's denoise_paired
+TRUNC_Q = 2
+MIN_FOLD_PARENT_OVER_ABUNDANCE = 1.0
+N_READS_LEARN = 1000000
+
+# Columns of the SampleData[DADA2Stats] artifact written by q2-dada2's denoise_paired
+PASSED_FILTER = 'percentage of input passed filter'
+MERGED = 'percentage of input merged'
+NON_CHIMERIC = 'percentage of input non-chimeric'
+STATS_COLUMNS = ['input', 'filtered', PASSED_FILTER, 'denoised', 'merged', MERGED, 'non-chimeric', NON_CHIMERIC]
+
+
+def read_manifest(manifest_path: str) -> OrderedDict:
+    """
+    :param manifest_path: MANIFEST file of a SampleData[PairedEndSequencesWithQuality] artifact
+    :return: OrderedDict of {sample ID: {'forward': filename, 'reverse': filename}} in manifest order
+    """
+    samples = OrderedDict()
+    with open(manifest_path) as f:
+        rows = csv.reader(line for line in f if line.strip() and not line.startswith('#'))
+        header = next(rows)
+        for row in rows:
+            row = dict(zip(header, row))
+            samples.setdefault(row['sample-id'], {})[row['direction']] = row['filename']
+    return samples
+
+
+def extract_reads(data_artifact_path: str, reads_dir: str) -> OrderedDict:
+    """
+    Unpacks the reads of a demultiplexed artifact. Files already unpacked by an earlier attempt are kept.
+
+    :param data_artifact_path: Path to the SampleData[PairedEndSequencesWithQuality] .qza
+    :param reads_dir: Folder to unpack the reads into
+    :return: OrderedDict of {sample ID: (forward read path, reverse read path)}
+    """
+    os.makedirs(reads_dir, exist_ok=True)
+    with zipfile.ZipFile(data_artifact_path) as archive:
+        for member in archive.infolist():
+            relative_path = member.filename.split('/', 1)[-1]
+            if not relative_path.startswith('data/') or member.filename.endswith('/'):
+                continue
+            out_path = os.path.join(reads_dir, os.path.basename(relative_path))
+            if os.path.isfile(out_path) and os.path.getsize(out_path) == member.file_size:
+                continue
+            with archive.open(member) as src, open(out_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+    samples = OrderedDict()
+    for sample_id, files in read_manifest(os.path.join(reads_dir, 'MANIFEST')).items():
+        samples[sample_id] = (os.path.join(reads_dir, files['forward']), os.path.join(reads_dir, files['reverse']))
+    return samples
+
+
+def shard_samples(sample_ids: list, shard_size: int) -> list:
+    """
+    :param sample_ids: Sample IDs in a fixed order
+    :param shard_size: Maximum number of samples per shard
+    :return: List of shards, each a list of sample IDs
+    """
+    return [sample_ids[i:i + shard_size] for i in range(0, len(sample_ids), shard_size)]
+
+
+def work_path(work_dir: str, *parts) -> str:
+    return os.path.join(work_dir, *parts)
+
+
+def create_plan(work_dir: str, data_artifact_path: str, params: dict, shard_size: int = DEFAULT_SHARD_SIZE) -> dict:
+    """
+    Sets up the work folder for a sharded run, or picks up the plan of an earlier attempt with the same input and
+    parameters so completed tasks are kept
+
+    :param work_dir: Work folder. Must be on storage shared with every host taking part.
+    :param data_artifact_path: Path to the SampleData[PairedEndSequencesWithQuality] .qza
+    :param params: Dictionary of trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, max_ee and chimera_method
+    :param shard_size: Maximum number of samples per shard
+    :return: Plan dictionary, also saved to plan.json in work_dir
+    """
+    plan_path = work_path(work_dir, PLAN_FILENAME)
+    artifact_digest = stage_cache.file_digest(data_artifact_path)
+    if os.path.isfile(plan_path):
+        with open(plan_path) as f:
+            plan = json.load(f, object_pairs_hook=OrderedDict)
+        if plan['artifact_digest'] != artifact_digest or plan['params'] != params:
+            raise ValueError('{} holds a sharded DADA2 run of different reads or parameters. Remove it or choose '
+                             'another work folder.'.format(work_dir))
+        logging.info('Resuming sharded DADA2 run in {}'.format(work_dir))
+        return plan
+
+    for folder in ['reads', 'filtered/forward', 'filtered/reverse', 'shards', 'logs', 'claims', 'done', 'failed']:
+        os.makedirs(work_path(work_dir, folder), exist_ok=True)
+    samples = extract_reads(data_artifact_path, work_path(work_dir, 'reads'))
+    shards = shard_samples(list(samples), shard_size)
+
+    for index, shard in enumerate(shards):
+        with open(work_path(work_dir, 'shards', 'shard-{:03d}.tsv'.format(index)), 'w') as f:
+            f.write('sample\tforward\treverse\n')
+            for sample_id in shard:
+                f.write('{}\t{}\t{}\n'.format(sample_id, *samples[sample_id]))
+
+    plan = OrderedDict([('artifact_digest', artifact_digest), ('params', params), ('shards', shards)])
+    # Written last, so a work folder with a plan is always complete
+    with open(plan_path + '.tmp', 'w') as f:
+        json.dump(plan, f, indent=2)
+    os.rename(plan_path + '.tmp', plan_path)
+    logging.info('Split {} samples into {} shards in {}'.format(len(samples), len(shards), work_dir))
+    return plan
+
+
+def load_plan(work_dir: str) -> dict:
+    with open(work_path(work_dir, PLAN_FILENAME)) as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def task_phases(plan: dict) -> list:
+    """
+    :param plan: Plan returned by create_plan()
+    :return: List of phases, each a list of task names that can run at the same time
+    """
+    shard_indexes = range(len(plan['shards']))
+    return [['filter-{:03d}'.format(i) for i in shard_indexes],
+            ['learn'],
+            ['denoise-{:03d}'.format(i) for i in shard_indexes],
+            ['merge']]
+
+
+def task_command(work_dir: str, plan: dict, task: str, threads: int) -> list:
+    """
+    :param work_dir: Work folder
+    :param plan: Plan returned by create_plan()
+    :param task: Task name, see task_phases()
+    :param threads: Number of threads the task may use
+    :return: Command line running the task
+    """
+    params = plan['params']
+    filtered_f = work_path(work_dir, 'filtered', 'forward')
+    filtered_r = work_path(work_dir, 'filtered', 'reverse')
+    errors = work_path(work_dir, 'errors.rds')
+    step, _, shard = task.partition('-')
+    shard_path = work_path(work_dir, 'shards', 'shard-' + shard)
+
+    if step == 'filter':
+        args = [shard_path + '.tsv', filtered_f, filtered_r, shard_path + '.filter.tsv',
+                params['trunc_len_f'], params['trunc_len_r'], params['trim_left_f'], params['trim_left_r'],
+                params['max_ee'], TRUNC_Q]
+    elif step == 'learn':
+        args = [filtered_f, filtered_r, errors, N_READS_LEARN]
+    elif step == 'denoise':
+        args = [shard_path + '.tsv', filtered_f, filtered_r, errors, shard_path + '.rds',
+                shard_path + '.denoise.tsv']
+    elif step == 'merge':
+        seqtab_list = work_path(work_dir, 'seqtabs.txt')
+        with open(seqtab_list, 'w') as f:
+            for index in range(len(plan['shards'])):
+                f.write(work_path(work_dir, 'shards', 'shard-{:03d}.rds'.format(index)) + '\n')
+        args = [seqtab_list, params['chimera_method'], MIN_FOLD_PARENT_OVER_ABUNDANCE,
+                work_path(work_dir, 'seqtab.tsv'), work_path(work_dir, 'nonchimeric.tsv')]
+    else:
+        raise ValueError('Unknown task {}'.format(task))
+    return ['Rscript', SHARD_SCRIPT, step] + [str(arg) for arg in args + [threads]]
+
+
+def task_done(work_dir: str, task: str) -> bool:
+    return os.path.isfile(work_path(work_dir, 'done', task))
+
+
+def task_failed(work_dir: str, task: str) -> bool:
+    return os.path.isfile(work_path(work_dir, 'failed', task))
+
+
+def claim_owner(work_dir: str, task: str) -> str:
+    """
+    :return: 'host:pid' of the worker holding the claim on the task, or None if there is no (complete) claim
+    """
+    try:
+        with open(work_path(work_dir, 'claims', task, 'owner')) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def claim_stale(work_dir: str, task: str, claim_timeout: float = CLAIM_TIMEOUT) -> bool:
+    """
+    :param work_dir: Work folder
+    :param task: Task name
+    :param claim_timeout: Seconds without a heartbeat after which a claim from another host is considered abandoned
+    :return: True if the task is claimed by a worker that is no longer running it. Claims from this host are checked
+    by PID, claims from other hosts by the time of their last heartbeat.
+    """
+    claim_path = work_path(work_dir, 'claims', task)
+    owner = claim_owner(work_dir, task)
+    host, _, pid = (owner or '').rpartition(':')
+    if host == socket.gethostname() and pid.isdigit():
+        return not pid_alive(int(pid))
+    try:
+        # A claim without an owner yet is timed from the creation of its folder
+        heartbeat = os.path.getmtime(os.path.join(claim_path, 'owner') if owner else claim_path)
+    except FileNotFoundError:
+        return False
+    return time.time() - heartbeat > claim_timeout
+
+
+def break_claim(work_dir: str, task: str) -> bool:
+    """
+    Removes a stale claim. The claim is moved aside first and put back if it turns out to have been replaced by a
+    fresh claim in the meantime, so only one of several workers finding the same stale claim breaks it.
+
+    :return: True if the claim was removed
+    """
+    claim_path = work_path(work_dir, 'claims', task)
+    owner = claim_owner(work_dir, task)
+    stale_path = '{}.stale-{}-{}'.format(claim_path, socket.gethostname(), os.getpid())
+    try:
+        os.rename(claim_path, stale_path)
+    except OSError:
+        return False
+    try:
+        with open(os.path.join(stale_path, 'owner')) as f:
+            moved_owner = f.read().strip() or None
+    except FileNotFoundError:
+        moved_owner = None
+    if moved_owner != owner:
+        try:
+            os.rename(stale_path, claim_path)
+            return False
+        except OSError:
+            pass
+    shutil.rmtree(stale_path, ignore_errors=True)
+    return True
+
+
+def claim_task(work_dir: str, task: str, claim_timeout: float = CLAIM_TIMEOUT) -> bool:
+    """
+    :param work_dir: Work folder
+    :param task: Task name
+    :param claim_timeout: Seconds without a heartbeat after which a claim from another host is taken over
+    :return: True if this process now owns the task, False if another live worker holds it
+    """
+    claim_path = work_path(work_dir, 'claims', task)
+    try:
+        os.mkdir(claim_path)
+    except FileExistsError:
+        if not (claim_stale(work_dir, task, claim_timeout) and break_claim(work_dir, task)):
+            return False
+        try:
+            os.mkdir(claim_path)
+        except FileExistsError:
+            return False
+        logging.warning('Took over the stale claim on DADA2 task {}'.format(task))
+    with open(os.path.join(claim_path, 'owner'), 'w') as f:
+        f.write('{}:{}\n'.format(socket.gethostname(), os.getpid()))
+    return True
+
+
+def release_task(work_dir: str, task: str):
+    shutil.rmtree(work_path(work_dir, 'claims', task), ignore_errors=True)
+
+
+def clear_failures(work_dir: str):
+    """
+    Clears the failure markers left by an earlier attempt so those tasks are retried. Claims are left alone: live
+    workers keep theirs and stale ones are taken over by claim_task().
+    """
+    shutil.rmtree(work_path(work_dir, 'failed'), ignore_errors=True)
+    os.makedirs(work_path(work_dir, 'failed'), exist_ok=True)
+
+
+def call_with_heartbeat(command: list, owner_path: str, heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                        **kwargs) -> int:
+    """
+    Runs a command, touching owner_path every heartbeat_interval seconds until it exits
+
+    :return: Exit code of the command
+    """
+    process = subprocess.Popen(command, **kwargs)
+    while True:
+        try:
+            os.utime(owner_path)
+        except FileNotFoundError:
+            pass
+        try:
+            return process.wait(timeout=heartbeat_interval)
+        except subprocess.TimeoutExpired:
+            continue
+
+
+def run_task(work_dir: str, plan: dict, task: str, threads: int, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+             claim_timeout: float = CLAIM_TIMEOUT) -> bool:
+    """
+    Runs a task unless it is already done or claimed by another live worker, retrying it up to max_attempts times
+
+    :param work_dir: Work folder
+    :param plan: Plan returned by create_plan()
+    :param task: Task name, see task_phases()
+    :param threads: Number of threads the task may use
+    :param max_attempts: Number of times to try the task before marking it as failed
+    :param claim_timeout: Seconds without a heartbeat after which a claim from another host is taken over
+    :return: True if this worker ran the task to completion
+    """
+    if task_done(work_dir, task) or task_failed(work_dir, task) or not claim_task(work_dir, task, claim_timeout):
+        return False
+    log_path = work_path(work_dir, 'logs', task + '.log')
+    try:
+        for attempt in range(1, max_attempts + 1):
+            logging.info('Running DADA2 task {} (attempt {} of {})'.format(task, attempt, max_attempts))
+            with open(log_path, 'a') as log:
+                returncode = call_with_heartbeat(task_command(work_dir, plan, task, threads),
+                                                 work_path(work_dir, 'claims', task, 'owner'), stdout=log,
+                                                 stderr=subprocess.STDOUT)
+            if returncode == 0:
+                open(work_path(work_dir, 'done', task), 'w').close()
+                return True
+            logging.warning('DADA2 task {} failed with exit code {}. See {}'.format(task, returncode, log_path))
+        with open(work_path(work_dir, 'failed', task), 'w') as f:
+            f.write(log_path + '\n')
+        return False
+    finally:
+        release_task(work_dir, task)
+
+
+def wait_for_tasks(work_dir: str, plan: dict, tasks: list, poll_interval: float = POLL_INTERVAL,
+                   claim_timeout: float = CLAIM_TIMEOUT) -> list:
+    """
+    Waits until every task is done, including tasks being run by workers on other hosts, or until no live worker is
+    running some of the tasks that are not done
+
+    :return: List of the tasks that are neither done nor held by a live worker, empty once every task is done
+    :raises RuntimeError: if a task failed, naming the samples affected
+    """
+    while True:
+        failed = [task for task in tasks if task_failed(work_dir, task)]
+        if failed:
+            messages = []
+            for task in failed:
+                step, _, shard = task.partition('-')
+                samples = plan['shards'][int(shard)] if shard else ['all samples']
+                messages.append('{} ({}), see {}'.format(task, ', '.join(samples),
+                                                         work_path(work_dir, 'logs', task + '.log')))
+            raise RuntimeError('Sharded DADA2 tasks failed: {}. Re-run to retry them.'.format('; '.join(messages)))
+        pending = [task for task in tasks if not task_done(work_dir, task)]
+        if not pending:
+            return []
+        orphaned = [task for task in pending if not os.path.isdir(work_path(work_dir, 'claims', task)) or
+                    claim_stale(work_dir, task, claim_timeout)]
+        if orphaned:
+            return orphaned
+        time.sleep(poll_interval)
+
+
+def work(work_dir: str, workers: int = 1, cpu_count: int = None, max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+         poll_interval: float = POLL_INTERVAL, claim_timeout: float = CLAIM_TIMEOUT):
+    """
+    Runs the unclaimed tasks of a sharded run phase by phase until every task is done, taking over the tasks of
+    workers that stop
+
+    :param work_dir: Work folder set up by create_plan()
+    :param workers: Number of tasks to run at once on this host
+    :param cpu_count: Number of CPUs to split between the tasks running at once. Defaults to all CPUs.
+    :param max_attempts: Number of times to try each task before marking it as failed
+    :param poll_interval: Seconds between checks for tasks run by other workers
+    :param claim_timeout: Seconds without a heartbeat after which a claim from another host is taken over
+    """
+    plan = load_plan(work_dir)
+    if cpu_count is None:
+        cpu_count = multiprocessing.cpu_count()
+    for tasks in task_phases(plan):
+        n_workers = max(1, min(workers, len(tasks)))
+        threads = max(1, cpu_count // n_workers)
+        pending = tasks
+        while pending:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                list(executor.map(lambda task: run_task(work_dir, plan, task, threads, max_attempts, claim_timeout),
+                                  pending))
+            pending = wait_for_tasks(work_dir, plan, tasks, poll_interval, claim_timeout)
+
+
+def read_track(path: str) -> pd.DataFrame:
+    return pd.read_csv(path, sep='\t', index_col='sample', dtype={'sample': str})
+
+
+def load_results(work_dir: str, plan: dict) -> tuple:
+    """
+    :param work_dir: Work folder of a completed sharded run
+    :param plan: Plan returned by create_plan()
+    :return: Tuple of (DataFrame of counts with a row per sequence and a column per sample, DataFrame of denoising
+    stats indexed by sample ID with the columns of denoise_paired). Sequences are ordered by total count then
+    sequence and samples follow the plan.
+    """
+    seqtab = pd.read_csv(work_path(work_dir, 'seqtab.tsv'), sep='\t', index_col='sequence')
+    seqtab.columns = seqtab.columns.astype(str)
+    sample_ids = [sample_id for shard in plan['shards'] for sample_id in shard]
+    seqtab = seqtab[[sample_id for sample_id in sample_ids if sample_id in seqtab.columns]]
+    totals = seqtab.sum(axis=1)
+    order = sorted(range(len(seqtab)), key=lambda i: (-totals.iloc[i], seqtab.index[i]))
+    seqtab = seqtab.iloc[order]
+
+    shard_prefixes = [work_path(work_dir, 'shards', 'shard-{:03d}'.format(i)) for i in range(len(plan['shards']))]
+    filtered = pd.concat([read_track(prefix + '.filter.tsv') for prefix in shard_prefixes])
+    denoised = pd.concat([read_track(prefix + '.denoise.tsv') for prefix in shard_prefixes])
+    nonchimeric = read_track(work_path(work_dir, 'nonchimeric.tsv'))
+    stats = filtered.join(denoised).join(nonchimeric).reindex(sample_ids).fillna(0).astype(int)
+    for column, count_column in [(PASSED_FILTER, 'filtered'), (MERGED, 'merged'), (NON_CHIMERIC, 'non-chimeric')]:
+        stats[column] = (stats[count_column] / stats['input'] * 100).fillna(0).round(2)
+    stats = stats[STATS_COLUMNS]
+    stats.index.name = 'sample-id'
+    return seqtab, stats
+
+
+def denoise_sharded(base_dir, data_artifact_path, trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, max_ee=2,
+                    chimera_method='consensus', cpu_count=None, shard_size=DEFAULT_SHARD_SIZE, work_dir=None,
+                    workers=None, max_attempts=DEFAULT_MAX_ATTEMPTS):
+    """
+    Sharded equivalent of qiime2_pipeline.dada2_qc(), saving the same artifacts
+
+    :param base_dir: Main working directory filepath
+    :param data_artifact_path: Path to the SampleData[PairedEndSequencesWithQuality] .qza
+    :param trim_left_f: Number of bases to trim from 5' of forward read
+    :param trim_left_r: Number of bases to trim from 5' of reverse read
+    :param trunc_len_f: Number of bases for forward read truncation
+    :param trunc_len_r: Number of bases for reverse read truncation
+    :param max_ee: number of errors allowed before rejecting a read
+    :param chimera_method: Method for chimera detection
+    :param cpu_count: Number of CPUs to split between the shards running at once
+    :param shard_size: Maximum number of samples per shard
+    :param work_dir: Work folder, which other hosts can join. Defaults to a dada2_shards folder in base_dir that is
+    removed once the run completes.
+    :param workers: Number of shards to run at once on this host. Defaults to one per CPU, up to the number of shards.
+    :param max_attempts: Number of times to try each task before giving up
+    :return: QIIME2/DADA2 filtered table and representative sequences objects
+    """
+    import biom
+    import qiime2
+
+    logging.info('Running sharded DADA2 ({} samples per shard)...'.format(shard_size))
+    if cpu_count is None:
+        cpu_count = multiprocessing.cpu_count() - 1
+    keep_work_dir = work_dir is not None
+    if work_dir is None:
+        work_dir = os.path.join(base_dir, 'dada2_shards')
+
+    params = OrderedDict([('trim_left_f', trim_left_f), ('trim_left_r', trim_left_r),
+                          ('trunc_len_f', trunc_len_f), ('trunc_len_r', trunc_len_r),
+                          ('max_ee', max_ee), ('chimera_method', chimera_method)])
+    plan = create_plan(work_dir, data_artifact_path, params, shard_size=shard_size)
+    clear_failures(work_dir)
+    work(work_dir, workers=workers or cpu_count, cpu_count=cpu_count, max_attempts=max_attempts)
+
+    seqtab, stats = load_results(work_dir, plan)
+    feature_ids = [run_merger.sequence_digest(sequence) for sequence in seqtab.index]
+    dada2_filtered_table = qiime2.Artifact.import_data(
+        'FeatureTable[Frequency]', biom.Table(seqtab.values, feature_ids, list(seqtab.columns)))
+    dada2_filtered_rep_seqs = qiime2.Artifact.import_data(
+        'FeatureData[Sequence]', pd.Series(list(seqtab.index), index=feature_ids))
+
+    # Save artifacts
+    dada2_filtered_table.save(os.path.join(base_dir, 'table-dada2.qza'))
+    dada2_filtered_rep_seqs.save(os.path.join(base_dir, 'rep-seqs-dada2.qza'))
+    try:
+        denoising_stats = qiime2.Artifact.import_data('SampleData[DADA2Stats]', qiime2.Metadata(stats))
+        denoising_stats.save(os.path.join(base_dir, 'dada2-denoising-stats.qza'))
+    except:
+        logging.info("Couldn't save DADA2 denoising stats")
+    stats.to_csv(os.path.join(base_dir, 'dada2-denoising-stats.tsv'), sep='\t')
+
+    if not keep_work_dir:
+        shutil.rmtree(work_dir)
+    logging.info('Completed running sharded DADA2')
+
+    return dada2_filtered_table, dada2_filtered_rep_seqs
+
+
+@click.command()
+@click.option('-w', '--work_dir',
+              type=click.Path(exists=True),
+              required=True,
+              help='Work folder of a sharded DADA2 run, as given to ampliconpipeline.py with --dada2_shard_dir')
+@click.option('-n', '--cpus',
+              type=click.INT,
+              default=None,
+              help='Number of CPUs to use on this host. Defaults to all CPUs.')
+@click.option('--workers',
+              type=click.INT,
+              default=None,
+              help='Number of shards to run at once on this host. Defaults to one per CPU.')
+def cli(work_dir, cpus, workers):
+    """
+    Joins a sharded DADA2 run from another host, running tasks no other worker has claimed
+    """
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    if cpus is None:
+        cpus = multiprocessing.cpu_count()
+    work(work_dir, workers=workers or cpus, cpu_count=cpus)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,294 @@
+"""
+Out-of-core Bray-Curtis and Jaccard distance matrices for studies with many thousands of samples.
+
+The distance matrix is computed one block of samples against another and written straight into a memory-mapped .npy
+file, so only a pair of blocks of the table is ever dense in memory. Each block only uses the features observed in its
+two sample blocks. The tests and ordination that follow read the matrix back a block of rows at a time:
+
+- PERMANOVA sums the squared distances within the groups of every permutation block by block, which gives the same
+  pseudo-F statistic as scikit-bio's permanova
+- PCoA finds the leading eigenvectors of the centered matrix with scipy's eigsh (Lanczos), which only needs products of
+  the matrix with a vector, so the n x n centered matrix is never built
+"""
+
+import os
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from scipy.sparse import linalg
+from scipy.spatial.distance import cdist
+from collections import OrderedDict
+
+METRICS = ['braycurtis', 'jaccard']
+DEFAULT_BLOCK_SIZE = 500
+DEFAULT_PERMUTATIONS = 999
+DEFAULT_DIMENSIONS = 10
+
+
+def ids_path(matrix_path: str) -> str:
+    """
+    :param matrix_path: Path to a distance matrix .npy file
+    :return: Path to the text file listing the sample IDs of its rows
+    """
+    return os.path.splitext(matrix_path)[0] + '.ids.txt'
+
+
+def block_bounds(n: int, block_size: int = DEFAULT_BLOCK_SIZE) -> list:
+    """
+    :return: List of (start, stop) tuples splitting range(n) into blocks of block_size
+    """
+    return [(start, min(start + block_size, n)) for start in range(0, n, block_size)]
+
+
+def block_distances(rows, columns, metric: str) -> np.ndarray:
+    """
+    :param rows: scipy sparse matrix of counts with a sample per row
+    :param columns: scipy sparse matrix of counts with a sample per row, over the same features as rows
+    :param metric: 'braycurtis', or 'jaccard' (on presence/absence)
+    :return: Dense array of the distances between every sample of rows and every sample of columns
+    """
+    # Features absent from both blocks add nothing to either metric
+    features = np.union1d(rows.indices, columns.indices)
+    rows = rows[:, features].toarray()
+    columns = columns[:, features].toarray()
+    if metric == 'jaccard':
+        rows = rows > 0
+        columns = columns > 0
+    elif metric != 'braycurtis':
+        raise ValueError('Unsupported metric {}, expected one of {}'.format(metric, METRICS))
+    return cdist(rows, columns, metric=metric)
+
+
+def write_block(matrix_path: str, matrix, metric: str, row_bounds: tuple, column_bounds: tuple):
+    """
+    Computes a block of the distance matrix and writes it and its mirror image into the memory-mapped matrix
+
+    :param matrix_path: Path to the .npy distance matrix, created by blockwise_distances()
+    :param matrix: scipy sparse CSR matrix of counts with a sample per row
+    :param metric: Distance metric, see block_distances()
+    :param row_bounds: (start, stop) of the samples of the block's rows
+    :param column_bounds: (start, stop) of the samples of the block's columns
+    """
+    rows = slice(*row_bounds)
+    columns = slice(*column_bounds)
+    distances = block_distances(matrix[rows], matrix[columns], metric)
+    out = np.load(matrix_path, mmap_mode='r+')
+    out[rows, columns] = distances
+    out[columns, rows] = distances.T
+    out.flush()
+    del out
+
+
+def _init_distance_worker(matrix_path, matrix, metric):
+    global _worker_data
+    _worker_data = (matrix_path, matrix, metric)
+
+
+def _write_block_worker(bounds):
+    matrix_path, matrix, metric = _worker_data
+    write_block(matrix_path, matrix, metric, *bounds)
+
+
+def blockwise_distances(matrix, sample_ids: list, out_path: str, metric: str,
+                        block_size: int = DEFAULT_BLOCK_SIZE, processes: int = None) -> str:
+    """
+    :param matrix: scipy sparse matrix of counts with features as rows and samples as columns, e.g. the matrix_data
+    of a rarefied biom.Table
+    :param sample_ids: Sample IDs of the columns
+    :param out_path: Path to write the .npy distance matrix to. The sample IDs are written next to it, see ids_path().
+    :param metric: 'braycurtis' or 'jaccard'
+    :param block_size: Number of samples per block
+    :param processes: Number of blocks computed in parallel. Defaults to all CPUs.
+    :return: out_path
+    """
+    if metric not in METRICS:
+        raise ValueError('Unsupported metric {}, expected one of {}'.format(metric, METRICS))
+    matrix = sparse.csr_matrix(matrix.T, dtype=float)
+    n = matrix.shape[0]
+    if len(sample_ids) != n:
+        raise ValueError('Got {} sample IDs for {} samples'.format(len(sample_ids), n))
+
+    out = np.lib.format.open_memmap(out_path, mode='w+', dtype=np.float64, shape=(n, n))
+    out.flush()
+    del out
+    with open(ids_path(out_path), 'w') as f:
+        f.write(''.join('{}\n'.format(sample_id) for sample_id in sample_ids))
+
+    # Upper triangle of blocks only, every block also fills its mirror image
+    bounds = block_bounds(n, block_size)
+    blocks = [(bounds[i], bounds[j]) for i in range(len(bounds)) for j in range(i, len(bounds))]
+    processes = min(processes or multiprocessing.cpu_count(), len(blocks))
+    logging.debug('Computing {} distances of {} samples in {} blocks'.format(metric, n, len(blocks)))
+
+    if processes > 1:
+        # Spawned rather than forked: the pipeline calls this from the stage scheduler's threads
+        with multiprocessing.get_context('spawn').Pool(processes, initializer=_init_distance_worker,
+                                                       initargs=(out_path, matrix, metric)) as pool:
+            pool.map(_write_block_worker, blocks)
+    else:
+        for row_bounds, column_bounds in blocks:
+            write_block(out_path, matrix, metric, row_bounds, column_bounds)
+    return out_path
+
+
+def open_distance_matrix(matrix_path: str) -> tuple:
+    """
+    :param matrix_path: Path to a distance matrix written by blockwise_distances()
+    :return: Tuple of (read-only memory-mapped distance matrix, list of sample IDs)
+    """
+    with open(ids_path(matrix_path)) as f:
+        sample_ids = [line.rstrip('\n') for line in f]
+    return np.load(matrix_path, mmap_mode='r'), sample_ids
+
+
+def permanova(distance_matrix, grouping, permutations: int = DEFAULT_PERMUTATIONS, seed: int = 0,
+              block_size: int = DEFAULT_BLOCK_SIZE) -> OrderedDict:
+    """
+    PERMANOVA read a block of rows at a time, with the statistic and p-value defined as in scikit-bio's permanova
+
+    :param distance_matrix: Square distance matrix, typically memory-mapped by open_distance_matrix()
+    :param grouping: Group of every sample of the matrix
+    :param permutations: Number of permutations of the grouping the p-value is computed from
+    :param seed: Seed of the permutations
+    :param block_size: Number of rows read at a time
+    :return: OrderedDict with the sample size, number of groups, test statistic (pseudo-F), p-value and permutations
+    """
+    groups, codes = np.unique(np.asarray(grouping), return_inverse=True)
+    n = len(codes)
+    k = len(groups)
+    if k < 2 or k >= n:
+        raise ValueError('PERMANOVA needs at least two groups and a group with more than one sample, got {} samples in '
+                         '{} groups'.format(n, k))
+
+    def groupings():
+        # The permutations are drawn again for every block rather than kept in memory
+        random_state = np.random.RandomState(seed)
+        yield codes
+        for _ in range(permutations):
+            yield random_state.permutation(codes)
+
+    sizes = np.bincount(codes, minlength=k).astype(float)
+    indicator = np.eye(k)
+
+    # Sums of the squared distances of every row to the rest of its group, for the grouping and every permutation
+    total = 0.0
+    within = np.zeros(permutations + 1)
+    for start, stop in block_bounds(n, block_size):
+        squared = np.asarray(distance_matrix[start:stop], dtype=float) ** 2
+        total += squared.sum()
+        rows = np.arange(stop - start)
+        for i, permuted_codes in enumerate(groupings()):
+            row_codes = permuted_codes[start:stop]
+            group_sums = squared.dot(indicator[permuted_codes])
+            within[i] += (group_sums[rows, row_codes] / sizes[row_codes]).sum()
+
+    # Every pair of samples is counted twice
+    s_total = total / 2 / n
+    s_within = within / 2
+    f_stats = ((s_total - s_within) / (k - 1)) / (s_within / (n - k))
+    p_value = (np.sum(f_stats[1:] >= f_stats[0]) + 1) / (permutations + 1) if permutations else np.nan
+    return OrderedDict([
+        ('sample size', n),
+        ('number of groups', k),
+        ('test statistic', f_stats[0]),
+        ('p-value', p_value),
+        ('number of permutations', permutations),
+    ])
+
+
+class _SubsetMatrix:
+    """
+    Rows and columns of a distance matrix restricted to a subset of its samples, read a block of rows at a time
+    """
+
+    def __init__(self, distance_matrix, indices):
+        self.distance_matrix = distance_matrix
+        self.indices = np.asarray(indices)
+
+    def __getitem__(self, rows):
+        return self.distance_matrix[self.indices[rows]][:, self.indices]
+
+
+def group_significance(distance_matrix, sample_ids: list, grouping: pd.Series, pairwise: bool = True,
+                       permutations: int = DEFAULT_PERMUTATIONS, block_size: int = DEFAULT_BLOCK_SIZE) -> pd.DataFrame:
+    """
+    PERMANOVA of all groups, and optionally of every pair of groups, as in QIIME 2's beta_group_significance
+
+    :param distance_matrix: Square distance matrix, typically memory-mapped by open_distance_matrix()
+    :param sample_ids: Sample IDs of the rows of the matrix
+    :param grouping: Series of the group of every sample, indexed by sample ID. Samples without a group are left out.
+    :param pairwise: Also test every pair of groups
+    :param permutations: Number of permutations of every test
+    :param block_size: Number of rows read at a time
+    :return: DataFrame with the columns group_1, group_2, sample_size, permutations, pseudo_f and p_value. The test of
+    all groups is the first row, with group_1 and group_2 set to 'all'.
+    """
+    grouping = grouping.reindex(sample_ids)
+    indices = np.flatnonzero(grouping.notnull().values)
+    groups = grouping.values[indices].astype(str)
+
+    tests = [('all', 'all', indices, groups)]
+    if pairwise:
+        labels = sorted(set(groups))
+        for i, group_1 in enumerate(labels):
+            for group_2 in labels[i + 1:]:
+                in_pair = (groups == group_1) | (groups == group_2)
+                tests.append((group_1, group_2, indices[in_pair], groups[in_pair]))
+
+    rows = []
+    for group_1, group_2, test_indices, test_groups in tests:
+        result = permanova(_SubsetMatrix(distance_matrix, test_indices), test_groups, permutations=permutations,
+                           block_size=block_size)
+        rows.append(OrderedDict([
+            ('group_1', group_1),
+            ('group_2', group_2),
+            ('sample_size', result['sample size']),
+            ('permutations', result['number of permutations']),
+            ('pseudo_f', result['test statistic']),
+            ('p_value', result['p-value']),
+        ]))
+    return pd.DataFrame(rows)
+
+
+def pcoa(distance_matrix, dimensions: int = DEFAULT_DIMENSIONS, block_size: int = DEFAULT_BLOCK_SIZE) -> tuple:
+    """
+    Principal coordinate analysis of the leading dimensions, reading the matrix a block of rows at a time
+
+    :param distance_matrix: Square distance matrix, typically memory-mapped by open_distance_matrix()
+    :param dimensions: Number of principal coordinates to compute. At most one less than the number of samples.
+    :param block_size: Number of rows read at a time
+    :return: Tuple of (eigenvalues, samples x dimensions coordinates, proportion of the variation explained by every
+    dimension), sorted by decreasing eigenvalue
+    """
+    n = distance_matrix.shape[0]
+    if n < 3:
+        raise ValueError('PCoA needs at least 3 samples, got {}'.format(n))
+    dimensions = min(dimensions, n - 1)
+    bounds = block_bounds(n, block_size)
+
+    def squared_product(vector):
+        product = np.empty(n)
+        for start, stop in bounds:
+            product[start:stop] = (np.asarray(distance_matrix[start:stop], dtype=float) ** 2).dot(vector)
+        return product
+
+    def centered_product(vector):
+        # Product with -0.5 * J * D^2 * J, where J = I - 1/n is the centering matrix
+        vector = np.ravel(vector)
+        product = squared_product(vector - vector.mean())
+        return -0.5 * (product - product.mean())
+
+    operator = linalg.LinearOperator((n, n), matvec=centered_product, dtype=float)
+    eigvals, eigvecs = linalg.eigsh(operator, k=dimensions, which='LA')
+    order = np.argsort(eigvals)[::-1]
+    eigvals = eigvals[order]
+    eigvecs = eigvecs[:, order]
+
+    # The eigenvalues of the centered matrix sum to its trace, sum(D^2) / 2n
+    trace = sum((np.asarray(distance_matrix[start:stop], dtype=float) ** 2).sum() for start, stop in bounds) / 2 / n
+    coordinates = eigvecs * np.sqrt(np.clip(eigvals, 0, None))
+    return eigvals, coordinates, eigvals / trace
@@ -0,0 +1,166 @@
+"""
+Benchmark of the beta diversity distance matrices computed by run_diversity_metrics() at different job counts.
+
+The table of a finished run is rarefied once, then unweighted and weighted UniFrac (Striped UniFrac), Bray-Curtis and
+Jaccard are computed with every requested job count. Each matrix is compared to the single job result (the serial
+path run_diversity_metrics() used before), so the report shows both the speedup and that the distances are unchanged.
+Given the run's metadata, core_metrics_phylogenetic as a whole is timed too. It rarefies the table again on every call,
+so only its timing is compared.
+
+Usage:
+    python -m bin.diversity_benchmark -i OUTDIR/qiime2 -j 1,4,16 -m METADATA.tsv -o diversity_benchmark.json
+"""
+
+import os
+import json
+import time
+import click
+import logging
+import multiprocessing
+
+import numpy as np
+
+from collections import OrderedDict
+
+PHYLOGENETIC_METRICS = ['unweighted_unifrac', 'weighted_unifrac']
+NON_PHYLOGENETIC_METRICS = ['braycurtis', 'jaccard']
+
+
+def time_call(func, repeats: int = 1) -> tuple:
+    """
+    :param func: Callable without arguments
+    :param repeats: Number of times to call func
+    :return: Tuple of (fastest wall time in seconds, result of the last call)
+    """
+    timings = []
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def benchmark_summary(timings: dict, differences: dict) -> list:
+    """
+    :param timings: Dictionary of {metric: {job count: seconds}}, including a job count of 1 for every metric
+    :param differences: Dictionary of {metric: {job count: largest absolute difference to the single job matrix}}
+    :return: List of OrderedDicts with the metric, jobs, seconds, speedup over a single job and max_difference
+    """
+    rows = []
+    for metric, metric_timings in timings.items():
+        for jobs in sorted(metric_timings):
+            rows.append(OrderedDict([
+                ('metric', metric),
+                ('jobs', jobs),
+                ('seconds', round(metric_timings[jobs], 3)),
+                ('speedup', round(metric_timings[1] / metric_timings[jobs], 2) if metric_timings[jobs] else None),
+                ('max_difference', differences.get(metric, {}).get(jobs)),
+            ]))
+    return rows
+
+
+def benchmark_distances(table_path: str, tree_path: str, job_counts: list, sampling_depth: int = None,
+                        repeats: int = 1, metadata_path: str = None) -> list:
+    """
+    :param table_path: Path to a FeatureTable[Frequency] artifact, e.g. table-dada2.qza
+    :param tree_path: Path to a Phylogeny[Rooted] artifact, e.g. rooted-tree.qza
+    :param job_counts: Job counts to benchmark. A single job is always included as the baseline.
+    :param sampling_depth: Depth the table is rarefied to. Defaults to 10% of the deepest sample, as in
+    run_diversity_metrics().
+    :param repeats: Number of times each computation is timed. The fastest time is reported.
+    :param metadata_path: Path to the run's sample metadata. When given, core_metrics_phylogenetic is timed too and
+    reported as the 'core_metrics_phylogenetic' metric.
+    :return: Rows of benchmark_summary()
+    """
+    import qiime2
+    import skbio
+    from qiime2.plugins import diversity, feature_table
+    from bin.qiime2_pipeline import calculate_maximum_depth
+
+    table = qiime2.Artifact.load(table_path)
+    tree = qiime2.Artifact.load(tree_path)
+    if sampling_depth is None:
+        sampling_depth = int(calculate_maximum_depth(table) * 0.1)
+    rarefied = feature_table.methods.rarefy(table=table, sampling_depth=sampling_depth).rarefied_table
+    job_counts = sorted(set([1] + list(job_counts)))
+
+    def distance_func(metric, jobs):
+        if metric in PHYLOGENETIC_METRICS:
+            return lambda: diversity.methods.beta_phylogenetic(table=rarefied, phylogeny=tree, metric=metric,
+                                                               n_jobs=jobs).distance_matrix
+        return lambda: diversity.methods.beta(table=rarefied, metric=metric, n_jobs=jobs).distance_matrix
+
+    timings = OrderedDict()
+    differences = OrderedDict()
+    for metric in PHYLOGENETIC_METRICS + NON_PHYLOGENETIC_METRICS:
+        timings[metric] = OrderedDict()
+        differences[metric] = OrderedDict()
+        baseline = None
+        for jobs in job_counts:
+            seconds, distance_matrix = time_call(distance_func(metric, jobs), repeats=repeats)
+            data = distance_matrix.view(skbio.DistanceMatrix).data
+            if baseline is None:
+                baseline = data
+            timings[metric][jobs] = seconds
+            differences[metric][jobs] = float(np.abs(data - baseline).max()) if data.size else 0.0
+            logging.info('{} with {} job(s): {:.2f} s'.format(metric, jobs, seconds))
+
+    if metadata_path is not None:
+        timings['core_metrics_phylogenetic'] = OrderedDict()
+        metadata = qiime2.Metadata.load(metadata_path)
+        for jobs in job_counts:
+            seconds, _ = time_call(lambda: diversity.pipelines.core_metrics_phylogenetic(
+                table=table, phylogeny=tree, sampling_depth=sampling_depth, metadata=metadata, n_jobs=jobs),
+                repeats=repeats)
+            timings['core_metrics_phylogenetic'][jobs] = seconds
+            logging.info('core_metrics_phylogenetic with {} job(s): {:.2f} s'.format(jobs, seconds))
+
+    return benchmark_summary(timings, differences)
+
+
+@click.command()
+@click.option('-i', '--input_dir',
+              type=click.Path(exists=True, file_okay=False),
+              required=True,
+              help='qiime2 folder of an ampliconpipeline.py run, containing table-dada2.qza and rooted-tree.qza.')
+@click.option('-j', '--jobs',
+              default='1,{}'.format(multiprocessing.cpu_count()),
+              show_default=True,
+              help='Comma-separated job counts to benchmark.')
+@click.option('-d', '--sampling_depth',
+              type=click.INT,
+              default=None,
+              help='Depth the table is rarefied to. Defaults to 10% of the deepest sample.')
+@click.option('-r', '--repeats',
+              type=click.INT,
+              default=1,
+              show_default=True,
+              help='Number of times each computation is timed. The fastest time is reported.')
+@click.option('-o', '--out_path',
+              type=click.Path(),
+              default=None,
+              help='Path to write the results to as JSON.')
+@click.option('-m', '--metadata',
+              type=click.Path(exists=True),
+              default=None,
+              help='Sample metadata of the run. When given, core_metrics_phylogenetic is timed as a whole too.')
+def cli(input_dir, jobs, sampling_depth, repeats, out_path, metadata):
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    rows = benchmark_distances(os.path.join(input_dir, 'table-dada2.qza'), os.path.join(input_dir, 'rooted-tree.qza'),
+                               job_counts=[int(x) for x in jobs.split(',')], sampling_depth=sampling_depth,
+                               repeats=repeats, metadata_path=metadata)
+
+    click.echo('{:<28}{:>6}{:>12}{:>10}{:>16}'.format('metric', 'jobs', 'seconds', 'speedup', 'max_difference'))
+    for row in rows:
+        click.echo('{:<28}{:>6}{:>12}{:>10}{:>16}'.format(*[str(value) for value in row.values()]))
+    if out_path is not None:
+        with open(out_path, 'w') as f:
+            json.dump(rows, f, indent=2)
+
+
+if __name__ == '__main__':
+    cli()
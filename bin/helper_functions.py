@@ -1,8 +1,22 @@
 import os
+import re
 import glob
+import json
+import shutil
+import hashlib
 import logging
 import subprocess
 
+from collections import OrderedDict
+from bin import profiling
+
+# Matches Illumina/CASAVA style names, e.g. 2017-SEQ-1114_S1_L001_R1_001.fastq.gz. The sample_id and read groups are
+# required; lane is optional and defaults to '001' when absent.
+DEFAULT_FASTQ_PATTERN = r'^(?P<sample_id>[^_]+)_(?:.*?_)?(?:L(?P<lane>\d+)_)?(?P<read>R[12])(?:_\d+)?\.fastq\.gz$'
+
+# Directory listings of run folders are cached here, keyed by directory path and invalidated by the directory mtime
+SCAN_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'AmpliconPipeline', 'fastq_scans')
+
 
 def retrieve_fastqgz(directory: str) -> list:
     """
@@ -38,21 +52,130 @@ def retrieve_unique_sampleids(fastq_file_list: list) -> list:
     :return: List of valid OLC Sample IDs
     """
     logging.info('Scanning for valid OLC sample IDs')
-    # Iterate through all of the fastq files and grab the sampleID, append to list
-    sample_id_list = list()
-    for f in fastq_file_list:
-        sample_id_list.append(os.path.basename(f).split('_')[0])  # TODO: Revisit all of this read pairing junk
+    # Sample ID is the first element of the filename when split on "_"
+    sample_id_list = list(set(os.path.basename(f).split('_')[0] for f in fastq_file_list))
+    return sample_id_list
 
-    # Get unique sample IDs
-    sample_id_list = list(set(sample_id_list))
 
-    return sample_id_list
+def scan_fastq_directory(directory: str, cache_dir: str = SCAN_CACHE_DIR) -> list:
+    """
+    Lists the .fastq.gz files in a run directory with a single os.scandir() pass. The listing is cached in cache_dir
+    and reused as long as the directory's mtime is unchanged (adding, removing or renaming files updates it), so
+    repeat invocations on the same run folder only stat the directory instead of re-listing it.
+
+    :param directory: Path to folder containing output from MiSeq run
+    :param cache_dir: Folder to cache listings in. Pass None to disable caching.
+    :return: Sorted list of .fastq.gz filenames (not paths) in directory
+    """
+    directory = os.path.abspath(directory)
+    directory_mtime = os.stat(directory).st_mtime_ns
+
+    cache_path = None
+    if cache_dir is not None:
+        cache_path = os.path.join(cache_dir, hashlib.sha1(directory.encode('utf-8')).hexdigest() + '.json')
+        try:
+            with open(cache_path, 'r') as f:
+                cached_scan = json.load(f)
+            if cached_scan['directory'] == directory and cached_scan['mtime_ns'] == directory_mtime:
+                logging.debug('Using cached listing of {}'.format(directory))
+                return cached_scan['filenames']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    filenames = sorted(entry.name for entry in os.scandir(directory)
+                       if entry.name.endswith('.fastq.gz') and entry.is_file())
+
+    if cache_path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_path, 'w') as f:
+                json.dump({'directory': directory, 'mtime_ns': directory_mtime, 'filenames': filenames}, f)
+        except OSError as e:
+            logging.debug('Could not cache listing of {}: {}'.format(directory, e))
+
+    return filenames
+
+
+def index_fastq_files(fastq_file_list: list, pattern: str = DEFAULT_FASTQ_PATTERN) -> tuple:
+    """
+    Builds an index of sample ID -> lane -> read direction in a single pass over the file list.
+
+    :param fastq_file_list: List of fastq.gz file paths
+    :param pattern: Regular expression matched against each basename. Must define the named groups sample_id and
+    read (matching R1 or R2), and may define lane.
+    :return: Tuple of (index, orphans). index is an OrderedDict of {sample_id: OrderedDict({lane: {'R1': path,
+    'R2': path}})} containing only complete pairs, sorted by sample ID and lane. orphans is a list of the paths that
+    didn't match the pattern, duplicated another file, or are missing their mate.
+    """
+    regex = re.compile(pattern)
+    found = {}
+    orphans = []
+    for filepath in fastq_file_list:
+        match = regex.match(os.path.basename(filepath))
+        if match is None:
+            orphans.append(filepath)
+            continue
+        groups = match.groupdict()
+        lane = groups.get('lane') or '001'
+        reads = found.setdefault(groups['sample_id'], {}).setdefault(lane, {})
+        if groups['read'] in reads:
+            orphans.append(filepath)
+        else:
+            reads[groups['read']] = filepath
+
+    index = OrderedDict()
+    for sample_id in sorted(found):
+        for lane in sorted(found[sample_id]):
+            reads = found[sample_id][lane]
+            if 'R1' in reads and 'R2' in reads:
+                index.setdefault(sample_id, OrderedDict())[lane] = reads
+            else:
+                orphans.extend(reads.values())
+
+    return index, sorted(orphans)
+
+
+def index_fastq_directory(directory: str, pattern: str = DEFAULT_FASTQ_PATTERN,
+                          cache_dir: str = SCAN_CACHE_DIR) -> tuple:
+    """
+    :param directory: Path to folder containing output from MiSeq run
+    :param pattern: Filename regular expression, see index_fastq_files()
+    :param cache_dir: Folder to cache directory listings in, see scan_fastq_directory()
+    :return: Tuple of (index, orphans) as returned by index_fastq_files()
+    """
+    fastq_file_list = [os.path.join(directory, filename)
+                       for filename in scan_fastq_directory(directory, cache_dir=cache_dir)]
+    index, orphans = index_fastq_files(fastq_file_list, pattern=pattern)
+    logging.info('Indexed {} paired samples from {} .fastq.gz files in {}'.format(len(index), len(fastq_file_list),
+                                                                                 directory))
+    if orphans:
+        logging.warning('{} .fastq.gz file(s) could not be paired and will be skipped:'.format(len(orphans)))
+        for orphan in orphans:
+            logging.warning('    {}'.format(orphan))
+    return index, orphans
+
+
+def sample_dictionary_from_index(index: dict) -> dict:
+    """
+    :param index: Index generated by index_fastq_files()
+    :return: Dictionary with each Sample ID as a key and [R1, R2] as values. For samples sequenced over several lanes,
+    R1 and R2 are tuples containing the file for each lane in lane order.
+    """
+    sample_dictionary = OrderedDict()
+    for sample_id, lanes in index.items():
+        if len(lanes) == 1:
+            reads = list(lanes.values())[0]
+            sample_dictionary[sample_id] = [reads['R1'], reads['R2']]
+        else:
+            sample_dictionary[sample_id] = [tuple(reads['R1'] for reads in lanes.values()),
+                                            tuple(reads['R2'] for reads in lanes.values())]
+    return sample_dictionary
 
 
 def get_readpair(sample_id: str, fastq_file_list: list, forward_id='_R1', reverse_id='_R2') -> list:
     """
-    This needs to be reworked at some point. Right now it assumes the SampleID is the first element if splitting
-    the file name by an "_" character, which seems like a reasonable assumption, but other delimiters might be used.
+    Retrieves the read pair of a single sample. To pair every sample in a run, use index_fastq_files(), which
+    pairs all of them in one pass instead of rescanning the file list for each sample.
 
     :param sample_id: String of a valid OLC ID
     :param fastq_file_list: List of fastq.gz file paths generated by retrieve_fastqgz()
@@ -80,26 +203,22 @@ def populate_sample_dictionary(sample_id_list: list, fastq_file_list: list) -> d
     :param fastq_file_list: List of fastq.gz file paths generated by retrieve_fastqgz()
     :return: dictionary with each Sample ID as a key and the read pairs as values
     """
-
-    # Find file pairs for each unique sample ID
-    sample_dictionary = {}
-    for sample_id in sample_id_list:
-        read_pair = get_readpair(sample_id, fastq_file_list)
-        sample_dictionary[sample_id] = read_pair
-    return sample_dictionary
+    index, orphans = index_fastq_files(fastq_file_list)
+    sample_dictionary = sample_dictionary_from_index(index)
+    return {sample_id: sample_dictionary.get(sample_id) for sample_id in sample_id_list}
 
 
-def get_sample_dictionary(directory: str) -> dict:
+def get_sample_dictionary(directory: str, pattern: str = DEFAULT_FASTQ_PATTERN) -> dict:
     """
-    Chains several functions together to create a sample dictionary with unique/valid sample IDs as keys
-    and paths to forward and reverse reads as values
+    Creates a sample dictionary with unique/valid sample IDs as keys and paths to forward and reverse reads as values
+    from a single (cached) scan of the directory
+
     :param directory: Path to a directory containing .fastq.gz files
+    :param pattern: Filename regular expression, see index_fastq_files()
     :return: Validated sample dictionary with sample_ID:R1,R2 structure
     """
-    fastq_file_list = retrieve_fastqgz(directory)
-    sample_id_list = retrieve_unique_sampleids(fastq_file_list)
-    sample_dictionary = populate_sample_dictionary(sample_id_list, fastq_file_list)
-    return sample_dictionary
+    index, orphans = index_fastq_directory(directory, pattern=pattern)
+    return sample_dictionary_from_index(index)
 
 
 def append_dummy_barcodes(path: str):
@@ -109,6 +228,9 @@ def append_dummy_barcodes(path: str):
     :param path: Path to .fastq.gz file
     """
     for file in retrieve_fastqgz(path):
+        # Files renamed by a previous (resumed) setup already carry the dummy barcode
+        if '_00_S' in os.path.basename(file):
+            continue
         os.rename(os.path.abspath(file), os.path.abspath(file).replace('_S', '_00_S'))
     logging.info('Added dummy barcodes to all valid OLC *.fastq.gz files in {}'.format(path))
 
@@ -117,51 +239,105 @@ def create_symlink(target, destination_folder):
     os.symlink(target, os.path.join(destination_folder, os.path.basename(target)))
 
 
+def concatenate_lanes(lane_files: tuple, destination_folder: str) -> str:
+    """
+    Merges the per-lane .fastq.gz files of one read direction into a single file named after the first lane.
+    Concatenated gzip members form a valid gzip file, so no recompression is needed.
+
+    :param lane_files: Tuple of .fastq.gz paths, one per lane, in lane order
+    :param destination_folder: Folder to write the merged file to
+    :return: Path to the merged file
+    """
+    merged_path = os.path.join(destination_folder, os.path.basename(lane_files[0]))
+    with open(merged_path, 'wb') as merged:
+        for lane_file in lane_files:
+            with open(lane_file, 'rb') as f:
+                shutil.copyfileobj(f, merged)
+    return merged_path
+
+
 def symlink_dictionary(sample_dictionary: dict, destination_folder: str):
     """
-    :param sample_dictionary: Dictionary created with get_sample_dictionary()
+    :param sample_dictionary: Dictionary created with get_sample_dictionary(). Samples sequenced over several lanes
+    have their lanes concatenated into destination_folder instead of being symlinked.
     :param destination_folder: Path to folder to generate symlinks
     """
     logging.info('Creating symlinks for samples at {}'.format(destination_folder))
     for key, value in sample_dictionary.items():
         try:
-            create_symlink(value[0], destination_folder)
-            create_symlink(value[1], destination_folder)
+            for reads in value:
+                if isinstance(reads, tuple):
+                    concatenate_lanes(reads, destination_folder)
+                else:
+                    create_symlink(reads, destination_folder)
             logging.debug('Created symlinks for {}'.format(key))
-        except:
+        except FileExistsError:
             logging.error('Symbolic links to read pair {} already exist'.format(key))
 
 
+def import_artifact(semantic_type: str, input_path: str, output_path: str, source_format: str = None) -> str:
+    """
+    Imports data into a QIIME 2 Artifact in-process with qiime2.Artifact.import_data(), which is equivalent to
+    `qiime tools import` without paying the CLI's plugin-loading startup on every call. Any import error is raised
+    to the caller.
+
+    :param semantic_type: QIIME 2 semantic type, e.g. 'SampleData[PairedEndSequencesWithQuality]'
+    :param input_path: Path to the file or directory to import
+    :param output_path: Path to write the .qza artifact to
+    :param source_format: Name of the format of input_path, e.g. 'CasavaOneEightSingleLanePerSampleDirFmt'.
+    QIIME 2 picks the default format for the semantic type when None.
+    :return: Path to the saved artifact
+    """
+    # Imported here so that the rest of this module can be used without loading the QIIME 2 framework
+    import qiime2
+
+    logging.info('Importing {} as {}...'.format(input_path, semantic_type))
+    artifact = qiime2.Artifact.import_data(semantic_type, str(input_path), view_type=source_format)
+    saved_path = artifact.save(str(output_path))
+    logging.info('Saved {}'.format(saved_path))
+    return saved_path
+
+
 def create_sampledata_artifact(datadir: str, qiimedir: str) -> str:
     """
     :param datadir: Path to directory containing all symlinks to paired .fastq.gz files for analysis
     :param qiimedir: Path to dump all QIIME 2 output
     :return: Path to QIIME 2 Sample Data Artifact
     """
-    cmd = "qiime tools import " \
-          "--type 'SampleData[PairedEndSequencesWithQuality]' " \
-          "--input-path {datadir} " \
-          "--output-path {qiimeout} " \
-          "--source-format CasavaOneEightSingleLanePerSampleDirFmt " \
-          "".format(datadir=datadir, qiimeout=os.path.join(qiimedir, 'paired-sample-data.qza'))
-    out, err = execute_command(cmd)
+    artifact_path = import_artifact(semantic_type='SampleData[PairedEndSequencesWithQuality]',
+                                    input_path=datadir,
+                                    output_path=os.path.join(qiimedir, 'paired-sample-data.qza'),
+                                    source_format='CasavaOneEightSingleLanePerSampleDirFmt')
+    logging.info('Successfully created QIIME 2 data Artifact')
+    return artifact_path
 
-    if out is not '' or err is not '':
-        logging.debug('OUT: {}\nERR: {}'.format(out, err))
 
-    logging.info('Successfully created QIIME 2 data Artifact')
-    return os.path.join(qiimedir, 'paired-sample-data.qza')
+def project_setup(outdir: str, inputdir: str, resume: bool = False, profile_records: list = None,
+                  fastq_pattern: str = DEFAULT_FASTQ_PATTERN) -> str:
+    """
+    :param outdir: Base directory for all output from AmpliconPipeline
+    :param inputdir: Directory containing raw MiSeq output
+    :param fastq_pattern: Filename regular expression used to pair reads, see index_fastq_files()
+    :param resume: If True, outdir may already exist and a previously created data artifact is reused
+    :param profile_records: List to append a bin.profiling record for the artifact import step to
+    :return: Path to QIIME 2 Sample Data Artifact
+    """
+    if profile_records is None:
+        profile_records = []
 
+    # Reuse the data artifact from the interrupted run
+    existing_artifact_path = os.path.join(outdir, 'qiime2', 'paired-sample-data.qza')
+    if resume and os.path.isfile(existing_artifact_path):
+        logging.info('Resuming with existing data artifact {}'.format(existing_artifact_path))
+        return existing_artifact_path
 
-def project_setup(outdir: str, inputdir: str) -> str:
     # Create folder structure
-    os.mkdir(outdir)
-    os.mkdir(os.path.join(outdir, 'data'))
-    os.mkdir(os.path.join(outdir, 'qiime2'))
+    os.makedirs(os.path.join(outdir, 'data'), exist_ok=resume)
+    os.makedirs(os.path.join(outdir, 'qiime2'), exist_ok=resume)
     logging.debug('Created QIIME2 analysis folder: {}'.format(outdir))
 
     # Prepare dictionary containing R1 and R2 for each sample ID
-    sample_dictionary = get_sample_dictionary(inputdir)
+    sample_dictionary = get_sample_dictionary(inputdir, pattern=fastq_pattern)
     logging.debug('Sample Dictionary: {}'.format(sample_dictionary))
 
     # Create symlinks in data folder
@@ -172,6 +348,9 @@ def project_setup(outdir: str, inputdir: str) -> str:
 
     # Call Qiime 2 to create artifact
     logging.info('Creating sample data artifact for QIIME 2...')
-    data_artifact_path = create_sampledata_artifact(datadir=os.path.join(outdir, 'data'),
-                                                    qiimedir=os.path.join(outdir, 'qiime2'))
+    with profiling.profile_stage(profile_records, 'create_sampledata_artifact',
+                                 input_paths=[os.path.join(outdir, 'data')],
+                                 output_paths=[os.path.join(outdir, 'qiime2', 'paired-sample-data.qza')]):
+        data_artifact_path = create_sampledata_artifact(datadir=os.path.join(outdir, 'data'),
+                                                        qiimedir=os.path.join(outdir, 'qiime2'))
     return data_artifact_path
@@ -0,0 +1,118 @@
+"""
+Parsing of SILVA lineage strings (e.g. 'D_0__Bacteria;D_1__Firmicutes;...;D_6__Listeria monocytogenes') shared by
+bin/taxonomy_report_generator.py and qiimegraph.py.
+
+Lineages are factorized first so each unique lineage is only parsed once per call, and the per-lineage labels are
+memoized across calls. Taxonomy barplot exports repeat the same few hundred lineages across every level file, so most
+lookups are cache hits.
+"""
+
+from functools import lru_cache
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+RANK_PREFIXES = OrderedDict([
+    ('kingdom', 'D_0__'),
+    ('phylum', 'D_1__'),
+    ('class', 'D_2__'),
+    ('order', 'D_3__'),
+    ('family', 'D_4__'),
+    ('genus', 'D_5__'),
+    ('species', 'D_6__'),
+])
+RANKS = list(RANK_PREFIXES)
+CLOSEST_KNOWN_COLUMN = 'closest_known_classification'
+
+# Rank values that mean no call could be made at that rank
+MISSING_VALUES = ['', '_', '__']
+
+
+@lru_cache(maxsize=None)
+def closest_known_classification(lineage: str) -> str:
+    """
+    :param lineage: SILVA lineage string
+    :return: Name at the deepest rank of the lineage. When that rank is empty or uncultured, the deepest usable name is
+    returned with ' (closest known classification)' appended instead.
+    """
+    if 'Unassigned;_' in lineage:
+        return 'Unassigned'
+
+    # Initial cleanup
+    for level in range(8):
+        lineage = lineage.replace('D_{}__'.format(level), '')
+
+    tax_list = lineage.split(';')
+    tax_string = tax_list[-1]
+
+    # Fall back on the deepest rank that was resolved to a cultured organism
+    if tax_string in MISSING_VALUES or 'uncultured' in tax_string.lower():
+        known = [x for x in tax_list if x not in MISSING_VALUES and 'uncultured' not in x.lower()]
+        if known:
+            tax_string = known[-1] + ' (closest known classification)'
+
+    return tax_string
+
+
+@lru_cache(maxsize=None)
+def rank_label(lineage: str, rank: str) -> str:
+    """
+    :param lineage: SILVA lineage string, truncated at rank as in the level-N.csv files of a taxonomy barplot
+    :param rank: One of RANKS
+    :return: Name at the given rank, 'Unclassified' if no call could be made at that rank, or 'Unassigned'
+    """
+    if 'Unassigned;_' in lineage:
+        return 'Unassigned'
+
+    parts = lineage.split(RANK_PREFIXES[rank])
+    tax_string = parts[1] if len(parts) > 1 and parts[1] != '' else lineage
+
+    # If there are remaining taxonomy characters it means a call to the specified level couldn't be made
+    if ';' in tax_string and '__' in tax_string:
+        tax_string = 'Unclassified'
+    return tax_string
+
+
+def _map_unique(lineages, func) -> pd.Series:
+    """
+    :param lineages: Iterable of lineage strings
+    :param func: Function applied once to every unique lineage
+    :return: Series of func(lineage) aligned with lineages
+    """
+    lineages = lineages if isinstance(lineages, pd.Series) else pd.Series(list(lineages))
+    codes, uniques = pd.factorize(lineages)
+    labels = np.array([func(lineage) for lineage in uniques], dtype=object)
+    return pd.Series(pd.Categorical(labels[codes]), index=lineages.index)
+
+
+def rank_labels(lineages, rank: str) -> pd.Series:
+    """
+    :param lineages: Iterable of lineage strings
+    :param rank: One of RANKS
+    :return: Categorical Series of rank_label() for every lineage
+    """
+    return _map_unique(lineages, lambda lineage: rank_label(lineage, rank))
+
+
+def parse_lineages(lineages) -> pd.DataFrame:
+    """
+    Splits every lineage into its ranks at once
+
+    :param lineages: Iterable of lineage strings
+    :return: DataFrame aligned with lineages with a categorical column per rank (kingdom..species, prefixes removed
+    and NaN where no call was made) and a closest_known_classification column, see closest_known_classification()
+    """
+    lineages = lineages if isinstance(lineages, pd.Series) else pd.Series(list(lineages))
+    codes, uniques = pd.factorize(lineages)
+
+    split = pd.Series(uniques).str.split(';', expand=True).reindex(columns=range(len(RANKS))).astype(object)
+    table = pd.DataFrame(index=range(len(uniques)))
+    for position, rank in enumerate(RANKS):
+        names = split[position].str.strip().str.replace(r'^D_\d+__', '', regex=True)
+        table[rank] = names.where(~names.isin(MISSING_VALUES))
+    table[CLOSEST_KNOWN_COLUMN] = [closest_known_classification(lineage) for lineage in uniques]
+
+    table = table.take(codes)
+    table.index = lineages.index
+    return table.astype('category')
@@ -0,0 +1,223 @@
+"""
+Per-stage resource profiling for pipeline runs.
+
+Each profiled stage records its wall time, CPU time, peak resident memory and the sizes of its input and output files.
+Peak memory is sampled across the whole process tree (including child processes such as DADA2's R session, MAFFT
+and joblib workers) with psutil when it is available, falling back to resource.getrusage() otherwise.
+
+When several stages run concurrently they share the process, so their peak memory and CPU time figures overlap: the
+CPU time of a stage is that of the whole process (and of the child processes reaped) while it ran. Child processes
+can't be attributed to the thread that started them, so the CPU time of the stage's own thread is recorded
+separately, and every record lists the stages that overlapped with it.
+"""
+
+import os
+import json
+import time
+import logging
+import resource
+import threading
+
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+SAMPLE_INTERVAL = 0.5
+PROFILE_FILENAME = 'run_profile.json'
+
+
+def process_tree_rss() -> int:
+    """
+    :return: Combined resident set size in bytes of this process and all of its descendants
+    """
+    if psutil is not None:
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                pass
+        return rss
+
+    # ru_maxrss is reported in kilobytes on Linux. Without psutil only lifetime peaks are available.
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss +
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * 1024
+
+
+def cpu_seconds() -> float:
+    """
+    :return: User + system CPU time consumed so far by this process and its terminated children
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def thread_cpu_seconds():
+    """
+    :return: User + system CPU time consumed so far by the calling thread, excluding child processes. None where
+    resource.RUSAGE_THREAD isn't available (it is Linux only).
+    """
+    if not hasattr(resource, 'RUSAGE_THREAD'):
+        return None
+    usage = resource.getrusage(resource.RUSAGE_THREAD)
+    return usage.ru_utime + usage.ru_stime
+
+
+def overlapping_stages(records: list) -> dict:
+    """
+    :param records: List of records generated by profile_stage()
+    :return: Dictionary of {stage name: sorted names of the other stages that ran at the same time}
+    """
+    intervals = [(record['stage'], record['start_timestamp'], record['start_timestamp'] + record['wall_seconds'])
+                 for record in records]
+    return {stage: sorted(other for other, other_start, other_end in intervals
+                          if other != stage and other_start < end and start < other_end)
+            for stage, start, end in intervals}
+
+
+def path_size(path: str) -> int:
+    """
+    :param path: Path to a file or directory
+    :return: Size in bytes of the file, or of every file under the directory. 0 if the path doesn't exist.
+    """
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for filename in files:
+            filepath = os.path.join(root, filename)
+            if os.path.isfile(filepath):
+                total += os.path.getsize(filepath)
+    return total
+
+
+class PeakMemorySampler(threading.Thread):
+    """
+    Background thread that polls process_tree_rss() and keeps the highest value seen
+    """
+
+    def __init__(self, interval: float = SAMPLE_INTERVAL):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak_rss = process_tree_rss()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak_rss = max(self.peak_rss, process_tree_rss())
+
+    def stop(self) -> int:
+        """
+        :return: Peak RSS in bytes observed while the sampler was running
+        """
+        self._stop_event.set()
+        self.join()
+        self.peak_rss = max(self.peak_rss, process_tree_rss())
+        return self.peak_rss
+
+
+@contextmanager
+def profile_stage(records: list, stage_name: str, input_paths: list = None, output_paths: list = None):
+    """
+    Context manager that appends a profile record for the wrapped block to records. The record is written even if
+    the block raises, with its status set to 'failed'.
+
+    :param records: List that the finished record is appended to
+    :param stage_name: Name of the stage being profiled
+    :param input_paths: Paths to the files read by the stage
+    :param output_paths: Paths to the files written by the stage (sized once the stage completes)
+    :return: The record dictionary, which the wrapped block may add fields to
+    """
+    input_paths = input_paths if input_paths is not None else []
+    output_paths = output_paths if output_paths is not None else []
+    wall_start = time.time()
+    record = {
+        'stage': stage_name,
+        'start_time': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall_start)),
+        'start_timestamp': wall_start,
+        'input_bytes': {path: path_size(path) for path in input_paths},
+    }
+
+    sampler = PeakMemorySampler()
+    sampler.start()
+    cpu_start = cpu_seconds()
+    thread_cpu_start = thread_cpu_seconds()
+    try:
+        yield record
+        record['status'] = 'completed'
+    except BaseException:
+        record['status'] = 'failed'
+        raise
+    finally:
+        record['wall_seconds'] = round(time.time() - wall_start, 3)
+        record['cpu_seconds'] = round(cpu_seconds() - cpu_start, 3)
+        if thread_cpu_start is not None:
+            record['thread_cpu_seconds'] = round(thread_cpu_seconds() - thread_cpu_start, 3)
+        record['peak_rss_bytes'] = sampler.stop()
+        record['output_bytes'] = {path: path_size(path) for path in output_paths}
+        records.append(record)
+
+
+def write_run_profile(records: list, out_dir: str) -> str:
+    """
+    :param records: List of records generated by profile_stage()
+    :param out_dir: Folder to write run_profile.json into
+    :return: Path to run_profile.json
+    """
+    profile_path = os.path.join(out_dir, PROFILE_FILENAME)
+    overlaps = overlapping_stages(records)
+    for record in records:
+        record['overlapping_stages'] = overlaps[record['stage']]
+    profile = {
+        'psutil_available': psutil is not None,
+        'cpu_count': os.cpu_count(),
+        'notes': {
+            'cpu_seconds': 'Process-wide CPU time (including reaped child processes) while the stage ran. Includes the '
+                           'CPU time of the overlapping_stages.',
+            'thread_cpu_seconds': "CPU time of the stage's own thread, excluding its child processes and workers.",
+            'peak_rss_bytes': 'Peak memory of the whole process tree while the stage ran. Includes the memory of the '
+                              'overlapping_stages.',
+        },
+        'stages': records,
+    }
+    with open(profile_path, 'w') as f:
+        json.dump(profile, f, indent=2, sort_keys=True)
+    logging.info('Saved {}'.format(profile_path))
+    return profile_path
+
+
+def format_bytes(n_bytes: int) -> str:
+    """
+    :param n_bytes: Number of bytes
+    :return: Human readable size, e.g. '1.5 GB'
+    """
+    size = float(n_bytes)
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if size < 1024:
+            return '{:.1f} {}'.format(size, unit)
+        size /= 1024
+    return '{:.1f} TB'.format(size)
+
+
+def log_profile_summary(records: list):
+    """
+    Logs a table summarizing every profiled stage in the order they started
+
+    :param records: List of records generated by profile_stage()
+    """
+    row = '{:<32} {:>10} {:>10} {:>10} {:>10} {:>10}'
+    logging.info('Run profile summary:')
+    logging.info(row.format('stage', 'wall (s)', 'cpu (s)', 'peak RSS', 'in', 'out'))
+    for record in sorted(records, key=lambda r: r['start_timestamp']):
+        logging.info(row.format(record['stage'] + ('' if record['status'] == 'completed' else ' (failed)'),
+                                '{:.1f}'.format(record['wall_seconds']),
+                                '{:.1f}'.format(record['cpu_seconds']),
+                                format_bytes(record['peak_rss_bytes']),
+                                format_bytes(sum(record['input_bytes'].values())),
+                                format_bytes(sum(record['output_bytes'].values()))))
+    if any(overlapping_stages(records).values()):
+        logging.info('CPU time and peak RSS are process-wide and include the stages running at the same time')
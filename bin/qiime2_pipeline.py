@@ -1,9 +1,12 @@
 import os
 import logging
 import multiprocessing
+import biom
 import qiime2
 import pandas as pd
 
+from types import SimpleNamespace
+from collections import OrderedDict
 from qiime2 import Metadata
 from qiime2.plugins import feature_table, \
     dada2, \
@@ -16,6 +19,36 @@ from qiime2.plugins import feature_table, \
     feature_classifier, \
     taxa
 
+from q2_types.feature_data import DNAFASTAFormat
+from q2_feature_classifier.classifier import classify_sklearn
+
+from bin import asv_registry, classifier_store, dada2_sharding, distance_memmap, profiling, rarefaction, run_merger, \
+    stage_cache, stage_scheduler, table_statistics, taxonomy_cache
+
+# Every file run_diversity_metrics() may write into base_dir
+DIVERSITY_OUTPUTS = [
+    'bray_curtis_emperor.qzv',
+    'jaccard_emperor.qzv',
+    'unweighted_unifrac_emperor.qzv',
+    'weighted_unifrac_emperor.qzv',
+    'faith-pd-group-significance.qzv',
+    'evenness-group-significance.qzv',
+    'unweighted-unifrac-sample-type-significance.qzv',
+]
+
+# Every file run_diversity_metrics_out_of_core() may write into base_dir
+OUT_OF_CORE_DIVERSITY_OUTPUTS = [
+    'bray_curtis_distance_matrix.npy',
+    'bray_curtis_distance_matrix.ids.txt',
+    'jaccard_distance_matrix.npy',
+    'jaccard_distance_matrix.ids.txt',
+    'bray_curtis_emperor.qzv',
+    'jaccard_emperor.qzv',
+    'faith-pd-group-significance.qzv',
+    'evenness-group-significance.qzv',
+    'bray-curtis-sample-type-significance.tsv',
+]
+
 
 def load_data_artifact(filepath):
     """
@@ -232,6 +265,22 @@ def load_artifact(artifact_path):
     return artifact
 
 
+def calculate_table_statistics(dada2_table):
+    """
+    Per-sample depths, per-feature totals and prevalence, and depth quantiles computed from the sparse BIOM table
+
+    :param dada2_table: QIIME2 DADA2 table object
+    :return: bin.table_statistics.TableStatistics namedtuple
+    """
+    statistics = table_statistics.biom_table_statistics(dada2_table.view(biom.Table))
+    logging.info('DADA2 table: {} features across {} samples'.format(len(statistics.feature_totals),
+                                                                    len(statistics.sample_depths)))
+    logging.info('Sample depth quantiles: {}'.format(
+        ', '.join('{:g}%: {:g}'.format(quantile * 100, depth)
+                  for quantile, depth in statistics.depth_quantiles.items())))
+    return statistics
+
+
 def calculate_maximum_depth(dada2_table):
     """
     Extracts the maximum observed read depth from post-filtering sequence object
@@ -239,46 +288,56 @@ def calculate_maximum_depth(dada2_table):
     :param dada2_table: QIIME2 DADA2 table object
     :return: Maximum depth retrieved from the QIIME2/DADA2 table object
     """
-    # Read in dada2 table
-    df = dada2_table.view(pd.DataFrame)
-    df = df.transpose()
-    value_dict = {}
-
-    # Calculate the sum of each column (sample)
-    for column in df:
-        value_dict[column] = df[column].sum()
-
-    max_depth = max(value_dict.values())
+    max_depth = int(calculate_table_statistics(dada2_table).sample_depths.max())
     logging.info('Maximum depth in DADA2 table: {}'.format(str(max_depth)))
     return max_depth
 
 
-def alpha_rarefaction_visualization(base_dir, dada2_filtered_table, max_depth=None):
+def alpha_rarefaction_curves(base_dir, dada2_filtered_table, phylo_rooted_tree=None, max_depth=None,
+                             steps=rarefaction.DEFAULT_STEPS, iterations=rarefaction.DEFAULT_ITERATIONS,
+                             cpu_count=None):
     """
-    Produces rarefaction visualization object
+    Computes alpha rarefaction curves (observed features, Shannon and Faith's PD) with bin.rarefaction instead of
+    QIIME 2's alpha_rarefaction visualizer, and writes them to alpha-rarefaction.tsv and alpha-rarefaction.png
 
     :param base_dir: Main working directory filepath
     :param dada2_filtered_table: QIIME2 DADA2 filtered table object
+    :param phylo_rooted_tree: QIIME2 rooted tree object from phylo_tree(). Faith's PD is skipped when None.
     :param max_depth: Maximum depth value (integer)
-    :return: QIIME2 alpha rarefaction visualization object
+    :param steps: Number of depths between 1 and max_depth
+    :param iterations: Number of subsamples drawn at every depth
+    :param cpu_count: Number of iterations computed in parallel. Defaults to all CPUs.
+    :return: DataFrame of the curves, see rarefaction.rarefaction_curves()
     """
     logging.info('Generating rarefaction curves...')
 
     # Path setup
-    alpha_rarefaction_export_path = os.path.join(base_dir, 'alpha-rarefaction.qzv')
+    table_export_path = os.path.join(base_dir, 'alpha-rarefaction.tsv')
+    plot_export_path = os.path.join(base_dir, 'alpha-rarefaction.png')
 
     # Max depth calculation. This (arbitrarily) sets the maximum depth to 80% of the highest value found.
     if max_depth is None:
         max_depth = int(calculate_maximum_depth(dada2_filtered_table) * 0.8)
 
-    # Produce rarefaction curve
-    alpha_rarefaction_viz = diversity.visualizers.alpha_rarefaction(table=dada2_filtered_table, max_depth=max_depth)
+    table = dada2_filtered_table.view(biom.Table)
+    phylogeny = None
+    if phylo_rooted_tree is not None:
+        import skbio
+        phylogeny = rarefaction.phylogeny_from_tree(phylo_rooted_tree.rooted_tree.view(skbio.TreeNode),
+                                                    list(table.ids(axis='observation')))
+
+    # Produce rarefaction curves
+    curves = rarefaction.rarefaction_curves(table.matrix_data, list(table.ids(axis='sample')), max_depth=max_depth,
+                                            steps=steps, iterations=iterations, phylogeny=phylogeny,
+                                            processes=cpu_count)
 
     # Save
-    alpha_rarefaction_viz.visualization.save(alpha_rarefaction_export_path)
-    logging.info('Saved {}'.format(alpha_rarefaction_export_path))
+    curves.to_csv(table_export_path, sep='\t', index=False)
+    logging.info('Saved {}'.format(table_export_path))
+    rarefaction.plot_rarefaction(curves, plot_export_path)
+    logging.info('Saved {}'.format(plot_export_path))
 
-    return alpha_rarefaction_viz
+    return curves
 
 
 def classify_taxonomy(base_dir, dada2_filtered_rep_seqs, classifier, cpu_count=None):
@@ -312,6 +371,151 @@ def classify_taxonomy(base_dir, dada2_filtered_rep_seqs, classifier, cpu_count=N
     return taxonomy_analysis
 
 
+def classify_reads(reads, classifier_artifact_path, cpu_count):
+    """
+    Runs classify_sklearn with the memory-mapped copy of the classifier made by bin.classifier_store if there is one,
+    and by loading the classifier artifact otherwise
+
+    :param reads: QIIME2 representative sequences object
+    :param classifier_artifact_path: Path to the .qza classifer for assigning reads to taxonomy
+    :param cpu_count: Number of CPUs to use for taxonomy classification
+    :return: pandas DataFrame with Taxon and Confidence columns, indexed by feature ID
+    """
+    pipeline = classifier_store.load_mmap_classifier(classifier_artifact_path)
+    if pipeline is not None:
+        return classify_sklearn(reads=reads.view(DNAFASTAFormat), classifier=pipeline, n_jobs=cpu_count)
+
+    classifier = load_artifact(artifact_path=classifier_artifact_path)
+    classification = feature_classifier.methods.classify_sklearn(reads=reads,
+                                                                 classifier=classifier,
+                                                                 n_jobs=cpu_count).classification
+    return classification.view(pd.DataFrame)
+
+
+def classify_taxonomy_cached(base_dir, dada2_filtered_rep_seqs, classifier_artifact_path, cpu_count=None,
+                             cache_path=taxonomy_cache.DEFAULT_CACHE_PATH,
+                             max_entries=taxonomy_cache.DEFAULT_MAX_ENTRIES):
+    """
+    Same as classify_taxonomy, but assignments are looked up in a persistent cache keyed by the classifier and the
+    exact ASV sequence first. Only ASVs that have never been classified with this classifier are sent to
+    classify_sklearn, and the classifier is not loaded at all if every ASV is cached. A memory-mapped copy of the
+    classifier is used when available, see classify_reads().
+
+    :param base_dir: Main working directory filepath
+    :param dada2_filtered_rep_seqs: DADA2 filtered representative sequences object
+    :param classifier_artifact_path: Path to the .qza classifer for assigning reads to taxonomy
+    :param cpu_count: Number of CPUs to use for taxonomy classification
+    :param cache_path: Path to the taxonomy cache database. Every ASV is classified when None.
+    :param max_entries: Maximum number of assignments to keep in the cache
+    :return: Object exposing the same attributes as the result of classify_taxonomy()
+    """
+    logging.info('Classifying reads...')
+
+    # Path setup
+    export_path = os.path.join(base_dir, 'taxonomy.qza')
+
+    # Threading setup
+    if cpu_count is None:
+        cpu_count = multiprocessing.cpu_count()
+        logging.info('Set CPU count to {}'.format(cpu_count))
+
+    if cache_path is None:
+        taxonomy_df = classify_reads(dada2_filtered_rep_seqs, classifier_artifact_path, cpu_count)
+    else:
+        sequences = dada2_filtered_rep_seqs.view(pd.Series)
+        sequence_hashes = pd.Series([run_merger.sequence_digest(str(sequence)) for sequence in sequences],
+                                    index=sequences.index)
+        # The artifact UUID identifies the classifier without reading the multi-GB archive
+        classifier_id = classifier_store.archive_fingerprint(classifier_artifact_path)['uuid']
+
+        connection = taxonomy_cache.open_cache(cache_path)
+        try:
+            assignments = taxonomy_cache.lookup(connection, classifier_id, sequence_hashes.unique())
+            novel = ~sequence_hashes.isin(list(assignments)) & ~sequence_hashes.duplicated()
+            logging.info('{} of {} ASVs found in the taxonomy cache'.format(
+                sequence_hashes.isin(list(assignments)).sum(), len(sequence_hashes)))
+
+            if novel.any():
+                # Classify each novel sequence once, identified by its hash so results can go straight into the cache
+                novel_sequences = pd.Series(sequences[novel].values, index=sequence_hashes[novel].values)
+                novel_reads = qiime2.Artifact.import_data('FeatureData[Sequence]', novel_sequences)
+                novel_df = classify_reads(novel_reads, classifier_artifact_path, cpu_count)
+                novel_assignments = {sequence_hash: (row['Taxon'], row['Confidence'])
+                                     for sequence_hash, row in novel_df.iterrows()}
+                taxonomy_cache.store(connection, classifier_id, novel_assignments)
+                taxonomy_cache.evict(connection, max_entries)
+                assignments.update(novel_assignments)
+        finally:
+            connection.close()
+
+        taxonomy_df = pd.DataFrame([assignments[sequence_hash] for sequence_hash in sequence_hashes],
+                                   index=pd.Index(sequence_hashes.index, name='Feature ID'),
+                                   columns=['Taxon', 'Confidence'])
+
+    classification = qiime2.Artifact.import_data('FeatureData[Taxonomy]', taxonomy_df)
+
+    # Save the resulting artifact
+    classification.save(export_path)
+    logging.info('Saved {}'.format(export_path))
+
+    return SimpleNamespace(classification=classification)
+
+
+def register_asvs(registry_path, run_id, run_path, dada2_filtered_table, dada2_filtered_rep_seqs, overwrite=False):
+    """
+    Adds the per-sample counts of every ASV in a run to the ASV registry, keyed by sequence hash
+
+    :param registry_path: Path to the ASV registry database
+    :param run_id: Unique name of the run
+    :param run_path: Output folder of the run
+    :param dada2_filtered_table: DADA2 filtered table object
+    :param dada2_filtered_rep_seqs: DADA2 filtered representative sequences object
+    :param overwrite: Replace a run registered under run_id from a different output folder
+    :return: Number of (ASV, sample) counts registered
+    """
+    sequences = dada2_filtered_rep_seqs.view(pd.Series)
+    hashed_sequences = {run_merger.sequence_digest(str(sequence)): str(sequence).upper() for sequence in sequences}
+    feature_hashes = {feature_id: run_merger.sequence_digest(str(sequence))
+                      for feature_id, sequence in sequences.items()}
+
+    table = dada2_filtered_table.view(biom.Table)
+    # Collapses any features that share a sequence into a single row
+    matrix, sequence_hashes, sample_ids = run_merger.merge_sparse_tables(
+        [(table.matrix_data, [feature_hashes[feature_id] for feature_id in table.ids(axis='observation')],
+          list(table.ids(axis='sample')))])
+    matrix = matrix.tocoo()
+    counts = ((sequence_hashes[row], sample_ids[col], count) for row, col, count in zip(matrix.row, matrix.col,
+                                                                                         matrix.data))
+
+    connection = asv_registry.open_registry(registry_path)
+    try:
+        return asv_registry.register_run(connection, run_id, hashed_sequences, counts, run_path=run_path,
+                                         overwrite=overwrite)
+    finally:
+        connection.close()
+
+
+def register_taxonomy(registry_path, taxonomy_analysis, dada2_filtered_rep_seqs):
+    """
+    Stores the taxonomy assigned to every ASV of a run in the ASV registry
+
+    :param registry_path: Path to the ASV registry database
+    :param taxonomy_analysis: QIIME2 post-classification taxonomy object
+    :param dada2_filtered_rep_seqs: DADA2 filtered representative sequences object
+    """
+    sequences = dada2_filtered_rep_seqs.view(pd.Series)
+    taxonomy_df = taxonomy_analysis.classification.view(pd.DataFrame)
+    assignments = {run_merger.sequence_digest(str(sequences[feature_id])): (row['Taxon'], row['Confidence'])
+                   for feature_id, row in taxonomy_df.iterrows() if feature_id in sequences.index}
+
+    connection = asv_registry.open_registry(registry_path)
+    try:
+        asv_registry.update_taxonomy(connection, assignments)
+    finally:
+        connection.close()
+    logging.info('Stored taxonomy for {} ASVs in {}'.format(len(assignments), registry_path))
+
+
 def visualize_taxonomy(base_dir, metadata_object, taxonomy_analysis, dada2_filtered_table):
     """
     Generates .qzv visualization files (taxonomy_barplot, taxonomy) from a QIIME2 taxonomy object
@@ -348,7 +552,7 @@ def visualize_taxonomy(base_dir, metadata_object, taxonomy_analysis, dada2_filte
 
 
 def run_diversity_metrics(base_dir, dada2_filtered_table, phylo_rooted_tree, metadata_object,
-                          sampling_depth=None, beta_column='sample_annotation'):
+                          sampling_depth=None, beta_column='sample_annotation', cpu_count=None):
     """
     TODO: Allow beta_column (for beta diversity calculation) to be set through CLI
 
@@ -358,10 +562,17 @@ def run_diversity_metrics(base_dir, dada2_filtered_table, phylo_rooted_tree, met
     :param metadata_object: 
     :param sampling_depth:
     :param beta_column: Column name to use for the beta group significance step of the pipeline
+    :param cpu_count: Number of CPUs the distance matrices are computed with. UniFrac is computed with Striped UniFrac,
+    which splits the matrix into stripes computed in parallel, and Bray-Curtis and Jaccard split their rows between
+    jobs. The distances are the same whatever the CPU count. Defaults to all CPUs.
     :return: QIIME2 diversity core metrics object
     """
     logging.info('Running diversity metrics...')
 
+    # Threading setup
+    if cpu_count is None:
+        cpu_count = multiprocessing.cpu_count()
+
     # Set sampling_depth to 10% of the maximum if no value is provided. Should probably rework this.
     if sampling_depth is None:
         sampling_depth = int(calculate_maximum_depth(dada2_filtered_table) * 0.1)
@@ -380,7 +591,8 @@ def run_diversity_metrics(base_dir, dada2_filtered_table, phylo_rooted_tree, met
     diversity_metrics = diversity.pipelines.core_metrics_phylogenetic(table=dada2_filtered_table,
                                                                       phylogeny=phylo_rooted_tree.rooted_tree,
                                                                       sampling_depth=sampling_depth,
-                                                                      metadata=metadata_object)
+                                                                      metadata=metadata_object,
+                                                                      n_jobs=cpu_count)
 
     # Save
     diversity_metrics.bray_curtis_emperor.save(bray_curtis_path)
@@ -427,6 +639,101 @@ def run_diversity_metrics(base_dir, dada2_filtered_table, phylo_rooted_tree, met
     return diversity_metrics
 
 
+def run_diversity_metrics_out_of_core(base_dir, dada2_filtered_table, phylo_rooted_tree, metadata_object,
+                                      sampling_depth=None, beta_column='sample_annotation', cpu_count=None,
+                                      block_size=distance_memmap.DEFAULT_BLOCK_SIZE):
+    """
+    Version of run_diversity_metrics() for studies with too many samples for in-memory distance matrices. The
+    Bray-Curtis and Jaccard distance matrices are computed block by block into memory-mapped .npy files with
+    bin.distance_memmap, and the PCoA behind their Emperor plots and the beta group significance test (PERMANOVA on
+    Bray-Curtis, written to bray-curtis-sample-type-significance.tsv) read them back a block at a time. UniFrac is not
+    computed, as q2-diversity only computes it in memory.
+
+    :param base_dir: Main working directory filepath
+    :param dada2_filtered_table: QIIME2 DADA2 filtered table object
+    :param phylo_rooted_tree: QIIME2 rooted tree object from phylo_tree()
+    :param metadata_object: QIIME2 metadata object
+    :param sampling_depth: Depth the table is rarefied to. Defaults to 10% of the deepest sample.
+    :param beta_column: Column name to use for the beta group significance step of the pipeline
+    :param cpu_count: Number of blocks of the distance matrices computed in parallel. Defaults to all CPUs.
+    :param block_size: Number of samples per block
+    :return: SimpleNamespace with the rarefied table, the Faith's PD and evenness vectors and the paths to the
+    distance matrices
+    """
+    import skbio
+
+    logging.info('Running out-of-core diversity metrics...')
+
+    # Set sampling_depth to 10% of the maximum if no value is provided
+    if sampling_depth is None:
+        sampling_depth = int(calculate_maximum_depth(dada2_filtered_table) * 0.1)
+
+    # Path setup
+    faith_visualization_path = os.path.join(base_dir, 'faith-pd-group-significance.qzv')
+    evenness_visualization_path = os.path.join(base_dir, 'evenness-group-significance.qzv')
+    beta_significance_path = os.path.join(base_dir, 'bray-curtis-sample-type-significance.tsv')
+
+    # Rarefy and compute alpha diversity, as core_metrics_phylogenetic does
+    rarefied_table = feature_table.methods.rarefy(table=dada2_filtered_table,
+                                                  sampling_depth=sampling_depth).rarefied_table
+    faith_pd_vector = diversity.methods.alpha_phylogenetic(table=rarefied_table,
+                                                           phylogeny=phylo_rooted_tree.rooted_tree,
+                                                           metric='faith_pd').alpha_diversity
+    evenness_vector = diversity.methods.alpha(table=rarefied_table, metric='pielou_e').alpha_diversity
+
+    # Alpha group significance
+    try:
+        for alpha_diversity, visualization_path in [(faith_pd_vector, faith_visualization_path),
+                                                    (evenness_vector, evenness_visualization_path)]:
+            alpha_group = diversity.visualizers.alpha_group_significance(alpha_diversity=alpha_diversity,
+                                                                         metadata=metadata_object)
+            alpha_group.visualization.save(visualization_path)
+            logging.info('Saved {}'.format(visualization_path))
+    except ValueError as e:
+        logging.info("Could not calculate alpha group significance")
+        logging.info(e)
+
+    # Distance matrices and their ordination
+    table = rarefied_table.view(biom.Table)
+    sample_ids = list(table.ids(axis='sample'))
+    distance_matrix_paths = OrderedDict()
+    for metric, name in [('braycurtis', 'bray_curtis'), ('jaccard', 'jaccard')]:
+        distance_matrix_path = os.path.join(base_dir, '{}_distance_matrix.npy'.format(name))
+        distance_memmap.blockwise_distances(table.matrix_data, sample_ids, distance_matrix_path, metric,
+                                            block_size=block_size, processes=cpu_count)
+        logging.info('Saved {}'.format(distance_matrix_path))
+        distance_matrix_paths[metric] = distance_matrix_path
+
+        distance_matrix, _ = distance_memmap.open_distance_matrix(distance_matrix_path)
+        eigvals, coordinates, proportion_explained = distance_memmap.pcoa(distance_matrix, block_size=block_size)
+        axes = ['PC{}'.format(i + 1) for i in range(len(eigvals))]
+        ordination = skbio.OrdinationResults(short_method_name='PCoA',
+                                             long_method_name='Principal Coordinate Analysis',
+                                             eigvals=pd.Series(eigvals, index=axes),
+                                             samples=pd.DataFrame(coordinates, index=sample_ids, columns=axes),
+                                             proportion_explained=pd.Series(proportion_explained, index=axes))
+        pcoa_results = qiime2.Artifact.import_data('PCoAResults', ordination)
+
+        emperor_path = os.path.join(base_dir, '{}_emperor.qzv'.format(name))
+        emperor.visualizers.plot(pcoa=pcoa_results, metadata=metadata_object).visualization.save(emperor_path)
+        logging.info('Saved {}'.format(emperor_path))
+
+    # Beta group significance
+    try:
+        distance_matrix, _ = distance_memmap.open_distance_matrix(distance_matrix_paths['braycurtis'])
+        grouping = metadata_object.get_column(beta_column).to_series()
+        significance = distance_memmap.group_significance(distance_matrix, sample_ids, grouping, pairwise=True,
+                                                          block_size=block_size)
+        significance.to_csv(beta_significance_path, sep='\t', index=False)
+        logging.info('Saved {}'.format(beta_significance_path))
+    except (ValueError, TypeError) as e:
+        logging.info('Could not calculate beta group significance with metadata feature {}\n'.format(beta_column))
+        logging.info(e)
+
+    return SimpleNamespace(rarefied_table=rarefied_table, faith_pd_vector=faith_pd_vector,
+                           evenness_vector=evenness_vector, distance_matrix_paths=distance_matrix_paths)
+
+
 def run_qc_pipeline(base_dir, data_artifact_path, sample_metadata_path):
     """
     1. Loads qiime2 data artifact and sample metadata file
@@ -499,8 +806,53 @@ def validate_metadata(sample_metadata_path):
     return new_metadata_path
 
 
+def load_dada2_outputs(base_dir):
+    """
+    Reloads the artifacts saved by dada2_qc() so a cached DADA2 stage can stand in for a fresh run
+
+    :param base_dir: Main working directory filepath
+    :return: QIIME2/DADA2 filtered table and representative sequences objects
+    """
+    dada2_filtered_table = load_artifact(os.path.join(base_dir, 'table-dada2.qza'))
+    dada2_filtered_rep_seqs = load_artifact(os.path.join(base_dir, 'rep-seqs-dada2.qza'))
+    return dada2_filtered_table, dada2_filtered_rep_seqs
+
+
+def load_alignment_outputs(base_dir):
+    """
+    :param base_dir: Main working directory filepath
+    :return: Objects exposing the same attributes as the results of seq_alignment_mask()
+    """
+    seq_mask = SimpleNamespace(masked_alignment=load_artifact(os.path.join(base_dir, 'masked-aligned-rep-seqs.qza')))
+    seq_alignment = SimpleNamespace(alignment=load_artifact(os.path.join(base_dir, 'aligned-rep-seqs.qza')))
+    return seq_mask, seq_alignment
+
+
+def load_tree_outputs(base_dir):
+    """
+    :param base_dir: Main working directory filepath
+    :return: Objects exposing the same attributes as the results of phylo_tree()
+    """
+    phylo_unrooted_tree = SimpleNamespace(tree=load_artifact(os.path.join(base_dir, 'unrooted-tree.qza')))
+    phylo_rooted_tree = SimpleNamespace(rooted_tree=load_artifact(os.path.join(base_dir, 'rooted-tree.qza')))
+    return phylo_unrooted_tree, phylo_rooted_tree
+
+
+def load_taxonomy_outputs(base_dir):
+    """
+    :param base_dir: Main working directory filepath
+    :return: Object exposing the same attributes as the result of classify_taxonomy()
+    """
+    return SimpleNamespace(classification=load_artifact(os.path.join(base_dir, 'taxonomy.qza')))
+
+
 def run_pipeline(base_dir, data_artifact_path, sample_metadata_path, classifier_artifact_path,
-                 trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, filtering_flag=False):
+                 trim_left_f, trim_left_r, trunc_len_f, trunc_len_r, filtering_flag=False,
+                 cache_dir=None, resume=False, cpu_count=None, profile_records=None,
+                 taxonomy_cache_path=None, taxonomy_cache_size=taxonomy_cache.DEFAULT_MAX_ENTRIES,
+                 registry_path=None, run_id=None, overwrite_run_id=False, dada2_shard_size=None, dada2_shard_dir=None,
+                 rarefaction_steps=rarefaction.DEFAULT_STEPS, rarefaction_iterations=rarefaction.DEFAULT_ITERATIONS,
+                 out_of_core=False):
     """
     1. Load sequence data and sample metadata file into a QIIME 2 Artifact
     2. Filter, denoise reads with dada2
@@ -511,6 +863,11 @@ def run_pipeline(base_dir, data_artifact_path, sample_metadata_path, classifier_
     7. Generate taxonomy barplots
     8. Run diversity metrics
 
+    The steps are run as a dependency graph by bin.stage_scheduler, so stages that only depend on the DADA2 output
+    (alignment -> tree -> rarefaction, classification, visualizations) run concurrently and share cpu_count CPUs.
+    Every stage is run through bin.stage_cache, keyed by the content of its inputs and its parameters. With
+    resume=True, stages that already have a cached result are restored rather than recomputed.
+
     :param base_dir: Main working directory filepath
     :param data_artifact_path: Artifact generated via helper_functions.create_sampledata_artifact()
     :param sample_metadata_path: Path to .tsv sample metadata file
@@ -520,9 +877,38 @@ def run_pipeline(base_dir, data_artifact_path, sample_metadata_path, classifier_
     :param trim_left_r: Number of bases to trim from 5' of reverse read
     :param trunc_len_f: Number of bases for forward read truncation
     :param trunc_len_r: Number of bases for reverse read truncation
+    :param cache_dir: Directory to store stage results in. Caching is disabled when None.
+    :param resume: Skip every stage that already has a cached result in cache_dir
+    :param cpu_count: Total number of CPUs shared by concurrently running stages. Defaults to all CPUs.
+    :param profile_records: List of bin.profiling records from earlier steps (e.g. the import in
+    helper_functions.project_setup) to include in run_profile.json alongside the records for these stages
+    :param taxonomy_cache_path: Path to a persistent per-ASV taxonomy cache, see classify_taxonomy_cached(). Every ASV
+    is classified from scratch when None.
+    :param taxonomy_cache_size: Maximum number of assignments to keep in the taxonomy cache
+    :param registry_path: Path to the ASV registry to add the run's ASV counts and taxonomy to. Nothing is registered
+    when None.
+    :param run_id: Name the run is registered under. Defaults to the absolute path of the folder containing
+    base_dir, which is unique to the run.
+    :param overwrite_run_id: Replace a run already registered under run_id from a different output folder
+    :param dada2_shard_size: Run DADA2 in shards of this many samples with bin.dada2_sharding instead of a single
+    denoise_paired call. The result is the same, so both share cached results.
+    :param dada2_shard_dir: Work folder for sharded DADA2 that workers on other hosts can join. Defaults to a
+    temporary folder in base_dir.
+    :param rarefaction_steps: Number of depths of the alpha rarefaction curves, see alpha_rarefaction_curves()
+    :param rarefaction_iterations: Number of subsamples drawn at every depth of the alpha rarefaction curves
+    :param out_of_core: Compute diversity metrics with run_diversity_metrics_out_of_core(), which keeps the distance
+    matrices on disk, instead of run_diversity_metrics()
+    :return: Dictionary of {stage name: stage result}
     """
-    # Load seed object
-    data_artifact = load_data_artifact(data_artifact_path)
+    if profile_records is None:
+        profile_records = []
+
+    # Paths to the artifacts passed between stages
+    table_path = os.path.join(base_dir, 'table-dada2.qza')
+    rep_seqs_path = os.path.join(base_dir, 'rep-seqs-dada2.qza')
+    masked_alignment_path = os.path.join(base_dir, 'masked-aligned-rep-seqs.qza')
+    rooted_tree_path = os.path.join(base_dir, 'rooted-tree.qza')
+    taxonomy_path = os.path.join(base_dir, 'taxonomy.qza')
 
     # Validate and correct metadata (currently only adds _00 if the SampleID doesn't end with it already)
     new_metadata_path = validate_metadata(sample_metadata_path)
@@ -530,46 +916,162 @@ def run_pipeline(base_dir, data_artifact_path, sample_metadata_path, classifier_
     # Load metadata
     metadata_object = load_sample_metadata(new_metadata_path)
 
-    # Visualize metadata
-    visualize_metadata(base_dir=base_dir, metadata_object=metadata_object)
-
-    # Demux
-    visualize_demux(base_dir=base_dir, data_artifact=data_artifact)
-
-    # Filter & denoise w/dada2
-    dada2_filtered_table, dada2_filtered_rep_seqs = dada2_qc(base_dir=base_dir, demultiplexed_seqs=data_artifact,
-                                                             trim_left_f=trim_left_f, trim_left_r=trim_left_r,
-                                                             trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r)
-    # Visualize dada2
-    visualize_dada2(base_dir=base_dir, dada2_filtered_table=dada2_filtered_table,
-                    dada2_filtered_rep_seqs=dada2_filtered_rep_seqs, metadata_object=metadata_object)
+    dada2_params = dict(trim_left_f=trim_left_f, trim_left_r=trim_left_r,
+                        trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r)
+    classifier_id = classifier_store.archive_fingerprint(classifier_artifact_path)['uuid']
+
+    def cached(stage_name, func, kwargs, outputs, input_paths, params=None, restore_func=None, identified_inputs=None):
+        # identified_inputs: {path: identifier} of inputs keyed by identity instead of content, see stage_cache
+        identified_inputs = identified_inputs or {}
+        output_paths = [os.path.join(base_dir, output) for output in outputs]
+        with profiling.profile_stage(profile_records, stage_name, input_paths + list(identified_inputs),
+                                     output_paths):
+            return stage_cache.run_cached_stage(stage_name, func, kwargs=kwargs, base_dir=base_dir, outputs=outputs,
+                                                input_paths=input_paths, params=params, restore_func=restore_func,
+                                                cache_dir=cache_dir, resume=resume,
+                                                input_ids=list(identified_inputs.values()))
+
+    # Each stage receives the results of its dependencies and the number of CPUs allocated to it
+    def load_data_stage(results, cpus):
+        with profiling.profile_stage(profile_records, 'load_data', [data_artifact_path]):
+            return load_data_artifact(data_artifact_path)
+
+    def visualize_metadata_stage(results, cpus):
+        return cached('visualize_metadata', visualize_metadata,
+                      kwargs=dict(base_dir=base_dir, metadata_object=metadata_object),
+                      outputs=['sample-metadata-tabulate.qzv'], input_paths=[new_metadata_path])
+
+    def visualize_demux_stage(results, cpus):
+        return cached('visualize_demux', visualize_demux,
+                      kwargs=dict(base_dir=base_dir, data_artifact=results['load_data']),
+                      outputs=['demux_summary.qzv'], input_paths=[data_artifact_path])
+
+    def dada2_stage(results, cpus):
+        if dada2_shard_size is not None:
+            return cached('dada2_qc', dada2_sharding.denoise_sharded,
+                          kwargs=dict(base_dir=base_dir, data_artifact_path=data_artifact_path, cpu_count=cpus,
+                                      shard_size=dada2_shard_size, work_dir=dada2_shard_dir, **dada2_params),
+                          outputs=['table-dada2.qza', 'rep-seqs-dada2.qza', 'dada2-denoising-stats.qza'],
+                          input_paths=[data_artifact_path], params=dada2_params, restore_func=load_dada2_outputs)
+        return cached('dada2_qc', dada2_qc,
+                      kwargs=dict(base_dir=base_dir, demultiplexed_seqs=results['load_data'], cpu_count=cpus,
+                                  **dada2_params),
+                      outputs=['table-dada2.qza', 'rep-seqs-dada2.qza', 'dada2-denoising-stats.qza'],
+                      input_paths=[data_artifact_path], params=dada2_params, restore_func=load_dada2_outputs)
+
+    def visualize_dada2_stage(results, cpus):
+        (dada2_filtered_table, dada2_filtered_rep_seqs) = results['dada2_qc']
+        return cached('visualize_dada2', visualize_dada2,
+                      kwargs=dict(base_dir=base_dir, dada2_filtered_table=dada2_filtered_table,
+                                  dada2_filtered_rep_seqs=dada2_filtered_rep_seqs, metadata_object=metadata_object),
+                      outputs=['table-dada2-summary.qzv', 'rep-seqs-summary.qzv'],
+                      input_paths=[table_path, rep_seqs_path, new_metadata_path])
+
+    def alignment_stage(results, cpus):
+        return cached('seq_alignment_mask', seq_alignment_mask,
+                      kwargs=dict(base_dir=base_dir, dada2_filtered_rep_seqs=results['dada2_qc'][1], cpu_count=cpus),
+                      outputs=['aligned-rep-seqs.qza', 'masked-aligned-rep-seqs.qza'],
+                      input_paths=[rep_seqs_path], restore_func=load_alignment_outputs)
+
+    def tree_stage(results, cpus):
+        (seq_mask, seq_alignment) = results['seq_alignment_mask']
+        return cached('phylo_tree', phylo_tree,
+                      kwargs=dict(base_dir=base_dir, seq_mask=seq_mask),
+                      outputs=['unrooted-tree.qza', 'rooted-tree.qza'],
+                      input_paths=[masked_alignment_path], restore_func=load_tree_outputs)
+
+    def export_newick_stage(results, cpus):
+        (phylo_unrooted_tree, phylo_rooted_tree) = results['phylo_tree']
+        return cached('export_newick', export_newick,
+                      kwargs=dict(base_dir=base_dir, tree=phylo_rooted_tree),
+                      outputs=[os.path.join('tree', 'tree.nwk')], input_paths=[rooted_tree_path])
+
+    def rarefaction_stage(results, cpus):
+        (phylo_unrooted_tree, phylo_rooted_tree) = results['phylo_tree']
+        rarefaction_params = dict(steps=rarefaction_steps, iterations=rarefaction_iterations)
+        return cached('alpha_rarefaction', alpha_rarefaction_curves,
+                      kwargs=dict(base_dir=base_dir, dada2_filtered_table=results['dada2_qc'][0],
+                                  phylo_rooted_tree=phylo_rooted_tree, cpu_count=cpus, **rarefaction_params),
+                      outputs=['alpha-rarefaction.tsv', 'alpha-rarefaction.png'],
+                      input_paths=[table_path, rooted_tree_path], params=rarefaction_params)
+
+    def classify_stage(results, cpus):
+        # The classifier is only loaded when the stage actually has to run
+        return cached('classify_taxonomy', classify_taxonomy_cached,
+                      kwargs=dict(base_dir=base_dir, dada2_filtered_rep_seqs=results['dada2_qc'][1], cpu_count=cpus,
+                                  classifier_artifact_path=classifier_artifact_path, cache_path=taxonomy_cache_path,
+                                  max_entries=taxonomy_cache_size),
+                      outputs=['taxonomy.qza'], input_paths=[rep_seqs_path],
+                      identified_inputs={classifier_artifact_path: classifier_id}, restore_func=load_taxonomy_outputs)
+
+    def visualize_taxonomy_stage(results, cpus):
+        return cached('visualize_taxonomy', visualize_taxonomy,
+                      kwargs=dict(base_dir=base_dir, metadata_object=metadata_object,
+                                  taxonomy_analysis=results['classify_taxonomy'],
+                                  dada2_filtered_table=results['dada2_qc'][0]),
+                      outputs=['taxonomy.qzv', 'taxonomy_barplot.qzv'],
+                      input_paths=[new_metadata_path, taxonomy_path, table_path])
+
+    run_path = os.path.dirname(os.path.abspath(base_dir))
+    if run_id is None:
+        run_id = run_path
+
+    def register_asvs_stage(results, cpus):
+        (dada2_filtered_table, dada2_filtered_rep_seqs) = results['dada2_qc']
+        with profiling.profile_stage(profile_records, 'register_asvs', [table_path, rep_seqs_path]):
+            return register_asvs(registry_path=registry_path, run_id=run_id, run_path=run_path,
+                                 dada2_filtered_table=dada2_filtered_table,
+                                 dada2_filtered_rep_seqs=dada2_filtered_rep_seqs, overwrite=overwrite_run_id)
+
+    def register_taxonomy_stage(results, cpus):
+        with profiling.profile_stage(profile_records, 'register_taxonomy', [taxonomy_path]):
+            return register_taxonomy(registry_path=registry_path, taxonomy_analysis=results['classify_taxonomy'],
+                                     dada2_filtered_rep_seqs=results['dada2_qc'][1])
+
+    # Alpha and beta diversity
+    # TODO: requires metadata object with some sort of sample information (e.g. sample type)
+    def diversity_stage(results, cpus):
+        (phylo_unrooted_tree, phylo_rooted_tree) = results['phylo_tree']
+        kwargs = dict(base_dir=base_dir, dada2_filtered_table=results['dada2_qc'][0],
+                      phylo_rooted_tree=phylo_rooted_tree, metadata_object=metadata_object, cpu_count=cpus)
+        input_paths = [table_path, rooted_tree_path, new_metadata_path]
+        if out_of_core:
+            return cached('run_diversity_metrics', run_diversity_metrics_out_of_core, kwargs=kwargs,
+                          outputs=OUT_OF_CORE_DIVERSITY_OUTPUTS, input_paths=input_paths,
+                          params=dict(out_of_core=True))
+        return cached('run_diversity_metrics', run_diversity_metrics, kwargs=kwargs, outputs=DIVERSITY_OUTPUTS,
+                      input_paths=input_paths)
+
+    stages = [
+        stage_scheduler.make_stage('load_data', load_data_stage),
+        stage_scheduler.make_stage('visualize_metadata', visualize_metadata_stage),
+        stage_scheduler.make_stage('visualize_demux', visualize_demux_stage, ['load_data']),
+        stage_scheduler.make_stage('dada2_qc', dada2_stage, ['load_data'], cpus=None),
+        stage_scheduler.make_stage('visualize_dada2', visualize_dada2_stage, ['dada2_qc']),
+    ]
 
     if filtering_flag is False:
-        # Mask and alignment
-        (seq_mask, seq_alignment) = seq_alignment_mask(base_dir=base_dir,
-                                                       dada2_filtered_rep_seqs=dada2_filtered_rep_seqs)
-
-        # Phylogenetic tree
-        (phylo_unrooted_tree, phylo_rooted_tree) = phylo_tree(base_dir=base_dir, seq_mask=seq_mask)
-
-        # Export tree
-        export_newick(base_dir=base_dir, tree=phylo_rooted_tree)
-
-        # Load classifier
-        classifier = load_artifact(artifact_path=classifier_artifact_path)
-
-        # Produce rarefaction visualization
-        alpha_rarefaction_visualization(base_dir=base_dir, dada2_filtered_table=dada2_filtered_table)
-
-        # Run taxonomic analysis
-        taxonomy_analysis = classify_taxonomy(base_dir=base_dir, dada2_filtered_rep_seqs=dada2_filtered_rep_seqs,
-                                              classifier=classifier)
-
-        # Visualize taxonomy
-        visualize_taxonomy(base_dir=base_dir, metadata_object=metadata_object,
-                           taxonomy_analysis=taxonomy_analysis, dada2_filtered_table=dada2_filtered_table)
-
-        # Alpha and beta diversity
-        # TODO: requires metadata object with some sort of sample information (e.g. sample type)
-        run_diversity_metrics(base_dir=base_dir, dada2_filtered_table=dada2_filtered_table,
-                              phylo_rooted_tree=phylo_rooted_tree, metadata_object=metadata_object)
+        stages += [
+            stage_scheduler.make_stage('seq_alignment_mask', alignment_stage, ['dada2_qc'], cpus=None),
+            stage_scheduler.make_stage('phylo_tree', tree_stage, ['seq_alignment_mask']),
+            stage_scheduler.make_stage('export_newick', export_newick_stage, ['phylo_tree']),
+            stage_scheduler.make_stage('alpha_rarefaction', rarefaction_stage, ['phylo_tree', 'dada2_qc'], cpus=None),
+            stage_scheduler.make_stage('classify_taxonomy', classify_stage, ['dada2_qc'], cpus=None),
+            stage_scheduler.make_stage('visualize_taxonomy', visualize_taxonomy_stage,
+                                       ['classify_taxonomy', 'dada2_qc']),
+            stage_scheduler.make_stage('run_diversity_metrics', diversity_stage, ['phylo_tree', 'dada2_qc'],
+                                       cpus=None),
+        ]
+
+    if registry_path is not None:
+        stages.append(stage_scheduler.make_stage('register_asvs', register_asvs_stage, ['dada2_qc']))
+        if filtering_flag is False:
+            stages.append(stage_scheduler.make_stage('register_taxonomy', register_taxonomy_stage,
+                                                     ['register_asvs', 'classify_taxonomy', 'dada2_qc']))
+
+    # The profile is written even if a stage fails, so the stages that did complete can still be inspected
+    try:
+        return stage_scheduler.run_stage_graph(stages, cpu_budget=cpu_count)
+    finally:
+        profiling.write_run_profile(profile_records, base_dir)
+        profiling.log_profile_summary(profile_records)
@@ -0,0 +1,352 @@
+"""
+Native FASTQ quality profiler used by ampliconpipeline.py --evaluate_quality.
+
+Streams the .fastq.gz files of a run in a process pool and accumulates, per sample and read direction, a histogram of
+Phred scores at every position and a read length histogram with NumPy. From those it reports per-position quality
+quantiles (the same 2/9/25/50/75/91/98th percentiles shown by QIIME 2's demux summary) as JSON and a PNG, without
+importing the run into a QIIME 2 artifact.
+"""
+
+import os
+import gzip
+import json
+import click
+import logging
+import itertools
+import multiprocessing
+
+import numpy as np
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from bin import helper_functions
+
+PHRED_OFFSET = 33
+N_QUALITY_BINS = 64
+CHUNK_SIZE = 20000
+DEFAULT_MAX_READS = 100000
+QUANTILES = (0.02, 0.09, 0.25, 0.5, 0.75, 0.91, 0.98)
+DIRECTIONS = OrderedDict([('R1', 'forward'), ('R2', 'reverse')])
+
+
+def empty_histograms() -> tuple:
+    """
+    :return: Tuple of (position histogram with shape (positions, N_QUALITY_BINS), read length histogram)
+    """
+    return np.zeros((0, N_QUALITY_BINS), dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+
+def _grow(array: np.ndarray, length: int) -> np.ndarray:
+    """
+    :return: array zero-padded along its first axis to at least length rows
+    """
+    if array.shape[0] >= length:
+        return array
+    padding = [(0, length - array.shape[0])] + [(0, 0)] * (array.ndim - 1)
+    return np.pad(array, padding, mode='constant')
+
+
+def accumulate_qualities(quality_lines: list, position_histogram: np.ndarray, length_histogram: np.ndarray) -> tuple:
+    """
+    Adds a chunk of quality strings to the histograms with a single bincount
+
+    :param quality_lines: List of quality strings (bytes, without newline)
+    :param position_histogram: Histogram of scores per position, shape (positions, N_QUALITY_BINS)
+    :param length_histogram: Histogram of read lengths
+    :return: Updated (position_histogram, length_histogram)
+    """
+    lengths = np.fromiter((len(line) for line in quality_lines), dtype=np.int64, count=len(quality_lines))
+    if lengths.size == 0 or lengths.max() == 0:
+        return position_histogram, length_histogram
+
+    scores = np.frombuffer(b''.join(quality_lines), dtype=np.uint8).astype(np.int64) - PHRED_OFFSET
+    scores = np.clip(scores, 0, N_QUALITY_BINS - 1)
+
+    # Position of every score within its read
+    read_starts = np.cumsum(lengths) - lengths
+    positions = np.arange(scores.size) - np.repeat(read_starts, lengths)
+
+    max_length = int(lengths.max())
+    chunk_histogram = np.bincount(positions * N_QUALITY_BINS + scores,
+                                  minlength=max_length * N_QUALITY_BINS).reshape(max_length, N_QUALITY_BINS)
+
+    position_histogram = _grow(position_histogram, max_length)
+    position_histogram[:max_length] += chunk_histogram
+
+    length_histogram = _grow(length_histogram, max_length + 1)
+    length_histogram[:max_length + 1] += np.bincount(lengths, minlength=max_length + 1)
+    return position_histogram, length_histogram
+
+
+def _quality_chunks(quality_lines) -> list:
+    """
+    :param quality_lines: Iterator over the quality lines of a FASTQ file
+    :return: Generator of lists of up to CHUNK_SIZE quality strings without their newline
+    """
+    while True:
+        chunk = [line.rstrip(b'\r\n') for line in itertools.islice(quality_lines, CHUNK_SIZE)]
+        if not chunk:
+            return
+        yield chunk
+
+
+def reservoir_sample(chunks, max_items: int, seed: int = 0) -> tuple:
+    """
+    Draws a uniform random sample of max_items items from a stream of any length (reservoir sampling), with the
+    replacements of each chunk drawn at once
+
+    :param chunks: Iterator over lists of items
+    :param max_items: Number of items to keep
+    :param seed: Seed of the sample
+    :return: Tuple of (list of sampled items, number of items in the stream)
+    """
+    random_state = np.random.RandomState(seed)
+    reservoir = []
+    n_seen = 0
+    for chunk in chunks:
+        n_fill = min(len(chunk), max_items - len(reservoir))
+        reservoir.extend(chunk[:n_fill])
+        if n_fill < len(chunk):
+            # Item i replaces a random slot in [0, i] if that slot is in the reservoir
+            item_indices = np.arange(n_seen + n_fill, n_seen + len(chunk))
+            slots = (random_state.random_sample(len(item_indices)) * (item_indices + 1)).astype(np.int64)
+            for position in np.flatnonzero(slots < max_items):
+                reservoir[slots[position]] = chunk[n_fill + position]
+        n_seen += len(chunk)
+    return reservoir, n_seen
+
+
+def sample_quality_lines(quality_lines, max_reads: int, seed: int = 0) -> tuple:
+    """
+    Draws a uniform random sample of max_reads quality strings from across the whole file. The first tiles of a
+    MiSeq run have lower quality than the rest, so the first reads of a file are not representative of it.
+
+    :param quality_lines: Iterator over the quality lines of a FASTQ file
+    :param max_reads: Number of quality strings to keep
+    :param seed: Seed of the sample
+    :return: Tuple of (list of sampled quality strings, number of reads in the file)
+    """
+    return reservoir_sample(_quality_chunks(quality_lines), max_reads, seed=seed)
+
+
+def profile_fastq(filepath: str, max_reads: int = DEFAULT_MAX_READS, seed: int = 0) -> tuple:
+    """
+    :param filepath: Path to a .fastq.gz file
+    :param max_reads: Only profile a uniform random sample of max_reads reads drawn from the whole file. Profiles
+    every read when None or 0.
+    :param seed: Seed of the sample
+    :return: Tuple of (position histogram, read length histogram, number of reads profiled)
+    """
+    position_histogram, length_histogram = empty_histograms()
+    n_reads = 0
+    with gzip.open(filepath, 'rb') as f:
+        # Every fourth line of a FASTQ record is the quality string
+        quality_lines = itertools.islice(f, 3, None, 4)
+        if max_reads:
+            sample, _ = sample_quality_lines(quality_lines, max_reads, seed=seed)
+            chunks = (sample[start:start + CHUNK_SIZE] for start in range(0, len(sample), CHUNK_SIZE))
+        else:
+            chunks = _quality_chunks(quality_lines)
+        for chunk in chunks:
+            position_histogram, length_histogram = accumulate_qualities(chunk, position_histogram, length_histogram)
+            n_reads += len(chunk)
+    return position_histogram, length_histogram, n_reads
+
+
+def _profile_task(task: tuple) -> tuple:
+    """
+    Process pool entry point
+
+    :param task: Tuple of (sample_id, read direction, filepath, max_reads)
+    :return: Tuple of (sample_id, read direction, profile_fastq() result)
+    """
+    sample_id, read, filepath, max_reads = task
+    return sample_id, read, profile_fastq(filepath, max_reads=max_reads)
+
+
+def profile_run(index: dict, max_reads: int = DEFAULT_MAX_READS, cpu_count: int = None) -> dict:
+    """
+    Profiles every file of a run in a process pool
+
+    :param index: Index generated by helper_functions.index_fastq_files()
+    :param max_reads: Number of reads sampled from across each file and profiled. Profiles every read when None or 0.
+    :param cpu_count: Number of worker processes. Defaults to all CPUs.
+    :return: Dictionary of {read direction: OrderedDict({sample_id: {'position_histogram', 'length_histogram',
+    'n_reads'}})}. Lanes of the same sample are combined.
+    """
+    tasks = [(sample_id, read, reads[read], max_reads)
+             for sample_id, lanes in index.items()
+             for reads in lanes.values()
+             for read in DIRECTIONS]
+
+    profile = {read: OrderedDict() for read in DIRECTIONS}
+    for sample_id in index:
+        for read in DIRECTIONS:
+            position_histogram, length_histogram = empty_histograms()
+            profile[read][sample_id] = {'position_histogram': position_histogram,
+                                        'length_histogram': length_histogram,
+                                        'n_reads': 0}
+
+    logging.info('Profiling quality of {} .fastq.gz files...'.format(len(tasks)))
+    with ProcessPoolExecutor(max_workers=cpu_count or multiprocessing.cpu_count()) as executor:
+        for sample_id, read, (position_histogram, length_histogram, n_reads) in executor.map(_profile_task, tasks):
+            sample_profile = profile[read][sample_id]
+            sample_profile['position_histogram'] = _add_histograms(sample_profile['position_histogram'],
+                                                                   position_histogram)
+            sample_profile['length_histogram'] = _add_histograms(sample_profile['length_histogram'],
+                                                                 length_histogram)
+            sample_profile['n_reads'] += n_reads
+    return profile
+
+
+def _add_histograms(first: np.ndarray, second: np.ndarray) -> np.ndarray:
+    """
+    :return: Sum of two histograms that may differ in length along their first axis
+    """
+    length = max(first.shape[0], second.shape[0])
+    return _grow(first, length) + _grow(second, length)
+
+
+def combine_samples(sample_profiles: dict) -> np.ndarray:
+    """
+    :param sample_profiles: Dictionary of {sample_id: sample profile} for one read direction from profile_run()
+    :return: Position histogram summed over every sample
+    """
+    combined, _ = empty_histograms()
+    for sample_profile in sample_profiles.values():
+        combined = _add_histograms(combined, sample_profile['position_histogram'])
+    return combined
+
+
+def histogram_quantiles(position_histogram: np.ndarray, quantiles: tuple = QUANTILES) -> OrderedDict:
+    """
+    :param position_histogram: Histogram of scores per position, shape (positions, N_QUALITY_BINS)
+    :param quantiles: Quantiles to compute, between 0 and 1
+    :return: OrderedDict of {quantile: array of the quantile score at each position}
+    """
+    totals = position_histogram.sum(axis=1)
+    cumulative = np.cumsum(position_histogram, axis=1) / np.maximum(totals, 1)[:, np.newaxis]
+    return OrderedDict((quantile, np.argmax(cumulative >= quantile, axis=1)) for quantile in quantiles)
+
+
+def summarize_histogram(position_histogram: np.ndarray, length_histogram: np.ndarray = None,
+                        n_reads: int = None) -> OrderedDict:
+    """
+    :return: JSON-serializable summary of a position histogram with per-position quantiles, mean and read counts
+    """
+    totals = position_histogram.sum(axis=1)
+    means = (position_histogram * np.arange(N_QUALITY_BINS)).sum(axis=1) / np.maximum(totals, 1)
+    summary = OrderedDict()
+    if n_reads is not None:
+        summary['n_reads'] = int(n_reads)
+    summary['reads_per_position'] = totals.tolist()
+    summary['mean'] = np.round(means, 2).tolist()
+    summary['quantiles'] = OrderedDict(('{:g}'.format(quantile * 100), values.tolist())
+                                       for quantile, values in histogram_quantiles(position_histogram).items())
+    if length_histogram is not None:
+        lengths = np.nonzero(length_histogram)[0]
+        summary['read_lengths'] = OrderedDict((str(length), int(length_histogram[length])) for length in lengths)
+    return summary
+
+
+def plot_quality_profile(profile: dict, out_path: str) -> str:
+    """
+    Plots median quality with 25-75th and 9-91st percentile bands per position for each read direction
+
+    :param profile: Profile generated by profile_run()
+    :param out_path: Path to write the .png to
+    :return: out_path
+    """
+    fig, axes = plt.subplots(len(DIRECTIONS), 1, figsize=(14, 8), sharey=True)
+    for ax, (read, direction) in zip(axes, DIRECTIONS.items()):
+        quantiles = histogram_quantiles(combine_samples(profile[read]))
+        positions = np.arange(1, len(quantiles[0.5]) + 1)
+        ax.fill_between(positions, quantiles[0.09], quantiles[0.91], color='lightsteelblue', label='9th-91st')
+        ax.fill_between(positions, quantiles[0.25], quantiles[0.75], color='steelblue', label='25th-75th')
+        ax.plot(positions, quantiles[0.5], color='black', linewidth=1, label='median')
+        ax.set_title('{} reads'.format(direction.capitalize()))
+        ax.set_xlabel('Position (bp)')
+        ax.set_ylabel('Quality score')
+        ax.legend(loc='lower left')
+    fig.tight_layout()
+    fig.savefig(out_path)
+    plt.close(fig)
+    logging.info('Saved {}'.format(out_path))
+    return out_path
+
+
+def write_quality_report(profile: dict, out_dir: str) -> tuple:
+    """
+    :param profile: Profile generated by profile_run()
+    :param out_dir: Folder to write quality_profile.json and quality_profile.png into
+    :return: Tuple of (path to .json report, path to .png plot)
+    """
+    report = OrderedDict()
+    for read, direction in DIRECTIONS.items():
+        report[direction] = summarize_histogram(combine_samples(profile[read]),
+                                                n_reads=sum(p['n_reads'] for p in profile[read].values()))
+
+    report['samples'] = OrderedDict()
+    for read, direction in DIRECTIONS.items():
+        for sample_id, sample_profile in profile[read].items():
+            report['samples'].setdefault(sample_id, OrderedDict())[direction] = summarize_histogram(
+                sample_profile['position_histogram'], sample_profile['length_histogram'], sample_profile['n_reads'])
+
+    json_path = os.path.join(out_dir, 'quality_profile.json')
+    with open(json_path, 'w') as f:
+        json.dump(report, f, indent=1)
+    logging.info('Saved {}'.format(json_path))
+
+    png_path = plot_quality_profile(profile, os.path.join(out_dir, 'quality_profile.png'))
+    return json_path, png_path
+
+
+def evaluate_quality(inputdir: str, outdir: str, max_reads: int = DEFAULT_MAX_READS, cpu_count: int = None,
+                     fastq_pattern: str = helper_functions.DEFAULT_FASTQ_PATTERN) -> tuple:
+    """
+    Profiles the quality of every paired .fastq.gz file in a run directory and writes the report to outdir
+
+    :param inputdir: Directory containing raw MiSeq output
+    :param outdir: Folder to write the report into. Created if it doesn't exist.
+    :param max_reads: Number of reads sampled from across each file and profiled. Profiles every read when None or 0.
+    :param cpu_count: Number of worker processes. Defaults to all CPUs.
+    :param fastq_pattern: Filename regular expression used to pair reads
+    :return: Tuple of (path to .json report, path to .png plot)
+    """
+    os.makedirs(outdir, exist_ok=True)
+    index, orphans = helper_functions.index_fastq_directory(inputdir, pattern=fastq_pattern)
+    profile = profile_run(index, max_reads=max_reads, cpu_count=cpu_count)
+    return write_quality_report(profile, outdir)
+
+
+@click.command()
+@click.option('-i', '--inputdir',
+              type=click.Path(exists=True),
+              required=True,
+              help='Directory containing your raw MiSeq output (files must be *.fastq.gz)')
+@click.option('-o', '--outdir',
+              type=click.Path(),
+              required=True,
+              help='Folder to write quality_profile.json and quality_profile.png into')
+@click.option('--max_reads',
+              default=DEFAULT_MAX_READS,
+              help='Number of reads sampled from across each file to profile. Set to 0 to profile every read. '
+                   'Defaults to {}.'.format(DEFAULT_MAX_READS))
+@click.option('-n', '--cpus',
+              type=click.INT,
+              default=None,
+              help='Number of worker processes. Defaults to all CPUs.')
+def cli(inputdir, outdir, max_reads, cpus):
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    evaluate_quality(inputdir=inputdir, outdir=outdir, max_reads=max_reads, cpu_count=cpus)
+
+
+if __name__ == '__main__':
+    cli()
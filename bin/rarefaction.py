@@ -0,0 +1,239 @@
+"""
+Alpha rarefaction curves computed directly from the sparse feature table.
+
+Subsampling a sample to depth d without replacement is the same as taking the first d reads of a random permutation of
+its reads, and the first d reads of that permutation are also a valid subsample at every smaller depth. So each
+iteration shuffles the reads of a sample once and reads every depth off the prefixes of that single permutation:
+feature counts grow with one bincount per depth, a feature is observed at depth d if its first read falls before d,
+and a branch of the tree counts towards Faith's PD at depth d if the first read of any tip below it does. Only the
+non-zero counts of each sample are expanded, and iterations run in parallel in a process pool. The pool spawns its
+workers rather than forking them, since the pipeline calls this from the stage scheduler's threads.
+
+The curves (observed features, Shannon and Faith's PD, as computed by QIIME 2's alpha_rarefaction) are returned as a
+table with a row per sample, depth and iteration.
+"""
+
+import logging
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import matplotlib as mpl
+mpl.use('Agg')
+import matplotlib.pyplot as plt
+
+from scipy import sparse
+from collections import namedtuple
+
+# Same defaults as QIIME 2's alpha_rarefaction
+DEFAULT_MIN_DEPTH = 1
+DEFAULT_STEPS = 10
+DEFAULT_ITERATIONS = 10
+METRICS = ['observed_features', 'shannon', 'faith_pd']
+
+# parents: index of the parent of every node (-1 for the root); lengths: branch length of every node; tips: node index
+# of every feature (-1 if it isn't in the tree); levels: node indices grouped by height, tips first, so every node
+# comes after all of its descendants
+Phylogeny = namedtuple('Phylogeny', ['parents', 'lengths', 'tips', 'levels'])
+
+
+def rarefaction_depths(max_depth: int, steps: int = DEFAULT_STEPS, min_depth: int = DEFAULT_MIN_DEPTH) -> np.ndarray:
+    """
+    :return: steps evenly spaced depths from min_depth to max_depth, as in QIIME 2's alpha_rarefaction
+    """
+    return np.unique(np.linspace(min_depth, max_depth, num=steps).astype(int))
+
+
+def make_phylogeny(parents, lengths, tips) -> Phylogeny:
+    """
+    :param parents: Index of the parent of every node, -1 for the root
+    :param lengths: Branch length of every node. The root's length is ignored.
+    :param tips: Node index of every feature of the table, -1 for features not in the tree
+    :return: Phylogeny namedtuple
+    """
+    parents = np.asarray(parents, dtype=np.int64)
+    lengths = np.nan_to_num(np.asarray(lengths, dtype=float))
+    lengths[parents < 0] = 0
+
+    # Height of every node above its deepest tip, found by walking up from every tip
+    heights = np.zeros(len(parents), dtype=np.int64)
+    nodes = np.flatnonzero(parents >= 0)
+    height = 0
+    while len(nodes):
+        height += 1
+        nodes = parents[nodes]
+        np.maximum.at(heights, nodes, height)
+        nodes = np.unique(nodes[parents[nodes] >= 0])
+    levels = [np.flatnonzero(heights == level) for level in range(int(heights.max()) + 1)] if len(parents) else []
+    return Phylogeny(parents=parents, lengths=lengths, tips=np.asarray(tips, dtype=np.int64), levels=levels)
+
+
+def phylogeny_from_tree(tree, feature_ids: list) -> Phylogeny:
+    """
+    :param tree: Rooted skbio.TreeNode, e.g. viewed from a QIIME 2 Phylogeny[Rooted] artifact
+    :param feature_ids: Feature IDs of the rows of the table
+    :return: Phylogeny namedtuple
+    """
+    nodes = list(tree.postorder(include_self=True))
+    index = {id(node): i for i, node in enumerate(nodes)}
+    parents = [index[id(node.parent)] if node.parent is not None else -1 for node in nodes]
+    lengths = [node.length if node.length is not None else 0 for node in nodes]
+    tip_index = {node.name: i for i, node in enumerate(nodes) if node.is_tip()}
+    return make_phylogeny(parents, lengths, [tip_index.get(feature_id, -1) for feature_id in feature_ids])
+
+
+def first_read_positions(prefix: np.ndarray, n_labels: int) -> np.ndarray:
+    """
+    :param prefix: Feature label of every read, in subsampling order
+    :param n_labels: Number of distinct labels
+    :return: Position of the first read of every label in prefix, or len(prefix) if it doesn't occur
+    """
+    first = np.full(n_labels, len(prefix), dtype=np.int64)
+    labels, positions = np.unique(prefix, return_index=True)
+    first[labels] = positions
+    return first
+
+
+def sample_curves(features: np.ndarray, counts: np.ndarray, depths: np.ndarray, random_state: np.random.RandomState,
+                  phylogeny: Phylogeny = None) -> np.ndarray:
+    """
+    Rarefies a single sample to every depth once
+
+    :param features: Row indices of the features observed in the sample
+    :param counts: Counts of those features
+    :param depths: Sorted depths to rarefy to
+    :param random_state: numpy RandomState drawing the subsample
+    :param phylogeny: Phylogeny of the features. Faith's PD is NaN when None.
+    :return: Array of depths x METRICS. NaN at depths deeper than the sample.
+    """
+    curves = np.full((len(depths), len(METRICS)), np.nan)
+    total = int(counts.sum())
+    n_depths = int(np.searchsorted(depths, total, side='right'))
+    if n_depths == 0:
+        return curves
+
+    reads = np.repeat(np.arange(len(features)), counts.astype(np.int64))
+    random_state.shuffle(reads)
+    prefix = reads[:depths[n_depths - 1]]
+    first = first_read_positions(prefix, len(features))
+
+    # Observed features: features whose first read falls within the depth
+    curves[:n_depths, 0] = np.searchsorted(np.sort(first), depths[:n_depths], side='left')
+
+    # Shannon entropy (base 2, as in scikit-bio) of the counts at every depth
+    depth_counts = np.zeros(len(features))
+    start = 0
+    for i, depth in enumerate(depths[:n_depths]):
+        depth_counts += np.bincount(prefix[start:depth], minlength=len(features))
+        start = depth
+        proportions = depth_counts[depth_counts > 0] / depth
+        curves[i, 1] = -np.sum(proportions * np.log2(proportions))
+
+    if phylogeny is not None:
+        # First read below every node, propagated up the tree one level at a time
+        node_first = np.full(len(phylogeny.parents), len(prefix), dtype=np.int64)
+        tips = phylogeny.tips[features]
+        in_tree = tips >= 0
+        np.minimum.at(node_first, tips[in_tree], first[in_tree])
+        for level in phylogeny.levels:
+            level = level[phylogeny.parents[level] >= 0]
+            np.minimum.at(node_first, phylogeny.parents[level], node_first[level])
+        order = np.argsort(node_first, kind='mergesort')
+        cumulative_lengths = np.concatenate([[0], np.cumsum(phylogeny.lengths[order])])
+        curves[:n_depths, 2] = cumulative_lengths[np.searchsorted(node_first[order], depths[:n_depths],
+                                                                  side='left')]
+    return curves
+
+
+def rarefy_iteration(matrix, depths: np.ndarray, seed: int, phylogeny: Phylogeny = None) -> np.ndarray:
+    """
+    :param matrix: scipy sparse matrix of counts with features as rows and samples as columns
+    :param depths: Sorted depths to rarefy to
+    :param seed: Seed of the iteration
+    :param phylogeny: Phylogeny of the features
+    :return: Array of samples x depths x METRICS
+    """
+    matrix = sparse.csc_matrix(matrix)
+    random_state = np.random.RandomState(seed)
+    curves = np.empty((matrix.shape[1], len(depths), len(METRICS)))
+    for sample in range(matrix.shape[1]):
+        column = slice(matrix.indptr[sample], matrix.indptr[sample + 1])
+        observed = matrix.data[column] > 0
+        curves[sample] = sample_curves(matrix.indices[column][observed], matrix.data[column][observed], depths,
+                                       random_state, phylogeny=phylogeny)
+    return curves
+
+
+def _init_rarefaction_worker(matrix, depths, phylogeny):
+    global _worker_data
+    _worker_data = (matrix, depths, phylogeny)
+
+
+def _rarefy_iteration_worker(seed):
+    matrix, depths, phylogeny = _worker_data
+    return rarefy_iteration(matrix, depths, seed, phylogeny=phylogeny)
+
+
+def rarefaction_curves(matrix, sample_ids: list, max_depth: int, steps: int = DEFAULT_STEPS,
+                       iterations: int = DEFAULT_ITERATIONS, phylogeny: Phylogeny = None, processes: int = None,
+                       seed: int = 0, min_depth: int = DEFAULT_MIN_DEPTH) -> pd.DataFrame:
+    """
+    :param matrix: scipy sparse matrix of counts with features as rows and samples as columns
+    :param sample_ids: Sample IDs of the columns
+    :param max_depth: Deepest depth to rarefy to
+    :param steps: Number of depths between min_depth and max_depth
+    :param iterations: Number of subsamples drawn at every depth
+    :param phylogeny: Phylogeny of the features for Faith's PD, see phylogeny_from_tree(). Not computed when None.
+    :param processes: Number of iterations run in parallel. Defaults to all CPUs.
+    :param seed: Seed of the first iteration. Iteration i uses seed + i, so results are reproducible.
+    :param min_depth: Shallowest depth to rarefy to
+    :return: DataFrame with the columns sample_id, depth, iteration and one per metric. Samples shallower than a
+    depth have no rows for it.
+    """
+    depths = rarefaction_depths(max_depth, steps=steps, min_depth=min_depth)
+    matrix = sparse.csc_matrix(matrix)
+    seeds = [seed + i for i in range(iterations)]
+    processes = min(processes or multiprocessing.cpu_count(), iterations)
+    logging.debug('Rarefying {} samples to {} depths x {} iterations'.format(matrix.shape[1], len(depths),
+                                                                            iterations))
+
+    if processes > 1:
+        with multiprocessing.get_context('spawn').Pool(processes, initializer=_init_rarefaction_worker,
+                                                       initargs=(matrix, depths, phylogeny)) as pool:
+            results = pool.map(_rarefy_iteration_worker, seeds)
+    else:
+        results = [rarefy_iteration(matrix, depths, iteration_seed, phylogeny=phylogeny) for iteration_seed in seeds]
+
+    # iterations x samples x depths x metrics -> a row per sample, depth and iteration
+    curves = np.stack(results).transpose(1, 2, 0, 3).reshape(-1, len(METRICS))
+    index = pd.MultiIndex.from_product([sample_ids, depths, range(1, iterations + 1)],
+                                       names=['sample_id', 'depth', 'iteration'])
+    df = pd.DataFrame(curves, index=index, columns=METRICS).reset_index()
+    if phylogeny is None:
+        df = df.drop('faith_pd', axis=1)
+    return df.dropna(subset=['observed_features']).reset_index(drop=True)
+
+
+def plot_rarefaction(curves: pd.DataFrame, out_path: str) -> str:
+    """
+    Plots the mean of every sample's iterations at every depth, with a panel per metric
+
+    :param curves: DataFrame returned by rarefaction_curves()
+    :param out_path: Path to write the .png to
+    :return: out_path
+    """
+    metrics = [metric for metric in METRICS if metric in curves.columns]
+    means = curves.groupby(['sample_id', 'depth'])[metrics].mean().reset_index()
+    fig, axes = plt.subplots(1, len(metrics), figsize=(6 * len(metrics), 5), squeeze=False)
+    for ax, metric in zip(axes[0], metrics):
+        for sample_id, sample_curve in means.groupby('sample_id'):
+            ax.plot(sample_curve['depth'], sample_curve[metric], color='grey', alpha=0.5, linewidth=0.75)
+        median = means.groupby('depth')[metric].median()
+        ax.plot(median.index, median.values, color='black', linewidth=2, label='Median of samples')
+        ax.set_xlabel('Sequencing depth')
+        ax.set_ylabel(metric)
+        ax.legend(loc='lower right')
+    fig.tight_layout()
+    fig.savefig(out_path, dpi=150)
+    plt.close(fig)
+    return out_path
@@ -0,0 +1,146 @@
+"""
+N-way merging of DADA2 results from separate MiSeq runs, used by merge_runs.py.
+
+Runs are merged one at a time so only a single run's table is ever loaded. Feature tables are accumulated as sparse
+(feature, sample, count) triplets and assembled once at the end, so the merged table is never densified.
+Representative sequences are streamed straight out of each .qza and deduplicated by the MD5 of the sequence, which
+also becomes the feature ID; the same ASV therefore collapses to one feature no matter what ID each run gave it.
+"""
+
+import os
+import io
+import hashlib
+import logging
+import zipfile
+
+import numpy as np
+
+from scipy import sparse
+from collections import OrderedDict
+
+TABLE_FILENAME = 'table-dada2.qza'
+REPSEQS_FILENAME = 'rep-seqs-dada2.qza'
+
+
+def sequence_digest(sequence: str) -> str:
+    """
+    :param sequence: Nucleotide sequence
+    :return: MD5 hex digest of the upper-cased sequence, matching the feature IDs DADA2 assigns in QIIME 2
+    """
+    return hashlib.md5(sequence.upper().encode()).hexdigest()
+
+
+def read_run_manifest(manifest_path: str) -> list:
+    """
+    :param manifest_path: Text file listing one run directory per line. Blank lines and lines starting with # are
+    ignored, and relative paths are resolved against the folder containing the manifest.
+    :return: List of run directory paths
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_path))
+    run_dirs = []
+    with open(manifest_path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            run_dirs.append(os.path.join(manifest_dir, os.path.expanduser(line)))
+    return run_dirs
+
+
+def locate_run_artifacts(run_dir: str) -> tuple:
+    """
+    :param run_dir: Output folder from ampliconpipeline.py, or the qiime2 folder inside it
+    :return: Tuple of paths to the run's (table-dada2.qza, rep-seqs-dada2.qza)
+    """
+    for folder in [os.path.join(run_dir, 'qiime2'), run_dir]:
+        table_path = os.path.join(folder, TABLE_FILENAME)
+        repseqs_path = os.path.join(folder, REPSEQS_FILENAME)
+        if os.path.isfile(table_path) and os.path.isfile(repseqs_path):
+            return table_path, repseqs_path
+    raise FileNotFoundError('Could not find {} and {} in {}'.format(TABLE_FILENAME, REPSEQS_FILENAME, run_dir))
+
+
+def iter_fasta(handle):
+    """
+    :param handle: Open text handle to a FASTA file
+    :return: Generator of (identifier, sequence) tuples
+    """
+    identifier, chunks = None, []
+    for line in handle:
+        line = line.strip()
+        if line.startswith('>'):
+            if identifier is not None:
+                yield identifier, ''.join(chunks)
+            identifier, chunks = line[1:].split()[0], []
+        elif line:
+            chunks.append(line)
+    if identifier is not None:
+        yield identifier, ''.join(chunks)
+
+
+def iter_artifact_sequences(artifact_path: str):
+    """
+    Streams the sequences of a FeatureData[Sequence] .qza without loading the artifact through QIIME 2
+
+    :param artifact_path: Path to representative sequences .qza file
+    :return: Generator of (feature ID, sequence) tuples
+    """
+    with zipfile.ZipFile(artifact_path) as archive:
+        member = [name for name in archive.namelist() if name.endswith('/data/dna-sequences.fasta')][0]
+        with archive.open(member) as f:
+            for record in iter_fasta(io.TextIOWrapper(f, encoding='utf-8')):
+                yield record
+
+
+def deduplicate_sequences(records, out_handle, seen: set) -> dict:
+    """
+    Writes every sequence not already in seen to out_handle as FASTA, identified by its digest
+
+    :param records: Iterable of (feature ID, sequence) tuples from a single run
+    :param out_handle: Open text handle to write the merged FASTA to
+    :param seen: Set of digests already written by earlier runs. Updated in place.
+    :return: Dictionary of {feature ID in this run: digest}
+    """
+    id_map = {}
+    for feature_id, sequence in records:
+        digest = sequence_digest(sequence)
+        id_map[feature_id] = digest
+        if digest not in seen:
+            seen.add(digest)
+            out_handle.write('>{}\n{}\n'.format(digest, sequence.upper()))
+    return id_map
+
+
+def merge_sparse_tables(tables) -> tuple:
+    """
+    :param tables: Iterable of (matrix, feature_ids, sample_ids) tuples, one per run, where matrix is a scipy sparse
+    matrix of counts with features as rows and samples as columns. Tables are consumed one at a time.
+    :return: Tuple of (CSR matrix, feature_ids, sample_ids) for the merged table. Counts of features shared between
+    runs are placed in the same row.
+    """
+    feature_index = OrderedDict()
+    sample_index = OrderedDict()
+    rows, cols, values = [], [], []
+
+    for matrix, feature_ids, sample_ids in tables:
+        overlap = [sample_id for sample_id in sample_ids if sample_id in sample_index]
+        if overlap:
+            raise ValueError('Sample IDs are present in more than one run: {}'.format(', '.join(overlap)))
+
+        row_lookup = np.array([feature_index.setdefault(feature_id, len(feature_index))
+                               for feature_id in feature_ids], dtype=np.int64)
+        col_lookup = np.array([sample_index.setdefault(sample_id, len(sample_index))
+                               for sample_id in sample_ids], dtype=np.int64)
+        coo = sparse.coo_matrix(matrix)
+        rows.append(row_lookup[coo.row])
+        cols.append(col_lookup[coo.col])
+        values.append(coo.data)
+
+    if not values:
+        raise ValueError('No tables were provided to merge')
+
+    # coo -> csr sums the counts of features that were collapsed onto the same row
+    merged = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))),
+                               shape=(len(feature_index), len(sample_index))).tocsr()
+    merged.sum_duplicates()
+    return merged, list(feature_index), list(sample_index)
@@ -0,0 +1,214 @@
+"""
+Detection of finished MiSeq runs for watch_runs.py.
+
+A run folder under the runs root is ready once the sequencer's sentinel file (CompletedJobInfo.xml by default) exists
+and its set of .fastq.gz files (names, sizes and mtimes) has not changed for settle_time seconds. Ready runs with a
+matching metadata .tsv are submitted to a bin/batch_queue.py queue, which processes them with bounded concurrency.
+What has been seen and submitted is recorded under 'watched' in the queue's state file, so repeated filesystem events
+and restarts of the watcher never submit a run twice.
+"""
+
+import os
+import time
+import logging
+import threading
+
+from collections import OrderedDict
+
+from bin import batch_queue
+
+SENTINEL = 'CompletedJobInfo.xml'
+
+# Folders of a run, relative to the run folder, that are checked for .fastq.gz files in this order
+FASTQ_SUBDIRS = [os.path.join('Data', 'Intensities', 'BaseCalls'), '']
+
+
+def find_fastq_dir(run_dir: str):
+    """
+    :param run_dir: Path to a MiSeq run folder
+    :return: Path to the folder holding the run's .fastq.gz files, or None if there are none yet
+    """
+    for subdir in FASTQ_SUBDIRS:
+        fastq_dir = os.path.join(run_dir, subdir)
+        if os.path.isdir(fastq_dir) and any(entry.name.endswith('.fastq.gz') for entry in os.scandir(fastq_dir)):
+            return os.path.normpath(fastq_dir)
+    return None
+
+
+def fastq_signature(fastq_dir: str) -> list:
+    """
+    :param fastq_dir: Folder holding .fastq.gz files
+    :return: Sorted list of [filename, size, mtime_ns] for every .fastq.gz file. Changes while files are still being
+    written or copied.
+    """
+    signature = []
+    for entry in os.scandir(fastq_dir):
+        if entry.name.endswith('.fastq.gz') and entry.is_file():
+            stat = entry.stat()
+            signature.append([entry.name, stat.st_size, stat.st_mtime_ns])
+    return sorted(signature)
+
+
+def run_name_parts(run_name: str) -> set:
+    """
+    :param run_name: Name of the run folder, e.g. 181010_M05722_0034_000000000-BY4T5
+    :return: Set of every run of consecutive underscore-delimited components of the run name, e.g. '000000000-BY4T5',
+    'M05722_0034' or '181010_M05722'
+    """
+    components = run_name.split('_')
+    return set('_'.join(components[start:end]) for start in range(len(components))
+               for end in range(start + 1, len(components) + 1))
+
+
+def match_metadata(run_name: str, metadata_dir: str):
+    """
+    :param run_name: Name of the run folder, e.g. 181010_M05722_0034_000000000-BY4T5
+    :param metadata_dir: Folder of metadata .tsv files
+    :return: Path to RUN_NAME.tsv if it exists, otherwise to the .tsv named after whole underscore-delimited
+    components of the run name (e.g. 000000000-BY4T5.tsv or M05722_0034.tsv), preferring the longest name if several
+    match. None if there is no match.
+    """
+    exact = os.path.join(metadata_dir, run_name + '.tsv')
+    if os.path.isfile(exact):
+        return exact
+    parts = run_name_parts(run_name)
+    candidates = sorted(entry.name for entry in os.scandir(metadata_dir)
+                        if entry.name.endswith('.tsv') and entry.is_file() and entry.name[:-len('.tsv')] in parts)
+    if not candidates:
+        return None
+    match = max(candidates, key=len)
+    if len(candidates) > 1:
+        logging.warning('Several metadata files match run {}: {}. Using {}'.format(run_name, ', '.join(candidates),
+                                                                                 match))
+    return os.path.join(metadata_dir, match)
+
+
+def scan_runs(runs_root: str, sentinel: str = SENTINEL) -> OrderedDict:
+    """
+    :param runs_root: Folder the sequencer writes run folders into
+    :param sentinel: File written into a run folder once the run has finished
+    :return: OrderedDict of {run name: (fastq folder, fastq signature)} for every finished run with .fastq.gz files
+    """
+    runs = OrderedDict()
+    for entry in sorted(os.scandir(runs_root), key=lambda x: x.name):
+        if not entry.is_dir() or not os.path.isfile(os.path.join(entry.path, sentinel)):
+            continue
+        fastq_dir = find_fastq_dir(entry.path)
+        if fastq_dir is not None:
+            runs[entry.name] = (fastq_dir, fastq_signature(fastq_dir))
+    return runs
+
+
+def check_runs(state_path: str, runs_root: str, metadata_dir: str, outdir_root: str, settle_time: float = 300,
+               sentinel: str = SENTINEL, options: OrderedDict = None, flags: list = None, cpus: int = None,
+               memory_gb: float = None, dry_run: bool = False, now: float = None) -> list:
+    """
+    Scans the runs root once and submits every run that became ready to the queue
+
+    :param state_path: Path to the queue's state file
+    :param runs_root: Folder the sequencer writes run folders into
+    :param metadata_dir: Folder of metadata .tsv files, see match_metadata()
+    :param outdir_root: Folder the pipeline output of every run is written into, as OUTDIR_ROOT/RUN_NAME
+    :param settle_time: Seconds the .fastq.gz files of a finished run must stay unchanged before it is submitted
+    :param sentinel: File written into a run folder once the run has finished
+    :param options: ampliconpipeline.py options for every run, see batch_queue.PIPELINE_OPTIONS
+    :param flags: ampliconpipeline.py flags for every run, see batch_queue.PIPELINE_FLAGS
+    :param cpus: CPUs per run
+    :param memory_gb: Memory budget in GB for each run
+    :param dry_run: Only log the runs that would be submitted
+    :param now: Current time, for testing
+    :return: Run dictionaries of the runs submitted (or that would have been submitted with dry_run)
+    """
+    now = time.time() if now is None else now
+    runs_root, metadata_dir, outdir_root = (os.path.abspath(path) for path in (runs_root, metadata_dir, outdir_root))
+    # Scan outside of the lock, the runs root is usually on a NAS
+    finished = scan_runs(runs_root, sentinel=sentinel)
+    metadata = OrderedDict((run_name, match_metadata(run_name, metadata_dir)) for run_name in finished)
+
+    ready = []
+    with batch_queue.locked_state(state_path) as state:
+        watched = state.setdefault('watched', OrderedDict())
+        for run_name, (fastq_dir, signature) in finished.items():
+            seen = watched.get(run_name)
+            if seen is not None and seen['status'] == 'submitted':
+                continue
+            if seen is None or seen['signature'] != signature:
+                if seen is None:
+                    logging.info('Found finished run {}'.format(run_name))
+                seen = OrderedDict([('status', 'settling'), ('signature', signature), ('stable_since', now)])
+                watched[run_name] = seen
+            if now - seen['stable_since'] < settle_time:
+                continue
+            if metadata[run_name] is None:
+                if seen['status'] != 'waiting_for_metadata':
+                    logging.warning('No metadata found for run {} in {}'.format(run_name, metadata_dir))
+                seen['status'] = 'waiting_for_metadata'
+                continue
+
+            ready.append(OrderedDict([
+                ('run_id', run_name),
+                ('inputdir', fastq_dir),
+                ('outdir', os.path.join(outdir_root, run_name)),
+                ('metadata', metadata[run_name]),
+                ('cpus', cpus),
+                ('memory_gb', memory_gb),
+                ('options', OrderedDict(options or ())),
+                ('flags', list(flags or ())),
+            ]))
+            if dry_run:
+                logging.info('Would submit run {} with metadata {}'.format(run_name, metadata[run_name]))
+            else:
+                seen['status'] = 'submitted'
+                seen['submitted'] = now
+
+        if not dry_run:
+            batch_queue.queue_runs(state, ready)
+    return ready
+
+
+def watch(runs_root: str, metadata_dir: str, outdir_root: str, state_path: str, poll_interval: float = 60,
+          settle_time: float = 300, concurrency: int = 1, once: bool = False, dry_run: bool = False,
+          stop_event: threading.Event = None, pipeline_script: str = batch_queue.PIPELINE_SCRIPT, **run_settings):
+    """
+    Watches the runs root and processes every run that finishes, up to concurrency runs at a time
+
+    :param poll_interval: Seconds between scans of the runs root
+    :param once: Scan once, process the submitted runs and return. Runs that are still settling are picked up by the
+    next invocation, e.g. from cron.
+    :param dry_run: Only log the runs that would be submitted
+    :param stop_event: Event that stops the watcher. Runs already started are finished first.
+    :param pipeline_script: Path to ampliconpipeline.py
+    :param run_settings: Passed to check_runs(), i.e. sentinel, options, flags, cpus and memory_gb
+    See check_runs() for the other parameters.
+    """
+    if stop_event is None:
+        stop_event = threading.Event()
+    queue_settings = dict(concurrency=concurrency, pipeline_script=pipeline_script,
+                          default_cpus=run_settings.get('cpus'),
+                          default_memory_gb=run_settings.get('memory_gb'))
+
+    if once:
+        check_runs(state_path, runs_root, metadata_dir, outdir_root, settle_time=settle_time, dry_run=dry_run,
+                   **run_settings)
+        if not dry_run:
+            batch_queue.run_queue(state_path, stop_event=stop_event, **queue_settings)
+        return
+
+    queue_thread = None
+    if not dry_run:
+        queue_thread = threading.Thread(target=batch_queue.run_queue, args=(state_path,),
+                                        kwargs=dict(poll_interval=poll_interval, stop_event=stop_event,
+                                                    **queue_settings),
+                                        daemon=True)
+        queue_thread.start()
+    logging.info('Watching {} for finished runs every {} seconds'.format(runs_root, poll_interval))
+    while not stop_event.is_set():
+        try:
+            check_runs(state_path, runs_root, metadata_dir, outdir_root, settle_time=settle_time, dry_run=dry_run,
+                       **run_settings)
+        except OSError as e:
+            # e.g. the NAS is briefly unavailable. Try again on the next scan.
+            logging.warning('Could not scan {}: {}'.format(runs_root, e))
+        stop_event.wait(poll_interval)
+    if queue_thread is not None:
+        queue_thread.join()
@@ -0,0 +1,230 @@
+"""
+Scratch space for the temporary files of a pipeline run.
+
+QIIME 2 extracts every artifact it loads into $TMPDIR, and DADA2 writes its filtered reads there, so a run needs
+several times the size of its .fastq.gz files in temporary space. When $TMPDIR (or the container) fills up, the run
+crashes with an OSError hours in. Before a run starts, preflight() estimates the temporary and output space it needs from
+the size of the .fastq.gz files and their read counts, which are extrapolated from the first few MB of a sample of the
+files, and picks a folder with enough room. scratch_space() then points $TMPDIR at a fresh folder inside it for the
+duration of the run (inherited by DADA2's R session and MAFFT) and removes it afterwards, whether the run succeeded or
+not.
+"""
+
+import os
+import zlib
+import errno
+import shutil
+import logging
+import tempfile
+
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from bin.profiling import format_bytes
+
+# Copies of the input held in temporary space at once: the reads staged by the artifact import, and the extracted
+# paired-sample-data.qza read by DADA2
+TEMP_INPUT_COPIES = 2
+# paired-sample-data.qza in the output folder holds another copy of the reads
+OUTPUT_INPUT_COPIES = 1
+# Visualizations, alignments, trees, taxonomy and diversity results, which don't scale with the input
+OUTPUT_OVERHEAD_BYTES = 500 * 1024 ** 2
+# Estimates are multiplied by this to allow for error in the read count extrapolation
+SAFETY_FACTOR = 1.25
+
+SAMPLE_BYTES = 4 * 1024 ** 2
+MAX_SAMPLED_FILES = 8
+READ_CHUNK_SIZE = 256 * 1024
+
+
+def sample_fastq(filepath: str, max_bytes: int = SAMPLE_BYTES) -> tuple:
+    """
+    Decompresses the start of a .fastq.gz file
+
+    :param filepath: Path to a .fastq.gz file
+    :param max_bytes: Maximum number of compressed bytes to read
+    :return: Tuple of (compressed bytes read, number of complete records in them, total read length of those records)
+    """
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    compressed_bytes = 0
+    buffer = b''
+    n_records = 0
+    n_bases = 0
+    with open(filepath, 'rb') as f:
+        while compressed_bytes < max_bytes:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            compressed_bytes += len(chunk)
+            data = b''
+            while chunk:
+                data += decompressor.decompress(chunk)
+                # Files written in blocks (e.g. bgzip) are several gzip members back to back
+                chunk = decompressor.unused_data
+                if chunk:
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            lines = (buffer + data).split(b'\n')
+            # Keep the incomplete record at the end for the next chunk
+            complete = (len(lines) - 1) // 4 * 4
+            buffer = b'\n'.join(lines[complete:])
+            n_records += complete // 4
+            n_bases += sum(len(line.rstrip(b'\r')) for line in lines[1:complete:4])
+    return compressed_bytes, n_records, n_bases
+
+
+def estimate_run_space(fastq_paths: list, trunc_len_f: int = 0, trunc_len_r: int = 0,
+                       max_sampled_files: int = MAX_SAMPLED_FILES) -> OrderedDict:
+    """
+    :param fastq_paths: Paths to the .fastq.gz files of a run
+    :param trunc_len_f: DADA2 forward truncation length. 0 for no truncation.
+    :param trunc_len_r: DADA2 reverse truncation length. 0 for no truncation.
+    :param max_sampled_files: Number of files, spread over the run, whose first few MB are decompressed to estimate the
+    number of reads per compressed byte, their length and the compressed size of a base
+    :return: OrderedDict with the input_bytes, reads (forward and reverse), temp_bytes and output_bytes of the run
+    """
+    sizes = [os.path.getsize(path) for path in fastq_paths]
+    input_bytes = sum(sizes)
+
+    step = max(1, len(fastq_paths) // max_sampled_files)
+    compressed_bytes = n_records = n_bases = 0
+    for path in fastq_paths[::step][:max_sampled_files]:
+        sampled = sample_fastq(path)
+        compressed_bytes += sampled[0]
+        n_records += sampled[1]
+        n_bases += sampled[2]
+    records_per_byte = n_records / compressed_bytes if compressed_bytes else 0
+    mean_read_length = n_bases / n_records if n_records else 0
+    bytes_per_base = compressed_bytes / n_bases if n_bases else 0
+
+    # DADA2 writes the filtered reads compressed, shortened to the truncation length: every read of a file takes the
+    # compressed size of a base times its truncated length
+    reads = 0
+    filtered_bytes = 0
+    for path, size in zip(fastq_paths, sizes):
+        if not n_bases:
+            filtered_bytes += size
+            continue
+        file_reads = size * records_per_byte
+        trunc_len = trunc_len_r if '_R2' in os.path.basename(path) else trunc_len_f
+        read_length = min(trunc_len, mean_read_length) if trunc_len else mean_read_length
+        reads += file_reads
+        filtered_bytes += file_reads * read_length * bytes_per_base
+
+    estimate = OrderedDict()
+    estimate['input_bytes'] = input_bytes
+    estimate['reads'] = int(round(reads))
+    estimate['temp_bytes'] = int((TEMP_INPUT_COPIES * input_bytes + filtered_bytes) * SAFETY_FACTOR)
+    estimate['output_bytes'] = int((OUTPUT_INPUT_COPIES * input_bytes + OUTPUT_OVERHEAD_BYTES) * SAFETY_FACTOR)
+    return estimate
+
+
+def existing_parent(path: str) -> str:
+    """
+    :return: path, or its closest parent folder that exists
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return path
+
+
+def free_bytes(path: str) -> int:
+    return shutil.disk_usage(existing_parent(path)).free
+
+
+def scratch_candidates(outdir: str) -> list:
+    """
+    :return: Folders tried for scratch space when none is given: $TMPDIR, the system temporary folder and the output
+    folder, without duplicates
+    """
+    candidates = []
+    for path in [os.environ.get('TMPDIR'), tempfile.gettempdir(), outdir]:
+        if path and os.path.abspath(path) not in candidates:
+            candidates.append(os.path.abspath(path))
+    return candidates
+
+
+def choose_scratch_dir(estimate: dict, outdir: str, scratch_dir: str = None) -> str:
+    """
+    :param estimate: Space estimate from estimate_run_space()
+    :param outdir: Output folder of the run
+    :param scratch_dir: Folder to use for scratch space. Picked from scratch_candidates() when None.
+    :return: Folder with room for the temporary files of the run. When it's on the same filesystem as outdir, it also
+    has room for the output.
+    :raises OSError: With errno ENOSPC if no folder has enough room
+    """
+    outdir_device = os.stat(existing_parent(outdir)).st_dev
+    output_free = free_bytes(outdir)
+    if output_free < estimate['output_bytes']:
+        raise OSError(errno.ENOSPC, 'The output folder {} has {} free but the run needs about {}'.format(
+            outdir, format_bytes(output_free), format_bytes(estimate['output_bytes'])))
+
+    candidates = [scratch_dir] if scratch_dir is not None else scratch_candidates(outdir)
+    shortfalls = []
+    for candidate in candidates:
+        if scratch_dir is None and not os.path.isdir(candidate):
+            continue
+        needed = estimate['temp_bytes']
+        if os.stat(existing_parent(candidate)).st_dev == outdir_device:
+            needed += estimate['output_bytes']
+        available = free_bytes(candidate)
+        if available >= needed:
+            return candidate
+        shortfalls.append('{} has {} free of the {} needed'.format(candidate, format_bytes(available),
+                                                                    format_bytes(needed)))
+    raise OSError(errno.ENOSPC, 'Not enough scratch space for the temporary files of the run: {}. Use --scratch_dir to '
+                                'point to a folder with more room.'.format('; '.join(shortfalls)))
+
+
+def preflight(fastq_paths: list, outdir: str, scratch_dir: str = None, trunc_len_f: int = 0,
+              trunc_len_r: int = 0) -> str:
+    """
+    Checks that there is enough space for a run before it starts
+
+    :param fastq_paths: Paths to the .fastq.gz files of the run
+    :param outdir: Output folder of the run
+    :param scratch_dir: Folder to use for scratch space. Picked from scratch_candidates() when None.
+    :param trunc_len_f: DADA2 forward truncation length
+    :param trunc_len_r: DADA2 reverse truncation length
+    :raises OSError: With errno ENOSPC if there isn't enough space for the run
+    :return: Folder to create the scratch folder of the run in, see choose_scratch_dir()
+    """
+    estimate = estimate_run_space(fastq_paths, trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r)
+    logging.info('Estimated space needed for {} reads ({} of .fastq.gz): {} temporary, {} output'.format(
+        estimate['reads'], format_bytes(estimate['input_bytes']), format_bytes(estimate['temp_bytes']),
+        format_bytes(estimate['output_bytes'])))
+    return choose_scratch_dir(estimate, outdir, scratch_dir=scratch_dir)
+
+
+@contextmanager
+def scratch_space(outdir: str, scratch_dir: str = None):
+    """
+    Context manager that creates a scratch folder for a run and points $TMPDIR at it. The folder and everything in it
+    is removed on exit, including when the run fails.
+
+    :param outdir: Output folder of the run
+    :param scratch_dir: Folder to create the scratch folder in, e.g. from preflight(). Defaults to the first of
+    scratch_candidates().
+    :return: Path to the scratch folder
+    """
+    if scratch_dir is None:
+        scratch_dir = scratch_candidates(outdir)[0]
+    os.makedirs(scratch_dir, exist_ok=True)
+    run_scratch_dir = tempfile.mkdtemp(prefix='ampliconpipeline_{}_'.format(os.path.basename(os.path.normpath(outdir))),
+                                       dir=scratch_dir)
+    logging.info('Writing temporary files to {}'.format(run_scratch_dir))
+
+    previous_tmpdir = os.environ.get('TMPDIR')
+    os.environ['TMPDIR'] = run_scratch_dir
+    # tempfile caches the temporary folder the first time it's used
+    tempfile.tempdir = None
+    try:
+        yield run_scratch_dir
+    finally:
+        if previous_tmpdir is None:
+            del os.environ['TMPDIR']
+        else:
+            os.environ['TMPDIR'] = previous_tmpdir
+        tempfile.tempdir = None
+        shutil.rmtree(run_scratch_dir, ignore_errors=True)
+        logging.debug('Removed scratch folder {}'.format(run_scratch_dir))
@@ -0,0 +1,226 @@
+"""
+Content-addressed cache for the stages of qiime2_pipeline.run_pipeline().
+
+Every stage is keyed by a SHA-256 digest of its name, its parameters and the content of each of its input files.
+Inputs too large to hash on every run, such as a taxonomy classifier, can be keyed by an identifier instead (e.g. the
+UUID of a QIIME 2 artifact, which identifies its content).
+When a stage completes, the files it wrote into the working directory are copied into the cache under that key.
+When a pipeline is resumed, any stage whose key is already present in the cache is skipped and its outputs are
+restored into the working directory instead of being recomputed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import zipfile
+
+MANIFEST_NAME = 'manifest.json'
+CHUNK_SIZE = 1024 * 1024
+
+# Digests are memoized per (path, size, mtime) so large artifacts shared by several stages are only hashed once
+_DIGEST_MEMO = {}
+
+
+def _update_from_stream(digest, stream):
+    """
+    :param digest: hashlib object to update
+    :param stream: Binary file-like object to read in chunks
+    """
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+        digest.update(chunk)
+
+
+def archive_payload_digest(filepath: str) -> str:
+    """
+    Hashes the payload of a QIIME 2 archive (.qza/.qzv). Only the semantic type, the format and the files under data/
+    are considered; the archive UUID and provenance are ignored because they change every time identical data is
+    re-imported or re-saved.
+
+    :param filepath: Path to a QIIME 2 .qza or .qzv archive
+    :return: Hex digest of the archive payload
+    """
+    digest = hashlib.sha256()
+    with zipfile.ZipFile(filepath) as archive:
+        for member in sorted(archive.namelist()):
+            # Archive members are laid out as <uuid>/<relative path>
+            relative_path = member.split('/', 1)[-1]
+            if relative_path == 'metadata.yaml':
+                with archive.open(member) as stream:
+                    for line in stream.read().decode('utf-8').splitlines():
+                        if line.startswith(('type:', 'format:')):
+                            digest.update(line.encode('utf-8'))
+            elif relative_path.startswith('data/') and not member.endswith('/'):
+                digest.update(relative_path.encode('utf-8'))
+                with archive.open(member) as stream:
+                    _update_from_stream(digest, stream)
+    return digest.hexdigest()
+
+
+def file_digest(filepath: str) -> str:
+    """
+    :param filepath: Path to any input file. QIIME 2 archives are hashed with archive_payload_digest().
+    :return: Hex digest of the file content
+    """
+    stat = os.stat(filepath)
+    memo_key = (os.path.abspath(filepath), stat.st_size, stat.st_mtime)
+    if memo_key in _DIGEST_MEMO:
+        return _DIGEST_MEMO[memo_key]
+
+    if filepath.endswith(('.qza', '.qzv')) and zipfile.is_zipfile(filepath):
+        digest = archive_payload_digest(filepath)
+    else:
+        sha = hashlib.sha256()
+        with open(filepath, 'rb') as stream:
+            _update_from_stream(sha, stream)
+        digest = sha.hexdigest()
+
+    _DIGEST_MEMO[memo_key] = digest
+    logging.debug('Digest for {}: {}'.format(filepath, digest))
+    return digest
+
+
+def stage_key(stage_name: str, input_paths: list, params: dict = None, input_ids: list = None) -> str:
+    """
+    :param stage_name: Name of the pipeline stage, e.g. 'dada2_qc'
+    :param input_paths: List of paths to every file the stage reads and that is keyed by its content
+    :param params: Dictionary of parameters that influence the output of the stage
+    :param input_ids: List of identifiers of inputs that are keyed by identity instead of content
+    :return: Hex digest uniquely identifying this stage invocation
+    """
+    key_data = {
+        'stage': stage_name,
+        'inputs': [file_digest(path) for path in input_paths],
+        'params': params if params is not None else {},
+    }
+    if input_ids:
+        key_data['input_ids'] = list(input_ids)
+    return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(source: str, destination: str):
+    """
+    Hard links source to destination, falling back to a copy when the two paths are on different filesystems.
+    Any existing file at destination is replaced.
+    """
+    if os.path.lexists(destination):
+        os.remove(destination)
+    elif not os.path.isdir(os.path.dirname(destination)):
+        os.makedirs(os.path.dirname(destination))
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def lookup(cache_dir: str, stage_name: str, key: str):
+    """
+    :param cache_dir: Root directory of the stage cache
+    :param stage_name: Name of the pipeline stage
+    :param key: Key generated with stage_key()
+    :return: Path to the cache entry if it is complete, otherwise None
+    """
+    entry_dir = os.path.join(cache_dir, stage_name, key)
+    if os.path.isfile(os.path.join(entry_dir, MANIFEST_NAME)):
+        return entry_dir
+    return None
+
+
+def store(cache_dir: str, stage_name: str, key: str, base_dir: str, outputs: list, params: dict = None) -> str:
+    """
+    Copies the outputs of a completed stage into the cache. The entry is assembled in a temporary folder and renamed
+    into place so an interrupted store never leaves a partial entry behind.
+
+    :param cache_dir: Root directory of the stage cache
+    :param stage_name: Name of the pipeline stage
+    :param key: Key generated with stage_key()
+    :param base_dir: Working directory the stage wrote its outputs to
+    :param outputs: List of output paths relative to base_dir. Missing files are skipped.
+    :param params: Parameters of the stage, recorded in the manifest for reference
+    :return: Path to the cache entry
+    """
+    entry_dir = os.path.join(cache_dir, stage_name, key)
+    temp_dir = '{}.tmp-{}'.format(entry_dir, os.getpid())
+    if os.path.isdir(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+
+    stored_outputs = []
+    for output in outputs:
+        output_path = os.path.join(base_dir, output)
+        if os.path.isfile(output_path):
+            _link_or_copy(output_path, os.path.join(temp_dir, output))
+            stored_outputs.append(output)
+        else:
+            logging.debug('Expected output {} of stage {} was not found'.format(output_path, stage_name))
+
+    with open(os.path.join(temp_dir, MANIFEST_NAME), 'w') as manifest:
+        json.dump({'stage': stage_name, 'key': key, 'outputs': stored_outputs,
+                   'params': params if params is not None else {}}, manifest, indent=2, sort_keys=True)
+
+    if os.path.isdir(entry_dir):
+        shutil.rmtree(entry_dir)
+    os.rename(temp_dir, entry_dir)
+    logging.debug('Cached {} outputs at {}'.format(stage_name, entry_dir))
+    return entry_dir
+
+
+def restore(entry_dir: str, base_dir: str) -> list:
+    """
+    :param entry_dir: Path to a cache entry returned by lookup()
+    :param base_dir: Working directory to restore the cached outputs into
+    :return: List of restored file paths
+    """
+    with open(os.path.join(entry_dir, MANIFEST_NAME), 'r') as manifest:
+        outputs = json.load(manifest)['outputs']
+
+    restored = []
+    for output in outputs:
+        destination = os.path.join(base_dir, output)
+        _link_or_copy(os.path.join(entry_dir, output), destination)
+        restored.append(destination)
+    return restored
+
+
+def run_cached_stage(stage_name: str, func, kwargs: dict, base_dir: str, outputs: list, input_paths: list = None,
+                     params: dict = None, restore_func=None, cache_dir: str = None, resume: bool = False,
+                     input_ids: list = None):
+    """
+    Runs a single pipeline stage through the cache.
+
+    :param stage_name: Name of the pipeline stage
+    :param func: Stage function to call, e.g. qiime2_pipeline.dada2_qc
+    :param kwargs: Keyword arguments passed to func
+    :param base_dir: Working directory the stage writes its outputs to
+    :param outputs: List of output filenames (relative to base_dir) written by the stage
+    :param input_paths: List of paths to every file the stage reads
+    :param params: Parameters that influence the stage output
+    :param restore_func: Callable taking base_dir that rebuilds the return value of func from restored outputs
+    :param cache_dir: Root directory of the stage cache. Caching is disabled when None.
+    :param resume: If True, stages with a matching cache entry are skipped and restored instead of recomputed
+    :param input_ids: Identifiers of inputs keyed by identity instead of content, see stage_key()
+    :return: Return value of func, or of restore_func when the stage was restored from the cache
+    """
+    if cache_dir is None:
+        return func(**kwargs)
+
+    key = stage_key(stage_name, input_paths if input_paths is not None else [], params, input_ids=input_ids)
+
+    if resume:
+        entry_dir = lookup(cache_dir, stage_name, key)
+        if entry_dir is not None:
+            restore(entry_dir, base_dir)
+            logging.info('Restored {} from cache ({})'.format(stage_name, key[:12]))
+            return restore_func(base_dir) if restore_func is not None else None
+
+    # Outputs left over from an earlier attempt may be hard links into the cache; unlink them so the stage writes
+    # fresh files instead of overwriting cached entries in place
+    for output in outputs:
+        output_path = os.path.join(base_dir, output)
+        if os.path.isfile(output_path):
+            os.remove(output_path)
+
+    result = func(**kwargs)
+    store(cache_dir, stage_name, key, base_dir, outputs, params)
+    return result
@@ -0,0 +1,142 @@
+"""
+Dependency graph scheduler for pipeline stages.
+
+Stages are launched on a thread pool as soon as every stage they depend on has finished. The heavy lifting inside
+each QIIME 2 stage happens in child processes (DADA2's R, MAFFT, FastTree) or joblib workers, so threads are enough
+to keep several stages busy at once. A global CPU budget is split between the stages that are running concurrently.
+
+A stage's CPU count is fixed when it starts, because QIIME 2 methods take their thread or job count as an argument.
+CPUs freed by a stage that finishes go to the stages started after it, split according to the CPUs actually free at
+that point, but they are not handed to stages that are already running. While no waiting stage is ready, freed CPUs
+stay idle.
+"""
+
+import logging
+import multiprocessing
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# func is called as func(results, cpu_count) where results maps the name of every dependency to its return value.
+# cpus is the most CPUs the stage can make use of; None means it will take as many as it is given.
+Stage = namedtuple('Stage', ['name', 'func', 'dependencies', 'cpus'])
+
+
+def make_stage(name: str, func, dependencies: list = None, cpus: int = 1) -> Stage:
+    """
+    :param name: Unique name of the stage
+    :param func: Callable taking (results, cpu_count)
+    :param dependencies: Names of the stages that must complete before this one starts
+    :param cpus: Maximum number of CPUs the stage can use, or None for no limit
+    :return: Stage namedtuple
+    """
+    return Stage(name=name, func=func, dependencies=tuple(dependencies) if dependencies else (), cpus=cpus)
+
+
+def validate_stage_graph(stages: list):
+    """
+    Ensures stage names are unique, every dependency exists and the graph has no cycles
+
+    :param stages: List of Stage namedtuples
+    """
+    names = [stage.name for stage in stages]
+    if len(names) != len(set(names)):
+        raise ValueError('Stage names must be unique: {}'.format(names))
+
+    for stage in stages:
+        for dependency in stage.dependencies:
+            if dependency not in names:
+                raise ValueError('Stage {} depends on unknown stage {}'.format(stage.name, dependency))
+
+    # Kahn's algorithm; any stage left over is part of a cycle
+    remaining = {stage.name: set(stage.dependencies) for stage in stages}
+    while remaining:
+        ready = [name for name, dependencies in remaining.items() if not dependencies]
+        if not ready:
+            raise ValueError('Stage graph contains a cycle between: {}'.format(sorted(remaining)))
+        for name in ready:
+            del remaining[name]
+        for dependencies in remaining.values():
+            dependencies.difference_update(ready)
+
+
+def allocate_cpus(ready: list, free_cpus: int) -> list:
+    """
+    Splits the free CPUs between the stages that are ready to start. Stages with a CPU limit are served first, in
+    order, so the stages without one split what is actually left evenly between them. Stages that don't fit are left
+    for a later round, when they are given a share of the CPUs free at that point.
+
+    :param ready: List of Stage namedtuples ready to run
+    :param free_cpus: Number of CPUs not currently allocated to a running stage
+    :return: List of (Stage, cpu_count) tuples to launch now
+    """
+    capped = [stage for stage in ready if stage.cpus is not None]
+    uncapped = [stage for stage in ready if stage.cpus is None]
+
+    allocations = []
+    for index, stage in enumerate(capped + uncapped):
+        if free_cpus < 1:
+            break
+        if stage.cpus is None:
+            share = max(1, free_cpus // (len(ready) - index))
+        else:
+            # Capped stages use what they can, but leave at least one CPU for every uncapped stage after them
+            share = max(1, min(stage.cpus, free_cpus - len(uncapped)))
+        allocations.append((stage, share))
+        free_cpus -= share
+    return allocations
+
+
+def run_stage_graph(stages: list, cpu_budget: int = None) -> dict:
+    """
+    Runs every stage in the graph, starting each one as soon as its dependencies have completed.
+    If a stage fails, no further stages are started; the stages already running are allowed to finish and the
+    first exception is re-raised.
+
+    :param stages: List of Stage namedtuples
+    :param cpu_budget: Total number of CPUs shared by concurrently running stages. Defaults to all CPUs.
+    :return: Dictionary of {stage name: return value}
+    """
+    validate_stage_graph(stages)
+
+    if cpu_budget is None:
+        cpu_budget = multiprocessing.cpu_count()
+    cpu_budget = max(1, cpu_budget)
+
+    pending = OrderedDict((stage.name, stage) for stage in stages)
+    results = {}
+    running = {}
+    free_cpus = cpu_budget
+    failure = None
+
+    with ThreadPoolExecutor(max_workers=cpu_budget) as executor:
+        while pending or running:
+            if failure is None:
+                ready = [stage for stage in pending.values()
+                         if all(dependency in results for dependency in stage.dependencies)]
+                for stage, cpu_count in allocate_cpus(ready, free_cpus):
+                    del pending[stage.name]
+                    dependency_results = {name: results[name] for name in stage.dependencies}
+                    logging.debug('Starting stage {} with {} CPU(s)'.format(stage.name, cpu_count))
+                    future = executor.submit(stage.func, dependency_results, cpu_count)
+                    running[future] = (stage, cpu_count)
+                    free_cpus -= cpu_count
+
+            if not running:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                stage, cpu_count = running.pop(future)
+                free_cpus += cpu_count
+                try:
+                    results[stage.name] = future.result()
+                    logging.debug('Finished stage {}'.format(stage.name))
+                except Exception as e:
+                    logging.error('Stage {} failed: {}'.format(stage.name, e))
+                    if failure is None:
+                        failure = e
+
+    if failure is not None:
+        raise failure
+    return results
@@ -0,0 +1,58 @@
+"""
+Summary statistics of feature tables computed directly from their sparse representation.
+
+A BIOM table stores its counts as a scipy sparse matrix with features as rows and samples as columns. Every statistic
+here is computed with a single pass over the non-zero counts, so the cost scales with the number of non-zero entries
+rather than features x samples and the table is never densified.
+"""
+
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from collections import namedtuple, OrderedDict
+
+DEPTH_QUANTILES = (0.0, 0.1, 0.25, 0.5, 0.75, 0.9, 1.0)
+
+# sample_depths: total count per sample; feature_totals: total count per feature; feature_prevalence: number of
+# samples each feature is observed in; depth_quantiles: OrderedDict of {quantile: sample depth}
+TableStatistics = namedtuple('TableStatistics', ['sample_depths', 'feature_totals', 'feature_prevalence',
+                                                 'depth_quantiles'])
+
+
+def compute_table_statistics(matrix, feature_ids: list, sample_ids: list,
+                             quantiles: tuple = DEPTH_QUANTILES) -> TableStatistics:
+    """
+    :param matrix: scipy sparse matrix of counts with features as rows and samples as columns
+    :param feature_ids: Feature IDs of the rows
+    :param sample_ids: Sample IDs of the columns
+    :param quantiles: Quantiles of the sample depths to compute, between 0 and 1
+    :return: TableStatistics namedtuple
+    """
+    coo = sparse.coo_matrix(matrix)
+    n_features, n_samples = coo.shape
+    observed = coo.data > 0
+
+    sample_depths = np.bincount(coo.col, weights=coo.data, minlength=n_samples)
+    feature_totals = np.bincount(coo.row, weights=coo.data, minlength=n_features)
+    feature_prevalence = np.bincount(coo.row[observed], minlength=n_features)
+
+    depth_quantiles = OrderedDict()
+    if n_samples:
+        for quantile, depth in zip(quantiles, np.percentile(sample_depths, [q * 100 for q in quantiles])):
+            depth_quantiles[quantile] = float(depth)
+
+    return TableStatistics(sample_depths=pd.Series(sample_depths, index=sample_ids),
+                           feature_totals=pd.Series(feature_totals, index=feature_ids),
+                           feature_prevalence=pd.Series(feature_prevalence, index=feature_ids),
+                           depth_quantiles=depth_quantiles)
+
+
+def biom_table_statistics(table, quantiles: tuple = DEPTH_QUANTILES) -> TableStatistics:
+    """
+    :param table: biom.Table
+    :param quantiles: Quantiles of the sample depths to compute, between 0 and 1
+    :return: TableStatistics namedtuple
+    """
+    return compute_table_statistics(table.matrix_data, list(table.ids(axis='observation')),
+                                    list(table.ids(axis='sample')), quantiles=quantiles)
@@ -0,0 +1,145 @@
+"""
+Consistent colours for taxa across qiimegraph charts, e.g. Listeria is always drawn in the same colour.
+
+Colours are kept in a compact text index (qiimegraph_taxonomic_colors.tsv next to this module) with one
+"taxon<TAB>colour" line per taxon, sorted by taxon. lookup_colors() memory-maps the index and binary searches it for
+only the taxa being plotted, so nothing is loaded up front. Taxa missing from the index get a colour derived from a
+hash of their name, which is the same on every run and every machine.
+"""
+
+import os
+import mmap
+import click
+import hashlib
+import colorsys
+import logging
+
+DEFAULT_COLOR_INDEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'qiimegraph_taxonomic_colors.tsv')
+
+# Colours that aren't derived from the name
+FIXED_COLORS = {
+    'Unassigned': 'grey',
+    'Unclassified': 'grey',
+}
+
+
+def taxon_color(taxon: str) -> str:
+    """
+    :param taxon: Taxon name, e.g. 'Listeria'
+    :return: Hex colour derived from the MD5 of the name, or the colour in FIXED_COLORS
+    """
+    if taxon in FIXED_COLORS:
+        return FIXED_COLORS[taxon]
+    digest = hashlib.md5(taxon.encode()).digest()
+    hue = int.from_bytes(digest[:4], 'big') / 2 ** 32
+    # Vary saturation and value a little too so neighbouring hues stay distinguishable
+    saturation = 0.55 + 0.4 * digest[4] / 255
+    value = 0.65 + 0.3 * digest[5] / 255
+    return '#{:02x}{:02x}{:02x}'.format(*(int(round(x * 255)) for x in colorsys.hsv_to_rgb(hue, saturation, value)))
+
+
+def write_color_index(colors: dict, index_path: str = DEFAULT_COLOR_INDEX):
+    """
+    :param colors: Dictionary of {taxon: colour}
+    :param index_path: Path to write the index to
+    """
+    with open(index_path, 'wb') as f:
+        for taxon in sorted(colors, key=lambda x: x.encode()):
+            f.write('{}\t{}\n'.format(taxon, colors[taxon]).encode())
+
+
+def _search_index(index, taxon: bytes):
+    """
+    :param index: Memory-mapped index
+    :param taxon: UTF-8 encoded taxon name
+    :return: Colour of the taxon as bytes, or None if it isn't in the index
+    """
+    lo, hi = 0, len(index)
+    # lo and hi always sit at the start of a line
+    while lo < hi:
+        mid = (lo + hi) // 2
+        start = index.rfind(b'\n', 0, mid) + 1
+        end = index.find(b'\n', start)
+        if end == -1:
+            end = len(index)
+        name, _, color = index[start:end].partition(b'\t')
+        if name == taxon:
+            return color
+        elif name < taxon:
+            lo = end + 1
+        else:
+            hi = start
+    return None
+
+
+def lookup_colors(taxa, index_path: str = DEFAULT_COLOR_INDEX) -> dict:
+    """
+    :param taxa: Iterable of taxon names
+    :param index_path: Path to the colour index
+    :return: Dictionary of {taxon: colour} for every taxon, falling back on taxon_color() for taxa not in the index
+    """
+    taxa = set(taxa)
+    colors = {}
+    if os.path.isfile(index_path) and os.path.getsize(index_path):
+        with open(index_path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+            for taxon in taxa:
+                color = _search_index(index, taxon.encode())
+                if color is not None:
+                    colors[taxon] = color.decode()
+    for taxon in taxa - set(colors):
+        colors[taxon] = taxon_color(taxon)
+    return colors
+
+
+def iter_taxonomy_names(handle):
+    """
+    :param handle: Open handle to a SILVA QIIME formatted taxonomy file of "ID<TAB>lineage" lines
+    :return: Generator of the name at every rank of every lineage, with the rank prefixes (e.g. D_0__) removed
+    """
+    for line in handle:
+        if '\t' not in line:
+            continue
+        for tax in line.split('\t', 1)[1].split(';'):
+            tax = tax.strip()
+            if tax.startswith('D_') and '__' in tax:
+                tax = tax.split('__', 1)[1]
+            if tax != '':
+                yield tax
+
+
+def generate_color_index(taxonomy_file: str, index_path: str = DEFAULT_COLOR_INDEX) -> int:
+    """
+    Builds a colour index for every taxon in a taxonomy file in a single pass over the file
+
+    :param taxonomy_file: SILVA QIIME formatted taxonomy file, e.g. consensus_taxonomy_all_levels.txt
+    :param index_path: Path to write the index to
+    :return: Number of taxa in the index
+    """
+    with open(taxonomy_file) as f:
+        taxa = set(iter_taxonomy_names(f))
+    taxa.update(FIXED_COLORS)
+    write_color_index({taxon: taxon_color(taxon) for taxon in taxa}, index_path)
+    logging.info('Wrote colours for {} taxa to {}'.format(len(taxa), index_path))
+    return len(taxa)
+
+
+@click.command()
+@click.option('-t', '--taxonomy_file',
+              type=click.Path(exists=True),
+              required=True,
+              help='SILVA QIIME formatted taxonomy file to assign colours for, e.g. '
+                   'SILVA_128_QIIME_release/taxonomy/taxonomy_all/99/consensus_taxonomy_all_levels.txt')
+@click.option('-o', '--index_path',
+              type=click.Path(exists=False),
+              default=DEFAULT_COLOR_INDEX,
+              help='Path to write the colour index to. Defaults to the index qiimegraph.py reads.')
+def cli(taxonomy_file, index_path):
+    logging.basicConfig(
+        format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S')
+    generate_color_index(taxonomy_file, index_path)
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,96 @@
+"""
+Persistent cache of taxonomy assignments per ASV, shared between runs.
+
+Assignments are stored in an SQLite database keyed by the UUID of the classifier artifact
+(bin.classifier_store.archive_fingerprint) and the MD5 of the exact ASV sequence, so an ASV is only ever classified
+once per classifier. The database is capped at a maximum number of entries; the least recently used entries are evicted first.
+"""
+
+import os
+import time
+import sqlite3
+import logging
+
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.cache', 'AmpliconPipeline', 'taxonomy_cache.sqlite')
+DEFAULT_MAX_ENTRIES = 1000000
+
+# SQLite limits the number of bound parameters in a single statement
+QUERY_CHUNK_SIZE = 500
+
+
+def open_cache(cache_path: str = DEFAULT_CACHE_PATH) -> sqlite3.Connection:
+    """
+    :param cache_path: Path to the SQLite database. Created if it doesn't exist.
+    :return: Open connection to the cache
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+    # Several pipelines may share the cache, so wait on their writes rather than failing immediately
+    connection = sqlite3.connect(cache_path, timeout=60)
+    connection.execute('CREATE TABLE IF NOT EXISTS taxonomy ('
+                       'classifier TEXT NOT NULL, '
+                       'sequence_hash TEXT NOT NULL, '
+                       'taxon TEXT NOT NULL, '
+                       'confidence TEXT NOT NULL, '
+                       'last_used REAL NOT NULL, '
+                       'PRIMARY KEY (classifier, sequence_hash))')
+    connection.execute('CREATE INDEX IF NOT EXISTS taxonomy_last_used ON taxonomy (last_used)')
+    connection.commit()
+    return connection
+
+
+def lookup(connection: sqlite3.Connection, classifier_id: str, sequence_hashes: list) -> dict:
+    """
+    Retrieves cached assignments and marks them as recently used
+
+    :param connection: Connection returned by open_cache()
+    :param classifier_id: UUID of the classifier artifact
+    :param sequence_hashes: MD5 digests of the ASV sequences to look up
+    :return: Dictionary of {sequence hash: (taxon, confidence)} for every hash found in the cache
+    """
+    sequence_hashes = list(sequence_hashes)
+    hits = {}
+    for start in range(0, len(sequence_hashes), QUERY_CHUNK_SIZE):
+        chunk = sequence_hashes[start:start + QUERY_CHUNK_SIZE]
+        rows = connection.execute('SELECT sequence_hash, taxon, confidence FROM taxonomy '
+                                  'WHERE classifier = ? AND sequence_hash IN ({})'.format(','.join('?' * len(chunk))),
+                                  [classifier_id] + chunk)
+        for sequence_hash, taxon, confidence in rows:
+            hits[sequence_hash] = (taxon, confidence)
+
+    now = time.time()
+    connection.executemany('UPDATE taxonomy SET last_used = ? WHERE classifier = ? AND sequence_hash = ?',
+                           [(now, classifier_id, sequence_hash) for sequence_hash in hits])
+    connection.commit()
+    return hits
+
+
+def store(connection: sqlite3.Connection, classifier_id: str, assignments: dict):
+    """
+    :param connection: Connection returned by open_cache()
+    :param classifier_id: UUID of the classifier artifact
+    :param assignments: Dictionary of {sequence hash: (taxon, confidence)}
+    """
+    now = time.time()
+    connection.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?, ?)',
+                           [(classifier_id, sequence_hash, str(taxon), str(confidence), now)
+                            for sequence_hash, (taxon, confidence) in assignments.items()])
+    connection.commit()
+
+
+def evict(connection: sqlite3.Connection, max_entries: int = DEFAULT_MAX_ENTRIES) -> int:
+    """
+    Deletes the least recently used entries until at most max_entries remain
+
+    :param connection: Connection returned by open_cache()
+    :param max_entries: Maximum number of entries to keep across all classifiers
+    :return: Number of entries evicted
+    """
+    n_entries = connection.execute('SELECT COUNT(*) FROM taxonomy').fetchone()[0]
+    excess = n_entries - max_entries
+    if excess <= 0:
+        return 0
+    connection.execute('DELETE FROM taxonomy WHERE rowid IN '
+                       '(SELECT rowid FROM taxonomy ORDER BY last_used, rowid LIMIT ?)', (excess,))
+    connection.commit()
+    logging.info('Evicted {} least recently used entries from the taxonomy cache'.format(excess))
+    return excess
@@ -1,10 +1,13 @@
 import os
-import glob
 import click
-import qiime2
-import shutil
+import zipfile
 import pandas as pd
 
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from bin import barplot_reader, lineage
+
 
 TAXONOMIC_DICT = {
     'kingdom': ('level-1', 'D_0__'),
@@ -17,9 +20,20 @@ TAXONOMIC_DICT = {
 }
 
 
+REPORT_FORMATS = ['sample', 'wide', 'long']
+
+
 # NOTE: Note that the index_col is by default 'sample_annotation'. This assumes that the METADATA file used to generate
 # this run has a column called 'sample_annotation' which acts as a secondary ID alongside the Seq-IDs provided.
-def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation', filtering=None, cutoff=None):
+def load_level_df(filepath, index_col='sample_annotation', filtering=None):
+    """
+    Reads a level-N.csv file exported from a taxonomy barplot into a table of lineages (rows) by samples (columns)
+
+    :param filepath: Path to level-N.csv, or an open handle to it e.g. from barplot_reader.open_level_csv()
+    :param index_col: Metadata column identifying the samples
+    :param filtering: Only keep lineages containing this keyword, e.g. Bacteroidales
+    :return: DataFrame with an 'index' column of lineages followed by a column of counts per sample
+    """
     df = pd.read_csv(filepath, index_col=index_col)
 
     # Remove all extraneous metadata columns
@@ -35,9 +49,22 @@ def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation',
     # Transpose
     df = df.transpose()
     df = df.reset_index()
+    return df
+
 
+def sample_report(df, taxonomic_level, sample, cutoff=None, names=None):
+    """
+    :param df: DataFrame returned by load_level_df()
+    :param taxonomic_level: Taxonomic level of the level-N.csv file the DataFrame was loaded from
+    :param sample: Sample name to prepare data for
+    :param cutoff: Only keep rows where the sample's percentage is >= cutoff
+    :param names: Closest known classification of every row of df. Parsed from the lineages if not provided.
+    :return: DataFrame with the 'index' column of classifications and the percentage for the sample
+    """
     # Drop columns that aren't our sample of interest
     df = df.drop((x for x in df.columns.tolist() if sample not in x and 'index' not in x), axis=1)
+    if df.shape[1] < 2:
+        raise ValueError('The specified sample {} could not be found.'.format(sample))
 
     # Columns to target for conversion to percentage
     columns_to_target = [x for x in df.columns.tolist() if x not in ['index', taxonomic_level]]
@@ -45,23 +72,133 @@ def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation',
     # Convert
     df = convert_to_percentages(df, columns_to_target)
 
+    # Fix names of index
+    if names is None:
+        names = lineage.parse_lineages(df['index'])[lineage.CLOSEST_KNOWN_COLUMN].astype(str)
+    df['index'] = names
+
     # Remove rows where the value for the sample is 0
-    try:
-        df = df[df.iloc[:, 1] != 0]
-    except IndexError:
-        print('The specified sample {} could not be found. Quitting.'.format(sample))
-        quit()
+    df = df[df.iloc[:, 1] != 0]
 
     if cutoff is not None:
         # Remove rows where the value for the sample is < cutoff
         df = df[df.iloc[:, 1] >= cutoff]
 
-    # Fix names of index
-    df['index'] = df['index'].map(extract_taxonomy)
-
     return df
 
 
+def prepare_df(filepath, taxonomic_level, sample, index_col='sample_annotation', filtering=None, cutoff=None):
+    df = load_level_df(filepath, index_col=index_col, filtering=filtering)
+    try:
+        return sample_report(df, taxonomic_level, sample, cutoff=cutoff)
+    except ValueError:
+        print('The specified sample {} could not be found. Quitting.'.format(sample))
+        quit()
+
+
+def level_reports(filepath, taxonomic_level, samples, out_dir, cutoff=None, report_format='sample'):
+    """
+    Writes the reports of every requested sample for a single taxonomic level. The level file is read and its lineages
+    parsed only once.
+
+    :param filepath: Path to level-N.csv, or an open handle to it
+    :param taxonomic_level: Taxonomic level of the file
+    :param samples: Sample names to report on. Every sample in the file is reported on if None.
+    :param out_dir: Folder to write reports into
+    :param cutoff: Only report taxa with a percentage >= cutoff in the sample
+    :param report_format: 'sample' for one taxonomy_report_<level>_<sample>.csv per sample, 'wide' for a single
+    taxonomy_report_<level>.csv with a column per sample, or 'long' to return rows for a combined long report
+    :return: List of paths written, or a long format DataFrame if report_format is 'long'
+    """
+    df = load_level_df(filepath)
+    names = lineage.parse_lineages(df['index'])[lineage.CLOSEST_KNOWN_COLUMN].astype(str)
+    if samples is None:
+        samples = [x for x in df.columns.tolist() if x != 'index']
+
+    # Match sample columns exactly where possible so e.g. 'S1' doesn't also pick up 'S10'
+    reports = [(sample, sample_report(df[['index', sample]] if sample in df.columns else df, taxonomic_level, sample,
+                                      cutoff=cutoff, names=names))
+               for sample in samples]
+
+    if report_format == 'sample':
+        out_paths = []
+        for sample, report in reports:
+            csv_out_path = os.path.join(out_dir, 'taxonomy_report_{}_{}.csv'.format(taxonomic_level, sample))
+            report.to_csv(csv_out_path, index=False)
+            out_paths.append(csv_out_path)
+        return out_paths
+
+    long_df = pd.concat([pd.DataFrame({'sample': sample,
+                                       'rank': taxonomic_level,
+                                       'lineage': df.loc[report.index, 'index'],
+                                       'taxonomy': report['index'],
+                                       'percentage': report.iloc[:, 1]},
+                                      columns=['sample', 'rank', 'lineage', 'taxonomy', 'percentage'])
+                         for sample, report in reports], ignore_index=True)
+    if report_format == 'long':
+        return long_df
+
+    wide_df = long_df.pivot_table(index=['lineage', 'taxonomy'], columns='sample', values='percentage',
+                                  fill_value=0).reset_index()
+    csv_out_path = os.path.join(out_dir, 'taxonomy_report_{}.csv'.format(taxonomic_level))
+    wide_df.to_csv(csv_out_path, index=False)
+    return [csv_out_path]
+
+
+@contextmanager
+def open_level(input_path, taxonomic_level):
+    """
+    :param input_path: Path to a taxonomy barplot *.qzv file, or a folder containing its exported level-N.csv files
+    :param taxonomic_level: One of TAXONOMIC_DICT
+    :return: Context manager yielding an open handle to the level file for the taxonomic level
+    """
+    level_name = TAXONOMIC_DICT[taxonomic_level][0]
+    if os.path.isdir(input_path):
+        with open(os.path.join(input_path, level_name + '.csv')) as f:
+            yield f
+    else:
+        with barplot_reader.open_level_csv(input_path, level_name) as f:
+            yield f
+
+
+def level_file_reports(input_path, taxonomic_level, samples, out_dir, cutoff=None, report_format='sample'):
+    """
+    Opens the level file for the taxonomic level and runs level_reports() on it
+    """
+    with open_level(input_path, taxonomic_level) as f:
+        return level_reports(f, taxonomic_level, samples, out_dir, cutoff=cutoff, report_format=report_format)
+
+
+def batch_reports(input_path, out_dir, samples=None, taxonomic_levels=None, cutoff=None, report_format='sample',
+                  threads=None):
+    """
+    Writes reports for every combination of samples and taxonomic levels, reading each level file only once. Levels
+    are processed in parallel.
+
+    :param input_path: Path to a taxonomy barplot *.qzv file, or a folder containing its exported level-N.csv files
+    :param out_dir: Folder to write reports into
+    :param samples: Sample names to report on. Defaults to every sample.
+    :param taxonomic_levels: Taxonomic levels to report on. Defaults to every level in TAXONOMIC_DICT.
+    :param cutoff: Only report taxa with a percentage >= cutoff in the sample
+    :param report_format: One of REPORT_FORMATS, see level_reports(). 'long' writes a single taxonomy_report_long.csv.
+    :param threads: Number of levels to process at once. Defaults to one per level.
+    :return: List of paths written
+    """
+    if taxonomic_levels is None:
+        taxonomic_levels = list(TAXONOMIC_DICT)
+
+    with ThreadPoolExecutor(max_workers=threads or len(taxonomic_levels)) as executor:
+        results = list(executor.map(lambda level: level_file_reports(input_path, level, samples, out_dir,
+                                                                     cutoff=cutoff, report_format=report_format),
+                                    taxonomic_levels))
+
+    if report_format == 'long':
+        csv_out_path = os.path.join(out_dir, 'taxonomy_report_long.csv')
+        pd.concat(results, ignore_index=True).to_csv(csv_out_path, index=False)
+        return [csv_out_path]
+    return [path for paths in results for path in paths]
+
+
 def convert_to_percentages(df, cols):
     """
     :param df:
@@ -74,85 +211,31 @@ def convert_to_percentages(df, cols):
 
 def extract_csv_files(input_path, out_dir):
     """
-    :param input_path:
-    :param out_dir:
-    :return:
+    :param input_path: Path to a taxonomy barplot *.qzv file
+    :param out_dir: Folder to extract the level-N.csv files into
+    :return: List of paths to the extracted files
     """
-    # Load visualization file
     try:
-        qzv = qiime2.Visualization.load(input_path)
-    except:
+        members = barplot_reader.level_members(input_path)
+    except (zipfile.BadZipFile, ValueError):
         print('Could not load .qzv file. Quitting.')
         return None
 
-    # Create temporary directory to dump contents into
-    temp_dir = os.path.join(out_dir, 'temporary_qiime2')
-    try:
-        os.makedirs(temp_dir)
-    except OSError:
-        shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir)
-
-    # Export contents of QZV
-    qzv.export_data(temp_dir)
-
-    # Make list of files to keep
-    all_files = glob.glob(os.path.join(temp_dir, 'level-*.csv'))
-    files_to_move = []
-    for file in all_files:
-        for key, value in TAXONOMIC_DICT.items():
-            if value[0]+'.' in os.path.basename(file):
-                files_to_move.append(file)
-
-    # Move .csv files of interest
-    out_files = []
-    for file in sorted(files_to_move):
-        out_files.append(os.path.join(out_dir, os.path.basename(file)))
-        shutil.move(file, os.path.join(out_dir, os.path.basename(file)))
-
-    # Cleanup
-    shutil.rmtree(temp_dir)
-
-    return out_files
+    level_names = [value[0] for value in TAXONOMIC_DICT.values()]
+    return [barplot_reader.extract_level_csv(input_path, level_name, os.path.join(out_dir, level_name + '.csv'))
+            for level_name in sorted(members) if level_name in level_names]
 
 
 def extract_taxonomy(value):
-    if 'Unassigned;_' in value:
-        return 'Unassigned'
-
-    junk_list = [
-        'D_0__', 'D_1__', 'D_2__', 'D_3__',
-        'D_4__', 'D_5__', 'D_6__', 'D_7__',
-    ]
-
-    # Initial cleanup
-    for junk in junk_list:
-        value = value.replace(junk, '')
-
-    tax_string = value.split(';')[-1:][0]  # last item in list
-
-    if tax_string == '':
-        tax_list = value.split(';')
-        tax_string = [x for x in reversed(tax_list) if x != ''][0] + ' (closest known classification)'
-    elif tax_string == '__':
-        tax_list = value.split(';')
-        for value in tax_list:
-            if value != '__':
-                tax_string = value + ' (closest known classification)'
-    elif 'uncultured' in tax_string.lower():
-        tax_list = value.split(';')
-        for value in tax_list:
-            if 'uncultured' not in value:
-                tax_string = value + ' (closest known classification)'
-
-    return tax_string
+    return lineage.closest_known_classification(value)
 
 
 @click.command()
 @click.option('-i', '--input_file',
               type=click.Path(exists=True),
               required=True,
-              help='Path to taxonomy barplot *.qzv file')
+              help='Path to taxonomy barplot *.qzv file, or a folder containing the level-N.csv files exported '
+                   'from one')
 @click.option('-o', '--out_dir',
               type=click.Path(exists=True),
               required=True,
@@ -160,29 +243,45 @@ def extract_taxonomy(value):
 @click.option('-s', '--sample',
               default=None,
               required=True,
-              help='Sample name to prepare data for')
+              help='Sample name to prepare data for. Multiple samples can be given separated by commas, or "all" to '
+                   'report on every sample.')
 @click.option('-t', '--taxonomic_level',
               required=True,
               help='Taxonomic level to generate report for. Options: '
-                   '["kingdom", "phylum", "class", "order", "family", "genus", "species"]')
+                   '["kingdom", "phylum", "class", "order", "family", "genus", "species"]. Multiple levels can be '
+                   'given separated by commas, or "all" to report on every level.')
 @click.option('-c', '--cutoff',
               required=False,
               default=0.0,
               help='Filter dataset to a specified cutoff level. For example, setting this to 5.5 will only show '
                    'rows with values >= 5.5%')
-def taxonomy_report_generator(input_file, out_dir, sample, taxonomic_level, cutoff):
-    csv_files = extract_csv_files(input_file, out_dir)
-
+@click.option('-f', '--output_format',
+              type=click.Choice(REPORT_FORMATS),
+              default='sample',
+              help='"sample" writes taxonomy_report_<level>_<sample>.csv for every sample and level, "wide" writes '
+                   'taxonomy_report_<level>.csv with a column per sample, "long" writes a single '
+                   'taxonomy_report_long.csv with a row per sample, level and taxon.')
+@click.option('-n', '--threads',
+              default=None,
+              type=int,
+              help='Number of taxonomic levels to process at once. Defaults to one per level.')
+def taxonomy_report_generator(input_file, out_dir, sample, taxonomic_level, cutoff, output_format, threads):
     taxonomic_level = taxonomic_level.lower()
+    if taxonomic_level == 'all':
+        taxonomic_levels = None
+    else:
+        taxonomic_levels = [x.strip() for x in taxonomic_level.split(',')]
+        for level in taxonomic_levels:
+            if level not in TAXONOMIC_DICT:
+                raise click.BadParameter('{} is not a valid taxonomic level'.format(level))
+    samples = None if sample.lower() == 'all' else [x.strip() for x in sample.split(',')]
 
-    target_file = None
-    for file in csv_files:
-        if TAXONOMIC_DICT[taxonomic_level][0] in file:
-            target_file = file
-
-    df = prepare_df(filepath=target_file, taxonomic_level=taxonomic_level, sample=sample, cutoff=cutoff)
-    csv_out_path = os.path.join(out_dir, 'taxonomy_report_{}_{}.csv'.format(taxonomic_level, sample))
-    df.to_csv(csv_out_path, index=False)
+    try:
+        batch_reports(input_file, out_dir, samples=samples, taxonomic_levels=taxonomic_levels, cutoff=cutoff,
+                      report_format=output_format, threads=threads)
+    except (zipfile.BadZipFile, ValueError) as e:
+        print('{} Quitting.'.format(e))
+        quit()
 
 
 if __name__ == '__main__':
@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 
 import click
+import biom
 from qiime2.plugins import feature_table
+from bin import asv_registry, helper_functions, profiling, run_merger, taxonomy_cache
 from bin.qiime2_pipeline import *
 
 """
@@ -14,9 +16,9 @@ We have two runs containing multiple sample types (veal, beef, sprouts).
 We only want to look at the sprout samples across the two runs, so we can first merge them, and then filter them
 down with this script. The final analysis files will only contain the sprouts samples.
 
-TODO: Allow for an unlimited number of tables/repseqs artifacts to be passed in and merged. This would be much more
-useful than the mandatory 2 right now. Unfortunately Click does not easily support the equivalent of nargs='*' so I'm 
-putting off doing this for now.
+Any number of runs can be merged at once, either by repeating -t/-rs or by listing the run directories in a
+--run_manifest. Runs are merged one at a time with sparse tables, so memory use is bounded by the size of the merged
+table rather than the number of runs. Representative sequences are deduplicated by sequence hash.
 """
 
 logging.basicConfig(
@@ -25,30 +27,95 @@ logging.basicConfig(
     datefmt='%Y-%m-%d %H:%M:%S')
 
 
-def merge_run_tables(table1_artifact_path, table2_artifact_path):
+def merge_run_repseqs(repseqs_artifact_paths, base_dir):
     """
-    :param table1_artifact_path: str path to DADA2 table .qza file (first run)
-    :param table2_artifact_path: str path to DADA2 table .qza file (second run)
+    :param repseqs_artifact_paths: list of str paths to representative sequences .qza files, one per run
+    :param base_dir: Main working directory filepath
+    :return: Tuple of (merged QIIME2 representative sequences object, list of {feature ID: sequence hash} per run)
+    """
+    seen = set()
+    id_maps = []
+    fasta_path = os.path.join(base_dir, 'merged-rep-seqs.fasta')
+    with open(fasta_path, 'w') as f:
+        for repseqs_artifact_path in repseqs_artifact_paths:
+            logging.info('Merging {}...'.format(repseqs_artifact_path))
+            records = run_merger.iter_artifact_sequences(repseqs_artifact_path)
+            id_maps.append(run_merger.deduplicate_sequences(records, f, seen))
+    logging.info('Merged {} unique representative sequences from {} runs'.format(len(seen),
+                                                                                len(repseqs_artifact_paths)))
+    return save_merged_repseqs(fasta_path, base_dir), id_maps
+
+
+def merge_run_tables(table_artifact_paths, id_maps, base_dir, profile_records):
+    """
+    :param table_artifact_paths: list of str paths to DADA2 table .qza files, one per run
+    :param id_maps: list of {feature ID: sequence hash} per run as returned by merge_run_repseqs()
+    :param base_dir: Main working directory filepath
+    :param profile_records: List that the resource usage of loading each run is appended to
+    :return: Merged QIIME2 DADA2 table object
+    """
+    def load_tables():
+        for table_artifact_path, id_map in zip(table_artifact_paths, id_maps):
+            logging.info('Merging {}...'.format(table_artifact_path))
+            with profiling.profile_stage(profile_records, 'merge_table:{}'.format(table_artifact_path),
+                                         input_paths=[table_artifact_path]):
+                table = load_data_artifact(table_artifact_path).view(biom.Table)
+                feature_ids = [id_map[feature_id] for feature_id in table.ids(axis='observation')]
+                yield table.matrix_data, feature_ids, list(table.ids(axis='sample'))
+
+    return save_merged_table(*run_merger.merge_sparse_tables(load_tables()), base_dir=base_dir)
+
+
+def merge_registry_runs(registry_path, run_ids, base_dir):
+    """
+    Builds the merged table and representative sequences straight from the ASV registry, without loading any of the
+    runs' artifacts
+
+    :param registry_path: Path to the ASV registry database
+    :param run_ids: list of IDs of registered runs
+    :param base_dir: Main working directory filepath
+    :return: Tuple of (merged QIIME2 DADA2 table object, merged QIIME2 representative sequences object)
+    """
+    logging.info('Merging runs {} from {}...'.format(', '.join(run_ids), registry_path))
+    connection = asv_registry.open_registry(registry_path)
+    try:
+        matrix, feature_ids, sample_ids = run_merger.merge_sparse_tables(asv_registry.run_tables(connection, run_ids))
+        fasta_path = os.path.join(base_dir, 'merged-rep-seqs.fasta')
+        with open(fasta_path, 'w') as f:
+            for sequence_hash, sequence in asv_registry.sequences_for_hashes(connection, feature_ids).items():
+                f.write('>{}\n{}\n'.format(sequence_hash, sequence))
+    finally:
+        connection.close()
+    return save_merged_table(matrix, feature_ids, sample_ids, base_dir), save_merged_repseqs(fasta_path, base_dir)
+
+
+def save_merged_table(matrix, feature_ids, sample_ids, base_dir):
+    """
+    :param matrix: scipy sparse matrix of counts with features as rows and samples as columns
+    :param feature_ids: list of feature IDs for the rows
+    :param sample_ids: list of sample IDs for the columns
+    :param base_dir: Main working directory filepath
     :return: Merged QIIME2 DADA2 table object
     """
-    logging.info('Merging {} and {}...'.format(table1_artifact_path, table2_artifact_path))
-    table1 = load_data_artifact(table1_artifact_path)
-    table2 = load_data_artifact(table2_artifact_path)
-    dada2_filtered_table = feature_table.actions.merge(tables=[table1, table2]).merged_table
+    logging.info('Merged table contains {} features across {} samples ({} non-zero counts)'.format(
+        len(feature_ids), len(sample_ids), matrix.nnz))
+    dada2_filtered_table = qiime2.Artifact.import_data('FeatureTable[Frequency]',
+                                                       biom.Table(matrix, feature_ids, sample_ids))
+    dada2_filtered_table.save(os.path.join(base_dir, 'table-dada2.qza'))
     return dada2_filtered_table
 
 
-def merge_run_repseqs(repseqs1_artifact_path, repseqs2_artifact_path):
+def save_merged_repseqs(fasta_path, base_dir):
     """
-    :param repseqs1_artifact_path: str path to representative sequences .qza file (first run)
-    :param repseqs2_artifact_path: str path to representative sequences .qza file (second run)
+    :param fasta_path: Path to FASTA file of the merged representative sequences. Removed once imported.
+    :param base_dir: Main working directory filepath
     :return: Merged QIIME2 representative sequences object
     """
-    logging.info('Merging {} and {}...'.format(repseqs1_artifact_path, repseqs2_artifact_path))
-    repseqs1 = load_data_artifact(repseqs1_artifact_path)
-    repseqs2 = load_data_artifact(repseqs2_artifact_path)
-    dada2_filtered_rep_seqs = feature_table.actions.merge_seqs(data=[repseqs1, repseqs2]).merged_data
-    return dada2_filtered_rep_seqs
+    artifact_path = helper_functions.import_artifact(semantic_type='FeatureData[Sequence]',
+                                                     input_path=fasta_path,
+                                                     output_path=os.path.join(base_dir, 'rep-seqs-dada2.qza'))
+    os.remove(fasta_path)
+    return load_artifact(artifact_path)
 
 
 def filter_run_tables(sample_id_file, dada2_table):
@@ -95,35 +162,58 @@ def filter_run_repseqs(sample_id_file, dada2_rep_seqs):
               required=False,
               default='./classifiers/99_V3V4_Silva_naive_bayes_classifier.qza',
               help='Path to QIIME2 Classifier Artifact')
-@click.option('-t1', '--table1_artifact_path',
-              type=click.Path(exists=True),
-              required=True,
-              help='Path to first table artifact generated by DADA2 for merging')
-@click.option('-t2', '--table2_artifact_path',
+@click.option('-t', '-t1', '-t2', '--table_artifact_path', '--table1_artifact_path', '--table2_artifact_path',
+              'table_artifact_paths',
               type=click.Path(exists=True),
-              required=True,
-              help='Path to second table artifact generated by DADA2 for merging')
-@click.option('-rs1', '--repseqs1_artifact_path',
+              multiple=True,
+              help='Path to a table artifact generated by DADA2 for merging. Repeat for every run.')
+@click.option('-rs', '-rs1', '-rs2', '--repseqs_artifact_path', '--repseqs1_artifact_path', '--repseqs2_artifact_path',
+              'repseqs_artifact_paths',
               type=click.Path(exists=True),
-              required=True,
-              help='Path to first representative sequences artifact generated by DADA2 for merging')
-@click.option('-rs2', '--repseqs2_artifact_path',
+              multiple=True,
+              help='Path to a representative sequences artifact generated by DADA2 for merging. Repeat for every run, '
+                   'in the same order as the table artifacts.')
+@click.option('-r', '--run_manifest',
               type=click.Path(exists=True),
-              required=True,
-              help='Path to second representative sequences artifact generated by DADA2 for merging')
+              required=False,
+              default=None,
+              help='Path to a text file listing one ampliconpipeline.py output directory per line. The table-dada2.qza '
+                   'and rep-seqs-dada2.qza of every listed run are merged.')
 @click.option('-f', '--filtering_list',
               required=False,
               type=click.Path(exists=True),
               default=None,
               help='Path to a .tsv file containing sample IDs that you wish to keep for the analysis.'
                    'Each sample ID should be on a new row. The header for this .tsv must be #SampleID')
+@click.option('--taxonomy_cache', 'taxonomy_cache_path',
+              type=click.Path(exists=False),
+              required=False,
+              default=taxonomy_cache.DEFAULT_CACHE_PATH,
+              help='Path to the persistent per-ASV taxonomy cache. ASVs already classified in earlier runs are not '
+                   'classified again. Defaults to {}'.format(taxonomy_cache.DEFAULT_CACHE_PATH))
+@click.option('-rr', '--registry_run', 'registry_run_ids',
+              multiple=True,
+              help='ID of a run in the ASV registry to merge. Repeat for every run. Registry runs are merged with '
+                   'index lookups instead of loading artifacts, and cannot be combined with -t/-rs/--run_manifest.')
+@click.option('--asv_registry', 'asv_registry_path',
+              type=click.Path(exists=False),
+              required=False,
+              default=asv_registry.DEFAULT_REGISTRY_PATH,
+              help='Path to the ASV registry used by --registry_run. Defaults to {}'.format(
+                  asv_registry.DEFAULT_REGISTRY_PATH))
+@click.option('--out_of_core',
+              is_flag=True,
+              default=False,
+              help='Set this flag to keep the Bray-Curtis and Jaccard distance matrices on disk and read them a block '
+                   'at a time, for merged studies with too many samples for in-memory matrices. UniFrac is skipped.')
 def run_merge_pipeline(base_dir, sample_metadata_path, classifier_artifact_path,
-                       table1_artifact_path, table2_artifact_path, repseqs1_artifact_path, repseqs2_artifact_path,
-                       filtering_list):
+                       table_artifact_paths, repseqs_artifact_paths, run_manifest, filtering_list,
+                       taxonomy_cache_path, registry_run_ids, asv_registry_path, out_of_core):
     """
     How this works:
 
-    1. Loads and merges dada2 results from two previous analyses (requires rep-seqs-dada2 and table-dada2 for each run)
+    1. Loads and merges dada2 results from any number of previous analyses (requires rep-seqs-dada2 and table-dada2 for
+    each run)
 
     2. Runs the full pipeline as usual with the merged run
 
@@ -136,12 +226,35 @@ def run_merge_pipeline(base_dir, sample_metadata_path, classifier_artifact_path,
     if not os.path.isdir(base_dir):
         os.makedirs(base_dir)
 
+    # Collect runs
+    table_artifact_paths = list(table_artifact_paths)
+    repseqs_artifact_paths = list(repseqs_artifact_paths)
+    if run_manifest is not None:
+        for run_dir in run_merger.read_run_manifest(run_manifest):
+            table_artifact_path, repseqs_artifact_path = run_merger.locate_run_artifacts(run_dir)
+            table_artifact_paths.append(table_artifact_path)
+            repseqs_artifact_paths.append(repseqs_artifact_path)
+    if len(table_artifact_paths) != len(repseqs_artifact_paths):
+        raise click.UsageError('Every table artifact needs a matching representative sequences artifact')
+    if registry_run_ids and table_artifact_paths:
+        raise click.UsageError('Runs from the ASV registry cannot be merged with runs given as artifacts')
+    if len(table_artifact_paths) + len(registry_run_ids) < 2:
+        raise click.UsageError('At least two runs are required for merging')
+
     # Load metadata
     metadata_object = load_sample_metadata(sample_metadata_path)
 
     # Merge runs
-    dada2_merged_table = merge_run_tables(table1_artifact_path, table2_artifact_path)
-    dada2_merged_rep_seqs = merge_run_repseqs(repseqs1_artifact_path, repseqs2_artifact_path)
+    profile_records = []
+    with profiling.profile_stage(profile_records, 'merge_runs', input_paths=table_artifact_paths):
+        if registry_run_ids:
+            dada2_merged_table, dada2_merged_rep_seqs = merge_registry_runs(asv_registry_path, list(registry_run_ids),
+                                                                            base_dir)
+        else:
+            dada2_merged_rep_seqs, id_maps = merge_run_repseqs(repseqs_artifact_paths, base_dir)
+            dada2_merged_table = merge_run_tables(table_artifact_paths, id_maps, base_dir, profile_records)
+    profiling.write_run_profile(profile_records, base_dir)
+    profiling.log_profile_summary(profile_records)
 
     # Filter runs
     if filtering_list is not None:
@@ -167,17 +280,16 @@ def run_merge_pipeline(base_dir, sample_metadata_path, classifier_artifact_path,
     # Export tree
     export_newick(base_dir=base_dir, tree=phylo_rooted_tree)
 
-    # Load classifier
-    classifier = load_artifact(artifact_path=classifier_artifact_path)
-
-    # Produce rarefaction visualization
-    alpha_rarefaction_visualization(base_dir=base_dir,
-                                    dada2_filtered_table=dada2_merged_table)
+    # Produce rarefaction curves
+    alpha_rarefaction_curves(base_dir=base_dir,
+                             dada2_filtered_table=dada2_merged_table,
+                             phylo_rooted_tree=phylo_rooted_tree)
 
-    # Run taxonomic analysis
-    taxonomy_analysis = classify_taxonomy(base_dir=base_dir,
-                                          dada2_filtered_rep_seqs=dada2_merged_rep_seqs,
-                                          classifier=classifier)
+    # Run taxonomic analysis. ASVs shared with the individual runs are taken from the taxonomy cache.
+    taxonomy_analysis = classify_taxonomy_cached(base_dir=base_dir,
+                                                 dada2_filtered_rep_seqs=dada2_merged_rep_seqs,
+                                                 classifier_artifact_path=classifier_artifact_path,
+                                                 cache_path=taxonomy_cache_path)
 
     # Visualize taxonomy
     visualize_taxonomy(base_dir=base_dir,
@@ -186,10 +298,16 @@ def run_merge_pipeline(base_dir, sample_metadata_path, classifier_artifact_path,
                        dada2_filtered_table=dada2_merged_table)
 
     # Alpha and beta diversity
-    run_diversity_metrics(base_dir=base_dir,
-                          dada2_filtered_table=dada2_merged_table,
-                          phylo_rooted_tree=phylo_rooted_tree,
-                          metadata_object=metadata_object)
+    if out_of_core:
+        run_diversity_metrics_out_of_core(base_dir=base_dir,
+                                          dada2_filtered_table=dada2_merged_table,
+                                          phylo_rooted_tree=phylo_rooted_tree,
+                                          metadata_object=metadata_object)
+    else:
+        run_diversity_metrics(base_dir=base_dir,
+                              dada2_filtered_table=dada2_merged_table,
+                              phylo_rooted_tree=phylo_rooted_tree,
+                              metadata_object=metadata_object)
 
 
 if __name__ == '__main__':
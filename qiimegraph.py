@@ -4,38 +4,35 @@ from collections import OrderedDict
 
 import os
 import re
+import math
 import click
-import pickle
-import qiime2
-import shutil
-import random
+import zipfile
+import multiprocessing
 
 import pandas as pd
 import matplotlib as mpl
 mpl.use('Agg')
 import matplotlib.pyplot as plt
 
+from bin import barplot_reader, lineage, taxon_colors
+
+TAXONOMIC_DICT = {
+    'kingdom': ('level-1', 'D_0__'),
+    'phylum': ('level-2', 'D_1__'),
+    'class': ('level-3', 'D_2__'),
+    'order': ('level-4', 'D_3__'),
+    'family': ('level-5', 'D_4__'),
+    'genus': ('level-6', 'D_5__'),
+    'species': ('level-7', 'D_6__'),
+}
+
 
 def extract_taxonomy(value):
     """
     :param value:
     :return:
     """
-    if 'Unassigned;_' in value:
-        return 'Unassigned'
-
-    try:
-        tax_string = value.split(TAXONOMIC_DICT[TAXONOMIC_LEVEL][1])[1]
-        if tax_string == '':
-            tax_string = value
-    except:
-        tax_string = value
-
-    # Final cleanup. If there are remaining taxonomy characters it means a call to the specified level couldn't be made.
-    if ';' in tax_string and '__' in tax_string:
-        tax_string = 'Unclassified'
-
-    return tax_string
+    return lineage.rank_label(value, TAXONOMIC_LEVEL)
 
 
 def convert_to_percentages(df, cols):
@@ -63,15 +60,14 @@ def get_column_pair(df, col1, col2):
     return df
 
 
-def prepare_df(filepath, index_col, filtering=None):
+def level_table(df, taxonomic_level, filtering=None):
     """
-    :param filepath:
-    :param index_col:
-    :param filtering:
-    :return:
+    :param df: DataFrame of a level-N.csv file exported from a taxonomy barplot, indexed by sample
+    :param taxonomic_level: Taxonomic level of the file
+    :param filtering: Only keep lineages containing this keyword, e.g. Bacteroidales
+    :return: DataFrame with a row per lineage: the lineage in 'index', the percentage in each sample, and the taxon
+    name in a column named after the taxonomic level
     """
-    df = pd.read_csv(filepath, index_col=index_col)
-
     # Remove all extraneous metadata columns
     df = df.drop((x for x in df.columns.tolist()
                   if (x.startswith('D_0__') is False) and
@@ -87,10 +83,10 @@ def prepare_df(filepath, index_col, filtering=None):
     df = df.reset_index()
 
     # Create taxonomic basename column
-    df[TAXONOMIC_LEVEL] = df['index'].map(extract_taxonomy)
+    df[taxonomic_level] = lineage.rank_labels(df['index'], taxonomic_level).astype(str)
 
     # Columns to target for conversion to percentage
-    columns_to_target = [x for x in df.columns.tolist() if x not in ['index', TAXONOMIC_LEVEL]]
+    columns_to_target = [x for x in df.columns.tolist() if x not in ['index', taxonomic_level]]
 
     # Convert
     df = convert_to_percentages(df, columns_to_target)
@@ -98,6 +94,47 @@ def prepare_df(filepath, index_col, filtering=None):
     return df
 
 
+def plot_table(df, taxonomic_level, filtering=None):
+    """
+    :param df: DataFrame of a level-N.csv file exported from a taxonomy barplot, indexed by sample
+    :param taxonomic_level: Taxonomic level of the file
+    :param filtering: Only keep lineages containing this keyword, e.g. Bacteroidales
+    :return: level_table() indexed by taxon name, ready for plot_data()
+    """
+    return level_table(df, taxonomic_level, filtering=filtering).set_index(taxonomic_level).fillna('NA')
+
+
+def plot_data(table, samples):
+    """
+    :param table: DataFrame returned by plot_table()
+    :param samples: Samples to prepare
+    :return: OrderedDict of {sample: (values, labels, explode)}, see prepare_plot()
+    """
+    return OrderedDict((sample, prepare_plot(table, sample)) for sample in samples)
+
+
+def read_level_table(filename, index_col):
+    """
+    :param filename: CSV file exported from a taxonomy barplot, or the barplot *.qzv itself. The level file for
+    TAXONOMIC_LEVEL is streamed out of a *.qzv without writing it to disk.
+    :param index_col: Column to index the DataFrame by
+    :return: DataFrame of the level file
+    """
+    if filename.endswith('.qzv'):
+        return barplot_reader.read_level_csv(filename, TAXONOMIC_DICT[TAXONOMIC_LEVEL][0], index_col=index_col)
+    return pd.read_csv(filename, index_col=index_col)
+
+
+def prepare_df(filepath, index_col, filtering=None):
+    """
+    :param filepath:
+    :param index_col:
+    :param filtering:
+    :return:
+    """
+    return level_table(read_level_table(filepath, index_col), TAXONOMIC_LEVEL, filtering=filtering)
+
+
 def fixed_df(filename, index='sample_annotation', filtering=None):
     """
     :param filename:
@@ -105,16 +142,7 @@ def fixed_df(filename, index='sample_annotation', filtering=None):
     :param filtering:
     :return:
     """
-    df = prepare_df(filepath=filename, index_col=index, filtering=filtering)
-    new_filename = filename.replace('.csv', '_temp.csv')
-
-    # Stupid hack
-    df.to_csv(new_filename, index=None)
-    df = pd.read_csv(new_filename, index_col=TAXONOMIC_LEVEL).fillna('NA')
-
-    # Cleanup
-    os.remove(new_filename)
-    return df
+    return plot_table(read_level_table(filename, index), TAXONOMIC_LEVEL, filtering=filtering)
 
 
 def load_visualization(filepath):
@@ -122,6 +150,8 @@ def load_visualization(filepath):
     :param filepath: path to qiime2 visualization
     :return: qiime2 object containing all information on viz
     """
+    import qiime2
+
     data_visualization = qiime2.Visualization.load(filepath)
     return data_visualization
 
@@ -133,7 +163,7 @@ def prepare_plot(df, sampleid):
     :return:
     """
 
-    ordered_dict = df.to_dict(into=OrderedDict)[sampleid]
+    ordered_dict = OrderedDict(df[sampleid].items())
     ordered_dict = OrderedDict(sorted(ordered_dict.items(), key=lambda x: x[1], reverse=True))
 
     # Set explodes (i.e. separation from the other wedges). This will take the top 3 wedges and explode them.
@@ -173,8 +203,8 @@ def style_wedges(wedges, colordict):
         # wedge.set_color('black') # This puts outlines around the wedges.
         try:
             wedge.set_facecolor(colordict[wedge.get_label()])
-        except:
-            wedge.set_facecolor(colordict[random.sample(list(colordict), 1)[0]])
+        except KeyError:
+            wedge.set_facecolor(taxon_colors.taxon_color(wedge.get_label()))
 
 
 def generate_pct_labels(values, labels):
@@ -194,103 +224,112 @@ def generate_pct_labels(values, labels):
     return pct_labels
 
 
-def paired_multi_pie_charts(samples, out_dir, filtering):
+def grid_shape(n_samples):
     """
-    :param samples:
-    :param out_dir:
-    :param filtering:
-    :return:
+    :param n_samples: Number of pie charts to fit on a figure
+    :return: (rows, columns) of the smallest near-square grid that fits every chart
+    """
+    n_cols = int(math.ceil(math.sqrt(n_samples)))
+    n_rows = int(math.ceil(n_samples / n_cols))
+    return n_rows, n_cols
+
+
+def draw_pie(ax, sample, attributes, colordict):
+    """
+    :param ax: Axes to draw the pie chart on
+    :param sample: Sample name, used as the title
+    :param attributes: (values, labels, explode) as returned by prepare_plot()
+    :param colordict: Dictionary of {taxon: colour}
+    """
+    # Regex setup -- grabs numeric value from string
+    reg_pattern = re.compile(r'^\D*(\d+(?:\.\d+)?)\D*$')
+
+    pct_labels = generate_pct_labels(attributes[0], attributes[1])
+
+    # Create raw pie chart
+    wedges, labels = ax.pie(attributes[0], labels=attributes[1], explode=attributes[2],
+                            startangle=0, shadow=False)
+
+    # Fix labels on the pie chart
+    for label, pct_label in zip(labels, pct_labels):
+
+        # This will allow for the regex to properly extract the value
+        pct_label_fix = pct_label
+        for x in range(6):
+            pct_label_fix = pct_label_fix.replace('D_{}__'.format(str(x)), '')
+
+        # Grab percentage value from string
+        try:
+            pct_value = float(re.findall(reg_pattern, pct_label_fix)[0])
+        except:
+            pct_value = 0
+
+        # Only show the label if it's value is >= 2%
+        if pct_value >= 2:
+            label.set_text(pct_label)
+        else:
+            label.set_text('')
+
+    # Make the wedges look nice with a fixed color
+    style_wedges(wedges=wedges, colordict=colordict)
+
+    # Make sure pie chart is a circle
+    ax.axis('equal')
+
+    # Add title
+    ax.set_title(sample)
+
+
+def render_pie_panel(samples, outfile, colordict):
+    """
+    :param samples: OrderedDict of {sample: (values, labels, explode)} as returned by prepare_plot()
+    :param outfile: Path to save the figure to
+    :param colordict: Dictionary of {taxon: colour}
+    :return: outfile
     """
     # Style setup
     plt.style.use('fivethirtyeight')
 
-    # Consistent colouring across taxonomy e.g. Listeria will always be red
-    colordict = read_color_pickle()
-
     # Font size
     mpl.rcParams['font.size'] = 8
 
-    # Setup figure canvas
-    plt.figure(figsize=(24, 14))
+    # Setup figure canvas sized to the grid
+    n_rows, n_cols = grid_shape(len(samples))
+    fig = plt.figure(figsize=(6 * n_cols, 5 * n_rows))
 
-    # Regex setup -- grabs numeric value from string
-    reg_pattern = re.compile(r'^\D*(\d+(?:\.\d+)?)\D*$')
+    # Create a pie chart for every sample, filling the grid row by row
+    for position, (sample, attributes) in enumerate(samples.items()):
+        ax = plt.subplot2grid((n_rows, n_cols), divmod(position, n_cols))
+        draw_pie(ax, sample, attributes, colordict)
+
+    # Save the file (set transparent=True if you want to eliminate the background)
+    plt.savefig(outfile, bbox_inches='tight', transparent=True)
+    plt.close(fig)
+
+    return outfile
+
+
+def plot_filename(out_dir, prefix, filtering):
+    """
+    :param out_dir: Folder to save the figure into
+    :param prefix: Name identifying the figure, e.g. its samples or panel
+    :param filtering: Group the dataset was filtered to, if any
+    :return: Path to save the figure to
+    """
+    if filtering is not None:
+        return os.path.join(out_dir, '{}_[{}]_{}_plot.png'.format(prefix, filtering, TAXONOMIC_LEVEL.capitalize()))
+    return os.path.join(out_dir, '{}_{}_plot.png'.format(prefix, TAXONOMIC_LEVEL.capitalize()))
 
-    # Dictionary to store all labels for each sample
-    pct_labels_dict = {}
-
-    # Number of samples to figure out grid size
-    n_samples = len(samples)
-
-    # These counters control the positioning of pie charts on the grid
-    x_counter = 1
-    y_counter = 1
-
-    # Create a pie chart for every sample
-    for sample, attributes in samples.items():
-        # print('Generating plot for {}'.format(sample))
-        pct_labels_dict[sample] = generate_pct_labels(attributes[0], attributes[1])
-
-        # Grid position for plot depending on n_samples
-        if n_samples == 4:
-            ax = plt.subplot2grid((4, 4), (y_counter, x_counter))
-        elif n_samples == 6:
-            ax = plt.subplot2grid((3, 4), (y_counter, x_counter))
-        elif n_samples < 4:
-            ax = plt.subplot2grid((3, 4), (y_counter, x_counter))
-
-        # Create raw pie chart
-        wedges, labels = ax.pie(attributes[0], labels=attributes[1], explode=attributes[2],
-                                startangle=0, shadow=False)
-
-        # Fix labels on the pie chart
-        for label, pct_label in zip(labels, pct_labels_dict[sample]):
-
-            # This will allow for the regex to properly extract the value
-            pct_label_fix = pct_label
-            for x in range(6):
-                pct_label_fix = pct_label_fix.replace('D_{}__'.format(str(x)), '')
-
-            # Grab percentage value from string
-            try:
-                pct_value = float(re.findall(reg_pattern, pct_label_fix)[0])
-            except:
-                pct_value = 0
-
-            # Only show the label if it's value is >= 2%
-            if pct_value >= 2:
-                label.set_text(pct_label)
-            else:
-                label.set_text('')
-
-        # Make the wedges look nice with a fixed color
-        style_wedges(wedges=wedges, colordict=colordict)
-
-        # Make sure pie chart is a circle
-        ax.axis('equal')
-
-        # Add title
-        plt.title(sample)
-
-        # Increment grid logic for pie chart placement
-        if n_samples == 6:
-            if x_counter == 3:
-                x_counter = 1
-                y_counter += 1
-            else:
-                x_counter += 1
-
-            if y_counter == 3:
-                y_counter = 1
-
-        elif n_samples == 4:
-            if x_counter == 2:
-                x_counter = 1
-                y_counter += 1
-            else:
-                x_counter += 1
-        elif n_samples < 4:
-            x_counter += 1
+
+def paired_multi_pie_charts(samples, out_dir, filtering):
+    """
+    :param samples:
+    :param out_dir:
+    :param filtering:
+    :return:
+    """
+    # Consistent colouring across taxonomy e.g. Listeria will always be red
+    colordict = read_colors(samples)
 
     # File naming
     prepend = ''
@@ -298,16 +337,74 @@ def paired_multi_pie_charts(samples, out_dir, filtering):
         prepend += key
         prepend += '_'
 
-    # Set the filename
-    if filtering is not None:
-        outfile = os.path.join(out_dir, '{}_[{}]_{}_plot.png'.format(prepend, filtering, TAXONOMIC_LEVEL.capitalize()))
-    else:
-        outfile = os.path.join(out_dir, '{}_{}_plot.png'.format(prepend, TAXONOMIC_LEVEL.capitalize()))
+    return render_pie_panel(samples, plot_filename(out_dir, prepend, filtering), colordict)
 
-    # Save the file (set transparent=True if you want to eliminate the background)
-    plt.savefig(outfile, bbox_inches='tight', transparent=True)
 
-    return outfile
+def read_sample_sheet(sample_sheet, panel_size=9):
+    """
+    :param sample_sheet: Comma or tab separated file with a 'sample' column and optionally a 'panel' column naming the
+    figure each sample is drawn on. Without a 'panel' column samples are split into panels of panel_size in order.
+    :param panel_size: Number of samples per panel when the sheet has no 'panel' column
+    :return: OrderedDict of {panel: [samples]} in the order they appear in the sheet
+    """
+    with open(sample_sheet) as f:
+        sep = '\t' if '\t' in f.readline() else ','
+    sheet = pd.read_csv(sample_sheet, sep=sep, dtype=str)
+    if 'sample' not in sheet.columns:
+        raise ValueError('Sample sheet {} does not have a "sample" column'.format(sample_sheet))
+    if 'panel' not in sheet.columns:
+        sheet['panel'] = ['panel{}'.format(i // panel_size + 1) for i in range(len(sheet))]
+
+    panels = OrderedDict()
+    for panel, sample in zip(sheet['panel'], sheet['sample']):
+        panels.setdefault(panel, []).append(sample)
+    return panels
+
+
+_worker_colordict = None
+
+
+def _init_render_worker(colordict):
+    global _worker_colordict
+    _worker_colordict = colordict
+
+
+def _render_panel_worker(task):
+    samples, outfile = task
+    return render_pie_panel(samples, outfile, _worker_colordict)
+
+
+def batch_pie_charts(filename, panels, out_dir, filtering=None, processes=None, colordict=None):
+    """
+    Renders a figure per panel in a process pool. The table is parsed and the colour map loaded once, and each worker
+    only receives the plot-ready values of its panel.
+
+    :param filename: CSV file exported from a taxonomy barplot, or the barplot *.qzv itself
+    :param panels: OrderedDict of {panel: [samples]}, e.g. from read_sample_sheet()
+    :param out_dir: Folder to save the figures into
+    :param filtering: Filter the dataset to a single group (e.g. Enterobacteriaceae)
+    :param processes: Number of figures to render at once. Defaults to the number of CPUs.
+    :param colordict: Dictionary of {taxon: colour}. Defaults to the colour index, looked up for the plotted taxa.
+    :return: List of paths to the figures in the order of panels
+    """
+    df = fixed_df(filename=filename, filtering=filtering)
+
+    missing = [sample for samples in panels.values() for sample in samples if sample not in df.columns]
+    if missing:
+        raise ValueError('Samples not found in {}: {}'.format(filename, ', '.join(missing)))
+
+    tasks = []
+    for panel, samples in panels.items():
+        sample_dict = plot_data(df, samples)
+        tasks.append((sample_dict, plot_filename(out_dir, panel, filtering)))
+
+    # A single lookup in the colour index for every taxon across all panels
+    if colordict is None:
+        colordict = read_colors(OrderedDict((sample, attributes) for sample_dict, _ in tasks
+                                            for sample, attributes in sample_dict.items()))
+
+    with multiprocessing.Pool(processes, initializer=_init_render_worker, initargs=(colordict,)) as pool:
+        return pool.map(_render_panel_worker, tasks)
 
 
 def create_paired_pie_wrapper(filename, out_dir, samples, filtering):
@@ -319,11 +416,7 @@ def create_paired_pie_wrapper(filename, out_dir, samples, filtering):
     :return:
     """
     df = fixed_df(filename=filename, filtering=filtering)
-
-    sample_dict = OrderedDict()
-    for sample in samples:
-        (values, labels, explode) = prepare_plot(df, sample)
-        sample_dict[sample] = (values, labels, explode)
+    sample_dict = plot_data(df, samples)
 
     filename = paired_multi_pie_charts(sample_dict, out_dir, filtering)
 
@@ -343,101 +436,23 @@ def my_autopct(pct):
     return (('%.2f' % pct) + '%') if pct > 2 else ''
 
 
-def get_spaced_colors(n):
+def read_colors(samples):
     """
-    :param n:
-    :return: list of n colors in RGB
+    :param samples: OrderedDict of {sample: (values, labels, explode)} as returned by prepare_plot()
+    :return: Dictionary of {taxon: colour} for every taxon on the charts
     """
-    max_value = 16581375  # 255**3
-    interval = int(max_value / n)
-    colors = [hex(I)[2:].zfill(6) for I in range(0, max_value, interval)]
+    return taxon_colors.lookup_colors(label for attributes in samples.values() for label in attributes[1])
 
-    return [((int(i[:2], 16)) / 255, (int(i[2:4], 16)) / 255, (int(i[4:], 16) / 255)) for i in colors]
 
-
-def generate_color_pickle():
-    """
-    Takes the SILVA QIIME formatted taxonomy text file and assigns a unique colour to every single entry.
-    Drops a pickled dictionary of {organism:color} associations onto the NAS for usage whenever necessary.
-    :return:
+def check_viz(input_path):
     """
-    taxonomy_file = '/mnt/nas/Databases/16S/Silva/qiime2/SILVA_128_QIIME_release/taxonomy/taxonomy_all/99/consensus_taxonomy_all_levels.txt'
-    f = open(taxonomy_file, 'r')
-    curated_tax = []
-
-    # Extract text from each taxon
-    levels_range = [x for x in range(15)]
-    for line in f.readlines():
-        # Strip ID
-        line = line.split('\t', 1)[1]
-        # Strip all taxonomic level delineations (i.e. D_0__)
-        for level in levels_range:
-            line = line.replace('D_{}__'.format(str(level)), '')
-        # Cleanup
-        all_tax = line.split(';')
-        for tax in all_tax:
-            tax = tax.strip()
-            if tax is not '':
-                curated_tax.append(tax)
-        # Reduce list down to only unique entries
-        curated_tax = list(set(curated_tax))
-
-    # Associate a unique color with each entry
-    colors = get_spaced_colors(len(curated_tax))
-    colordict = {}
-    for l, c in zip(curated_tax, colors):
-        colordict[l] = c
-
-    # Manual additions
-    colordict['Unassigned'] = 'grey'
-    colordict['Unclassified'] = 'grey'
-
-    # Save the dictionary as a pickle for later reference
-    pickle.dump(colordict,
-                open('/mnt/nas/Redmine/QIIME2_CondaEnv/qiimegraph_taxonomic_color_dictionary_V2.pickle', 'wb'))
-
-
-def read_color_pickle():
-    colordict = pickle.load(open('./bin/qiimegraph_taxonomic_color_dictionary.pickle', 'rb'))
-    return colordict
-
-
-def extract_viz_csv(input_path, out_dir):
-    """
-    :param input_path:
-    :param out_dir:
-    :return:
+    :param input_path: Path to a taxonomy barplot *.qzv file
+    :return: True if the archive holds the level file for TAXONOMIC_LEVEL, which is then read straight out of it
     """
-    # Load visualization file
     try:
-        qzv = load_visualization(input_path)
-    except:
-        print('Could not load .qzv file. Quitting.')
-        return None
-
-    # Create temporary directory to dump contents into
-    temp_dir = os.path.join(os.path.dirname(out_dir), 'temporary_qiime2_extraction')
-
-    # Outfile path
-    out_file = os.path.join(out_dir, 'qiime2_data_extract.csv')
-
-    try:
-        os.mkdir(temp_dir)
-    except:
-        shutil.rmtree(temp_dir)
-        os.mkdir(temp_dir)
-
-    # Grab CSV
-    qzv.export_data(temp_dir)
-    taxonomic_csv_path = os.path.join(temp_dir, TAXONOMIC_DICT[TAXONOMIC_LEVEL][0]+'.csv')
-
-    # Move file
-    os.rename(taxonomic_csv_path, out_file)
-
-    # Cleanup
-    shutil.rmtree(temp_dir)
-
-    return out_file
+        return TAXONOMIC_DICT[TAXONOMIC_LEVEL][0] in barplot_reader.level_members(input_path)
+    except (zipfile.BadZipFile, ValueError):
+        return False
 
 
 @click.command()
@@ -454,7 +469,17 @@ def extract_viz_csv(input_path, out_dir):
 @click.option('-s', '--samples',
               default=None,
               help='List of samples to provide. Must be delimited by commas, e.g. -s SAMPLE1,SAMPLE2,SAMPLE3',
-              required=True)
+              required=False)
+@click.option('-ss', '--sample_sheet',
+              type=click.Path(exists=True),
+              default=None,
+              help='Comma or tab separated file with a "sample" column and optionally a "panel" column, for '
+                   'rendering a figure per panel in one go instead of --samples. Without a "panel" column samples '
+                   'are drawn 9 to a figure in the order listed.')
+@click.option('-p', '--processes',
+              type=int,
+              default=None,
+              help='Number of figures to render at once with --sample_sheet. Defaults to the number of CPUs.')
 @click.option('-t', '--taxonomic_level',
               required=False,
               default="family",
@@ -463,16 +488,14 @@ def extract_viz_csv(input_path, out_dir):
 @click.option('-f', '--filtering',
               required=False,
               help='Filter dataset to a single group (e.g. Enterobacteriaceae)')
-def cli(input_file, out_dir, samples, taxonomic_level, filtering):
-    # generate_color_pickle()
+def cli(input_file, out_dir, samples, sample_sheet, processes, taxonomic_level, filtering):
+    if (samples is None) == (sample_sheet is None):
+        click.echo('ERROR: Provide one of [-s, --samples] or [-ss, --sample_sheet]. Quitting.')
+        quit()
 
     if samples is not None:
         samples = tuple(samples.split(','))
 
-        if len(samples) > 9:
-            print('ERROR: Cannot process more than 9 samples. Quitting.')
-            quit()
-
     # Quick validation
     if not os.path.isdir(out_dir):
         click.echo('ERROR: Provided parameter to [-o, --out_dir] is not a valid directory. Try again.')
@@ -482,33 +505,26 @@ def cli(input_file, out_dir, samples, taxonomic_level, filtering):
     global TAXONOMIC_LEVEL
     TAXONOMIC_LEVEL = taxonomic_level
 
-    global TAXONOMIC_DICT
-    TAXONOMIC_DICT = {
-        'kingdom': ('level-1', 'D_0__'),
-        'phylum': ('level-2', 'D_1__'),
-        'class': ('level-3', 'D_2__'),
-        'order': ('level-4', 'D_3__'),
-        'family': ('level-5', 'D_4__'),
-        'genus': ('level-6', 'D_5__'),
-        'species': ('level-7', 'D_6__'),
-    }
-
-    filename = None
-
     # Input file handling
-    if input_file.endswith('.csv'):
-        filename = create_paired_pie_wrapper(input_file, out_dir, samples, filtering)
-    elif input_file.endswith('.qzv'):
-        input_file = extract_viz_csv(input_path=input_file, out_dir=out_dir)
-        if input_file is None:
+    if input_file.endswith('.qzv'):
+        if not check_viz(input_path=input_file):
+            print('Could not load .qzv file. Quitting.')
             quit()
-        else:
-            filename = create_paired_pie_wrapper(input_file, out_dir, samples, filtering)
-    else:
+    elif not input_file.endswith('.csv'):
         click.echo('ERROR: Invalid input_file provided. Please ensure file is .csv or .qzv.')
         quit()
 
-    click.echo('Created chart at {} successfully'.format(filename))
+    if sample_sheet is not None:
+        try:
+            filenames = batch_pie_charts(input_file, read_sample_sheet(sample_sheet), out_dir, filtering=filtering,
+                                         processes=processes)
+        except ValueError as e:
+            click.echo('ERROR: {}. Quitting.'.format(e))
+            quit()
+        click.echo('Created {} charts in {} successfully'.format(len(filenames), out_dir))
+    else:
+        filename = create_paired_pie_wrapper(input_file, out_dir, samples, filtering)
+        click.echo('Created chart at {} successfully'.format(filename))
 
 
 if __name__ == '__main__':
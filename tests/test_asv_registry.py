@@ -0,0 +1,61 @@
+import os
+import pytest
+
+pytest.importorskip('scipy')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.asv_registry import *
+
+LISTERIA = 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae;D_5__Listeria'
+
+
+def populate(connection):
+    sequences = {sequence_digest(sequence): sequence for sequence in ['ACGT', 'TTGG']}
+    register_run(connection, 'run1', sequences,
+                 [(sequence_digest('ACGT'), 'S1', 10), (sequence_digest('TTGG'), 'S1', 5),
+                  (sequence_digest('ACGT'), 'S2', 0)])
+    register_run(connection, 'run2', {sequence_digest('ACGT'): 'ACGT'}, [(sequence_digest('ACGT'), 'S3', 7)])
+    update_taxonomy(connection, {sequence_digest('ACGT'): (LISTERIA, '0.98')})
+
+
+def test_lookups(tmpdir):
+    connection = open_registry(str(tmpdir.join('registry.sqlite')))
+    populate(connection)
+
+    assert [(row[2], row[3], row[4]) for row in find_by_sequence(connection, 'acgt')] == [('run1', 'S1', 10),
+                                                                                         ('run2', 'S3', 7)]
+    assert [row[2] for row in find_by_taxon(connection, 'D_0__Bacteria;D_1__Firmicutes')] == ['run1', 'run2']
+    assert find_by_taxon(connection, 'D_0__Bacteria;D_1__Proteobacteria') == []
+    assert len(find_by_sample(connection, 'S1', run_id='run1')) == 2
+
+    # Re-registering a run replaces its counts
+    register_run(connection, 'run2', {}, [(sequence_digest('ACGT'), 'S4', 1)])
+    assert [row[3] for row in find_by_sequence(connection, 'ACGT')] == ['S1', 'S4']
+
+
+def test_run_tables(tmpdir):
+    connection = open_registry(str(tmpdir.join('registry.sqlite')))
+    populate(connection)
+
+    tables = list(run_tables(connection, ['run1', 'run2']))
+    matrix, feature_ids, sample_ids = tables[0]
+    assert sample_ids == ['S1']
+    assert sorted(matrix.toarray().ravel().tolist()) == [5, 10]
+    with pytest.raises(ValueError):
+        list(run_tables(connection, ['run3']))
+
+
+def test_register_run_conflict(tmpdir):
+    connection = open_registry(str(tmpdir.join('registry.sqlite')))
+    acgt = sequence_digest('ACGT')
+    register_run(connection, 'output', {acgt: 'ACGT'}, [(acgt, 'S1', 10)], run_path='/a/output')
+
+    # Another output folder registering under the same run ID doesn't remove the first run's counts
+    with pytest.raises(ValueError):
+        register_run(connection, 'output', {acgt: 'ACGT'}, [(acgt, 'S2', 3)], run_path='/b/output')
+    assert [row[3] for row in find_by_sequence(connection, 'ACGT')] == ['S1']
+
+    # Unless asked to
+    register_run(connection, 'output', {acgt: 'ACGT'}, [(acgt, 'S2', 3)], run_path='/b/output', overwrite=True)
+    assert [row[3] for row in find_by_sequence(connection, 'ACGT')] == ['S2']
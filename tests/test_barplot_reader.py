@@ -0,0 +1,46 @@
+import os
+import zipfile
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.barplot_reader import *
+
+LEVEL_CSV = 'index,D_0__Bacteria;D_1__Firmicutes,sample_annotation\nseq1,10,S1\nseq2,5,S2\n'
+
+
+def write_qzv(path):
+    uuid = '4c6f6f6b-2061-7420-796f-752067726f77'
+    with zipfile.ZipFile(str(path), 'w') as archive:
+        archive.writestr(uuid + '/metadata.yaml', 'type: Visualization\n')
+        archive.writestr(uuid + '/data/index.html', '<html></html>')
+        archive.writestr(uuid + '/data/level-2.csv', LEVEL_CSV)
+        archive.writestr(uuid + '/data/dist/bundle.js', '')
+    return str(path)
+
+
+def test_level_members(tmpdir):
+    qzv_path = write_qzv(tmpdir.join('taxa-bar-plots.qzv'))
+    assert list(level_members(qzv_path)) == ['level-2']
+
+    empty_path = str(tmpdir.join('empty.qzv'))
+    with zipfile.ZipFile(empty_path, 'w') as archive:
+        archive.writestr('uuid/data/index.html', '')
+    with pytest.raises(ValueError):
+        level_members(empty_path)
+
+
+def test_read_level_csv(tmpdir):
+    qzv_path = write_qzv(tmpdir.join('taxa-bar-plots.qzv'))
+    df = read_level_csv(qzv_path, 'level-2', index_col='sample_annotation')
+    assert df.loc['S2', 'D_0__Bacteria;D_1__Firmicutes'] == 5
+    with pytest.raises(ValueError):
+        read_level_csv(qzv_path, 'level-7')
+
+    out_path = extract_level_csv(qzv_path, 'level-2', str(tmpdir.join('level-2.csv')))
+    with open(out_path) as f:
+        assert f.read() == LEVEL_CSV
+    # Nothing besides the requested file is unpacked
+    assert sorted(os.listdir(str(tmpdir))) == ['level-2.csv', 'taxa-bar-plots.qzv']
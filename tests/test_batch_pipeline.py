@@ -0,0 +1,119 @@
+import os
+import json
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.batch_queue import *
+
+# Stands in for ampliconpipeline.py: records its arguments, and fails for runs whose input folder contains 'fail'
+FAKE_PIPELINE = '''import sys, json
+args = sys.argv[1:]
+outdir = args[args.index('--outdir') + 1]
+with open(outdir + '.args.json', 'a') as f:
+    f.write(json.dumps(args) + '\\n')
+sys.exit(1 if 'fail' in args[args.index('--inputdir') + 1] else 0)
+'''
+
+
+def write_manifest(path, rows):
+    with open(str(path), 'w') as f:
+        f.write('# Comment line\n')
+        f.write('run_id\tinputdir\toutdir\tmetadata\tcpus\ttrunc_len_f\tfiltering_flag\n')
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+
+
+def test_read_manifest(tmpdir):
+    manifest_path = tmpdir.join('batch.tsv')
+    write_manifest(manifest_path, [['RUN_1', 'miseq/RUN_1', 'out/RUN_1', 'meta.tsv', '4', '280', 'true'],
+                                   ['', '/abs/RUN_2', 'out/RUN_2', 'meta.tsv', '', '', '']])
+    runs = read_manifest(str(manifest_path))
+    assert [run['run_id'] for run in runs] == ['RUN_1', 'RUN_2']
+    assert runs[0]['inputdir'] == os.path.join(str(tmpdir), 'miseq/RUN_1')
+    assert runs[1]['inputdir'] == '/abs/RUN_2'
+    assert runs[0]['cpus'] == 4 and runs[1]['cpus'] is None
+    assert runs[0]['options'] == {'trunc_len_f': '280'} and runs[1]['options'] == {}
+    assert runs[0]['flags'] == ['filtering_flag'] and runs[1]['flags'] == []
+
+
+def test_read_manifest_invalid(tmpdir):
+    manifest_path = tmpdir.join('batch.tsv')
+    write_manifest(manifest_path, [['RUN_1', 'a', 'out/RUN_1', 'meta.tsv', '', '', ''],
+                                   ['RUN_1', 'b', 'out/RUN_2', 'meta.tsv', '', '', '']])
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest_path))
+
+    manifest_path.write('inputdir\toutdir\tmetadata\tunknown_option\na\tb\tc\td\n')
+    with pytest.raises(ValueError):
+        read_manifest(str(manifest_path))
+
+
+def test_pipeline_command():
+    run = OrderedDict([('run_id', 'RUN_1'), ('inputdir', 'in'), ('outdir', 'out'), ('metadata', 'meta.tsv'),
+                       ('cpus', None), ('memory_gb', None),
+                       ('options', OrderedDict([('trunc_len_f', '280')])), ('flags', ['filtering_flag']),
+                       ('attempts', 1)])
+    command = pipeline_command(run, pipeline_script='ampliconpipeline.py', default_cpus=8)
+    assert command[1:] == ['ampliconpipeline.py', '--inputdir', 'in', '--outdir', 'out', '--metadata', 'meta.tsv',
+                           '--trunc_len_f', '280', '--filtering_flag', '--cpus', '8']
+    run['attempts'] = 2
+    assert pipeline_command(run)[-1] == '--resume'
+
+
+def test_wait_within_budget():
+    pytest.importorskip('psutil')
+    # The memory is held by a child process, so only a budget for the whole process tree catches it
+    allocate = 'import subprocess, sys; subprocess.call([sys.executable, "-c", "x = bytearray(200 * 1024 ** 2); ' \
+               'import time; time.sleep(30)"])'
+    process = subprocess.Popen([sys.executable, '-c', allocate])
+    returncode, peak, over_budget = wait_within_budget(process, 0.1, poll_interval=0.2)
+    assert over_budget and returncode != 0
+    assert peak > 0.1 * 1024 ** 3
+
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    returncode, _, over_budget = wait_within_budget(process, 1, poll_interval=0.2)
+    assert returncode == 0 and not over_budget
+
+
+def test_run_queue(tmpdir):
+    pipeline_script = tmpdir.join('pipeline.py')
+    pipeline_script.write(FAKE_PIPELINE)
+    manifest_path = tmpdir.join('batch.tsv')
+    write_manifest(manifest_path, [['RUN_{}'.format(i), 'in_{}'.format(i), 'RUN_{}'.format(i), 'meta.tsv', '',
+                                    '', ''] for i in range(4)] + [['RUN_X', 'fail', 'RUN_X', 'meta.tsv', '', '', '']])
+    state_path = default_state_path(str(manifest_path))
+
+    assert len(add_runs(state_path, read_manifest(str(manifest_path)))) == 5
+    # Re-submitting the manifest doesn't queue anything twice
+    assert add_runs(state_path, read_manifest(str(manifest_path))) == []
+
+    run_queue(state_path, concurrency=2, pipeline_script=str(pipeline_script))
+    state = load_state(state_path)
+    assert summarize(state) == OrderedDict([('pending', 0), ('running', 0), ('completed', 4), ('failed', 1)])
+    assert state['runs']['RUN_X']['returncode'] == 1
+    assert os.path.isfile(log_path(state_path, 'RUN_X'))
+
+    # Completed runs are skipped and failed runs are resumed when retried
+    recover_interrupted(state_path, retry_failed=True)
+    run_queue(state_path, pipeline_script=str(pipeline_script))
+    assert load_state(state_path)['runs']['RUN_X']['attempts'] == 2
+    assert len(tmpdir.join('RUN_0.args.json').readlines()) == 1
+    retried = [json.loads(line) for line in tmpdir.join('RUN_X.args.json').readlines()]
+    assert '--resume' not in retried[0] and '--resume' in retried[1]
+
+
+def test_recover_interrupted(tmpdir):
+    state_path = str(tmpdir.join('batch.state.json'))
+    run = OrderedDict([('run_id', 'RUN_1'), ('inputdir', 'in'), ('outdir', 'out'), ('metadata', 'meta.tsv'),
+                       ('cpus', None), ('memory_gb', None), ('options', OrderedDict()), ('flags', [])])
+    add_runs(state_path, [run])
+    assert claim_next_run(state_path)['run_id'] == 'RUN_1'
+    assert claim_next_run(state_path) is None
+
+    # Claimed by this (live) process, so it is left alone
+    assert recover_interrupted(state_path) == []
+    # Claimed by a batch process that no longer exists
+    update_run(state_path, 'RUN_1', pid=2 ** 22 + 1)
+    assert recover_interrupted(state_path) == ['RUN_1']
+    assert load_state(state_path)['runs']['RUN_1']['status'] == 'pending'
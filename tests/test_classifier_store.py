@@ -0,0 +1,48 @@
+import os
+import io
+import tarfile
+import zipfile
+import pytest
+
+np = pytest.importorskip('numpy')
+joblib = pytest.importorskip('joblib')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.classifier_store import *
+
+
+def write_classifier(path, pipeline):
+    pickle_path = path + '.pkl'
+    joblib.dump(pipeline, pickle_path, compress=3)
+    tar_buffer = io.BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode='w') as tar:
+        tar.add(pickle_path, arcname=PIPELINE_FILENAME)
+    os.remove(pickle_path)
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('uuid/metadata.yaml', 'uuid: uuid\ntype: TaxonomicClassifier\n')
+        archive.writestr('uuid/data/sklearn_pipeline.tar', tar_buffer.getvalue())
+
+
+def test_convert_and_load(tmpdir, monkeypatch):
+    classifier_path = str(tmpdir.join('classifier.qza'))
+    write_classifier(classifier_path, {'feature_log_prob': np.arange(1000, dtype=float)})
+    assert load_mmap_classifier(classifier_path) is None
+
+    store_path = convert_classifier(classifier_path)
+    assert store_path == str(tmpdir.join('classifier.mmap'))
+
+    # Loading checks the archive's fingerprint instead of hashing its content
+    def no_digest(filepath):
+        raise AssertionError('Hashed {}'.format(filepath))
+    monkeypatch.setattr(stage_cache, 'file_digest', no_digest)
+
+    pipeline = load_mmap_classifier(classifier_path)
+    assert isinstance(pipeline['feature_log_prob'], np.memmap)
+    assert pipeline['feature_log_prob'][999] == 999
+    # Loaded once per process
+    assert load_mmap_classifier(classifier_path) is pipeline
+
+    # A store built from another version of the classifier is ignored
+    write_classifier(classifier_path, {'feature_log_prob': np.zeros(10)})
+    assert load_mmap_classifier(classifier_path) is None
@@ -0,0 +1,68 @@
+import os
+import gzip
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('matplotlib')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.dada2_optimizer import *
+
+
+def quality_histogram(scores):
+    position_histogram = np.zeros((len(scores), quality_profiler.N_QUALITY_BINS), dtype=np.int64)
+    position_histogram[np.arange(len(scores)), scores] = 100
+    return position_histogram
+
+
+def test_quality_cutoff():
+    histogram = quality_histogram([38] * 200 + [15] * 100)
+    assert 195 <= quality_cutoff(histogram, min_quality=25) <= 200
+    assert quality_cutoff(quality_histogram([38] * 300), min_quality=25) == 300
+
+
+def test_apply_overlap_constraint():
+    assert apply_overlap_constraint(280, 220, 300, 300, amplicon_length=464, min_overlap=20) == (280, 220, True)
+    # 22 bases short, but the forward read can only be extended by 5
+    assert apply_overlap_constraint(295, 167, 300, 300, amplicon_length=464, min_overlap=20) == (300, 184, True)
+    assert apply_overlap_constraint(200, 200, 240, 240, amplicon_length=464, min_overlap=20)[2] is False
+
+
+def test_propose_parameters():
+    profile = {'R1': {'sample': {'position_histogram': quality_histogram([38] * 300)}},
+               'R2': {'sample': {'position_histogram': quality_histogram([38] * 150 + [10] * 150)}}}
+    proposal = propose_parameters(profile, amplicon_length=464, min_overlap=20, forward_primer='CCTACGGGNGGCWGCAG')
+    assert proposal['trim_left_f'] == 17
+    assert proposal['trunc_len_f'] == 300
+    assert proposal['trunc_len_f'] + proposal['trunc_len_r'] >= 484
+
+    candidates = candidate_grid(proposal, max_len_f=300, max_len_r=300, amplicon_length=464, min_overlap=20)
+    assert candidates[0]['trunc_len_r'] == proposal['trunc_len_r']
+    assert all(c['trunc_len_f'] + c['trunc_len_r'] >= 484 and c['trunc_len_f'] <= 300 for c in candidates)
+
+
+def test_subsample_read_pairs(tmpdir):
+    # L002 has three times the reads of L001
+    lanes = []
+    for lane, n_pairs in [('L001', 1000), ('L002', 3000)]:
+        paths = []
+        for read in ['R1', 'R2']:
+            path = str(tmpdir.join('sample_S1_{}_{}_001.fastq.gz'.format(lane, read)))
+            with gzip.open(path, 'wt') as f:
+                for i in range(n_pairs):
+                    f.write('@{}_read{}\nACGT\n+\nIIII\n'.format(lane, i))
+            paths.append(path)
+        lanes.append(tuple(paths))
+
+    out_r1, out_r2 = subsample_read_pairs(lanes, str(tmpdir.mkdir('out')), n_reads=400)
+    assert os.path.basename(out_r1) == 'sample_S1_L001_R1_001.fastq.gz'
+    with gzip.open(out_r1, 'rt') as f1, gzip.open(out_r2, 'rt') as f2:
+        headers_r1 = f1.read().split('\n')[::4][:-1]
+        headers_r2 = f2.read().split('\n')[::4][:-1]
+    assert len(headers_r1) == 400
+    assert headers_r1 == headers_r2
+    # Drawn from the whole of both lanes in proportion to their reads, not from the head of the first one
+    from_l002 = sum(header.startswith('@L002') for header in headers_r1)
+    assert 250 < from_l002 < 350
+    assert max(int(header.split('read')[1]) for header in headers_r1 if header.startswith('@L002')) > 2500
@@ -0,0 +1,232 @@
+import os
+import gzip
+import time
+import random
+import shutil
+import zipfile
+import subprocess
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.dada2_sharding import *
+
+UUID = '0b8a0c36-0d1e-4f58-9b6e-6d4f2f0c7c11'
+SAMPLES = ['2018-SEQ-0001_00', '2018-SEQ-0002_00', '2018-SEQ-0003_00']
+PARAMS = OrderedDict([('trim_left_f', 10), ('trim_left_r', 5), ('trunc_len_f', 280), ('trunc_len_r', 280),
+                      ('max_ee', 2), ('chimera_method', 'consensus')])
+
+
+def write_demux_artifact(path):
+    manifest = 'sample-id,filename,direction\n'
+    with zipfile.ZipFile(str(path), 'w') as archive:
+        archive.writestr(UUID + '/metadata.yaml', 'type: SampleData[PairedEndSequencesWithQuality]\n')
+        for index, sample_id in enumerate(SAMPLES):
+            for read, direction in [('R1', 'forward'), ('R2', 'reverse')]:
+                filename = '{}_{}_L001_{}_001.fastq.gz'.format(sample_id, index, read)
+                archive.writestr(UUID + '/data/' + filename, filename)
+                manifest += '{},{},{}\n'.format(sample_id, filename, direction)
+        archive.writestr(UUID + '/data/MANIFEST', manifest)
+    return str(path)
+
+
+def test_create_plan(tmpdir):
+    data_artifact_path = write_demux_artifact(tmpdir.join('paired-sample-data.qza'))
+    work_dir = str(tmpdir.join('work'))
+
+    plan = create_plan(work_dir, data_artifact_path, PARAMS, shard_size=2)
+    assert plan['shards'] == [SAMPLES[:2], SAMPLES[2:]]
+    assert task_phases(plan) == [['filter-000', 'filter-001'], ['learn'], ['denoise-000', 'denoise-001'], ['merge']]
+    with open(os.path.join(work_dir, 'shards', 'shard-001.tsv')) as f:
+        assert f.read().splitlines() == ['sample\tforward\treverse',
+                                         '{0}\t{1}/reads/{0}_2_L001_R1_001.fastq.gz\t'
+                                         '{1}/reads/{0}_2_L001_R2_001.fastq.gz'.format(SAMPLES[2], work_dir)]
+
+    # An earlier plan for the same reads and parameters is picked up, anything else is refused
+    assert create_plan(work_dir, data_artifact_path, PARAMS, shard_size=1) == plan
+    with pytest.raises(ValueError):
+        create_plan(work_dir, data_artifact_path, OrderedDict(PARAMS, trunc_len_f=250))
+
+
+def test_task_command(tmpdir):
+    data_artifact_path = write_demux_artifact(tmpdir.join('paired-sample-data.qza'))
+    work_dir = str(tmpdir.join('work'))
+    plan = create_plan(work_dir, data_artifact_path, PARAMS, shard_size=2)
+
+    command = task_command(work_dir, plan, 'filter-001', 4)
+    assert command[:4] == ['Rscript', SHARD_SCRIPT, 'filter', os.path.join(work_dir, 'shards', 'shard-001.tsv')]
+    assert command[-7:] == ['280', '280', '10', '5', '2', '2', '4']
+    assert task_command(work_dir, plan, 'learn', 8)[-2:] == [str(N_READS_LEARN), '8']
+    assert task_command(work_dir, plan, 'merge', 8)[-1] == '8'
+    with open(os.path.join(work_dir, 'seqtabs.txt')) as f:
+        assert len(f.read().splitlines()) == 2
+
+
+def test_claims(tmpdir):
+    data_artifact_path = write_demux_artifact(tmpdir.join('paired-sample-data.qza'))
+    work_dir = str(tmpdir.join('work'))
+    plan = create_plan(work_dir, data_artifact_path, PARAMS, shard_size=2)
+
+    assert claim_task(work_dir, 'filter-000')
+    assert not claim_task(work_dir, 'filter-000')
+    # A claimed task is left to its owner
+    assert not run_task(work_dir, plan, 'filter-000', 1)
+    release_task(work_dir, 'filter-000')
+    assert claim_task(work_dir, 'filter-000')
+
+    open(os.path.join(work_dir, 'failed', 'filter-001'), 'w').close()
+    with pytest.raises(RuntimeError) as e:
+        wait_for_tasks(work_dir, plan, ['filter-000', 'filter-001'], poll_interval=0)
+    assert SAMPLES[2] in str(e.value)
+
+    # Clearing failures leaves the live claim on filter-000 alone
+    clear_failures(work_dir)
+    assert not task_failed(work_dir, 'filter-001')
+    assert not claim_task(work_dir, 'filter-000')
+    assert wait_for_tasks(work_dir, plan, ['filter-000', 'filter-001'], poll_interval=0) == ['filter-001']
+
+
+def dead_pid():
+    process = subprocess.Popen(['true'])
+    process.wait()
+    return process.pid
+
+
+def test_stale_claims(tmpdir):
+    data_artifact_path = write_demux_artifact(tmpdir.join('paired-sample-data.qza'))
+    work_dir = str(tmpdir.join('work'))
+    plan = create_plan(work_dir, data_artifact_path, PARAMS, shard_size=2)
+    tasks = ['filter-000', 'filter-001']
+
+    def write_claim(task, owner, age=0):
+        os.mkdir(os.path.join(work_dir, 'claims', task))
+        owner_path = os.path.join(work_dir, 'claims', task, 'owner')
+        with open(owner_path, 'w') as f:
+            f.write(owner + '\n')
+        os.utime(owner_path, (time.time() - age, time.time() - age))
+
+    # A claim from a process on this host that has exited is stale straight away
+    write_claim('filter-000', '{}:{}'.format(socket.gethostname(), dead_pid()))
+    assert claim_stale(work_dir, 'filter-000')
+    # A claim from another host is stale once its heartbeat is older than the timeout
+    write_claim('filter-001', 'otherhost:1', age=60)
+    assert not claim_stale(work_dir, 'filter-001', claim_timeout=120)
+    assert claim_stale(work_dir, 'filter-001', claim_timeout=30)
+
+    # Waiting on dead claims returns them instead of polling forever
+    assert wait_for_tasks(work_dir, plan, tasks, poll_interval=0, claim_timeout=30) == tasks
+
+    assert claim_task(work_dir, 'filter-000')
+    assert claim_owner(work_dir, 'filter-000') == '{}:{}'.format(socket.gethostname(), os.getpid())
+    assert not claim_task(work_dir, 'filter-001', claim_timeout=120)
+    assert claim_task(work_dir, 'filter-001', claim_timeout=30)
+    assert sorted(os.listdir(os.path.join(work_dir, 'claims'))) == tasks
+
+    # The live claims of this process are left alone
+    assert not claim_stale(work_dir, 'filter-000')
+    assert not claim_task(work_dir, 'filter-000')
+
+
+def test_call_with_heartbeat(tmpdir):
+    owner_path = str(tmpdir.join('owner'))
+    open(owner_path, 'w').close()
+    os.utime(owner_path, (0, 0))
+    assert call_with_heartbeat(['sleep', '0.3'], owner_path, heartbeat_interval=0.1) == 0
+    assert os.path.getmtime(owner_path) > time.time() - 60
+    assert call_with_heartbeat(['false'], owner_path) == 1
+
+
+def test_load_results(tmpdir):
+    work_dir = str(tmpdir)
+    os.makedirs(os.path.join(work_dir, 'shards'))
+    plan = OrderedDict([('shards', [['S1', 'S2'], ['S3']])])
+    tables = {
+        'seqtab.tsv': 'sequence\tS3\tS1\nACGT\t5\t5\nTTTT\t1\t20\nGGGG\t0\t10\n',
+        'nonchimeric.tsv': 'sample\tnon-chimeric\nS1\t35\nS3\t6\n',
+        'shards/shard-000.filter.tsv': 'sample\tinput\tfiltered\nS1\t100\t80\nS2\t50\t0\n',
+        'shards/shard-001.filter.tsv': 'sample\tinput\tfiltered\nS3\t20\t10\n',
+        'shards/shard-000.denoise.tsv': 'sample\tdenoised\tmerged\nS1\t70\t40\n',
+        'shards/shard-001.denoise.tsv': 'sample\tdenoised\tmerged\nS3\t9\t7\n',
+    }
+    for name, content in tables.items():
+        with open(os.path.join(work_dir, name), 'w') as f:
+            f.write(content)
+
+    seqtab, stats = load_results(work_dir, plan)
+    assert seqtab.columns.tolist() == ['S1', 'S3']
+    assert seqtab.index.tolist() == ['TTTT', 'ACGT', 'GGGG']
+    assert stats.columns.tolist() == ['input', 'filtered', 'percentage of input passed filter', 'denoised', 'merged',
+                                      'percentage of input merged', 'non-chimeric',
+                                      'percentage of input non-chimeric']
+    assert stats.loc['S2'].tolist() == [50, 0, 0.0, 0, 0, 0.0, 0, 0.0]
+    assert stats.loc['S1'].tolist() == [100, 80, 80.0, 70, 40, 40.0, 35, 35.0]
+    assert stats.loc['S3', 'percentage of input non-chimeric'] == 30.0
+
+
+def dada2_available():
+    if shutil.which('Rscript') is None:
+        return False
+    return subprocess.call(['Rscript', '-e', 'library(dada2)'], stdout=subprocess.DEVNULL,
+                           stderr=subprocess.DEVNULL) == 0
+
+
+def write_amplicon_reads(reads_dir, n_samples=4, n_pairs=300, read_length=150, seed=0):
+    """
+    Writes Casava 1.8 read pairs of a few 250 bp amplicons in different proportions per sample, with 0.5% errors
+    """
+    random_state = random.Random(seed)
+    complement = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+    templates = [''.join(random_state.choice('ACGT') for _ in range(250)) for _ in range(5)]
+
+    def mutate(read):
+        return ''.join(random_state.choice('ACGT'.replace(base, '')) if random_state.random() < 0.005 else base
+                       for base in read)
+
+    for sample in range(1, n_samples + 1):
+        # Each template a different share of the reads of the sample
+        pool = [template for template in templates for _ in range(random_state.randint(1, 10))]
+        handles = [gzip.open(os.path.join(reads_dir, 'S{0}_{0}_L001_{1}_001.fastq.gz'.format(sample, read)), 'wt')
+                   for read in ('R1', 'R2')]
+        for index in range(n_pairs):
+            template = random_state.choice(pool)
+            reverse = ''.join(complement[base] for base in reversed(template))
+            for handle, read, direction in zip(handles, (template, reverse), ('1', '2')):
+                handle.write('@M00000:1:000000000-AAAAA:1:1101:{}:{} {}:N:0:1\n{}\n+\n{}\n'.format(
+                    sample, index, direction, mutate(read[:read_length]), 'I' * read_length))
+        for handle in handles:
+            handle.close()
+
+
+@pytest.mark.skipif(not dada2_available(), reason='Requires Rscript with the dada2 package')
+def test_matches_denoise_paired(tmpdir):
+    qiime2 = pytest.importorskip('qiime2')
+    qiime2_pipeline = pytest.importorskip('bin.qiime2_pipeline')
+
+    reads_dir = str(tmpdir.mkdir('reads'))
+    write_amplicon_reads(reads_dir)
+    demultiplexed_seqs = qiime2.Artifact.import_data('SampleData[PairedEndSequencesWithQuality]', reads_dir,
+                                                     'CasavaOneEightSingleLanePerSampleDirFmt')
+    data_artifact_path = demultiplexed_seqs.save(str(tmpdir.join('paired-sample-data.qza')))
+    single_dir = str(tmpdir.mkdir('single'))
+    sharded_dir = str(tmpdir.mkdir('sharded'))
+
+    def sequence_table(table, rep_seqs):
+        sequences = rep_seqs.view(pd.Series).astype(str)
+        counts = table.view(pd.DataFrame).T
+        counts.index = [sequences[feature_id] for feature_id in counts.index]
+        return counts.sort_index().sort_index(axis=1)
+
+    expected = sequence_table(*qiime2_pipeline.dada2_qc(single_dir, demultiplexed_seqs, 0, 0, 150, 150,
+                                                        cpu_count=1))
+    observed = sequence_table(*denoise_sharded(sharded_dir, data_artifact_path, 0, 0, 150, 150, cpu_count=2,
+                                               shard_size=2))
+    pd.testing.assert_frame_equal(observed, expected, check_dtype=False)
+
+    expected_stats = qiime2.Artifact.load(os.path.join(single_dir, 'dada2-denoising-stats.qza')).view(
+        qiime2.Metadata).to_dataframe()
+    observed_stats = qiime2.Artifact.load(os.path.join(sharded_dir, 'dada2-denoising-stats.qza')).view(
+        qiime2.Metadata).to_dataframe()
+    assert observed_stats.columns.tolist() == expected_stats.columns.tolist()
+    pd.testing.assert_frame_equal(observed_stats.sort_index(), expected_stats.sort_index(), check_dtype=False)
@@ -0,0 +1,95 @@
+import os
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.distance_memmap import *
+
+from scipy.spatial.distance import pdist, squareform
+
+
+def random_table(n_features=40, n_samples=23, seed=0):
+    random_state = np.random.RandomState(seed)
+    counts = random_state.poisson(2, size=(n_features, n_samples)) * (random_state.rand(n_features, n_samples) < 0.3)
+    # Every sample has at least one read
+    counts[0] += 1
+    return counts
+
+
+def naive_pseudo_f(distances, grouping):
+    grouping = np.asarray(grouping)
+    n = len(grouping)
+    groups = np.unique(grouping)
+    squared = distances ** 2
+    s_total = squared[np.triu_indices(n, 1)].sum() / n
+    s_within = 0
+    for group in groups:
+        members = np.flatnonzero(grouping == group)
+        s_within += squared[np.ix_(members, members)][np.triu_indices(len(members), 1)].sum() / len(members)
+    return ((s_total - s_within) / (len(groups) - 1)) / (s_within / (n - len(groups)))
+
+
+@pytest.mark.parametrize('metric', METRICS)
+def test_blockwise_distances(tmpdir, metric):
+    counts = random_table()
+    sample_ids = ['S{}'.format(i) for i in range(counts.shape[1])]
+    expected = squareform(pdist(counts.T > 0 if metric == 'jaccard' else counts.T, metric=metric))
+
+    for processes in (1, 3):
+        out_path = str(tmpdir.join('{}_{}.npy'.format(metric, processes)))
+        blockwise_distances(sparse.csc_matrix(counts), sample_ids, out_path, metric, block_size=5,
+                            processes=processes)
+        distance_matrix, ids = open_distance_matrix(out_path)
+        assert isinstance(distance_matrix, np.memmap)
+        assert ids == sample_ids
+        np.testing.assert_allclose(distance_matrix, expected)
+
+
+def test_permanova():
+    counts = random_table()
+    distances = squareform(pdist(counts.T, metric='braycurtis'))
+    grouping = ['a'] * 8 + ['b'] * 7 + ['c'] * 8
+    result = permanova(distances, grouping, permutations=99, block_size=4)
+    assert result['sample size'] == 23
+    assert result['number of groups'] == 3
+    assert result['test statistic'] == pytest.approx(naive_pseudo_f(distances, grouping))
+    assert 0 < result['p-value'] <= 1
+    # Same permutations however the matrix is read
+    assert permanova(distances, grouping, permutations=99, block_size=100)['p-value'] == result['p-value']
+
+    with pytest.raises(ValueError):
+        permanova(distances, ['a'] * 23)
+
+
+def test_group_significance():
+    # Two well separated groups of samples
+    points = np.concatenate([np.zeros((6, 2)), np.ones((6, 2)) * 10]) + np.random.RandomState(0).rand(12, 2)
+    distances = squareform(pdist(points))
+    sample_ids = ['S{}'.format(i) for i in range(12)]
+    grouping = pd.Series(['near'] * 6 + ['far'] * 5 + [None], index=sample_ids[::-1])
+    results = group_significance(distances, sample_ids, grouping, permutations=99, block_size=5)
+    assert list(results[['group_1', 'group_2']].itertuples(index=False, name=None)) == [('all', 'all'),
+                                                                                        ('far', 'near')]
+    # The sample without a group is left out
+    assert list(results['sample_size']) == [11, 11]
+    assert results['p_value'].iloc[0] == pytest.approx(0.01)
+
+
+def test_pcoa():
+    counts = random_table()
+    distances = squareform(pdist(counts.T, metric='braycurtis'))
+    eigvals, coordinates, proportion_explained = pcoa(distances, dimensions=3, block_size=4)
+
+    # Classical scaling of the full centered matrix
+    n = len(distances)
+    centering = np.eye(n) - 1.0 / n
+    expected_eigvals, expected_eigvecs = np.linalg.eigh(-0.5 * centering.dot(distances ** 2).dot(centering))
+    expected_eigvals = expected_eigvals[::-1]
+    expected_coordinates = expected_eigvecs[:, ::-1][:, :3] * np.sqrt(expected_eigvals[:3])
+
+    np.testing.assert_allclose(eigvals, expected_eigvals[:3])
+    np.testing.assert_allclose(proportion_explained, expected_eigvals[:3] / expected_eigvals.sum())
+    # Axes are only defined up to their sign
+    np.testing.assert_allclose(np.abs(coordinates), np.abs(expected_coordinates), atol=1e-8)
@@ -0,0 +1,29 @@
+import os
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.diversity_benchmark import *
+
+
+def test_time_call():
+    calls = []
+    seconds, result = time_call(lambda: calls.append(1) or len(calls), repeats=3)
+    assert len(calls) == 3
+    assert result == 3
+    assert seconds >= 0
+
+
+def test_benchmark_summary():
+    timings = OrderedDict([('weighted_unifrac', OrderedDict([(4, 2.5), (1, 10.0)])),
+                           ('core_metrics_phylogenetic', OrderedDict([(1, 30.0), (4, 12.0)]))])
+    differences = {'weighted_unifrac': {1: 0.0, 4: 0.0}}
+    rows = benchmark_summary(timings, differences)
+    assert [(row['metric'], row['jobs']) for row in rows] == [
+        ('weighted_unifrac', 1), ('weighted_unifrac', 4), ('core_metrics_phylogenetic', 1),
+        ('core_metrics_phylogenetic', 4)]
+    assert rows[1]['speedup'] == 4.0
+    assert rows[1]['max_difference'] == 0.0
+    # core_metrics_phylogenetic rarefies on every call, so its matrices aren't compared
+    assert rows[3]['speedup'] == 2.5
+    assert rows[3]['max_difference'] is None
@@ -42,6 +42,8 @@ def test_get_readpair():
 
 
 def test_project_setup():
+    # project_setup imports the run as a QIIME 2 artifact
+    pytest.importorskip('qiime2')
     outdir = os.path.join(parentdir, 'tests', 'sample_outdir')
     inputdir = os.path.join(parentdir, 'tests', 'sample_miseq')
 
@@ -69,8 +71,39 @@ def test_valid_olc_id():
 
 
 def test_create_sampledata_artifact():
+    pytest.importorskip('qiime2')
     datadir = os.path.join(parentdir, 'tests', 'sample_miseq')
     qiimedir = os.path.join(parentdir, 'tests', 'sample_outdir', 'qiime2')
     path = create_sampledata_artifact(datadir, qiimedir)
     assert os.path.isfile(path)
 
+
+def test_index_fastq_files():
+    fastq_list = ['/run/2017-SEQ-1114_S1_L001_R1_001.fastq.gz',
+                  '/run/2017-SEQ-1114_S1_L001_R2_001.fastq.gz',
+                  '/run/2017-SEQ-1115_S2_L001_R1_001.fastq.gz',
+                  '/run/2017-SEQ-1115_S2_L002_R1_001.fastq.gz',
+                  '/run/2017-SEQ-1115_S2_L001_R2_001.fastq.gz',
+                  '/run/2017-SEQ-1115_S2_L002_R2_001.fastq.gz',
+                  '/run/2017-SEQ-1116_S3_L001_R1_001.fastq.gz',
+                  '/run/notes.fastq.gz']
+    index, orphans = index_fastq_files(fastq_list)
+    assert list(index) == ['2017-SEQ-1114', '2017-SEQ-1115']
+    assert list(index['2017-SEQ-1115']) == ['001', '002']
+    assert orphans == ['/run/2017-SEQ-1116_S3_L001_R1_001.fastq.gz', '/run/notes.fastq.gz']
+
+    sample_dictionary = sample_dictionary_from_index(index)
+    assert sample_dictionary['2017-SEQ-1114'] == fastq_list[:2]
+    assert sample_dictionary['2017-SEQ-1115'][0] == (fastq_list[2], fastq_list[3])
+
+
+def test_scan_fastq_directory_cache(tmpdir):
+    run_dir = tmpdir.mkdir('run')
+    cache_dir = str(tmpdir.join('cache'))
+    run_dir.join('2017-SEQ-1114_S1_L001_R1_001.fastq.gz').write('')
+    assert len(scan_fastq_directory(str(run_dir), cache_dir=cache_dir)) == 1
+
+    # Adding a file updates the directory mtime, which invalidates the cached listing
+    run_dir.join('2017-SEQ-1114_S1_L001_R2_001.fastq.gz').write('')
+    os.utime(str(run_dir), ns=(0, os.stat(str(run_dir)).st_mtime_ns + 1))
+    assert len(scan_fastq_directory(str(run_dir), cache_dir=cache_dir)) == 2
@@ -0,0 +1,49 @@
+import os
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.lineage import *
+
+LISTERIA = ('D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae;D_5__Listeria;'
+            'D_6__Listeria monocytogenes')
+UNRESOLVED = 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__;__'
+UNCULTURED = 'D_0__Bacteria;D_1__Proteobacteria;D_2__Gammaproteobacteria;D_3__uncultured bacterium'
+
+
+def test_closest_known_classification():
+    assert closest_known_classification(LISTERIA) == 'Listeria monocytogenes'
+    assert closest_known_classification(UNRESOLVED) == 'Bacillales (closest known classification)'
+    assert closest_known_classification('D_0__Bacteria;D_1__Firmicutes;') == \
+        'Firmicutes (closest known classification)'
+    assert closest_known_classification(UNCULTURED) == 'Gammaproteobacteria (closest known classification)'
+    assert closest_known_classification('Unassigned;__;__') == 'Unassigned'
+
+
+def test_rank_label():
+    assert rank_label('D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli', 'class') == 'Bacilli'
+    assert rank_label('D_0__Bacteria;D_1__Firmicutes;D_2__', 'class') == 'Unclassified'
+    assert rank_label('D_0__Bacteria;__;__', 'class') == 'Unclassified'
+    assert rank_label('Unassigned;_;_', 'class') == 'Unassigned'
+
+
+def test_parse_lineages():
+    lineages = pd.Series([LISTERIA, UNRESOLVED, LISTERIA], index=['a', 'b', 'c'])
+    table = parse_lineages(lineages)
+
+    assert list(table.index) == ['a', 'b', 'c']
+    assert list(table.columns) == RANKS + [CLOSEST_KNOWN_COLUMN]
+    assert table.loc['a', 'species'] == 'Listeria monocytogenes'
+    assert table.loc['b', 'order'] == 'Bacillales'
+    assert pd.isnull(table.loc['b', 'family'])
+    assert pd.isnull(table.loc['b', 'genus'])
+    assert table.loc['c', CLOSEST_KNOWN_COLUMN] == 'Listeria monocytogenes'
+    assert str(table['genus'].dtype) == 'category'
+
+    # Level files are truncated at their rank
+    family_lineages = ['D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae',
+                       'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__']
+    assert parse_lineages(family_lineages)['family'].tolist()[0] == 'Listeriaceae'
+    assert rank_labels(family_lineages, 'family').tolist() == ['Listeriaceae', 'Unclassified']
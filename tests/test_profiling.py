@@ -0,0 +1,41 @@
+import os
+import json
+import time
+import threading
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.profiling import *
+
+
+def test_overlapping_stages():
+    records = [{'stage': 'dada2_qc', 'start_timestamp': 0, 'wall_seconds': 10},
+               {'stage': 'classify_taxonomy', 'start_timestamp': 10, 'wall_seconds': 30},
+               {'stage': 'phylo_tree', 'start_timestamp': 12, 'wall_seconds': 5}]
+    assert overlapping_stages(records) == {'dada2_qc': [], 'classify_taxonomy': ['phylo_tree'],
+                                           'phylo_tree': ['classify_taxonomy']}
+
+
+def test_thread_cpu_seconds_excludes_other_threads(tmpdir):
+    records = []
+    stop = threading.Event()
+
+    def spin():
+        while not stop.is_set():
+            pass
+
+    with profile_stage(records, 'idle'):
+        spinner = threading.Thread(target=spin)
+        spinner.start()
+        time.sleep(0.5)
+        stop.set()
+        spinner.join()
+
+    record = records[0]
+    if 'thread_cpu_seconds' in record:
+        assert record['thread_cpu_seconds'] < record['cpu_seconds']
+
+    with open(write_run_profile(records, str(tmpdir))) as f:
+        profile = json.load(f)
+    assert 'cpu_seconds' in profile['notes']
+    assert profile['stages'][0]['overlapping_stages'] == []
@@ -0,0 +1,96 @@
+import os
+import zipfile
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('matplotlib')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+import qiimegraph
+from qiimegraph import *
+
+LINEAGES = ['D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae',
+            'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Bacillaceae',
+            'D_0__Bacteria;D_1__Proteobacteria;D_2__Gammaproteobacteria;D_3__Enterobacteriales;'
+            'D_4__Enterobacteriaceae']
+COLORDICT = {'Listeriaceae': 'red', 'Bacillaceae': 'blue', 'Enterobacteriaceae': 'green'}
+
+
+def write_level_csv(path, samples):
+    df = pd.DataFrame([[10 * (i + 1), 5, i] for i in range(len(samples))], columns=LINEAGES)
+    df.insert(0, 'index', ['seq{}'.format(i) for i in range(len(samples))])
+    df['sample_annotation'] = samples
+    df.to_csv(str(path), index=False)
+    return str(path)
+
+
+def test_plot_table(tmpdir):
+    filename = write_level_csv(tmpdir.join('level-5.csv'), ['S1', 'S2'])
+    table = plot_table(pd.read_csv(filename, index_col='sample_annotation'), 'family')
+    assert table.index.name == 'family'
+    assert table.index.tolist() == ['Listeriaceae', 'Bacillaceae', 'Enterobacteriaceae']
+    assert table['S1'].round(2).tolist() == [66.67, 33.33, 0.0]
+
+    data = plot_data(table, ['S1', 'S2'])
+    values, labels, explode = data['S2']
+    assert labels == ['Listeriaceae', 'Bacillaceae', 'Enterobacteriaceae']
+    assert explode == (0.1, 0.1, 0.1)
+
+    # fixed_df() gives the same table without writing anything next to the input
+    qiimegraph.TAXONOMIC_LEVEL = 'family'
+    assert fixed_df(filename).equals(table)
+    assert os.listdir(str(tmpdir)) == ['level-5.csv']
+
+
+def test_fixed_df_from_qzv(tmpdir):
+    filename = write_level_csv(tmpdir.join('level-5.csv'), ['S1', 'S2'])
+    qzv_path = str(tmpdir.join('taxa-bar-plots.qzv'))
+    with zipfile.ZipFile(qzv_path, 'w') as archive:
+        archive.write(filename, 'f1b2c3/data/level-5.csv')
+        archive.writestr('f1b2c3/data/index.html', '<html></html>')
+    os.remove(filename)
+
+    # The level file is streamed out of the archive without extracting anything
+    qiimegraph.TAXONOMIC_LEVEL = 'family'
+    assert check_viz(qzv_path)
+    table = fixed_df(qzv_path)
+    assert table['S1'].round(2).tolist() == [66.67, 33.33, 0.0]
+    assert os.listdir(str(tmpdir)) == ['taxa-bar-plots.qzv']
+
+    qiimegraph.TAXONOMIC_LEVEL = 'genus'
+    assert not check_viz(qzv_path)
+
+
+def test_grid_shape():
+    assert grid_shape(1) == (1, 1)
+    assert grid_shape(4) == (2, 2)
+    assert grid_shape(6) == (2, 3)
+    assert grid_shape(10) == (3, 4)
+    assert grid_shape(100) == (10, 10)
+
+
+def test_read_sample_sheet(tmpdir):
+    sheet = tmpdir.join('sheet.tsv')
+    sheet.write('panel\tsample\nB\tS3\nA\tS1\nB\tS2\n')
+    assert read_sample_sheet(str(sheet)) == OrderedDict([('B', ['S3', 'S2']), ('A', ['S1'])])
+
+    sheet = tmpdir.join('sheet.csv')
+    sheet.write('sample\n' + '\n'.join('S{}'.format(i) for i in range(5)) + '\n')
+    assert read_sample_sheet(str(sheet), panel_size=2) == OrderedDict([('panel1', ['S0', 'S1']),
+                                                                      ('panel2', ['S2', 'S3']),
+                                                                      ('panel3', ['S4'])])
+
+
+def test_batch_pie_charts(tmpdir):
+    qiimegraph.TAXONOMIC_LEVEL = 'family'
+    samples = ['S{}'.format(i) for i in range(12)]
+    filename = write_level_csv(tmpdir.join('level-5.csv'), samples)
+    panels = OrderedDict([('first', samples[:10]), ('second', samples[10:])])
+
+    out_paths = batch_pie_charts(filename, panels, str(tmpdir), processes=2, colordict=COLORDICT)
+    assert [os.path.basename(x) for x in out_paths] == ['first_Family_plot.png', 'second_Family_plot.png']
+    assert all(os.path.getsize(x) > 0 for x in out_paths)
+
+    with pytest.raises(ValueError):
+        batch_pie_charts(filename, OrderedDict([('missing', ['S99'])]), str(tmpdir), colordict=COLORDICT)
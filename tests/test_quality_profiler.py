@@ -0,0 +1,45 @@
+import os
+import gzip
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('matplotlib')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.quality_profiler import *
+
+
+def test_accumulate_qualities():
+    position_histogram, length_histogram = empty_histograms()
+    # 'I' = Q40, '#' = Q2
+    position_histogram, length_histogram = accumulate_qualities([b'III#', b'II'], position_histogram,
+                                                                length_histogram)
+    assert position_histogram.shape == (4, N_QUALITY_BINS)
+    assert position_histogram[0, 40] == 2
+    assert position_histogram[3, 2] == 1
+    assert length_histogram[2] == 1 and length_histogram[4] == 1
+
+
+def test_profile_fastq(tmpdir):
+    fastq_path = str(tmpdir.join('sample_S1_L001_R1_001.fastq.gz'))
+    with gzip.open(fastq_path, 'wt') as f:
+        for i in range(10):
+            f.write('@read{}\nACGT\n+\nIII#\n'.format(i))
+
+    position_histogram, length_histogram, n_reads = profile_fastq(fastq_path, max_reads=5)
+    assert n_reads == 5
+    quantiles = histogram_quantiles(position_histogram)
+    assert quantiles[0.5].tolist() == [40, 40, 40, 2]
+
+
+def test_sample_quality_lines_spans_file():
+    # Low quality reads at the start of the file, as from the first tiles of a run
+    quality_lines = iter([b'#\n'] * 1000 + [b'I\n'] * 49000)
+    sample, n_seen = sample_quality_lines(quality_lines, max_reads=500)
+    assert n_seen == 50000
+    assert len(sample) == 500
+    assert 0 < sample.count(b'#') < 50
+    # Files smaller than the sample are profiled whole
+    sample, n_seen = sample_quality_lines(iter([b'I\n'] * 10), max_reads=500)
+    assert sample == [b'I'] * 10
@@ -0,0 +1,83 @@
+import os
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.rarefaction import *
+
+#        root(6)
+#       /      \
+#    n4 (1)     n5 (2)
+#    /  \       /  \
+#  A(1) B(2)  C(3) D(4)
+PARENTS = [4, 4, 5, 5, 6, 6, -1]
+LENGTHS = [1, 2, 3, 4, 1, 2, 0]
+TIPS = [0, 1, 2, 3]
+
+
+def test_make_phylogeny():
+    phylogeny = make_phylogeny(PARENTS, LENGTHS, TIPS)
+    assert [list(level) for level in phylogeny.levels] == [[0, 1, 2, 3], [4, 5], [6]]
+
+
+def test_rarefaction_depths():
+    assert list(rarefaction_depths(100, steps=5)) == [1, 25, 50, 75, 100]
+    assert list(rarefaction_depths(3, steps=10)) == [1, 2, 3]
+
+
+def test_sample_curves_full_depth():
+    # At the full depth of the sample every subsample is the sample itself
+    phylogeny = make_phylogeny(PARENTS, LENGTHS, TIPS)
+    features = np.array([0, 1, 2])
+    counts = np.array([5, 5, 10])
+    curves = sample_curves(features, counts, np.array([1, 20, 30]), np.random.RandomState(0), phylogeny=phylogeny)
+    assert curves[1, 0] == 3
+    assert curves[1, 1] == pytest.approx(1.5)
+    # A, B and C with their ancestors n4 and n5
+    assert curves[1, 2] == 1 + 2 + 3 + 1 + 2
+    # A single read is a single feature and its path to the root
+    assert curves[0, 0] == 1 and curves[0, 1] == 0
+    assert curves[0, 2] in (1 + 1, 2 + 1, 3 + 2)
+    # Deeper than the sample
+    assert np.isnan(curves[2]).all()
+
+
+def test_sample_curves_hypergeometric():
+    # Observed features at depth d averages the expected number of features with at least one read in a subsample
+    random_state = np.random.RandomState(1)
+    features = np.arange(4)
+    counts = np.array([1, 1, 1, 97])
+    observed = [sample_curves(features, counts, np.array([10]), random_state)[0, 0] for _ in range(2000)]
+    expected = 1 + 3 * (1 - 90.0 / 100)
+    assert np.mean(observed) == pytest.approx(expected, abs=0.05)
+
+
+def test_rarefaction_curves(tmpdir):
+    matrix = sparse.csc_matrix(np.array([[5, 0, 1],
+                                         [5, 3, 0],
+                                         [10, 0, 0],
+                                         [0, 7, 0]]))
+    phylogeny = make_phylogeny(PARENTS, LENGTHS, TIPS)
+    curves = rarefaction_curves(matrix, ['S1', 'S2', 'S3'], max_depth=20, steps=3, iterations=4, phylogeny=phylogeny,
+                                processes=2)
+    assert list(curves.columns) == ['sample_id', 'depth', 'iteration'] + METRICS
+    # S2 (10 reads) has no rows at depth 20 and S3 (1 read) only has depth 1
+    assert sorted(set(zip(curves['sample_id'], curves['depth']))) == [
+        ('S1', 1), ('S1', 10), ('S1', 20), ('S2', 1), ('S2', 10), ('S3', 1)]
+    assert (curves.groupby(['sample_id', 'depth']).size() == 4).all()
+    s2_full = curves[(curves['sample_id'] == 'S2') & (curves['depth'] == 10)]
+    assert (s2_full['observed_features'] == 2).all()
+    assert (s2_full['faith_pd'] == 2 + 4 + 1 + 2).all()
+
+    # Reproducible, whether or not the iterations run in parallel
+    serial = rarefaction_curves(matrix, ['S1', 'S2', 'S3'], max_depth=20, steps=3, iterations=4, phylogeny=phylogeny,
+                                processes=1)
+    pd.testing.assert_frame_equal(curves, serial)
+
+    without_tree = rarefaction_curves(matrix, ['S1', 'S2', 'S3'], max_depth=20, steps=3, iterations=2)
+    assert 'faith_pd' not in without_tree.columns
+
+    out_path = plot_rarefaction(curves, str(tmpdir.join('alpha-rarefaction.png')))
+    assert os.path.isfile(out_path)
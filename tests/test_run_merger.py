@@ -0,0 +1,48 @@
+import os
+import io
+import zipfile
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.run_merger import *
+
+
+def test_merge_sparse_tables():
+    run1 = (sparse.csr_matrix([[1, 0], [2, 3]]), ['a', 'b'], ['S1', 'S2'])
+    run2 = (sparse.csr_matrix([[4], [5]]), ['b', 'c'], ['S3'])
+    matrix, feature_ids, sample_ids = merge_sparse_tables(iter([run1, run2]))
+
+    assert feature_ids == ['a', 'b', 'c']
+    assert sample_ids == ['S1', 'S2', 'S3']
+    assert sparse.issparse(matrix)
+    assert matrix.toarray().tolist() == [[1, 0, 0], [2, 3, 4], [0, 0, 5]]
+
+    with pytest.raises(ValueError):
+        merge_sparse_tables([run1, run1])
+
+
+def test_deduplicate_sequences(tmpdir):
+    artifact_path = str(tmpdir.join('rep-seqs-dada2.qza'))
+    with zipfile.ZipFile(artifact_path, 'w') as archive:
+        archive.writestr('uuid/data/dna-sequences.fasta', '>first\nACGT\nACGT\n>second\nTTTT\n')
+
+    seen = set()
+    out = io.StringIO()
+    id_map = deduplicate_sequences(iter_artifact_sequences(artifact_path), out, seen)
+    assert id_map == {'first': sequence_digest('ACGTACGT'), 'second': sequence_digest('TTTT')}
+
+    # Same sequences from a second run under different IDs are not written again
+    id_map = deduplicate_sequences([('other', 'acgtacgt')], out, seen)
+    assert id_map == {'other': sequence_digest('ACGTACGT')}
+    assert out.getvalue().count('>') == 2
+
+
+def test_read_run_manifest(tmpdir):
+    manifest_path = str(tmpdir.join('runs.txt'))
+    with open(manifest_path, 'w') as f:
+        f.write('# runs to merge\nrun1\n\n/data/run2\n')
+    assert read_run_manifest(manifest_path) == [str(tmpdir.join('run1')), '/data/run2']
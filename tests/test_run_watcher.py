@@ -0,0 +1,93 @@
+import os
+import logging
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.run_watcher import *
+
+FAKE_PIPELINE = '''import sys
+args = sys.argv[1:]
+open(args[args.index('--outdir') + 1], 'w').close()
+'''
+
+RUN_NAME = '181010_M05722_0034_000000000-BY4T5'
+
+
+def make_run(runs_root, run_name, finished=True):
+    basecalls = runs_root.mkdir(run_name).mkdir('Data').mkdir('Intensities').mkdir('BaseCalls')
+    basecalls.join('S1_S1_L001_R1_001.fastq.gz').write('@read\n')
+    basecalls.join('S1_S1_L001_R2_001.fastq.gz').write('@read\n')
+    if finished:
+        runs_root.join(run_name, SENTINEL).write('')
+    return basecalls
+
+
+def test_scan_runs(tmpdir):
+    runs_root = tmpdir.mkdir('runs')
+    basecalls = make_run(runs_root, RUN_NAME)
+    make_run(runs_root, 'still_sequencing', finished=False)
+    runs = scan_runs(str(runs_root))
+    assert list(runs) == [RUN_NAME]
+    assert runs[RUN_NAME][0] == str(basecalls)
+    assert [x[0] for x in runs[RUN_NAME][1]] == ['S1_S1_L001_R1_001.fastq.gz', 'S1_S1_L001_R2_001.fastq.gz']
+
+
+def test_match_metadata(tmpdir, caplog):
+    metadata_dir = tmpdir.mkdir('metadata')
+    assert match_metadata(RUN_NAME, str(metadata_dir)) is None
+    # Only whole underscore-delimited components of the run name match, not any substring of it
+    metadata_dir.join('BY4T5.tsv').write('')
+    metadata_dir.join('0034_0.tsv').write('')
+    metadata_dir.join('OTHER.tsv').write('')
+    assert match_metadata(RUN_NAME, str(metadata_dir)) is None
+    metadata_dir.join('M05722_0034.tsv').write('')
+    assert match_metadata(RUN_NAME, str(metadata_dir)) == str(metadata_dir.join('M05722_0034.tsv'))
+    # The longest of several matches is used, with a warning
+    metadata_dir.join('000000000-BY4T5.tsv').write('')
+    with caplog.at_level(logging.WARNING):
+        assert match_metadata(RUN_NAME, str(metadata_dir)) == str(metadata_dir.join('000000000-BY4T5.tsv'))
+    assert 'M05722_0034.tsv' in caplog.text
+    metadata_dir.join(RUN_NAME + '.tsv').write('')
+    assert match_metadata(RUN_NAME, str(metadata_dir)) == str(metadata_dir.join(RUN_NAME + '.tsv'))
+
+
+def test_check_runs(tmpdir):
+    runs_root = tmpdir.mkdir('runs')
+    metadata_dir = tmpdir.mkdir('metadata')
+    state_path = str(tmpdir.join('watch.state.json'))
+    basecalls = make_run(runs_root, RUN_NAME)
+    args = (state_path, str(runs_root), str(metadata_dir), str(tmpdir.join('out')))
+
+    # Not submitted until the files have been stable for settle_time seconds
+    assert check_runs(*args, settle_time=60, now=0) == []
+    basecalls.join('S2_S2_L001_R1_001.fastq.gz').write('@read\n')
+    assert check_runs(*args, settle_time=60, now=50) == []
+    assert check_runs(*args, settle_time=60, now=100) == []
+
+    # Then waits for its metadata
+    assert check_runs(*args, settle_time=60, now=120) == []
+    assert batch_queue.load_state(state_path)['watched'][RUN_NAME]['status'] == 'waiting_for_metadata'
+    metadata_dir.join(RUN_NAME + '.tsv').write('')
+    assert check_runs(*args, settle_time=60, now=130, dry_run=True)[0]['run_id'] == RUN_NAME
+    assert batch_queue.load_state(state_path)['runs'] == {}
+
+    submitted = check_runs(*args, settle_time=60, now=130, cpus=4)
+    assert submitted[0]['inputdir'] == str(basecalls) and submitted[0]['cpus'] == 4
+    assert list(batch_queue.load_state(state_path)['runs']) == [RUN_NAME]
+    # Repeated scans don't submit the run again
+    assert check_runs(*args, settle_time=60, now=500) == []
+
+
+def test_watch_once(tmpdir):
+    runs_root = tmpdir.mkdir('runs')
+    metadata_dir = tmpdir.mkdir('metadata')
+    metadata_dir.join(RUN_NAME + '.tsv').write('')
+    pipeline_script = tmpdir.join('pipeline.py')
+    pipeline_script.write(FAKE_PIPELINE)
+    state_path = str(tmpdir.join('watch.state.json'))
+    make_run(runs_root, RUN_NAME)
+
+    watch(str(runs_root), str(metadata_dir), str(tmpdir.mkdir('out')), state_path, settle_time=0, once=True,
+          pipeline_script=str(pipeline_script))
+    assert batch_queue.load_state(state_path)['runs'][RUN_NAME]['status'] == 'completed'
+    assert tmpdir.join('out', RUN_NAME).check()
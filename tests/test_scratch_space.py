@@ -0,0 +1,81 @@
+import os
+import gzip
+import errno
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.scratch_space import *
+
+
+def write_fastq(path, n_reads, read_length=300):
+    with gzip.open(str(path), 'wb') as f:
+        for i in range(n_reads):
+            f.write('@read{}\n{}\n+\n{}\n'.format(i, 'ACGT' * (read_length // 4), 'F' * read_length).encode())
+
+
+def test_sample_fastq(tmpdir):
+    path = tmpdir.join('S1_S1_L001_R1_001.fastq.gz')
+    write_fastq(path, 5000)
+    compressed_bytes, n_records, n_bases = sample_fastq(str(path))
+    assert compressed_bytes == os.path.getsize(str(path))
+    assert n_records == 5000
+    assert n_bases == 5000 * 300
+
+
+def test_sample_fastq_multiple_members(tmpdir):
+    # Several gzip members back to back, as written by bgzip
+    path = tmpdir.join('S1_S1_L001_R1_001.fastq.gz')
+    write_fastq(tmpdir.join('a.gz'), 100)
+    write_fastq(tmpdir.join('b.gz'), 50)
+    path.write_binary(tmpdir.join('a.gz').read_binary() + tmpdir.join('b.gz').read_binary())
+    assert sample_fastq(str(path))[1:] == (150, 150 * 300)
+
+
+def test_estimate_run_space(tmpdir):
+    paths = []
+    for sample in ['S1', 'S2']:
+        for read in ['R1', 'R2']:
+            path = tmpdir.join('{}_S1_L001_{}_001.fastq.gz'.format(sample, read))
+            write_fastq(path, 1000)
+            paths.append(str(path))
+    input_bytes = sum(os.path.getsize(path) for path in paths)
+
+    estimate = estimate_run_space(paths)
+    assert estimate['input_bytes'] == input_bytes
+    assert estimate['reads'] == 4000
+    assert estimate['temp_bytes'] == pytest.approx((TEMP_INPUT_COPIES + 1) * input_bytes * SAFETY_FACTOR, abs=1)
+    # Truncating the reads to half their length halves the space taken by the filtered reads
+    truncated = estimate_run_space(paths, trunc_len_f=150, trunc_len_r=150)
+    assert truncated['temp_bytes'] == pytest.approx((TEMP_INPUT_COPIES + 0.5) * input_bytes * SAFETY_FACTOR, abs=1)
+    # The filtered reads scale with the read count at the same truncation length
+    write_fastq(tmpdir.join('S3_S1_L001_R1_001.fastq.gz'), 2000, read_length=150)
+    more_reads = estimate_run_space(paths + [str(tmpdir.join('S3_S1_L001_R1_001.fastq.gz'))], trunc_len_f=150,
+                                    trunc_len_r=150)
+    assert more_reads['reads'] > truncated['reads']
+    assert more_reads['temp_bytes'] > truncated['temp_bytes']
+
+
+def test_choose_scratch_dir(tmpdir):
+    outdir = str(tmpdir.join('out'))
+    scratch_dir = str(tmpdir.mkdir('scratch'))
+    estimate = OrderedDict([('input_bytes', 0), ('reads', 0), ('temp_bytes', 1024), ('output_bytes', 1024)])
+    assert choose_scratch_dir(estimate, outdir, scratch_dir=scratch_dir) == scratch_dir
+
+    estimate['temp_bytes'] = 2 ** 62
+    with pytest.raises(OSError) as e:
+        choose_scratch_dir(estimate, outdir, scratch_dir=scratch_dir)
+    assert e.value.errno == errno.ENOSPC
+
+
+def test_scratch_space(tmpdir):
+    previous_tmpdir = os.environ.get('TMPDIR')
+    with pytest.raises(RuntimeError):
+        with scratch_space(str(tmpdir.join('RUN_1')), scratch_dir=str(tmpdir)) as run_scratch_dir:
+            assert os.path.dirname(run_scratch_dir) == str(tmpdir)
+            assert os.environ['TMPDIR'] == run_scratch_dir
+            assert tempfile.mkdtemp().startswith(run_scratch_dir)
+            raise RuntimeError('DADA2 failed')
+    # Removed and $TMPDIR restored even though the run failed
+    assert not os.path.exists(run_scratch_dir)
+    assert os.environ.get('TMPDIR') == previous_tmpdir
@@ -0,0 +1,80 @@
+import os
+import zipfile
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.stage_cache import *
+
+
+def write_archive(path, uuid, payload):
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('{}/metadata.yaml'.format(uuid), 'uuid: {}\ntype: FeatureTable[Frequency]\n'.format(uuid))
+        archive.writestr('{}/provenance/action/action.yaml'.format(uuid), 'execution: {}'.format(uuid))
+        archive.writestr('{}/data/feature-table.biom'.format(uuid), payload)
+
+
+def test_archive_digest_ignores_uuid(tmpdir):
+    first = str(tmpdir.join('first.qza'))
+    second = str(tmpdir.join('second.qza'))
+    different = str(tmpdir.join('different.qza'))
+    write_archive(first, 'aaaa', 'payload')
+    write_archive(second, 'bbbb', 'payload')
+    write_archive(different, 'cccc', 'other payload')
+
+    assert file_digest(first) == file_digest(second)
+    assert file_digest(first) != file_digest(different)
+
+
+def test_stage_key_depends_on_params(tmpdir):
+    input_path = str(tmpdir.join('metadata.tsv'))
+    with open(input_path, 'w') as f:
+        f.write('#SampleID\n')
+
+    key = stage_key('dada2_qc', [input_path], {'trunc_len_f': 280})
+    assert key == stage_key('dada2_qc', [input_path], {'trunc_len_f': 280})
+    assert key != stage_key('dada2_qc', [input_path], {'trunc_len_f': 250})
+    assert key != stage_key('phylo_tree', [input_path], {'trunc_len_f': 280})
+
+
+def test_stage_key_input_ids(tmpdir):
+    input_path = str(tmpdir.join('metadata.tsv'))
+    with open(input_path, 'w') as f:
+        f.write('#SampleID\n')
+
+    # Inputs keyed by identity are never read, only their identifier counts
+    key = stage_key('classify_taxonomy', [input_path], input_ids=['aaaa'])
+    assert key == stage_key('classify_taxonomy', [input_path], input_ids=['aaaa'])
+    assert key != stage_key('classify_taxonomy', [input_path], input_ids=['bbbb'])
+    # Keys of stages without any are unchanged
+    assert stage_key('classify_taxonomy', [input_path]) == stage_key('classify_taxonomy', [input_path], input_ids=[])
+
+
+def test_run_cached_stage_resume(tmpdir):
+    base_dir = str(tmpdir.mkdir('qiime2'))
+    cache_dir = str(tmpdir.join('cache'))
+    input_path = str(tmpdir.join('input.txt'))
+    with open(input_path, 'w') as f:
+        f.write('input')
+
+    calls = []
+
+    def stage(base_dir):
+        calls.append(base_dir)
+        with open(os.path.join(base_dir, 'output.txt'), 'w') as f:
+            f.write('output')
+        return 'computed'
+
+    kwargs = dict(func=stage, kwargs=dict(base_dir=base_dir), base_dir=base_dir, outputs=['output.txt'],
+                  input_paths=[input_path], restore_func=lambda base_dir: 'restored', cache_dir=cache_dir)
+
+    assert run_cached_stage('stage', resume=True, **kwargs) == 'computed'
+    os.remove(os.path.join(base_dir, 'output.txt'))
+
+    assert run_cached_stage('stage', resume=True, **kwargs) == 'restored'
+    assert os.path.isfile(os.path.join(base_dir, 'output.txt'))
+    assert len(calls) == 1
+
+    # Without resume the stage is always recomputed
+    assert run_cached_stage('stage', resume=False, **kwargs) == 'computed'
+    assert len(calls) == 2
@@ -0,0 +1,84 @@
+import os
+import threading
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.stage_scheduler import *
+
+
+def test_run_stage_graph_passes_results():
+    stages = [
+        make_stage('a', lambda results, cpus: 1),
+        make_stage('b', lambda results, cpus: results['a'] + 1, ['a']),
+        make_stage('c', lambda results, cpus: results['a'] + results['b'], ['a', 'b']),
+    ]
+    assert run_stage_graph(stages, cpu_budget=2) == {'a': 1, 'b': 2, 'c': 3}
+
+
+def test_independent_stages_run_concurrently():
+    barrier = threading.Barrier(2, timeout=5)
+
+    def wait_for_sibling(results, cpus):
+        # Deadlocks (and times out) unless both stages are running at the same time
+        barrier.wait()
+        return cpus
+
+    stages = [
+        make_stage('root', lambda results, cpus: None),
+        make_stage('left', wait_for_sibling, ['root'], cpus=None),
+        make_stage('right', wait_for_sibling, ['root'], cpus=None),
+    ]
+    results = run_stage_graph(stages, cpu_budget=8)
+    assert results['left'] + results['right'] == 8
+
+
+def test_allocate_cpus_respects_budget():
+    ready = [make_stage('greedy', None, cpus=None), make_stage('single', None), make_stage('other', None, cpus=None)]
+    allocations = allocate_cpus(ready, 10)
+    assert sum(cpu_count for stage, cpu_count in allocations) <= 10
+    assert dict((stage.name, cpu_count) for stage, cpu_count in allocations)['single'] == 1
+
+
+def test_allocate_cpus_splits_what_capped_stages_leave():
+    # The order of the stages doesn't change how the uncapped stages share the CPUs
+    for ready in ([make_stage('greedy', None, cpus=None), make_stage('single', None),
+                   make_stage('other', None, cpus=None)],
+                  [make_stage('single', None), make_stage('greedy', None, cpus=None),
+                   make_stage('other', None, cpus=None)]):
+        allocations = dict((stage.name, cpu_count) for stage, cpu_count in allocate_cpus(ready, 32))
+        assert allocations == {'single': 1, 'greedy': 15, 'other': 16}
+
+
+def test_later_stage_gets_free_cpus():
+    # 'late' only becomes ready once 'short' has finished, and gets its CPUs as well as those it didn't use
+    stages = [
+        make_stage('short', lambda results, cpus: cpus, cpus=2),
+        make_stage('long', lambda results, cpus: cpus, cpus=4),
+        make_stage('late', lambda results, cpus: cpus, ['short', 'long'], cpus=None),
+    ]
+    assert run_stage_graph(stages, cpu_budget=16)['late'] == 16
+
+
+def test_failed_stage_stops_dependents():
+    ran = []
+
+    def fail(results, cpus):
+        raise RuntimeError('boom')
+
+    stages = [
+        make_stage('fail', fail),
+        make_stage('dependent', lambda results, cpus: ran.append('dependent'), ['fail']),
+    ]
+    with pytest.raises(RuntimeError):
+        run_stage_graph(stages, cpu_budget=1)
+    assert ran == []
+
+
+def test_cycle_is_rejected():
+    stages = [
+        make_stage('a', None, ['b']),
+        make_stage('b', None, ['a']),
+    ]
+    with pytest.raises(ValueError):
+        validate_stage_graph(stages)
@@ -0,0 +1,25 @@
+import os
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.table_statistics import *
+
+
+def test_compute_table_statistics():
+    counts = np.array([[5, 0, 1, 0],
+                       [0, 0, 3, 2],
+                       [1, 0, 0, 0]])
+    statistics = compute_table_statistics(sparse.csr_matrix(counts), ['a', 'b', 'c'], ['S1', 'S2', 'S3', 'S4'])
+
+    assert statistics.sample_depths.tolist() == counts.sum(axis=0).tolist()
+    assert statistics.feature_totals.tolist() == counts.sum(axis=1).tolist()
+    assert statistics.feature_prevalence.tolist() == (counts > 0).sum(axis=1).tolist()
+    assert statistics.sample_depths['S3'] == 4
+    assert statistics.depth_quantiles[0.0] == 0
+    assert statistics.depth_quantiles[1.0] == 6
+    assert statistics.depth_quantiles[0.5] == np.median(counts.sum(axis=0))
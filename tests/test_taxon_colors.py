@@ -0,0 +1,45 @@
+import os
+import pytest
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.taxon_colors import *
+
+TAXONOMY = ('1\tD_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae;D_5__Listeria\n'
+            '2\tD_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Bacillaceae;D_5__Bacillus\n'
+            '3\tD_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae;D_5__Brochothrix\n')
+
+
+def test_taxon_color():
+    assert taxon_color('Listeria') == taxon_color('Listeria')
+    assert taxon_color('Listeria') != taxon_color('Bacillus')
+    assert taxon_color('Listeria').startswith('#') and len(taxon_color('Listeria')) == 7
+    assert taxon_color('Unassigned') == 'grey'
+
+
+def test_lookup_colors(tmpdir):
+    index_path = str(tmpdir.join('colors.tsv'))
+    colors = {'Listeria': 'red', 'Bacillus': '#0000ff', 'Zymomonas': 'green', 'Åkesson': 'black'}
+    write_color_index(colors, index_path)
+
+    assert lookup_colors(list(colors), index_path) == colors
+    assert lookup_colors(['Listeria', 'Acinetobacter'], index_path) == {'Listeria': 'red',
+                                                                         'Acinetobacter': taxon_color('Acinetobacter')}
+    assert lookup_colors(['Listeria'], str(tmpdir.join('missing.tsv'))) == {'Listeria': taxon_color('Listeria')}
+
+
+def test_generate_color_index(tmpdir):
+    taxonomy_file = tmpdir.join('taxonomy.txt')
+    taxonomy_file.write(TAXONOMY)
+    index_path = str(tmpdir.join('colors.tsv'))
+
+    assert generate_color_index(str(taxonomy_file), index_path) == 11
+    lines = open(index_path).read().splitlines()
+    assert lines == sorted(lines)
+    assert lookup_colors(['Listeria', 'Unclassified'], index_path) == {'Listeria': taxon_color('Listeria'),
+                                                                       'Unclassified': 'grey'}
+
+
+def test_default_color_index():
+    assert lookup_colors(['Unassigned'])['Unassigned'] == 'grey'
+    assert len(lookup_colors(['Listeria'])['Listeria']) == 7
@@ -0,0 +1,24 @@
+import os
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.taxonomy_cache import *
+
+
+def test_lookup_and_store(tmpdir):
+    connection = open_cache(str(tmpdir.join('cache', 'taxonomy.sqlite')))
+    store(connection, 'classifier1', {'hash1': ('D_0__Bacteria', '0.99'), 'hash2': ('Unassigned', '0.5')})
+
+    assert lookup(connection, 'classifier1', ['hash1', 'hash3']) == {'hash1': ('D_0__Bacteria', '0.99')}
+    # Assignments are specific to the classifier that produced them
+    assert lookup(connection, 'classifier2', ['hash1']) == {}
+
+
+def test_evict_least_recently_used(tmpdir):
+    connection = open_cache(str(tmpdir.join('taxonomy.sqlite')))
+    for i in range(5):
+        store(connection, 'classifier', {'hash{}'.format(i): ('taxon', '1.0')})
+    lookup(connection, 'classifier', ['hash0'])
+
+    assert evict(connection, max_entries=2) == 3
+    assert set(lookup(connection, 'classifier', ['hash{}'.format(i) for i in range(5)])) == {'hash0', 'hash4'}
@@ -0,0 +1,66 @@
+import os
+import pytest
+
+pd = pytest.importorskip('pandas')
+
+parentdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.sys.path.insert(0, parentdir)
+from bin.taxonomy_report_generator import *
+
+LISTERIA = 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Listeriaceae;D_5__Listeria'
+BACILLUS = 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__Bacillaceae;D_5__Bacillus'
+UNRESOLVED = 'D_0__Bacteria;D_1__Firmicutes;D_2__Bacilli;D_3__Bacillales;D_4__;__'
+
+
+def write_level_csv(path):
+    df = pd.DataFrame({'index': ['seq1', 'seq2', 'seq3'],
+                       LISTERIA: [50, 0, 10],
+                       BACILLUS: [50, 90, 0],
+                       UNRESOLVED: [0, 10, 30],
+                       'sample_annotation': ['S1', 'S2', 'S10'],
+                       'run': ['A', 'A', 'B']},
+                      columns=['index', LISTERIA, BACILLUS, UNRESOLVED, 'sample_annotation', 'run'])
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+def test_sample_report_matches_prepare_df(tmpdir):
+    filepath = write_level_csv(tmpdir.join('level-6.csv'))
+    df = load_level_df(filepath)
+    assert df.columns.tolist() == ['index', 'S1', 'S2', 'S10']
+
+    report = sample_report(df, 'genus', 'S2')
+    assert report['index'].tolist() == ['Bacillus', 'Bacillales (closest known classification)']
+    assert report['S2'].tolist() == [90.0, 10.0]
+    assert prepare_df(filepath, 'genus', 'S2').equals(report)
+
+    assert sample_report(df, 'genus', 'S2', cutoff=20)['index'].tolist() == ['Bacillus']
+    with pytest.raises(ValueError):
+        sample_report(df, 'genus', 'S3')
+
+
+def test_batch_reports(tmpdir):
+    write_level_csv(tmpdir.join('level-6.csv'))
+    write_level_csv(tmpdir.join('level-5.csv'))
+    out_dir = str(tmpdir)
+
+    out_paths = batch_reports(out_dir, out_dir, samples=['S1'], taxonomic_levels=['genus', 'family'])
+    assert sorted(os.path.basename(x) for x in out_paths) == ['taxonomy_report_family_S1.csv',
+                                                              'taxonomy_report_genus_S1.csv']
+    # 'S1' is matched exactly rather than also picking up 'S10'
+    report = pd.read_csv(os.path.join(out_dir, 'taxonomy_report_genus_S1.csv'))
+    assert report.columns.tolist() == ['index', 'S1']
+    assert report['S1'].tolist() == [50.0, 50.0]
+
+    out_paths = batch_reports(out_dir, out_dir, taxonomic_levels=['genus'], report_format='wide')
+    wide = pd.read_csv(out_paths[0])
+    assert os.path.basename(out_paths[0]) == 'taxonomy_report_genus.csv'
+    assert wide.columns.tolist() == ['lineage', 'taxonomy', 'S1', 'S10', 'S2']
+    assert wide.set_index('taxonomy').loc['Listeria', 'S10'] == 25.0
+
+    out_paths = batch_reports(out_dir, out_dir, taxonomic_levels=['genus', 'family'], report_format='long',
+                              threads=1)
+    long_df = pd.read_csv(out_paths[0])
+    assert long_df.columns.tolist() == ['sample', 'rank', 'lineage', 'taxonomy', 'percentage']
+    assert len(long_df) == 2 * 6
+    assert long_df.groupby(['rank', 'sample'])['percentage'].sum().round(6).eq(100).all()
@@ -9,7 +9,8 @@ import logging
 
 from pathlib import Path
 from qiime2.plugins import feature_classifier
-from bin.helper_functions import execute_command_simple
+from bin.helper_functions import import_artifact
+from bin.classifier_store import convert_classifier
 
 logging.basicConfig(
     format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
@@ -59,17 +60,14 @@ def cli(ctx, inputfasta, taxonomytext, outdir, forward_primer, reverse_primer):
     reference_taxonomy_filepath = output_ref_taxonomy_qza(outdir=outdir, inputtxt=taxonomytext)
     ref_seqs, ref_seqs_qza = extract_reads(otu_qza=otu_filepath, f_primer=forward_primer, r_primer=reverse_primer,
                                            outdir=outdir)
-    train_feature_classifier(reference_seqs=ref_seqs, reference_taxonomy_filepath=reference_taxonomy_filepath)
+    train_feature_classifier(reference_seqs=ref_seqs, reference_taxonomy_filepath=reference_taxonomy_filepath,
+                             outdir=outdir)
 
 
 def output_otu_qza(outdir: Path, inputfasta: Path) -> Path:
     logging.debug("Preparing .qza OTUs artifact from {}".format(inputfasta))
     outfile = outdir / inputfasta.with_suffix(".qza").name
-    cmd = "qiime tools import " \
-          "--type 'FeatureData[Sequence]' " \
-          "--input-path {inputfasta} " \
-          "--output-path {outfile}".format(inputfasta=inputfasta, outfile=outfile)
-    execute_command_simple(cmd)
+    import_artifact(semantic_type='FeatureData[Sequence]', input_path=inputfasta, output_path=outfile)
     logging.debug("Created {}".format(outfile))
     return outfile
 
@@ -77,12 +75,8 @@ def output_otu_qza(outdir: Path, inputfasta: Path) -> Path:
 def output_ref_taxonomy_qza(outdir: Path, inputtxt: Path):
     logging.debug("Preparing .qza taxonomy artifact from {}".format(inputtxt))
     outfile = outdir / inputtxt.with_suffix(".qza").name
-    cmd = "qiime tools import " \
-          "--type 'FeatureData[Taxonomy]' " \
-          "--source-format HeaderlessTSVTaxonomyFormat " \
-          "--input-path {inputtxt} " \
-          "--output-path {outfile}".format(inputtxt=inputtxt, outfile=outfile)
-    execute_command_simple(cmd)
+    import_artifact(semantic_type='FeatureData[Taxonomy]', input_path=inputtxt, output_path=outfile,
+                    source_format='HeaderlessTSVTaxonomyFormat')
     logging.debug("Created {}".format(outfile))
     return outfile
 
@@ -119,8 +113,9 @@ def train_feature_classifier(reference_seqs, reference_taxonomy_filepath, outdir
     ref_taxonomy = qiime2.Artifact.load(reference_taxonomy_filepath)
     naive_bayes_classifier = feature_classifier.methods.fit_classifier_naive_bayes(reference_reads=reference_seqs.reads,
                                                                                    reference_taxonomy=ref_taxonomy)
-    naive_bayes_classifier.save(outfile)
+    naive_bayes_classifier.classifier.save(str(outfile))
     logging.debug("Created {}".format(outfile))
+    convert_classifier(str(outfile))
     return naive_bayes_classifier
 
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import os
+import click
+import signal
+import logging
+import threading
+import multiprocessing
+
+from collections import OrderedDict
+
+from bin import run_watcher
+
+"""
+Watches the folder a MiSeq writes its runs into and runs ampliconpipeline.py on every run as soon as it has finished,
+i.e. once the sequencer's sentinel file exists and the run's .fastq.gz files have stopped changing. Each run is
+matched to a metadata .tsv named after the run folder (or whole parts of its name, e.g. the flowcell ID), and the
+output is written to OUTDIR_ROOT/RUN_NAME. Submitted runs are processed by the same queue as batch_pipeline.py, so
+"batch_pipeline.py status -s OUTDIR_ROOT/watch_queue.state.json" shows their progress.
+
+To try it out without a sequencer, create a run folder containing the sentinel file and some .fastq.gz files in a
+local folder and point --runs_root at it, e.g. with --once --settle_time 0 --dry_run.
+"""
+
+logging.basicConfig(
+    format='\033[92m \033[1m %(asctime)s \033[0m %(message)s ',
+    level=logging.INFO,
+    datefmt='%Y-%m-%d %H:%M:%S')
+
+
+@click.command()
+@click.option('-r', '--runs_root',
+              type=click.Path(exists=True, file_okay=False),
+              required=True,
+              help='Folder the sequencer writes run folders into.')
+@click.option('-m', '--metadata_dir',
+              type=click.Path(exists=True, file_okay=False),
+              required=True,
+              help='Folder of metadata .tsv files. A run uses RUN_NAME.tsv, or else the .tsv named after the longest '
+                   'run of whole underscore-separated parts of the run folder name, e.g. the flowcell ID.')
+@click.option('-o', '--outdir_root',
+              type=click.Path(file_okay=False),
+              required=True,
+              help='Folder the output of every run is written into, as OUTDIR_ROOT/RUN_NAME.')
+@click.option('-s', '--state',
+              type=click.Path(),
+              default=None,
+              help='State file of the watcher and its queue. Defaults to OUTDIR_ROOT/watch_queue.state.json.')
+@click.option('-c', '--classifier',
+              type=click.Path(exists=True),
+              default=None,
+              help='Classifier passed to ampliconpipeline.py. Defaults to the pipeline default.')
+@click.option('-f', '--filtering_flag',
+              is_flag=True,
+              default=False,
+              help='Pass --filtering_flag to ampliconpipeline.py.')
+@click.option('-j', '--concurrency',
+              type=click.INT,
+              default=1,
+              help='Maximum number of runs processed at the same time.')
+@click.option('-n', '--cpus_per_run',
+              type=click.INT,
+              default=None,
+              help='CPUs given to each run. Defaults to all CPUs divided by --concurrency.')
+@click.option('--memory_per_run',
+              type=click.FLOAT,
+              default=None,
+              help='Memory budget in GB for each run, see batch_pipeline.py. No limit by default.')
+@click.option('--sentinel',
+              default=run_watcher.SENTINEL,
+              show_default=True,
+              help='File the sequencer writes into a run folder once the run has finished.')
+@click.option('--settle_time',
+              type=click.FLOAT,
+              default=300,
+              show_default=True,
+              help='Seconds the .fastq.gz files of a finished run must stay unchanged before it is processed.')
+@click.option('--poll_interval',
+              type=click.FLOAT,
+              default=60,
+              show_default=True,
+              help='Seconds between scans of the runs root.')
+@click.option('--once',
+              is_flag=True,
+              default=False,
+              help='Scan once, process the runs that are ready and exit. Runs that are still settling are picked up '
+                   'by the next invocation, so this can be run from cron.')
+@click.option('--dry_run',
+              is_flag=True,
+              default=False,
+              help='Only log the runs that would be processed.')
+def watch_runs(runs_root, metadata_dir, outdir_root, state, classifier, filtering_flag, concurrency, cpus_per_run,
+               memory_per_run, sentinel, settle_time, poll_interval, once, dry_run):
+    os.makedirs(outdir_root, exist_ok=True)
+    state_path = state or os.path.join(outdir_root, 'watch_queue.state.json')
+    if cpus_per_run is None:
+        cpus_per_run = max(1, multiprocessing.cpu_count() // concurrency)
+
+    # Finish the runs in progress on SIGTERM instead of leaving them to be resumed by the next invocation
+    stop_event = threading.Event()
+
+    def stop(signum, frame):
+        logging.info('Stopping once the runs in progress have finished')
+        stop_event.set()
+    signal.signal(signal.SIGTERM, stop)
+
+    options = OrderedDict()
+    if classifier is not None:
+        options['classifier'] = os.path.abspath(classifier)
+    run_watcher.watch(runs_root, metadata_dir, outdir_root, state_path, poll_interval=poll_interval,
+                      settle_time=settle_time, concurrency=concurrency, once=once, dry_run=dry_run,
+                      stop_event=stop_event, sentinel=sentinel, options=options,
+                      flags=['filtering_flag'] if filtering_flag else [], cpus=cpus_per_run,
+                      memory_gb=memory_per_run)
+
+
+if __name__ == '__main__':
+    watch_runs()